@@ -13,5 +13,9 @@ setup(
     url='https://github.com/dmranck/ticketutil',
     download_url='https://github.com/dmranck/ticketutil/tarball/1.3.0',
     keywords=['jira', 'bugzilla', 'rt', 'redmine', 'servicenow', 'ticket', 'rest'],
-    install_requires=['gssapi>=1.2.0', 'requests>=2.6.0', 'requests-kerberos>=0.8.0']
+    python_requires='>=3.6',
+    install_requires=['gssapi>=1.2.0', 'requests>=2.6.0', 'requests-kerberos>=0.8.0'],
+    extras_require={'export': ['pyarrow>=1.0.0'], 'analytics': ['numpy>=1.13.0'],
+                    'tracing': ['opentelemetry-api>=1.0.0']},
+    entry_points={'console_scripts': ['ticketutil = ticketutil.cli:main']}
 )
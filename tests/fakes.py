@@ -0,0 +1,162 @@
+"""
+Fake responses and Ticket objects shared by the unit tests.
+"""
+import json
+import threading
+from collections import namedtuple
+
+import requests
+
+from ticketutil import ticket
+
+RESULT = namedtuple('Result', ['status', 'error_message', 'url', 'ticket_content'])
+
+
+class FakeResponse(object):
+    """Response with a canned JSON or text body
+    """
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.text = body if isinstance(body, str) else json.dumps(body)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("{0} Error".format(self.status_code), response=self)
+
+    def json(self):
+        return self.body
+
+
+class FakeSession(object):
+    """Records requests, answering GETs with the given content
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append(('GET', url, params))
+        return FakeResponse(self.content)
+
+    def put(self, url, json=None):
+        self.requests.append(('PUT', url, json))
+        return FakeResponse({'bugs': [{'changes': {'summary': {}}}]})
+
+    def post(self, url, data=None):
+        self.requests.append(('POST', url, data))
+        return FakeResponse('RT/4.4.2 200 Ok\n\n# Ticket 1 updated.\n')
+
+
+def ticket_object(cls, ticketing_tool, content):
+    """
+    :return: A cls Ticket object for ticket '1' that doesn't connect to the tool.
+    """
+    t = cls.__new__(cls)
+    t.ticketing_tool = ticketing_tool
+    t.url = 'https://tool'
+    t.rest_url = 'https://tool/rest'
+    t.ticket_id = '1'
+    t.ticket_url = 'https://tool/1'
+    t.mirror = None
+    t._metadata = {}
+    t.s = FakeSession(content)
+    t.request_result = RESULT('Success', None, None, None)
+    return t
+
+
+class FakeTicket(object):
+    """Mocks the public methods of a Ticket object
+    """
+
+    def __init__(self):
+        self.ticketing_tool = 'Fake'
+        self.ticket_id = None
+        self.request_result = RESULT('Success', None, None, None)
+
+    def set_ticket_id(self, ticket_id):
+        if ticket_id == 'BAD-1':
+            return self.request_result._replace(status='Failure', error_message='Ticket ID not valid')
+        self.ticket_id = ticket_id
+        return self.request_result._replace(url='fake/{0}'.format(ticket_id))
+
+    def create(self, summary, description):
+        self.ticket_id = 'NEW-{0}'.format(summary)
+        return self.request_result
+
+    def edit(self, **kwargs):
+        return self.request_result
+
+    def add_comment(self, comment):
+        if comment == 'explode':
+            raise ValueError('boom')
+        return self.request_result
+
+    def close_requests_session(self):
+        return self.request_result
+
+
+def fake_ticket_factory():
+    return FakeTicket()
+
+
+class LocalTicket(ticket.Ticket):
+    """Ticket whose create requests are answered locally
+    """
+
+    def __init__(self, fail=None, stored=False):
+        self.ticketing_tool = 'Fake'
+        self.url = 'fake'
+        self.project = 'KEY'
+        self.idempotency_index = None
+        self.duplicate_index = None
+        self.mirror = None
+        self.ticket_id = None
+        self.request_result = RESULT('Success', None, None, None)
+        self.fail = fail
+        self.stored = stored
+        self.requests = []
+        self.lookups = 0
+
+    def _generate_ticket_url(self):
+        return 'fake/{0}'.format(self.ticket_id)
+
+    def _create_ticket_request(self, params):
+        self.requests.append(params)
+        if self.fail is not None:
+            self._create_error = self.fail
+            return self.request_result._replace(status='Failure', error_message=str(self.fail))
+        self.ticket_id = 'KEY-{0}'.format(len(self.requests))
+        return self.request_result
+
+    def _find_created_ticket(self, params):
+        self.lookups += 1
+        return 'KEY-99' if self.stored else None
+
+
+class PagingTicket(LocalTicket):
+    """Ticket whose search pages are generated locally
+    """
+
+    def __init__(self, pages, fail_at=None):
+        super(PagingTicket, self).__init__()
+        self.pages = pages
+        self.fail_at = fail_at
+        self.fetched = 0
+        self.finished = threading.Event()
+
+    def _search_pages(self, query, fields, page_size):
+        try:
+            for number in range(self.pages):
+                if number == self.fail_at:
+                    raise ticket.TicketException("Error searching for tickets")
+                self.fetched += 1
+                yield [{'id': number * page_size + offset} for offset in range(page_size)]
+        finally:
+            self.finished.set()
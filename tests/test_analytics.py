@@ -0,0 +1,263 @@
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from unittest import main, skipIf, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import analytics, bugzilla, mirror, rt, servicenow
+
+from fakes import FakeResponse, ticket_object
+
+logging.disable(logging.CRITICAL)
+
+
+def jira_issue(key, project, created, changes, comments=()):
+    return {'key': key,
+            'fields': {'project': {'key': project},
+                       'created': created,
+                       'status': {'name': changes[-1][2] if changes else 'Open'},
+                       'comment': {'comments': [{'created': time} for time in comments]}},
+            'changelog': {'histories': [{'created': time,
+                                         'items': [{'field': 'status', 'fromString': old, 'toString': new}]}
+                                        for time, old, new in changes]}}
+
+
+ISSUES = [
+    jira_issue('KEY-1', 'KEY', '2017-01-13T10:00:00.000+0000',
+               [('2017-01-13T11:00:00.000+0000', 'Open', 'In Progress'),
+                ('2017-01-13T13:00:00.000+0000', 'In Progress', 'Done')],
+               comments=['2017-01-13T10:30:00.000+0000']),
+    jira_issue('KEY-2', 'KEY', '2017-01-13T10:00:00.000+0100',
+               [('2017-01-13T12:00:00.000+0100', 'Open', 'Done')]),
+    jira_issue('OPS-1', 'OPS', '2017-01-13T10:00:00.000+0000', []),
+]
+
+
+BUG = {'id': 7, 'product': 'Tools', 'status': 'RESOLVED', 'creation_time': '2017-01-13T10:00:00Z',
+       'history': [{'when': '2017-01-13T12:00:00Z',
+                    'changes': [{'field_name': 'status', 'removed': 'NEW', 'added': 'RESOLVED'},
+                                {'field_name': 'resolution', 'removed': '', 'added': 'FIXED'}]}],
+       'comments': [{'creation_time': '2017-01-13T10:00:00Z'}, {'creation_time': '2017-01-13T11:00:00Z'}]}
+
+RECORD = {'number': 'INC0010001', 'state': '6', 'opened_at': '2017-01-13 10:00:00',
+          'assignment_group': {'value': 'abc123', 'link': 'https://tool/api/now/table/sys_user_group/abc123'},
+          'audit': [{'fieldname': 'state', 'oldvalue': '2', 'newvalue': '6', 'sys_created_on': '2017-01-13 12:00:00'},
+                    {'fieldname': 'state', 'oldvalue': '1', 'newvalue': '2', 'sys_created_on': '2017-01-13 10:30:00'}],
+          'journals': [{'element': 'comments', 'sys_created_on': '2017-01-13 11:00:00'}]}
+
+
+@skipIf(analytics.numpy is None, 'numpy is not installed')
+class TestAnalytics(TestCase):
+    """analytics unit tests
+    """
+
+    def test_grouped_percentiles(self):
+        numpy = analytics.numpy
+        values = numpy.random.RandomState(1).rand(1000)
+        groups = numpy.arange(1000) % 3
+        codes, counts, results = analytics.grouped_percentiles(values, groups, (50, 90))
+        self.assertEqual(list(codes), [0, 1, 2])
+        self.assertEqual(list(counts), [334, 333, 333])
+        for code in codes:
+            expected = numpy.percentile(values[groups == code], [50, 90])
+            self.assertTrue(numpy.allclose(results[code], expected))
+
+    def test_sla_metrics(self):
+        table = analytics.EventTable.from_tickets('JIRA', ISSUES)
+        self.assertEqual(len(table), 7)
+        metrics = analytics.sla_metrics(table, percentiles=(50, 100))
+        self.assertEqual(metrics['first_response']['KEY'], {'count': 2, 'p50': 4500.0, 'p100': 7200.0})
+        self.assertEqual(metrics['resolve']['KEY'], {'count': 2, 'p50': 9000.0, 'p100': 10800.0})
+        self.assertNotIn('OPS', metrics['resolve'])
+        self.assertEqual(metrics['dwell'][('KEY', 'open')], {'count': 2, 'p50': 5400.0, 'p100': 7200.0})
+        self.assertEqual(metrics['dwell'][('KEY', 'in progress')]['count'], 1)
+
+    def test_parsers(self):
+        ticket_id, group, events = analytics.redmine_events(
+            {'id': 3, 'project': {'name': 'Ops'}, 'created_on': '2017-01-13T10:00:00Z', 'status': {'id': 5},
+             'journals': [{'created_on': '2017-01-13T11:00:00Z', 'notes': 'On it',
+                           'details': [{'property': 'attr', 'name': 'status_id', 'old_value': '1',
+                                        'new_value': '2'}]}],
+             'status_names': {'1': 'New'}})
+        self.assertEqual((ticket_id, group), (3, 'Ops'))
+        self.assertEqual([event[1:] for event in events],
+                         [(analytics.CREATED, 'New'), (analytics.STATUS, '2'), (analytics.COMMENT, None)])
+
+        ticket_id, group, events = analytics.rt_events(
+            {'id': 'ticket/12', 'Queue': 'General', 'Created': 'Fri Jan 13 10:00:00 2017', 'Status': 'open',
+             'History': [{'Type': 'Status', 'OldValue': 'new', 'NewValue': 'open',
+                          'Created': '2017-01-13 10:05:00'}]})
+        self.assertEqual((ticket_id, group), ('12', 'General'))
+        self.assertEqual(events[1][0] - events[0][0], 300)
+
+    def test_bugzilla_parser(self):
+        ticket_id, group, events = analytics.bugzilla_events(BUG)
+        self.assertEqual((ticket_id, group), (7, 'Tools'))
+        # The first comment is the description.
+        self.assertEqual([event[1:] for event in events],
+                         [(analytics.CREATED, 'NEW'), (analytics.STATUS, 'RESOLVED'), (analytics.COMMENT, None)])
+        self.assertEqual([event[0] - events[0][0] for event in events], [0, 7200, 3600])
+
+    def test_servicenow_parser(self):
+        ticket_id, group, events = analytics.servicenow_events(RECORD)
+        self.assertEqual((ticket_id, group), ('INC0010001', 'abc123'))
+        # States are numeric codes, named with the incident table's labels by default.
+        self.assertEqual([event[1:] for event in events],
+                         [(analytics.CREATED, 'new'), (analytics.STATUS, 'in progress'),
+                          (analytics.STATUS, 'resolved'), (analytics.COMMENT, None)])
+        metrics = analytics.sla_metrics(analytics.EventTable.from_tickets('ServiceNow', [RECORD]), (50,))
+        self.assertEqual(metrics['resolve']['abc123'], {'count': 1, 'p50': 7200.0})
+        # Records without an assignment group are grouped under None.
+        record = dict((key, value) for key, value in RECORD.items() if key != 'assignment_group')
+        metrics = analytics.sla_metrics(analytics.EventTable.from_tickets('ServiceNow', [record]), (50,))
+        self.assertEqual(metrics['resolve'], {None: {'count': 1, 'p50': 7200.0}})
+
+        record = dict(RECORD, state_labels={'1': 'Open', '2': 'Work in Progress', '6': 'Fixed'})
+        self.assertEqual([event[2] for event in analytics.servicenow_events(record)[2]],
+                         ['Open', 'Work in Progress', 'Fixed', None])
+
+    def test_add_events(self):
+        table = analytics.EventTable()
+        table.add('KEY-1', 'KEY', 10.0, analytics.CREATED, 'Open')
+        table.add_events(['KEY-2', 'KEY-1', 'OPS-1'], ['KEY', 'KEY', 'OPS'], [20.0, 30.0, 40.0],
+                         [analytics.CREATED, analytics.STATUS, analytics.COMMENT], ['Open', 'Done', None])
+        self.assertEqual(table.tickets, ['KEY-1', 'KEY-2', 'OPS-1'])
+        self.assertEqual(table.statuses, ['open', 'done'])
+        tickets, groups, times, kinds, statuses = table.arrays()
+        self.assertEqual(list(tickets), [0, 1, 0, 2])
+        self.assertEqual(list(groups), [0, 0, 0, 1])
+        self.assertEqual(list(statuses), [0, 0, 1, -1])
+        self.assertEqual(len(analytics.EventTable.from_tickets('JIRA', ISSUES).arrays()[0]), 7)
+
+    def test_add_after_arrays(self):
+        table = analytics.EventTable()
+        self.assertEqual(len(table.arrays()[2]), 0)
+        table.add('KEY-1', 'KEY', 10.0, analytics.CREATED, 'Open')
+        times = table.arrays()[2]
+        table.add_events(['KEY-1'], ['KEY'], [20.0], [analytics.STATUS], ['Done'])
+        table.add('KEY-1', 'KEY', 30.0, analytics.COMMENT)
+        self.assertEqual(list(times), [10.0])
+        self.assertEqual(list(table.arrays()[2]), [10.0, 20.0, 30.0])
+
+
+@skipIf(analytics.numpy is None, 'numpy is not installed')
+class TestLoaders(TestCase):
+    """EventTable loader unit tests
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_from_export(self):
+        path = os.path.join(self.work_dir, 'export.csv')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(u'key,summary,created,resolved\n'
+                    u'KEY-1,First,2017-01-13T10:00:00.000+0000,2017-01-13T13:00:00.000+0000\n'
+                    u'KEY-2,Second,2017-01-13T10:00:00.000+0100,2017-01-13T11:00:00.000+0000\n'
+                    u'OPS-1,Open,2017-01-13T10:00:00.000+0000,\n')
+        table = analytics.EventTable.from_export(path, 'JIRA')
+        self.assertEqual(len(table), 5)
+        metrics = analytics.sla_metrics(table, percentiles=(50, 100))
+        self.assertEqual(metrics['resolve'], {'KEY': {'count': 2, 'p50': 9000.0, 'p100': 10800.0}})
+        self.assertEqual(metrics['first_response'], {})
+        self.assertEqual(metrics['dwell'], {})
+
+    @skipIf(analytics.pyarrow is None, 'pyarrow is not installed')
+    def test_from_export_parquet(self):
+        path = os.path.join(self.work_dir, 'export.parquet')
+        table = analytics.pyarrow.table({'id': ['ticket/1', 'ticket/2'], 'queue': ['General', 'Ops'],
+                                         'created': ['Fri Jan 13 10:00:00 2017', 'Fri Jan 13 10:00:00 2017'],
+                                         'resolved': ['Fri Jan 13 10:30:00 2017', 'Not set']})
+        analytics.pyarrow.parquet.write_table(table, path)
+        metrics = analytics.sla_metrics(analytics.EventTable.from_export(path, 'RT'), percentiles=(50,))
+        self.assertEqual(metrics['resolve'], {'General': {'count': 1, 'p50': 1800.0}})
+
+    def test_from_mirror(self):
+        tickets = mirror.Mirror()
+        for issue in ISSUES:
+            tickets.store('JIRA', 'https://jira', {'ticket_id': issue['key']}, issue)
+        # Read with a field projection, without the creation time.
+        tickets.store('JIRA', 'https://jira', {'ticket_id': 'KEY-3'}, {'key': 'KEY-3', 'fields': {}}, partial=True)
+        tickets.store('Bugzilla', 'https://bugzilla', {'ticket_id': 7}, BUG)
+        table = analytics.EventTable.from_mirror(tickets, 'JIRA')
+        self.assertEqual(sorted(table.tickets), ['KEY-1', 'KEY-2', 'OPS-1'])
+        self.assertEqual(len(table), 7)
+
+
+class HistorySession(object):
+    """Answers GET requests with the body registered for the end of their URL
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, params=None, **kwargs):
+        self.requests.append((url, params))
+        for suffix, body in self.responses:
+            if url.endswith(suffix):
+                return FakeResponse(body)
+        return FakeResponse({}, 404)
+
+
+class TestTicketHistory(TestCase):
+    """get_ticket_history unit tests
+    """
+
+    def test_bugzilla(self):
+        t = ticket_object(bugzilla.BugzillaTicket, 'Bugzilla', None)
+        bug = dict((key, value) for key, value in BUG.items() if key not in ('history', 'comments'))
+        t.s = HistorySession([('/7/history', {'bugs': [{'id': 7, 'history': BUG['history']}]}),
+                              ('/7/comment', {'bugs': {'7': {'comments': BUG['comments']}}}),
+                              ('/7', {'bugs': [bug]})])
+        result = t.get_ticket_history(7)
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual(result.ticket_content, BUG)
+
+        t.s = HistorySession([('/8', {'error': True, 'message': 'Bug 8 does not exist.'})])
+        result = t.get_ticket_history(8)
+        self.assertEqual((result.status, result.error_message), ('Failure', 'Error getting ticket history'))
+
+    def test_rt(self):
+        t = ticket_object(rt.RTTicket, 'RT', None)
+        t.s = HistorySession([('/12/show', 'RT/4.4.2 200 Ok\n\nid: ticket/12\nQueue: General\n'
+                                           'Created: Fri Jan 13 10:00:00 2017\nStatus: open\n'),
+                              ('/12/history', 'RT/4.4.2 200 Ok\n\n# 2/2 (id/40/total)\n\n'
+                                              'id: 40\nType: Create\nCreated: 2017-01-13 10:00:00\n'
+                                              'Content: Disk full\n         on web-3\n\n--\n\n'
+                                              'id: 41\nType: Status\nOldValue: new\nNewValue: open\n'
+                                              'Created: 2017-01-13 10:05:00\n')])
+        result = t.get_ticket_history('12')
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual([entry['Type'] for entry in result.ticket_content['History']], ['Create', 'Status'])
+        self.assertEqual(result.ticket_content['History'][0]['Content'], 'Disk full\non web-3')
+        self.assertEqual(t.s.requests[1][1], {'format': 'l'})
+        self.assertEqual(analytics.rt_events(result.ticket_content)[2][1][1:], (analytics.STATUS, 'open'))
+
+    def test_servicenow(self):
+        t = ticket_object(servicenow.ServiceNowTicket, 'ServiceNow', None)
+        t.url = 'https://tool'
+        t.available_states = {'new': '1', 'resolved': '6'}
+        record = dict((key, value) for key, value in RECORD.items() if key not in ('audit', 'journals'))
+        t.s = HistorySession([('GOTOnumber%3DINC0010001', {'result': [dict(record, sys_id='abc')]}),
+                              ('/sys_audit', {'result': RECORD['audit']}),
+                              ('/sys_journal_field', {'result': RECORD['journals']})])
+        result = t.get_ticket_history('INC0010001')
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual(result.ticket_content['audit'], RECORD['audit'])
+        self.assertEqual(result.ticket_content['state_labels'], {'1': 'new', '6': 'resolved'})
+        self.assertEqual(t.s.requests[1][1]['sysparm_query'], 'documentkey=abc^fieldname=state')
+
+        t.s = HistorySession([('GOTOnumber%3DINC0010002', {'result': []})])
+        self.assertEqual(t.get_ticket_history('INC0010002').status, 'Failure')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from collections import namedtuple
+from unittest import main, TestCase
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import attachment, bugzilla, idempotency, jira, redmine, rt, ticket
+
+logging.disable(logging.CRITICAL)
+
+LOG = b'line of a build log\n' * 5000
+
+
+def chunked(data, size=7):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.text = body.decode('utf-8', 'replace')
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("{0} Error".format(self.status_code))
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size):
+        return iter(chunked(self.body, chunk_size))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, params=None, stream=False, headers=None):
+        self.requests.append(url)
+        return self.responses[url]
+
+    def post(self, url, data=None, files=None, headers=None):
+        self.requests.append(url)
+        return FakeResponse(b'RT/4.4.2 200 Ok\n\n# Message recorded\n')
+
+
+def ticket_object(cls, responses, ticketing_tool=None):
+    t = cls.__new__(cls)
+    t.ticketing_tool = ticketing_tool
+    t.url = 'https://tool'
+    t.rest_url = 'https://tool/rest'
+    t.ticket_id = '1'
+    t.ticket_url = 'https://tool/1'
+    t.s = FakeSession(responses)
+    Result = namedtuple('Result', ['status', 'error_message', 'url', 'ticket_content'])
+    t.request_result = Result('Success', None, None, None)
+    return t
+
+
+class TestStreaming(TestCase):
+    """Attachment streaming helper unit tests
+    """
+
+    def test_decode_base64_field(self):
+        encoded = base64.standard_b64encode(LOG).replace(b'/', b'\\/')
+        document = b'{"attachments": {"9": {"file_name": "log", "data": "' + encoded + b'"}}}'
+        for size in (1, 3, 7, 4096):
+            self.assertEqual(b''.join(attachment.decode_base64_field(chunked(document, size), 'data')), LOG)
+        with self.assertRaises(ValueError):
+            list(attachment.decode_base64_field([b'{"error": true}'], 'data'))
+        with self.assertRaises(ValueError):
+            list(attachment.decode_base64_field([b'{"data": "aGVsbG'], 'data'))
+
+    def test_write_and_matches(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'log')
+        size, digest = attachment.write(chunked(LOG), path)
+        self.assertEqual((size, digest), (len(LOG), hashlib.sha256(LOG).hexdigest()))
+        self.assertTrue(attachment.matches(path, len(LOG)))
+        self.assertTrue(attachment.matches(path, len(LOG), hashlib.md5(LOG).hexdigest()))
+        self.assertFalse(attachment.matches(path, len(LOG), hashlib.md5(b'other').hexdigest()))
+        self.assertFalse(attachment.matches(path))
+
+        def failing():
+            yield b'partial'
+            raise IOError('connection reset')
+        with self.assertRaises(IOError):
+            attachment.write(failing(), os.path.join(directory, 'broken'))
+        self.assertEqual(sorted(os.listdir(directory)), ['log'])
+
+        sink = io.BytesIO()
+        attachment.write(chunked(LOG), sink)
+        self.assertEqual(sink.getvalue(), LOG)
+
+    def test_rt_parsing(self):
+        text = ('RT/4.4.2 200 Ok\n\nid: ticket/1/attachments\n'
+                'Attachments: 1: (Unnamed) (multipart/mixed / 0b),\n'
+                '             2: build log.txt (text/plain / 97.7k),\n'
+                '             3: core (application/octet-stream / 1.2m)\n')
+        self.assertEqual(rt._parse_attachments(text), [('2', 'build log.txt', 'text/plain'),
+                                                       ('3', 'core', 'application/octet-stream')])
+        wrapped = b'RT/4.4.2 200 Ok\n\n' + LOG + b'\n\n\n'
+        for size in (1, 5, 4096):
+            self.assertEqual(b''.join(rt._strip_response(chunked(wrapped, size))), LOG)
+        with self.assertRaises(ticket.TicketException):
+            list(rt._strip_response([b'RT/4.4.2 401 Credentials required\n\n']))
+        # The response ended before the status line was complete.
+        for truncated in ([], [b'RT/4.4.2 200'], [b'RT/4.4.2 200 Ok\n']):
+            with self.assertRaises(ticket.TicketException):
+                list(rt._strip_response(truncated))
+        self.assertEqual(list(rt._strip_response([b'RT/4.4.2 200 Ok\n\n'])), [])
+
+
+class TestDownload(TestCase):
+    """get_attachments() and download_attachments() unit tests
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_jira(self):
+        issue = {'fields': {'attachment': [
+            {'id': '10', 'filename': 'log', 'size': len(LOG), 'mimeType': 'text/plain', 'content': 'https://c/10'},
+            {'id': '11', 'filename': 'log', 'size': 5, 'mimeType': 'text/plain', 'content': 'https://c/11'},
+            {'id': '12', 'filename': 'core', 'size': 4, 'mimeType': 'text/plain', 'content': 'https://c/12'}]}}
+        t = ticket_object(jira.JiraTicket, {'https://tool/rest/1': FakeResponse(json.dumps(issue).encode()),
+                                            'https://c/10': FakeResponse(LOG),
+                                            'https://c/11': FakeResponse(b'hello'),
+                                            'https://c/12': FakeResponse(b'', 404)})
+        result = t.download_attachments(self.directory, concurrency=2)
+        self.assertEqual(result.status, 'Failure')
+        self.assertIn('core', result.error_message)
+        self.assertEqual([(a['id'], os.path.basename(a['path'])) for a in result.ticket_content],
+                         [('10', '10-log'), ('11', '11-log'), ('12', 'core')])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['10-log', '11-log'])
+        with io.open(os.path.join(self.directory, '10-log'), 'rb') as f:
+            self.assertEqual(f.read(), LOG)
+
+        # Files already downloaded are skipped.
+        t.s.requests = []
+        result = t.download_attachments(self.directory)
+        self.assertEqual([a['downloaded'] for a in result.ticket_content], [False, False, True])
+        self.assertEqual(t.s.requests, ['https://tool/rest/1', 'https://c/12'])
+
+    def test_bugzilla_decodes_base64(self):
+        listing = {'bugs': {'1': [{'id': 9, 'file_name': 'log', 'size': len(LOG), 'content_type': 'text/plain'}]}}
+        data = {'attachments': {'9': {'data': base64.standard_b64encode(LOG).decode()}}}
+        t = ticket_object(bugzilla.BugzillaTicket, {
+            'https://tool/rest/1/attachment': FakeResponse(json.dumps(listing).encode()),
+            'https://tool/rest/attachment/9?include_fields=data': FakeResponse(json.dumps(data).encode())})
+        attachments = t.get_attachments().ticket_content
+        sink = io.BytesIO()
+        result = t.get_attachment(attachments[0], sink, chunk_size=100)
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual(result.ticket_content['digest'], hashlib.sha256(LOG).hexdigest())
+        self.assertEqual(sink.getvalue(), LOG)
+
+    def test_size_mismatch_fails(self):
+        t = ticket_object(jira.JiraTicket, {'https://c/10': FakeResponse(b'truncated')})
+        result = t.get_attachment({'id': '10', 'file_name': 'log', 'size': len(LOG), 'url': 'https://c/10'},
+                                  os.path.join(self.directory, 'log'))
+        self.assertEqual(result.status, 'Failure')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestDedup(TestCase):
+    """set_attachment_dedup() unit tests
+    """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'build.log')
+        with io.open(self.path, 'wb') as f:
+            f.write(LOG)
+
+    def test_jira_matches_name_and_size(self):
+        issue = {'fields': {'attachment': [
+            {'id': '10', 'filename': 'build.log', 'size': len(LOG), 'content': 'https://c/10'}]}}
+        t = ticket_object(jira.JiraTicket, {'https://tool/rest/1': FakeResponse(json.dumps(issue).encode())}, 'JIRA')
+        t.set_attachment_dedup(index=idempotency.FingerprintIndex())
+        self.assertEqual(t.add_attachment(self.path).status, 'Success')
+        self.assertEqual(t.s.requests, ['https://tool/rest/1'])
+
+        # The index remembers it, the ticket isn't listed again.
+        t.s.requests = []
+        t.add_attachment(self.path)
+        self.assertEqual(t.s.requests, [])
+
+        # Different content is uploaded.
+        with io.open(self.path, 'ab') as f:
+            f.write(b'one more line\n')
+        t.add_attachment(self.path)
+        self.assertEqual(t.s.requests, ['https://tool/rest/1', 'https://tool/rest/1/attachments'])
+
+    def test_redmine_matches_digest(self):
+        issue = {'issue': {'attachments': [{'id': 3, 'filename': 'renamed.log', 'filesize': len(LOG),
+                                            'content_url': 'https://c/3', 'digest': hashlib.md5(LOG).hexdigest()}]}}
+        t = ticket_object(redmine.RedmineTicket, {'https://tool/rest/1.json': FakeResponse(json.dumps(issue).encode())},
+                          'Redmine')
+        t.set_attachment_dedup()
+        self.assertEqual(t.add_attachment(self.path).status, 'Success')
+        self.assertEqual(t.s.requests, ['https://tool/rest/1.json'])
+
+    def test_rt_uses_the_index_only(self):
+        t = ticket_object(rt.RTTicket, {}, 'RT')
+        t.set_attachment_dedup(index=idempotency.FingerprintIndex())
+        t.add_attachment(self.path)
+        t.add_attachment(self.path)
+        self.assertEqual(t.s.requests, ['https://tool/rest/ticket/1/comment'])
+        t.set_attachment_dedup(False)
+        t.add_attachment(self.path)
+        self.assertEqual(len(t.s.requests), 2)
+
+
+if __name__ == '__main__':
+    main()
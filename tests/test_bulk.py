@@ -0,0 +1,124 @@
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import bulk, operation, ticket
+
+from fakes import FakeTicket, fake_ticket_factory
+
+logging.disable(logging.CRITICAL)
+
+OPERATIONS = [{'id': 1, 'operation': 'create', 'args': ['one', 'first ticket']},
+              {'id': 2, 'operation': 'edit', 'ticket_id': 'KEY-1', 'kwargs': {'priority': 'Major'}},
+              {'id': 3, 'operation': 'comment', 'ticket_id': 'KEY-1', 'args': ['a comment']},
+              {'id': 4, 'operation': 'comment', 'ticket_id': 'KEY-2', 'args': ['explode']},
+              {'id': 5, 'operation': 'edit', 'ticket_id': 'BAD-1', 'kwargs': {'priority': 'Major'}},
+              {'id': 6, 'operation': '_verify_project', 'ticket_id': 'KEY-2', 'args': ['KEY']}]
+
+
+class TestOperation(TestCase):
+    """operation.py unit tests
+    """
+
+    def test_apply_operation(self):
+        result = operation.apply_operation(FakeTicket(), OPERATIONS[1])
+        self.assertEqual(result['status'], 'Success')
+        self.assertEqual(result['ticket_id'], 'KEY-1')
+
+    def test_apply_operation_create(self):
+        result = operation.apply_operation(FakeTicket(), OPERATIONS[0])
+        self.assertEqual(result['ticket_id'], 'NEW-one')
+
+    def test_apply_operation_invalid_ticket_id(self):
+        result = operation.apply_operation(FakeTicket(), OPERATIONS[4])
+        self.assertEqual(result['error_message'], 'Ticket ID not valid')
+
+    def test_apply_operation_exception(self):
+        result = operation.apply_operation(FakeTicket(), OPERATIONS[3])
+        self.assertEqual(result['status'], 'Failure')
+        self.assertEqual(result['error_message'], 'boom')
+
+    def test_apply_operation_private_method(self):
+        result = operation.apply_operation(FakeTicket(), OPERATIONS[5])
+        self.assertEqual(result['status'], 'Failure')
+
+    def test_shard_for_same_ticket(self):
+        shards = set(operation.shard_for({'ticket_id': 'KEY-1', 'id': i}, 8) for i in range(20))
+        self.assertEqual(len(shards), 1)
+
+    def test_ticket_pool(self):
+        pool = operation.TicketPool(fake_ticket_factory, size=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+
+
+class TestBulkRunner(TestCase):
+    """BulkRunner unit tests
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _results(self, path):
+        with io.open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_run(self):
+        runner = bulk.BulkRunner(fake_ticket_factory, self.work_dir, shards=3)
+        metrics = runner.run(OPERATIONS)
+        self.assertEqual(metrics['total'], 6)
+        self.assertEqual(metrics['succeeded'], 3)
+        self.assertEqual(metrics['failed'], 3)
+        self.assertEqual(metrics['operations']['comment'], {'Success': 1, 'Failure': 1})
+        results = self._results(metrics['results'])
+        self.assertEqual(sorted(result['id'] for result in results), [1, 2, 3, 4, 5, 6])
+
+    def test_run_jsonl_file(self):
+        path = os.path.join(self.work_dir, 'operations.jsonl')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for item in OPERATIONS[:3]:
+                f.write(u'{0}\n'.format(json.dumps(item)))
+        runner = bulk.BulkRunner(fake_ticket_factory, os.path.join(self.work_dir, 'run'), shards=2)
+        metrics = runner.run(path)
+        self.assertEqual(metrics['succeeded'], 3)
+
+    def test_resume(self):
+        runner = bulk.BulkRunner(fake_ticket_factory, self.work_dir, shards=1)
+        runner.run(OPERATIONS)
+
+        # Simulate an interrupted run: keep two complete results and a partially written third.
+        results_path = os.path.join(self.work_dir, 'shard-0000.results.jsonl')
+        with io.open(results_path, 'rb') as f:
+            lines = f.readlines()
+        with io.open(results_path, 'wb') as f:
+            f.write(b''.join(lines[:2]) + lines[2][:5])
+
+        metrics = bulk.BulkRunner(fake_ticket_factory, self.work_dir, shards=1).run(OPERATIONS)
+        self.assertEqual(metrics['resumed'], 2)
+        self.assertEqual(metrics['total'], 4)
+        self.assertEqual(len(self._results(metrics['results'])), 6)
+
+    def test_resume_other_operations(self):
+        bulk.BulkRunner(fake_ticket_factory, self.work_dir, shards=1).run(OPERATIONS[:3])
+        runner = bulk.BulkRunner(fake_ticket_factory, self.work_dir, shards=1)
+        self.assertRaises(ticket.TicketException, runner.run, OPERATIONS)
+        changed = [dict(OPERATIONS[0], args=['two', 'second ticket'])] + OPERATIONS[1:3]
+        self.assertRaises(ticket.TicketException, runner.run, changed)
+        self.assertEqual(runner.run(OPERATIONS[:3])['resumed'], 3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import main, TestCase
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import cli
+
+from fakes import FakeTicket
+
+logging.disable(logging.CRITICAL)
+
+JSONL = u"""{"operation": "create", "args": ["one", "description"]}
+{"operation": "comment", "ticket_id": "KEY-1", "args": ["a comment"]}
+
+{"operation": "comment", "ticket_id": "KEY-2", "args": ["explode"]}
+"""
+
+CSV = u"""operation,ticket_id,args,priority,assignee
+edit,KEY-1,,Major,
+comment,KEY-1,"[""a comment""]",,
+"""
+
+
+def fake_ticket(url, project, auth=None):
+    return FakeTicket()
+
+
+class RecordingTicket(FakeTicket):
+    """FakeTicket recording the comments it receives, slow on the first comment of each ticket
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def add_comment(self, comment):
+        if comment == '0':
+            time.sleep(0.05)
+        with RecordingTicket.lock:
+            RecordingTicket.calls.append((self.ticket_id, comment))
+        return super(RecordingTicket, self).add_comment(comment)
+
+
+def recording_ticket(url, project, auth=None):
+    return RecordingTicket()
+
+
+class TestCli(TestCase):
+    """ticketutil command unit tests
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.work_dir, name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def _results(self, path):
+        with io.open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_read_operations_jsonl(self):
+        operations = list(cli.read_operations(io.StringIO(JSONL), 'jsonl'))
+        self.assertEqual([item['id'] for item in operations], [0, 1, 2])
+        self.assertEqual(operations[1]['ticket_id'], 'KEY-1')
+
+    def test_read_operations_csv(self):
+        operations = list(cli.read_operations(io.StringIO(CSV), 'csv'))
+        self.assertEqual(operations[0]['kwargs'], {'priority': 'Major'})
+        self.assertEqual(operations[1]['args'], ['a comment'])
+        self.assertEqual(operations[1]['kwargs'], {})
+
+    @patch.dict(cli.TOOLS, {'jira': fake_ticket})
+    def test_main(self):
+        input_path = self._write('operations.jsonl', JSONL)
+        output_path = os.path.join(self.work_dir, 'results.jsonl')
+        exit_code = cli.main(['jira', 'url', 'KEY', '-i', input_path, '-o', output_path, '-c', '2'])
+        self.assertEqual(exit_code, 1)
+        results = dict((result['id'], result) for result in self._results(output_path))
+        self.assertEqual(results[0]['ticket_id'], 'NEW-one')
+        self.assertEqual(results[1]['status'], 'Success')
+        self.assertEqual(results[2]['status'], 'Failure')
+
+    @patch.dict(cli.TOOLS, {'jira': fake_ticket})
+    def test_main_resume(self):
+        input_path = self._write('operations.jsonl', JSONL)
+        output_path = os.path.join(self.work_dir, 'results.jsonl')
+        checkpoint_path = self._write('checkpoint.json', u'{"done_below": 1, "completed": [2]}')
+        cli.main(['jira', 'url', 'KEY', '-i', input_path, '-o', output_path, '--checkpoint', checkpoint_path])
+        self.assertEqual([result['id'] for result in self._results(output_path)], [1])
+        with io.open(checkpoint_path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {'done_below': 3, 'completed': []})
+
+    @patch.dict(cli.TOOLS, {'jira': fake_ticket})
+    def test_main_invalid_lines(self):
+        input_path = self._write('operations.jsonl', u'{"operation": "comment", "ticket_id": "KEY-1", "args": ["ok"]}\n'
+                                                     u'{"operation": "comment", \n'
+                                                     u'[1, 2]\n')
+        output_path = os.path.join(self.work_dir, 'results.jsonl')
+        checkpoint_path = os.path.join(self.work_dir, 'checkpoint.json')
+        exit_code = cli.main(['jira', 'url', 'KEY', '-i', input_path, '-o', output_path,
+                              '--checkpoint', checkpoint_path])
+        self.assertEqual(exit_code, 1)
+        results = dict((result['id'], result) for result in self._results(output_path))
+        self.assertEqual(results[0]['status'], 'Success')
+        self.assertEqual(results[1]['status'], 'Failure')
+        self.assertIn('Error parsing operation', results[1]['error_message'])
+        self.assertEqual(results[2]['status'], 'Failure')
+        with io.open(checkpoint_path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {'done_below': 3, 'completed': []})
+
+    @patch.dict(cli.TOOLS, {'jira': fake_ticket})
+    def test_main_interrupted(self):
+        lines = [json.dumps({'operation': 'comment', 'ticket_id': 'KEY-1', 'args': [str(number)]})
+                 for number in range(3)]
+        input_path = self._write('operations.jsonl', u'\n'.join(lines))
+        output_path = os.path.join(self.work_dir, 'results.jsonl')
+        checkpoint_path = os.path.join(self.work_dir, 'checkpoint.json')
+        done = cli.Checkpoint.done
+
+        def interrupt(checkpoint, op_id):
+            done(checkpoint, op_id)
+            if checkpoint.done_below == 2:
+                raise KeyboardInterrupt
+
+        with patch.object(cli.Checkpoint, 'done', interrupt):
+            exit_code = cli.main(['jira', 'url', 'KEY', '-i', input_path, '-o', output_path, '-c', '1',
+                                  '--checkpoint', checkpoint_path])
+        self.assertEqual(exit_code, 130)
+        with io.open(checkpoint_path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {'done_below': 2, 'completed': []})
+
+        cli.main(['jira', 'url', 'KEY', '-i', input_path, '-o', output_path, '--checkpoint', checkpoint_path])
+        self.assertEqual([result['id'] for result in self._results(output_path)], [0, 1, 2])
+
+    def test_read_operations_invalid_csv(self):
+        operations = list(cli.read_operations(io.StringIO(u'operation,ticket_id,args\ncomment,KEY-1,[oops\n'), 'csv'))
+        self.assertEqual(operations[0]['id'], 0)
+        self.assertIn('invalid', operations[0])
+
+    @patch.dict(cli.TOOLS, {'jira': recording_ticket})
+    def test_main_orders_operations_per_ticket(self):
+        RecordingTicket.calls = []
+        lines = [json.dumps({'operation': 'comment', 'ticket_id': 'KEY-{0}'.format(key), 'args': [str(number)]})
+                 for number in range(4) for key in range(3)]
+        input_path = self._write('operations.jsonl', u'\n'.join(lines))
+        output_path = os.path.join(self.work_dir, 'results.jsonl')
+        exit_code = cli.main(['jira', 'url', 'KEY', '-i', input_path, '-o', output_path, '-c', '4'])
+        self.assertEqual(exit_code, 0)
+        for key in range(3):
+            comments = [comment for ticket_id, comment in RecordingTicket.calls
+                        if ticket_id == 'KEY-{0}'.format(key)]
+            self.assertEqual(comments, ['0', '1', '2', '3'])
+
+    def test_checkpoint(self):
+        checkpoint = cli.Checkpoint(None)
+        for number in range(4):
+            checkpoint.started('op{0}'.format(number), number)
+        checkpoint.done('op1')
+        checkpoint.done('op3')
+        self.assertEqual(checkpoint.done_below, 0)
+        checkpoint.done('op0')
+        self.assertEqual(checkpoint.done_below, 2)
+        self.assertTrue(checkpoint.is_done(3))
+        self.assertFalse(checkpoint.is_done(2))
+
+
+if __name__ == '__main__':
+    main()
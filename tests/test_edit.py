@@ -0,0 +1,117 @@
+import logging
+import os
+import sys
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import bugzilla, jira, mirror, redmine, rt, ticket
+
+from fakes import FakeResponse, ticket_object
+
+logging.disable(logging.CRITICAL)
+
+ISSUE = {'key': 'PROJ-1',
+         'fields': {'summary': 'Disk full on web-3',
+                    'priority': {'name': 'Major', 'id': '3'},
+                    'issuetype': {'name': 'Task', 'id': '10002'},
+                    'assignee': {'name': 'jdoe', 'displayName': 'J. Doe'},
+                    'components': [{'name': 'web', 'id': '1'}, {'name': 'ops', 'id': '2'}],
+                    'customfield_10010': {'value': 'Yes', 'id': '100'},
+                    'updated': '2017-01-13T10:00:00.000+0000'}}
+
+
+class TestSameValue(TestCase):
+    """Field comparison unit tests
+    """
+
+    def test_same_value(self):
+        self.assertTrue(ticket._same_value(70, '70'))
+        self.assertTrue(ticket._same_value(2.0, '2'))
+        self.assertTrue(ticket._same_value(None, ''))
+        self.assertTrue(ticket._same_value(['b', 'a'], ['a', 'b']))
+        self.assertTrue(ticket._same_value(['a'], 'a'))
+        self.assertTrue(ticket._same_value({'value': 'Yes', 'id': '1'}, {'value': 'Yes'}))
+        self.assertFalse(ticket._same_value({'value': 'Yes'}, {'value': 'No'}))
+        self.assertFalse(ticket._same_value('Yes', {'value': 'Yes'}))
+        self.assertFalse(ticket._same_value(['a', 'b'], ['a']))
+        self.assertFalse(ticket._same_value('007', '7'))
+
+
+class TestDiffEdit(TestCase):
+    """edit(diff=...) unit tests
+    """
+
+    def test_jira_sends_only_changed_fields(self):
+        t = ticket_object(jira.JiraTicket, 'JIRA', ISSUE)
+        result = t.edit(diff='fetch', summary='Disk full on web-3', priority='Major', type='Task',
+                        assignee='jdoe', components=['ops', 'web'], customfield_10010={'value': 'Yes'})
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual(t.sent_fields, [])
+        self.assertEqual(t.s.requests, [('GET', 'https://tool/rest/1', {
+            'fields': 'summary,priority,issuetype,assignee,components,customfield_10010'})])
+
+        t.s.requests = []
+        t.edit(diff='fetch', summary='Disk full on web-3', priority='Critical', reporter='jdoe')
+        self.assertEqual(t.sent_fields, ['priority', 'reporter'])
+        self.assertEqual(t.s.requests[-1], ('PUT', 'https://tool/rest/1', {
+            'fields': {'priority': {'name': 'Critical'}, 'reporter': {'name': 'jdoe'}}}))
+
+    def test_without_diff_every_field_is_sent(self):
+        t = ticket_object(jira.JiraTicket, 'JIRA', ISSUE)
+        t.edit(summary='Disk full on web-3')
+        self.assertEqual(t.sent_fields, ['summary'])
+        self.assertEqual([method for method, url, params in t.s.requests], ['PUT'])
+
+    def test_cache_uses_fresh_mirrored_tickets(self):
+        t = ticket_object(jira.JiraTicket, 'JIRA', ISSUE)
+        t.mirror = mirror.Mirror()
+        t._mirror_content(ISSUE)
+        t.ticket_id = 'PROJ-1'
+        t.edit(diff='cache', priority='Major')
+        self.assertEqual(t.s.requests, [])
+
+        t.mirror.invalidate('JIRA', 'https://tool', 'PROJ-1')
+        t.edit(diff='cache', priority='Major')
+        self.assertEqual([method for method, url, params in t.s.requests], ['GET'])
+
+    def test_failed_read_fails_the_edit(self):
+        t = ticket_object(jira.JiraTicket, 'JIRA', ISSUE)
+        t.s.get = lambda url, params=None: FakeResponse({}, 500)
+        result = t.edit(diff='fetch', summary='New summary')
+        self.assertEqual(result.status, 'Failure')
+        self.assertEqual(t.s.requests, [])
+
+    def test_bugzilla_groups_are_added(self):
+        bug = {'bugs': [{'id': 1, 'assigned_to': 'jdoe@mail.com', 'groups': ['qa', 'devel']}]}
+        t = ticket_object(bugzilla.BugzillaTicket, 'Bugzilla', bug)
+        t.edit(diff='fetch', assignee='jdoe@mail.com', groups='devel')
+        self.assertEqual(t.sent_fields, [])
+        t.edit(diff='fetch', groups=['devel', 'security'])
+        self.assertEqual(t.s.requests[-1][2], {'groups': {'add': ['devel', 'security']}})
+
+    def test_redmine_compares_ids_and_names(self):
+        issue = {'issue': {'id': 1, 'subject': 'Disk full', 'done_ratio': 70,
+                           'priority': {'id': 4, 'name': 'Urgent'}}}
+        t = ticket_object(redmine.RedmineTicket, 'Redmine', issue)
+        t._metadata['users'] = [{'id': 5, 'login': 'jdoe'}]
+        t.edit(diff='fetch', subject='Disk full', done_ratio='70', priority='Urgent')
+        self.assertEqual(t.sent_fields, [])
+        # Unassigned issues have no assigned_to.
+        t._metadata['priorities'] = [{'id': 4, 'name': 'Urgent'}]
+        t.edit(diff='fetch', priority='Urgent', assignee='jdoe@mail.com')
+        self.assertEqual(t.sent_fields, ['assignee'])
+        self.assertEqual(t.s.requests[-1][2], {'issue': {'assigned_to_id': 5}})
+
+    def test_rt_address_lists(self):
+        content = 'RT/4.4.2 200 Ok\n\nid: ticket/1\nPriority: 5\nCc: b@mail.com, a@mail.com\nAdminCc: \n'
+        t = ticket_object(rt.RTTicket, 'RT', content)
+        t.edit(diff='fetch', priority=5, cc=['a@mail.com', 'b@mail.com'], admincc='')
+        self.assertEqual(t.sent_fields, [])
+        self.assertEqual(t.s.requests[0][2], {'fields': 'Priority,Cc,Admincc'})
+        t.edit(diff='fetch', priority='5', admincc=['c@mail.com'])
+        self.assertEqual(t.s.requests[-1][2], {'content': 'Admincc: c@mail.com\n'})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import csv
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from unittest import main, skipIf, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import export, ticket
+
+from fakes import LocalTicket
+
+logging.disable(logging.CRITICAL)
+
+
+def issue(number):
+    return {'key': 'KEY-{0}'.format(number),
+            'fields': {'summary': 'Ticket {0}'.format(number),
+                       'status': {'name': 'Open'},
+                       'assignee': None if number % 2 else {'name': 'alice'},
+                       'labels': ['ops', 'disk']}}
+
+
+class ExportedTicket(LocalTicket):
+    """JIRA-like ticket whose search results are generated locally
+    """
+
+    def __init__(self, count):
+        super(ExportedTicket, self).__init__()
+        self.ticketing_tool = 'JIRA'
+        self.count = count
+        self.searches = []
+
+    def search(self, query=None, fields=None, page_size=100, prefetch=2):
+        self.searches.append(fields)
+        return (issue(number) for number in range(self.count))
+
+
+class TestExport(TestCase):
+    """export() unit tests
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _read_csv(self, path):
+        with io.open(path, encoding='utf-8', newline='') as f:
+            return list(csv.DictReader(f))
+
+    def test_flatten(self):
+        data = export.flatten(export.SCHEMAS['JIRA']['columns'], [issue(0), issue(1)])
+        self.assertEqual(data['key'], ['KEY-0', 'KEY-1'])
+        self.assertEqual(data['assignee'], ['alice', None])
+        self.assertEqual(data['labels'], ['ops,disk', 'ops,disk'])
+        self.assertEqual(data['resolution'], [None, None])
+        columns = [('id', ('id',), 'int')]
+        self.assertEqual(export.flatten(columns, [{'id': '12'}, {}]), {'id': [12, None]})
+
+    def test_export_csv(self):
+        path = os.path.join(self.work_dir, 'tickets.csv')
+        fake = ExportedTicket(25)
+        stats = export.export(fake, path, output_format='csv', batch_size=10)
+        self.assertEqual((stats.rows, stats.batches), (25, 3))
+        self.assertEqual(fake.searches, [export.SCHEMAS['JIRA']['fields']])
+        rows = self._read_csv(path)
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[2]['key'], 'KEY-2')
+        self.assertEqual(rows[2]['status'], 'Open')
+
+    def test_export_processes(self):
+        path = os.path.join(self.work_dir, 'tickets.csv')
+        stats = export.export(ExportedTicket(50), path, output_format='csv', batch_size=7, processes=2)
+        self.assertEqual(stats.rows, 50)
+        self.assertEqual([row['key'] for row in self._read_csv(path)], ['KEY-{0}'.format(n) for n in range(50)])
+
+    def test_unknown_tool(self):
+        fake = ExportedTicket(1)
+        fake.ticketing_tool = 'Other'
+        self.assertRaises(ticket.TicketException, export.export, fake, os.path.join(self.work_dir, 'x.csv'))
+
+    @skipIf(export.pyarrow is not None, 'pyarrow is installed')
+    def test_parquet_requires_pyarrow(self):
+        self.assertRaises(ticket.TicketException, export.export, ExportedTicket(1),
+                          os.path.join(self.work_dir, 'tickets.parquet'))
+
+    @skipIf(export.pyarrow is None, 'pyarrow is not installed')
+    def test_export_parquet(self):
+        path = os.path.join(self.work_dir, 'tickets.parquet')
+        export.export(ExportedTicket(25), path, batch_size=10)
+        table = export.pyarrow.parquet.read_table(path)
+        self.assertEqual(table.num_rows, 25)
+        self.assertEqual(table.column('key').to_pylist()[2], 'KEY-2')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import logging
+import os
+import sys
+import threading
+import time
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import bugzilla, federation, jira, rt, servicenow, ticket
+
+from fakes import FakeResponse, RESULT, ticket_object
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeInstance(object):
+    """Ticket object of one instance, answering after a delay
+    """
+
+    def __init__(self, url, tickets, delay=0.0, error=None):
+        self.url = url
+        self.tickets = tickets
+        self.delay = delay
+        self.error = error
+        self.queries = []
+        self.release = threading.Event()
+
+    def search(self, query=None, fields=None, page_size=100, prefetch=2):
+        self.queries.append(query)
+        for key in self.tickets:
+            if self.delay:
+                self.release.wait(self.delay)
+            if self.error:
+                raise ticket.TicketException(self.error)
+            yield {'key': key}
+
+    def get_ticket_content(self, ticket_id=None, fields=None):
+        if self.error:
+            return RESULT('Failure', self.error, None, None)
+        if ticket_id in self.tickets:
+            return RESULT('Success', None, None, {'key': ticket_id})
+        return RESULT('Failure', ticket.NOT_FOUND.format(ticket_id), None, None)
+
+
+class StatusSession(object):
+    """Answers every GET request with the same body and status code
+    """
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def get(self, url, params=None):
+        return FakeResponse(self.body, self.status_code)
+
+
+class TestFederation(TestCase):
+    """Federation unit tests
+    """
+
+    def test_results_stream_from_every_instance(self):
+        instances = {'emea': FakeInstance('emea', ['E-1', 'E-2']), 'apac': FakeInstance('apac', ['A-1'])}
+        results = federation.Federation(instances).search(lambda t: 'reference ~ {0}'.format(t.url))
+        hits = sorted(results, key=lambda hit: (hit.instance, hit.item['key']))
+        self.assertEqual(hits, [('apac', {'key': 'A-1'}), ('emea', {'key': 'E-1'}), ('emea', {'key': 'E-2'})])
+        self.assertEqual(sorted(results.completed), ['apac', 'emea'])
+        self.assertEqual(results.errors, {})
+        self.assertEqual(instances['emea'].queries, ['reference ~ emea'])
+
+    def test_slow_instances_time_out_without_stalling_others(self):
+        slow = FakeInstance('slow', ['S-1'], delay=5)
+        self.addCleanup(slow.release.set)
+        instances = {'fast': FakeInstance('fast', ['F-1', 'F-2']), 'slow': slow,
+                     'broken': FakeInstance('broken', ['B-1'], error='Error searching for tickets')}
+        client = federation.Federation(instances, timeout={'fast': 5, 'slow': 0.2, 'broken': 5})
+        start = time.time()
+        results = client.search()
+        first = next(iter(results))
+        self.assertEqual(first.instance, 'fast')
+        self.assertLess(time.time() - start, 0.2)
+        results = client.search()
+        self.assertEqual([hit.item['key'] for hit in results], ['F-1', 'F-2'])
+        self.assertEqual(results.errors['slow'], 'Busy with an earlier call')
+
+        slow.release.set()
+        time.sleep(0.1)
+        results = client.search(timeout=0.1)
+        slow.release.clear()
+        list(results)
+        self.assertEqual(results.completed, ['fast'])
+        self.assertEqual(results.errors['broken'], 'Error searching for tickets')
+        self.assertTrue(results.errors['slow'].startswith('Timed out'))
+
+    def test_get_ticket_content(self):
+        instances = [FakeInstance('emea', ['E-1']), FakeInstance('apac', ['A-1'])]
+        results = federation.Federation(instances).get_ticket_content('A-1')
+        self.assertEqual(list(results), [('apac', {'key': 'A-1'})])
+        self.assertEqual(sorted(results.completed), ['apac', 'emea'])
+
+    def test_get_ticket_content_errors(self):
+        instances = {'emea': FakeInstance('emea', ['E-1']), 'apac': FakeInstance('apac', ['A-1']),
+                     'broken': FakeInstance('broken', ['A-1'], error='Error getting ticket content')}
+        results = federation.Federation(instances).get_ticket_content('A-1')
+        self.assertEqual(list(results), [('apac', {'key': 'A-1'})])
+        self.assertEqual(sorted(results.completed), ['apac', 'emea'])
+        self.assertEqual(results.errors, {'broken': 'Error getting ticket content'})
+
+
+class TestNotFound(TestCase):
+    """get_ticket_content() not found unit tests
+    """
+
+    def assert_error(self, cls, tool, body, status_code, error_message):
+        t = ticket_object(cls, tool, None)
+        t.s = StatusSession(body, status_code)
+        result = t.get_ticket_content('7')
+        self.assertEqual((result.status, result.error_message), ('Failure', error_message))
+
+    def test_not_found(self):
+        not_found = ticket.NOT_FOUND.format('7')
+        self.assert_error(jira.JiraTicket, 'JIRA', {'errorMessages': ['Issue Does Not Exist']}, 404, not_found)
+        self.assert_error(bugzilla.BugzillaTicket, 'Bugzilla', {'error': True, 'code': 101}, 200, not_found)
+        self.assert_error(rt.RTTicket, 'RT', 'RT/4.4.2 200 Ok\n\n# Ticket 7 does not exist.\n', 200, not_found)
+        self.assert_error(servicenow.ServiceNowTicket, 'ServiceNow', {'result': []}, 200, not_found)
+
+    def test_other_errors(self):
+        error_message = 'Error getting ticket content'
+        self.assert_error(jira.JiraTicket, 'JIRA', {}, 503, error_message)
+        self.assert_error(bugzilla.BugzillaTicket, 'Bugzilla', {'error': True, 'code': 102}, 200, error_message)
+        self.assert_error(rt.RTTicket, 'RT', 'RT/4.4.2 400 Bad Request\n\n', 200, error_message)
+
+
+if __name__ == '__main__':
+    main()
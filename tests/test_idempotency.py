@@ -0,0 +1,200 @@
+import logging
+import os
+import sys
+import time
+from unittest import main, TestCase
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import bugzilla, idempotency, jira
+
+from fakes import FakeResponse, LocalTicket, ticket_object
+
+logging.disable(logging.CRITICAL)
+
+
+class TestFingerprintIndex(TestCase):
+    """FingerprintIndex unit tests
+    """
+
+    def test_fingerprint_ignores_field_order(self):
+        self.assertEqual(idempotency.fingerprint({'a': 1, 'b': 2}), idempotency.fingerprint({'b': 2, 'a': 1}))
+        self.assertEqual(idempotency.fingerprint('{"a": 1, "b": 2}'), idempotency.fingerprint({'b': 2, 'a': 1}))
+        self.assertNotEqual(idempotency.fingerprint({'a': 1}), idempotency.fingerprint({'a': 2}))
+
+    def test_get_put_delete(self):
+        index = idempotency.FingerprintIndex()
+        index.put('key', 'KEY-1')
+        self.assertEqual(index.get('key'), 'KEY-1')
+        self.assertIsNone(index.get('key', namespace='other'))
+        index.delete('key')
+        self.assertIsNone(index.get('key'))
+
+    def test_ttl(self):
+        index = idempotency.FingerprintIndex(ttl=0.05)
+        index.put('key', 'KEY-1')
+        time.sleep(0.1)
+        self.assertIsNone(index.get('key'))
+
+    def test_max_entries(self):
+        index = idempotency.FingerprintIndex(max_entries=10)
+        for number in range(25):
+            index.put(str(number), number)
+        self.assertLessEqual(len(index), 10)
+        self.assertEqual(index.get('24'), 24)
+        self.assertIsNone(index.get('0'))
+
+
+class TestIdempotentCreate(TestCase):
+    """Ticket._create_ticket() unit tests
+    """
+
+    def test_without_index(self):
+        fake = LocalTicket()
+        fake._create_ticket({'summary': 'one'})
+        fake._create_ticket({'summary': 'one'})
+        self.assertEqual(len(fake.requests), 2)
+
+    def test_repeated_create(self):
+        fake = LocalTicket()
+        fake.set_idempotency_index(idempotency.FingerprintIndex())
+        fake._create_ticket({'summary': 'one'})
+        t = fake._create_ticket({'summary': 'one'})
+        self.assertEqual(len(fake.requests), 1)
+        self.assertEqual(fake.ticket_id, 'KEY-1')
+        self.assertEqual(t.status, 'Success')
+        fake._create_ticket({'summary': 'two'})
+        self.assertEqual(len(fake.requests), 2)
+
+    def test_ambiguous_failure_stored(self):
+        fake = LocalTicket(fail=requests.ReadTimeout('Read timed out'), stored=True)
+        fake.set_idempotency_index(idempotency.FingerprintIndex())
+        t = fake._create_ticket({'summary': 'one'})
+        self.assertEqual(t.status, 'Success')
+        self.assertEqual(fake.ticket_id, 'KEY-99')
+        self.assertEqual(fake.lookups, 1)
+
+    def test_failure_not_stored(self):
+        index = idempotency.FingerprintIndex()
+        fake = LocalTicket(fail=requests.ReadTimeout('Read timed out'))
+        fake.set_idempotency_index(index)
+        t = fake._create_ticket({'summary': 'one'})
+        self.assertEqual(t.status, 'Failure')
+        self.assertEqual(len(index), 0)
+
+    def test_rejected_create_not_looked_up(self):
+        # A rejected create didn't store anything, whatever a search finds.
+        fake = LocalTicket(fail=requests.HTTPError('400 Error', response=FakeResponse({}, 400)), stored=True)
+        fake.set_idempotency_index(idempotency.FingerprintIndex())
+        t = fake._create_ticket({'summary': 'one'})
+        self.assertEqual(t.status, 'Failure')
+        self.assertEqual(fake.lookups, 0)
+
+    def test_pending_from_crashed_attempt(self):
+        index = idempotency.FingerprintIndex()
+        fake = LocalTicket(stored=True)
+        fake.set_idempotency_index(index)
+        index.put(idempotency.fingerprint('Fake', 'fake', 'KEY', {'summary': 'one'}), idempotency.PENDING)
+        fake._create_ticket({'summary': 'one'})
+        self.assertEqual(fake.ticket_id, 'KEY-99')
+        self.assertEqual(len(fake.requests), 0)
+
+
+class BugzillaSession(object):
+    """Answers create requests with create_status and finds a bug with the same summary
+    """
+
+    def __init__(self, create_status, description):
+        self.create_status = create_status
+        self.description = description
+        self.requests = []
+
+    def post(self, url, json=None):
+        self.requests.append(('POST', url))
+        return FakeResponse({'error': True, 'message': 'Rejected'}, self.create_status)
+
+    def get(self, url, params=None):
+        self.requests.append(('GET', url))
+        if url.endswith('/comment'):
+            return FakeResponse({'bugs': {'7': {'comments': [{'text': self.description}]}}})
+        return FakeResponse({'bugs': [{'id': 7, 'summary': 'Disk full'}]})
+
+
+class JiraSession(object):
+    """Answers create requests with create_response and finds an issue with the same summary
+    """
+
+    def __init__(self, create_response):
+        self.create_response = create_response
+        self.requests = []
+
+    def post(self, url, json=None):
+        self.requests.append(('POST', url))
+        return self.create_response
+
+    def get(self, url, params=None):
+        self.requests.append(('GET', url))
+        fields = {'summary': 'Disk full', 'description': 'web-3 is out of disk space'}
+        return FakeResponse({'issues': [{'key': 'KEY-7', 'fields': fields}]})
+
+
+class TestFindCreatedTicket(TestCase):
+    """Idempotent create with a ticketing tool's lookup unit tests
+    """
+
+    def _create(self, create_status, description):
+        t = ticket_object(bugzilla.BugzillaTicket, 'Bugzilla', None)
+        t.project = 'Product'
+        t.ticket_id = None
+        t.duplicate_index = None
+        t.s = BugzillaSession(create_status, description)
+        t.set_idempotency_index(idempotency.FingerprintIndex())
+        return t, t.create('Disk full', 'web-3 is out of disk space')
+
+    def test_rejected_with_same_summary(self):
+        t, result = self._create(400, 'web-3 is out of disk space')
+        self.assertEqual(result.status, 'Failure')
+        self.assertEqual(t.s.requests, [('POST', 'https://tool/rest')])
+
+    def test_server_error_created(self):
+        t, result = self._create(503, 'web-3 is out of disk space')
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual(t.ticket_id, 7)
+
+    def test_server_error_other_description(self):
+        t, result = self._create(503, 'web-4 is out of disk space')
+        self.assertEqual(result.status, 'Failure')
+        self.assertEqual(len(t.s.requests), 3)
+
+    def _create_jira(self, create_response):
+        t = ticket_object(jira.JiraTicket, 'JIRA', None)
+        t.project = 'KEY'
+        t.ticket_id = None
+        t.duplicate_index = None
+        t.s = JiraSession(create_response)
+        index = idempotency.FingerprintIndex()
+        t.set_idempotency_index(index)
+        return t, index, t.create('Disk full', 'web-3 is out of disk space')
+
+    def test_jira_proxy_error_created(self):
+        # A proxy's error page isn't JSON, the create may still have gone through.
+        t, index, result = self._create_jira(FakeResponse('<html>Service Unavailable</html>', 503))
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual(t.ticket_id, 'KEY-7')
+        # The index remembers the found ticket, so a retry doesn't post again.
+        t.create('Disk full', 'web-3 is out of disk space')
+        self.assertEqual(len(index), 1)
+        self.assertEqual([request for request in t.s.requests if request[0] == 'POST'], [('POST', 'https://tool/rest')])
+
+    def test_jira_rejected(self):
+        t, index, result = self._create_jira(FakeResponse({'errorMessages': [],
+                                                           'errors': {'summary': 'Summary is required'}}, 400))
+        self.assertEqual(result.error_message, 'Error creating ticket - Summary is required')
+        self.assertEqual(t.s.requests, [('POST', 'https://tool/rest')])
+        self.assertEqual(len(index), 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+import sys
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import jsonstream
+
+logging.disable(logging.CRITICAL)
+
+DOCUMENT = json.dumps({'expand': 'names', 'startAt': 0, 'maxResults': 50, 'total': 3,
+                       'issues': [{'key': 'KEY-1', 'fields': {'summary': u'Disk full – web-3', 'labels': []}},
+                                  {'key': 'KEY-2', 'fields': {'summary': 'CPU [load] {high}', 'estimate': 1.5}},
+                                  {'key': 'KEY-3', 'fields': {'summary': 'x' * 5000}}]}).encode('utf-8')
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestIterItems(TestCase):
+    """iter_items() unit tests
+    """
+
+    def test_items(self):
+        expected = json.loads(DOCUMENT.decode('utf-8'))
+        for size in (1, 2, 100, 100000):
+            header = {}
+            items = list(jsonstream.iter_items(chunked(DOCUMENT, size), 'issues', header))
+            self.assertEqual(items, expected['issues'])
+            self.assertEqual(header['total'], 3)
+            self.assertEqual(header['expand'], 'names')
+
+    def test_items_are_yielded_before_the_document_ends(self):
+        chunks = iter(chunked(DOCUMENT, 50))
+        items = jsonstream.iter_items(chunks, 'issues')
+        self.assertEqual(next(items)['key'], 'KEY-1')
+        self.assertTrue(next(chunks, None) is not None)
+
+    def test_empty_and_invalid(self):
+        self.assertEqual(list(jsonstream.iter_items([b'{"result": []}'], 'result')), [])
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_items(chunked(DOCUMENT[:-100], 10), 'issues'))
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_items([b'{"error": "Unauthorized"}'], 'result'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import metrics, transport
+
+logging.disable(logging.CRITICAL)
+
+
+CHUNKS = [b'log line\n' * 100] * 3
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers every request with a small JSON body, a 404 for /missing, or CHUNKS without a
+    Content-Length for /chunked
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            for chunk in CHUNKS + [b'']:
+                self.wfile.write('{0:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+            return
+        body = json.dumps({'id': '1', 'path': self.path}).encode('utf-8')
+        self.send_response(404 if self.path == '/missing' else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTicket(object):
+    """Makes requests the way Ticket objects do
+    """
+
+    def __init__(self, url):
+        self.ticketing_tool = 'JIRA'
+        self.url = url
+        self.s = transport.Session()
+
+    def create(self):
+        self._get_status_id()
+        return self.s.post('{0}/issue'.format(self.url), json={'summary': 'Disk full'})
+
+    def _get_status_id(self):
+        return self.s.get('{0}/missing'.format(self.url))
+
+    def get_attachment(self):
+        with self.s.get('{0}/chunked'.format(self.url), stream=True) as r:
+            return b''.join(r.iter_content(100))
+
+
+class TestMetrics(TestCase):
+    """Metrics unit tests
+    """
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.host = '127.0.0.1:{0}'.format(self.server.server_port)
+        self.ticket = FakeTicket('http://{0}'.format(self.host))
+        self.addCleanup(self.ticket.s.close)
+
+    def test_requests_are_labelled_by_operation_and_method(self):
+        recorder = metrics.Metrics(buckets=(1.0, 30.0)).enable()
+        self.addCleanup(recorder.disable)
+        self.ticket.create()
+        self.ticket.create()
+
+        snapshot = dict((item['method'], item) for item in recorder.snapshot())
+        self.assertEqual(sorted(snapshot), ['_get_status_id', 'create'])
+        lookup = snapshot['_get_status_id']
+        self.assertEqual((lookup['backend'], lookup['host'], lookup['operation']), ('JIRA', self.host, 'create'))
+        self.assertEqual(lookup['statuses'], {'404': 2})
+        self.assertEqual((lookup['latency']['count'], lookup['latency'][30.0]), (2, 2))
+        post = snapshot['create']
+        self.assertEqual(post['statuses'], {'200': 2})
+        self.assertEqual(post['bytes_sent'], 2 * len(json.dumps({'summary': 'Disk full'})))
+        self.assertGreater(post['bytes_received'], 0)
+        # The first request opens the connection, the others reuse it.
+        self.assertEqual(lookup['new_connections'] + post['new_connections'], 1)
+        self.assertEqual(lookup['reused_connections'] + post['reused_connections'], 3)
+
+        text = recorder.prometheus()
+        self.assertIn('ticketutil_requests_total{{backend="JIRA",host="{0}",operation="create",'
+                      'method="_get_status_id",code="404"}} 2'.format(self.host), text)
+        self.assertIn('le="+Inf"} 2', text)
+        self.assertIn('# TYPE ticketutil_request_duration_seconds histogram', text)
+
+    def test_streamed_bytes_are_counted_when_closed(self):
+        events = []
+        transport.add_request_listener(events.append)
+        self.addCleanup(transport.remove_request_listener, events.append)
+        r = self.ticket.s.get('http://{0}/chunked'.format(self.host), stream=True)
+        body = b''.join(r.iter_content(100))
+        # The size is only known once the response is closed.
+        self.assertEqual(events, [])
+        r.close()
+        self.assertEqual([event.bytes_received for event in events], [len(body)])
+
+        recorder = metrics.Metrics().enable()
+        self.addCleanup(recorder.disable)
+        body = self.ticket.get_attachment()
+        self.assertEqual(body, b''.join(CHUNKS))
+        self.assertEqual(recorder.snapshot()[0]['bytes_received'], len(body))
+
+    def test_disabled_metrics_record_nothing(self):
+        recorder = metrics.Metrics().enable()
+        recorder.disable()
+        self.ticket.create()
+        self.assertEqual(recorder.snapshot(), [])
+        self.assertEqual(transport._listeners, ())
+
+    def test_callbacks(self):
+        events = []
+        transport.add_request_listener(events.append)
+        self.addCleanup(transport.remove_request_listener, events.append)
+        self.ticket._get_status_id()
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0].operation, events[0].method, events[0].http_method, events[0].status_code),
+                         ('_get_status_id', '_get_status_id', 'GET', 404))
+
+
+if __name__ == '__main__':
+    main()
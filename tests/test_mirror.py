@@ -0,0 +1,198 @@
+import logging
+import os
+import sys
+from collections import namedtuple
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import jira, mirror, redmine, servicenow
+
+from fakes import PagingTicket
+
+logging.disable(logging.CRITICAL)
+
+FakeRequest = namedtuple('FakeRequest', ['method'])
+FakeResponse = namedtuple('FakeResponse', ['ok', 'request'])
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.hooks = {'response': []}
+
+
+class MirroredTicket(PagingTicket):
+    """Ticket whose search results have mirrored columns
+    """
+
+    def __init__(self, pages):
+        super(MirroredTicket, self).__init__(pages)
+        self.s = FakeSession()
+
+    def _mirror_fields(self, content):
+        return {'ticket_id': content['id'], 'project': 'KEY', 'summary': 'ticket {0}'.format(content['id']),
+                'status': 'Open' if content['id'] % 2 else 'Closed'}
+
+
+class CreatingTicket(MirroredTicket):
+    """Ticket whose create requests go through the session hooks
+    """
+
+    def _create_ticket_request(self, params):
+        for hook in self.s.hooks['response']:
+            hook(FakeResponse(True, FakeRequest('POST')))
+        return super(CreatingTicket, self)._create_ticket_request(params)
+
+
+def store(index, ticket_id, **fields):
+    fields['ticket_id'] = ticket_id
+    index.store('JIRA', 'jira', fields, {'key': ticket_id, 'fields': dict(fields)})
+
+
+class TestMirror(TestCase):
+    """Mirror unit tests
+    """
+
+    def setUp(self):
+        self.mirror = mirror.Mirror()
+        store(self.mirror, 'KEY-1', project='KEY', summary='Disk full on web-3.example.com', status='Open',
+              assignee='alice', comments='Cleaned /var/log')
+        store(self.mirror, 'KEY-2', project='KEY', summary='CPU load on web-4.example.com', status='Closed',
+              assignee='bob')
+        store(self.mirror, 'OPS-1', project='OPS', summary='Disk full on db-1', status='open', assignee='alice')
+
+    def _ids(self, **conditions):
+        return sorted(ticket['ticket_id'] for ticket in self.mirror.query(**conditions))
+
+    def test_query(self):
+        self.assertEqual(self._ids(text='disk'), ['KEY-1', 'OPS-1'])
+        self.assertEqual(self._ids(text='disk', project='key'), ['KEY-1'])
+        self.assertEqual(self._ids(status='OPEN', assignee='alice'), ['KEY-1', 'OPS-1'])
+        self.assertEqual(self._ids(text='"web-4.example.com"'), ['KEY-2'])
+        self.assertEqual(self._ids(text='cleaned'), ['KEY-1'])
+
+    def test_partial_read_keeps_fields(self):
+        self.mirror.store('JIRA', 'jira', {'ticket_id': 'KEY-1', 'status': 'Closed'},
+                          {'key': 'KEY-1', 'fields': {'status': 'Closed'}}, partial=True)
+        ticket = self.mirror.get('JIRA', 'jira', 'KEY-1')
+        self.assertEqual(ticket['status'], 'Closed')
+        self.assertEqual(ticket['summary'], 'Disk full on web-3.example.com')
+        self.assertEqual(ticket['content']['fields']['assignee'], 'alice')
+        self.assertEqual(self._ids(text='disk', status='closed'), ['KEY-1'])
+
+    def test_staleness(self):
+        ticket = self.mirror.get('JIRA', 'jira', 'KEY-1')
+        self.assertFalse(ticket['stale'])
+        self.assertGreaterEqual(ticket['age'], 0)
+        self.mirror.invalidate('JIRA', 'jira', 'KEY-1')
+        self.assertTrue(self.mirror.get('JIRA', 'jira', 'KEY-1')['stale'])
+        store(self.mirror, 'KEY-1', summary='Disk full')
+        self.assertFalse(self.mirror.get('JIRA', 'jira', 'KEY-1')['stale'])
+
+    def test_cleared_field(self):
+        self.mirror.store('JIRA', 'jira', {'ticket_id': 'KEY-1', 'assignee': None, 'comments': None},
+                          {'key': 'KEY-1', 'fields': {'assignee': None, 'comment': None}}, partial=True)
+        ticket = self.mirror.get('JIRA', 'jira', 'KEY-1')
+        self.assertIsNone(ticket['assignee'])
+        self.assertEqual(self._ids(text='cleaned'), [])
+        self.assertEqual(ticket['status'], 'Open')
+
+    def test_full_read_replaces_ticket(self):
+        # The tool left the assignee out of the read because it was cleared.
+        self.mirror.store('JIRA', 'jira', {'ticket_id': 'KEY-2', 'summary': 'CPU load', 'status': 'Closed'},
+                          {'key': 'KEY-2', 'fields': {'summary': 'CPU load', 'status': 'Closed'}})
+        ticket = self.mirror.get('JIRA', 'jira', 'KEY-2')
+        self.assertEqual(ticket['content'], {'key': 'KEY-2', 'fields': {'summary': 'CPU load', 'status': 'Closed'}})
+        self.assertIsNone(ticket['assignee'])
+        self.assertEqual(self._ids(assignee='bob'), [])
+
+    def test_partial_read_keeps_stale(self):
+        self.mirror.invalidate('JIRA', 'jira', 'KEY-1')
+        self.mirror.store('JIRA', 'jira', {'ticket_id': 'KEY-1', 'status': 'Closed'},
+                          {'key': 'KEY-1', 'fields': {'status': 'Closed'}}, partial=True)
+        self.assertTrue(self.mirror.get('JIRA', 'jira', 'KEY-1')['stale'])
+        self.mirror.store('JIRA', 'jira', {'ticket_id': 'KEY-1', 'status': 'Closed'},
+                          {'key': 'KEY-1', 'fields': {'status': 'Closed'}})
+        self.assertFalse(self.mirror.get('JIRA', 'jira', 'KEY-1')['stale'])
+
+    def test_remove(self):
+        self.mirror.remove('JIRA', 'jira', 'KEY-1')
+        self.assertEqual(len(self.mirror), 2)
+        self.assertEqual(self._ids(text='cleaned'), [])
+
+
+class TestTicketMirror(TestCase):
+    """Ticket.set_mirror() unit tests
+    """
+
+    def test_search_fills_mirror(self):
+        fake = MirroredTicket(pages=3)
+        fake.set_mirror(mirror.Mirror())
+        self.assertEqual(len(list(fake.search(page_size=4))), 12)
+        self.assertEqual(len(fake.mirror), 12)
+        self.assertEqual(len(fake.mirror.query(status='open')), 6)
+
+    def test_changes_mark_stale(self):
+        fake = MirroredTicket(pages=1)
+        fake.set_mirror(mirror.Mirror())
+        list(fake.search(page_size=2))
+        fake.ticket_id = 1
+        for hook in fake.s.hooks['response']:
+            hook(FakeResponse(True, FakeRequest('GET')))
+        self.assertFalse(fake.mirror.get('Fake', 'fake', 1)['stale'])
+        for hook in fake.s.hooks['response']:
+            hook(FakeResponse(True, FakeRequest('PUT')))
+        self.assertTrue(fake.mirror.get('Fake', 'fake', 1)['stale'])
+
+        fake.set_mirror(None)
+        self.assertEqual(fake.s.hooks['response'], [])
+
+    def test_create_keeps_previous_ticket_fresh(self):
+        fake = CreatingTicket(pages=1)
+        fake.set_mirror(mirror.Mirror())
+        list(fake.search(page_size=2))
+        fake.ticket_id = 1
+        fake._create_ticket({'summary': 'Disk full'})
+        self.assertEqual(fake.ticket_id, 'KEY-1')
+        self.assertFalse(fake.mirror.get('Fake', 'fake', 1)['stale'])
+
+
+class TestMirrorFields(TestCase):
+    """Ticket._mirror_fields() unit tests
+    """
+
+    def test_jira_projection(self):
+        t = jira.JiraTicket.__new__(jira.JiraTicket)
+        self.assertEqual(t._mirror_fields({'key': 'KEY-1', 'fields': {'status': {'name': 'Done'}}}),
+                         {'ticket_id': 'KEY-1', 'status': 'Done'})
+        self.assertEqual(t._mirror_fields({'key': 'KEY-1', 'fields': {'assignee': None}}),
+                         {'ticket_id': 'KEY-1', 'assignee': None})
+
+    def test_redmine_unassigned(self):
+        t = redmine.RedmineTicket.__new__(redmine.RedmineTicket)
+        issue = {'id': 1, 'subject': 'Disk full', 'author': {'name': 'alice'}, 'updated_on': '2017-01-13T10:00:00Z'}
+        self.assertIsNone(t._mirror_fields(issue)['assignee'])
+        self.assertNotIn('assignee', t._mirror_fields({'id': 1, 'subject': 'Disk full'}))
+
+    def test_servicenow_projection(self):
+        t = servicenow.ServiceNowTicket.__new__(servicenow.ServiceNowTicket)
+        t.ticketing_tool = 'ServiceNow'
+        t.url = 'servicenow'
+        t.project = 'incident'
+        t.ticket_id = 'INC01'
+        t.sys_id = 'abc'
+        t.mirror = mirror.Mirror()
+        t._mirror_content({'number': 'INC01', 'sys_id': 'abc', 'state': '1', 'short_description': 'Disk full'})
+
+        # A projection without the number is stored when it is the current record, skipped otherwise.
+        t._mirror_content({'sys_id': 'abc', 'state': '2'}, partial=True)
+        t._mirror_content({'sys_id': 'other', 'state': '3'}, partial=True)
+        ticket = t.mirror.get('ServiceNow', 'servicenow', 'INC01')
+        self.assertEqual(ticket['status'], '2')
+        self.assertEqual(ticket['summary'], 'Disk full')
+        self.assertEqual(len(t.mirror), 1)
+
+
+if __name__ == '__main__':
+    main()
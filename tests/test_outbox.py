@@ -0,0 +1,161 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from unittest import main, TestCase
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import outbox, transport
+
+from fakes import FakeTicket
+
+logging.disable(logging.CRITICAL)
+
+
+class RecordingTicket(FakeTicket):
+    """FakeTicket that records the order of comments it receives
+    """
+    calls = []
+
+    def add_comment(self, comment):
+        RecordingTicket.calls.append((self.ticket_id, comment))
+        return super(RecordingTicket, self).add_comment(comment)
+
+
+class StatusAdapter(requests.adapters.BaseAdapter):
+    """Answers every request with the status code in the URL, or fails to connect
+    """
+
+    def send(self, request, **kwargs):
+        status = request.url.rsplit('/', 1)[-1]
+        if status == 'down':
+            raise requests.ConnectionError('Connection refused')
+        response = requests.Response()
+        response.status_code = int(status)
+        response._content = b'{}'
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class RequestingTicket(FakeTicket):
+    """FakeTicket whose comments are posted to the status code they name
+    """
+
+    def __init__(self):
+        super(RequestingTicket, self).__init__()
+        self.s = transport.Session()
+        self.s.mount('https://', StatusAdapter())
+
+    def add_comment(self, comment):
+        try:
+            self.s.post('https://tool/{0}'.format(comment)).raise_for_status()
+        except requests.RequestException as e:
+            return self.request_result._replace(status='Failure', error_message=str(e))
+        return self.request_result
+
+
+class TestOutbox(TestCase):
+    """Outbox unit tests
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'outbox.db')
+        RecordingTicket.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_flush(self):
+        box = outbox.Outbox(self.path, RecordingTicket)
+        first = box.enqueue('comment', 'KEY-1', 'first')
+        second = box.enqueue('comment', 'KEY-1', 'second')
+        create = box.enqueue('create', None, 'summary', 'description')
+        self.assertEqual(box.status(first)['state'], outbox.PENDING)
+
+        # Only the first operation on KEY-1 is ready; the second waits for it.
+        self.assertEqual(box.flush(), 2)
+        self.assertEqual(box.flush(), 1)
+        self.assertEqual(RecordingTicket.calls, [('KEY-1', 'first'), ('KEY-1', 'second')])
+        self.assertEqual(box.status(second)['state'], outbox.DONE)
+        self.assertEqual(box.status(create)['result']['ticket_id'], 'NEW-summary')
+        box.close()
+
+    def test_retry(self):
+        box = outbox.Outbox(self.path, RecordingTicket, max_attempts=2, retry_delay=0)
+        op_id = box.enqueue('comment', 'KEY-1', 'explode')
+        box.flush()
+        self.assertEqual(box.status(op_id)['state'], outbox.PENDING)
+        box.flush()
+        status = box.status(op_id)
+        self.assertEqual(status['state'], outbox.FAILED)
+        self.assertEqual(status['attempts'], 2)
+        box.close()
+
+    def test_rejected_operations_fail(self):
+        box = outbox.Outbox(self.path, RequestingTicket, max_attempts=3, retry_delay=0)
+        rejected = box.enqueue('comment', 'KEY-1', '400')
+        limited = box.enqueue('comment', 'KEY-2', '429')
+        failed = box.enqueue('comment', 'KEY-3', '503')
+        down = box.enqueue('comment', 'KEY-4', 'down')
+        box.flush()
+        self.assertEqual(box.status(rejected)['state'], outbox.FAILED)
+        self.assertEqual(box.status(rejected)['attempts'], 1)
+        for op_id in (limited, failed, down):
+            self.assertEqual(box.status(op_id)['state'], outbox.PENDING)
+        box.flush()
+        box.flush()
+        for op_id in (limited, failed, down):
+            self.assertEqual(box.status(op_id)['state'], outbox.FAILED)
+            self.assertEqual(box.status(op_id)['attempts'], 3)
+        box.close()
+        self.assertNotIn(box._record_request, transport._listeners)
+
+    def test_survives_restart(self):
+        box = outbox.Outbox(self.path)
+        op_id = box.enqueue('comment', 'KEY-1', 'persisted')
+        box.close()
+
+        box = outbox.Outbox(self.path, RecordingTicket)
+        box.start()
+        status = box.wait(op_id, timeout=5)
+        box.close()
+        self.assertEqual(status['state'], outbox.DONE)
+        self.assertEqual(RecordingTicket.calls, [('KEY-1', 'persisted')])
+
+    def test_factory_errors_are_retried(self):
+        attempts = []
+
+        def factory():
+            # The tool is down for the first attempt.
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise outbox.ticket.TicketException("Error authenticating")
+            return RecordingTicket()
+
+        box = outbox.Outbox(self.path, factory, retry_delay=0, poll_interval=0.05)
+        op_id = box.enqueue('comment', 'KEY-1', 'after outage')
+        box.start()
+        status = box.wait(op_id, timeout=5)
+        box.close()
+        self.assertEqual(status['state'], outbox.DONE)
+        self.assertEqual(status['attempts'], 2)
+        self.assertEqual(RecordingTicket.calls, [('KEY-1', 'after outage')])
+
+    def test_invalid_operation(self):
+        box = outbox.Outbox(self.path)
+        with self.assertRaises(Exception):
+            box.enqueue('_create_ticket_request', None, {})
+        box.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import logging
+import os
+import sys
+import time
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import operation, pipeline
+
+from fakes import fake_ticket_factory
+
+logging.disable(logging.CRITICAL)
+
+
+class TestPipeline(TestCase):
+    """Pipeline unit tests
+    """
+
+    def test_map(self):
+        result = list(pipeline.Pipeline(range(10)).map(lambda x: x * 2).map(lambda x: x + 1))
+        self.assertEqual(result, [x * 2 + 1 for x in range(10)])
+
+    def test_map_concurrent(self):
+        result = pipeline.Pipeline(range(100)).map(lambda x: x * 2, concurrency=4)
+        self.assertEqual(sorted(result), [x * 2 for x in range(100)])
+
+    def test_map_key(self):
+        def slow_first(item):
+            # The first item of each key is the slowest, so an unordered stage would overtake it.
+            time.sleep(0.02 if item[1] == 0 else 0)
+            return item
+
+        items = [(key, number) for number in range(5) for key in 'abcd']
+        result = list(pipeline.Pipeline(items).map(slow_first, concurrency=3, key=lambda item: item[0]))
+        self.assertEqual(sorted(result), sorted(items))
+        for key in 'abcd':
+            self.assertEqual([number for k, number in result if k == key], list(range(5)))
+
+    def test_drop(self):
+        result = list(pipeline.Pipeline(range(10)).map(lambda x: x if x % 2 else None))
+        self.assertEqual(result, [1, 3, 5, 7, 9])
+
+    def test_backpressure(self):
+        read = []
+
+        def source():
+            for x in range(1000):
+                read.append(x)
+                yield x
+
+        items = iter(pipeline.Pipeline(source(), buffer=2).map(lambda x: x, buffer=2))
+        next(items)
+        time.sleep(0.2)
+        # Only the bounded queues fill up; the rest of the source isn't read ahead.
+        self.assertLess(len(read), 10)
+
+    def test_operation(self):
+        pool = operation.TicketPool(fake_ticket_factory, size=2)
+        records = [{'summary': str(x), 'comment': 'ok' if x else 'explode'} for x in range(4)]
+        run = (pipeline.Pipeline(records)
+               .operation(pool, lambda r: {'operation': 'create', 'args': [r['summary'], 'description']},
+                          concurrency=2, name='create')
+               .operation(pool, lambda r: {'operation': 'comment', 'ticket_id': r['ticket_id'],
+                                           'args': [r['comment']]}, concurrency=2, name='comment'))
+        result = dict((record['summary'], record) for record in run)
+        self.assertEqual(result['1']['ticket_id'], 'NEW-1')
+        self.assertEqual(result['1']['result']['status'], 'Success')
+        self.assertEqual(result['0']['result']['status'], 'Failure')
+
+        stats = run.stats()
+        self.assertEqual([stage['name'] for stage in stats], ['create', 'comment'])
+        self.assertEqual(stats[0]['processed'], 4)
+        self.assertEqual(stats[1]['in_flight'], 0)
+
+    def test_error(self):
+        run = pipeline.Pipeline(range(10)).map(lambda x: 1 // (x - 5))
+        with self.assertRaises(ZeroDivisionError):
+            list(run)
+        self.assertEqual(run.stats()[0]['errors'], 1)
+
+
+if __name__ == '__main__':
+    main()
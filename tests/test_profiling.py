@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import profiling, ticket, transport
+
+from fakes import RESULT
+
+logging.disable(logging.CRITICAL)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers every request with a small JSON body, slowly for /slow
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.path == '/slow':
+            time.sleep(0.1)
+        body = json.dumps({'id': '1'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeTicket(ticket.Ticket):
+    """Makes requests the way the backends do
+    """
+
+    def create(self, summary):
+        self._get_status_id()
+        r = self.s.post('{0}/slow'.format(self.url), json={'summary': summary})
+        self.ticket_id = r.json()['id']
+        return self.request_result
+
+    def change_status(self, status):
+        self._get_status_id()
+        return self.request_result
+
+    def _get_status_id(self):
+        return self.s.get('{0}/status'.format(self.url)).json()
+
+
+def ticket_object(url):
+    t = FakeTicket.__new__(FakeTicket)
+    t.ticketing_tool = 'JIRA'
+    t.url = url
+    t.ticket_id = None
+    t.profiler = None
+    t.s = transport.Session()
+    t.request_result = RESULT('Success', None, None, None)
+    return t
+
+
+class TestProfiler(TestCase):
+    """Profiler unit tests
+    """
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.ticket = ticket_object('http://127.0.0.1:{0}'.format(self.server.server_port))
+        self.addCleanup(self.ticket.s.close)
+
+    def test_slow_calls_are_broken_down(self):
+        profiler = profiling.Profiler(threshold=0.05, sample_interval=0.005)
+        self.addCleanup(profiler.close)
+        self.ticket.set_profiler(profiler)
+        self.ticket.create('Disk full')
+        self.ticket.change_status('Done')
+
+        # change_status() is fast, but may still pass the threshold on a loaded machine.
+        records = [record for record in profiler.records() if record['operation'] == 'create']
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual((record['operation'], record['backend'], record['ticket_id']), ('create', 'JIRA', '1'))
+        self.assertGreaterEqual(record['elapsed'], 0.1)
+        lookup, post = record['requests']
+        self.assertEqual((lookup['method'], lookup['http_method'], post['method']), ('_get_status_id', 'GET', 'create'))
+        # The first request opened the connection, the second reused it.
+        self.assertGreater(lookup['connect'], 0)
+        self.assertEqual((post['dns'], post['connect'], post['tls']), (0.0, 0.0, 0.0))
+        self.assertGreaterEqual(post['server'], 0.1)
+        self.assertGreater(post['parse'], 0)
+        self.assertEqual(post['bytes_sent'], len(json.dumps({'summary': 'Disk full'})))
+        self.assertEqual(record['bytes_received'], 2 * len(json.dumps({'id': '1'})))
+        self.assertTrue(any('create (' in stack for stack in record['stacks']))
+
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        self.assertEqual(profiler.dump(os.path.join(work_dir, 'slow.jsonl')), len(profiler.records()))
+        with open(os.path.join(work_dir, 'slow.jsonl')) as f:
+            self.assertEqual(json.loads(f.readline())['operation'], 'create')
+
+    def test_fast_calls_are_not_recorded(self):
+        profiler = profiling.Profiler(threshold=60)
+        self.addCleanup(profiler.close)
+        self.ticket.set_profiler(profiler)
+        self.ticket.create('Disk full')
+        self.assertEqual(profiler.records(), [])
+
+    def test_ring_buffer_and_detach(self):
+        profiler = profiling.Profiler(threshold=0, size=2)
+        adapter = self.ticket.s.get_adapter('http://')
+        self.ticket.set_profiler(profiler)
+        for _ in range(3):
+            self.ticket.change_status('Done')
+        self.assertEqual(len(profiler.records()), 2)
+
+        self.ticket.set_profiler(None)
+        self.assertNotIn('change_status', vars(self.ticket))
+        self.assertIs(self.ticket.s.get_adapter('http://'), adapter)
+        self.ticket.change_status('Done')
+        self.assertEqual(len(profiler.records()), 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import datetime
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import replication, sync, ticket
+
+from fakes import RESULT
+
+logging.disable(logging.CRITICAL)
+
+START = datetime.datetime(2017, 1, 13, 10, 0, 0)
+
+
+class Tool(object):
+    """An in-memory ticketing tool recording the changes made to it
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.tickets = {}
+        self.clock = 0
+        self.calls = []
+        self.fail = False
+        self.lock = threading.Lock()
+
+    def write(self, ticket_id, **fields):
+        with self.lock:
+            self.clock += 1
+            content = self.tickets.setdefault(ticket_id, {'id': ticket_id, 'status': 'New'})
+            content.update(fields)
+            content['updated'] = START + datetime.timedelta(minutes=self.clock)
+
+
+class ToolTicket(ticket.Ticket):
+    """Ticket working on a Tool
+    """
+    _sync_fields = ['updated']
+
+    def __init__(self, tool):
+        self.ticketing_tool = 'Fake'
+        self.tool = tool
+        self.url = tool.url
+        self.project = 'KEY'
+        self.ticket_id = None
+        self.mirror = None
+        self.request_result = RESULT('Success', None, None, None)
+
+    def _call(self, name, *args):
+        self.tool.calls.append((name,) + args)
+        if self.tool.fail:
+            return self.request_result._replace(status='Failure', error_message='Service unavailable')
+        return self.request_result
+
+    def create(self, summary, description, **kwargs):
+        result = self._call('create', dict(kwargs, summary=summary, description=description))
+        if result.status == 'Success':
+            self.ticket_id = 'T-{0}'.format(len(self.tool.tickets) + 1)
+            self.tool.write(self.ticket_id, summary=summary, description=description, **kwargs)
+        return result
+
+    def set_ticket_id(self, ticket_id):
+        self.ticket_id = ticket_id
+        return self.request_result
+
+    def edit(self, **kwargs):
+        result = self._call('edit', self.ticket_id, kwargs)
+        if result.status == 'Success':
+            self.tool.write(self.ticket_id, **kwargs)
+        return result
+
+    def change_status(self, status):
+        result = self._call('change_status', self.ticket_id, status)
+        if result.status == 'Success':
+            self.tool.write(self.ticket_id, status=status)
+        return result
+
+    def get_ticket_content(self, ticket_id=None, fields=None):
+        return self.request_result._replace(ticket_content=dict(self.tool.tickets[ticket_id]))
+
+    def _search_pages(self, query, fields, page_size):
+        yield [dict(content) for content in sorted(self.tool.tickets.values(), key=lambda item: item['updated'])
+               if query is None or content['updated'] >= query]
+
+    def _updated_since_query(self, since):
+        return since
+
+    def _ticket_updated(self, item):
+        return item['id'], item['updated']
+
+    def _mirror_fields(self, content):
+        return {'ticket_id': content['id'], 'status': content.get('status')}
+
+
+MAPPING = replication.Mapping({'summary': 'summary', 'description': 'description', 'priority': 'priority'},
+                              statuses={'New': 'Open', 'Closed': 'Done'},
+                              values={'priority': {'1': 'Critical', '2': 'Major'}},
+                              create_fields={'type': 'Task'})
+REVERSE = replication.Mapping({'summary': 'summary', 'description': 'description'},
+                              statuses={'Open': 'New', 'Done': 'Closed'})
+
+
+class TestReplicator(TestCase):
+    """Replicator unit tests
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.source = Tool('source')
+        self.target = Tool('target')
+        self.id_map = replication.IdMap(os.path.join(self.work_dir, 'ids.db'))
+        self.source.write('S-1', summary='Disk full', description='web-3', priority='1')
+        self.source.write('S-2', summary='Slow login', description='sso', priority='2')
+
+    def replicator(self, source=None, target=None, mapping=MAPPING, workers=2):
+        engine = sync.SyncEngine(overlap=0)
+        return replication.Replicator(ToolTicket(source or self.source), lambda: ToolTicket(target or self.target),
+                                      mapping, self.id_map, engine, workers=workers)
+
+    def test_creates_then_sends_only_deltas(self):
+        replicator = self.replicator()
+        metrics = replicator.run()
+        self.assertEqual((metrics['changes'], metrics['created'], metrics['failed']), (2, 2, 0))
+        self.assertEqual(metrics['fields_sent'], 6)
+        self.assertGreater(metrics['throughput'], 0)
+        self.assertGreater(metrics['lag']['max'], 0)
+        self.assertEqual(len(self.id_map), 2)
+        target_id = self.id_map.get('source KEY', 'S-1', 'target KEY')
+        content = self.target.tickets[target_id]
+        self.assertEqual((content['priority'], content['type'], content['status']), ('Critical', 'Task', 'Open'))
+
+        self.target.calls = []
+        self.source.write('S-1', priority='2', status='Closed')
+        metrics = replicator.run()
+        self.assertEqual((metrics['changes'], metrics['updated']), (1, 1))
+        self.assertEqual(self.target.calls, [('edit', target_id, {'priority': 'Major'}),
+                                             ('change_status', target_id, 'Done')])
+
+        # A change to a field that isn't mapped sends nothing.
+        self.target.calls = []
+        self.source.write('S-1', assignee='jdoe')
+        metrics = replicator.run()
+        self.assertEqual((metrics['changes'], metrics['unchanged']), (1, 1))
+        self.assertEqual(self.target.calls, [])
+
+    def test_replicating_back_doesnt_loop(self):
+        forward = self.replicator()
+        backward = self.replicator(self.target, self.source, REVERSE)
+        forward.run()
+
+        # The tickets replication created read back as they were written.
+        self.source.calls = []
+        metrics = backward.run()
+        self.assertEqual((metrics['changes'], metrics['unchanged']), (2, 2))
+        self.assertEqual(self.source.calls, [])
+
+        # A change on the target goes back to the linked source ticket, and no further.
+        target_id = self.id_map.get('source KEY', 'S-2', 'target KEY')
+        self.target.write(target_id, summary='Slow login on sso')
+        metrics = backward.run()
+        self.assertEqual(metrics['updated'], 1)
+        self.assertEqual(self.source.calls, [('edit', 'S-2', {'summary': 'Slow login on sso'})])
+        self.target.calls = []
+        metrics = forward.run()
+        self.assertEqual((metrics['changes'], metrics['unchanged']), (1, 1))
+        self.assertEqual(self.target.calls, [])
+
+    def test_failures_are_retried(self):
+        replicator = self.replicator(workers=1)
+        self.target.fail = True
+        metrics = replicator.run()
+        self.assertEqual(metrics['failed'], 2)
+        self.assertEqual(metrics['errors'], ['Service unavailable'] * 2)
+        self.assertEqual(self.id_map.pending('source KEY'), ['S-1', 'S-2'])
+
+        self.target.fail = False
+        metrics = replicator.run()
+        self.assertEqual(metrics['created'], 2)
+        self.assertEqual(self.id_map.pending('source KEY'), [])
+
+    def test_read_field(self):
+        issue = {'key': 'PROJ-1', 'fields': {'priority': {'name': 'Major', 'id': '3'},
+                                             'components': [{'name': 'web'}], 'summary': 'Disk full'}}
+        self.assertEqual(replication.read_field(issue, 'priority'), 'Major')
+        self.assertEqual(replication.read_field(issue, 'components'), ['web'])
+        self.assertEqual(replication.read_field(issue, 'summary'), 'Disk full')
+        record = {'assigned_to': {'link': 'https://sn/api/sys_user/1', 'value': '1'}, 'state': '2'}
+        self.assertEqual(replication.read_field(record, 'assigned_to'), '1')
+        self.assertIsNone(replication.read_field(record, 'missing'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+import base64
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import main, TestCase
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import metrics
+from ticketutil.bugzilla import BugzillaTicket
+from ticketutil.jira import JiraTicket
+from ticketutil.redmine import RedmineTicket
+from ticketutil.rt import RTTicket
+from ticketutil.servicenow import ServiceNowTicket
+
+logging.disable(logging.CRITICAL)
+
+# Public methods that never make a request, so they have no budget.
+NO_REQUESTS = {'close_requests_session', 'get_ticket_id', 'get_ticket_url', 'set_attachment_dedup',
+               'set_duplicate_index', 'set_idempotency_index', 'set_lane', 'set_mirror', 'set_profiler'}
+
+RT_OK = 'RT/4.4.0 200 Ok\n\n'
+RT_TICKET = RT_OK + 'id: ticket/1\nQueue: General\nSubject: Disk full\nStatus: open\nPriority: 3\n' \
+                    'LastUpdated: Thu Oct 01 10:00:00 2026\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers requests from the server's routes, a list of (HTTP method, path regex, response) tuples.
+    Dicts and lists are sent as JSON, strings as text and None as an empty 204. A callable response is
+    called with the path match and the query parameters.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlsplit(self.path)
+        for method, pattern, response in self.server.routes:
+            match = re.match(pattern + '$', url.path)
+            if method == self.command and match:
+                break
+        else:
+            return self._send(404, json.dumps({'errorMessages': ['Not found'], 'errors': {'': 'Not found'}}))
+
+        if callable(response):
+            response = response(match, parse_qs(url.query))
+        if response is None:
+            return self._send(204, '')
+        if not isinstance(response, str):
+            response = json.dumps(response)
+        self._send(200, response)
+
+    def _send(self, status, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RoundTrips(object):
+    """Runs every public method of a backend against a fake server, failing when a call makes more
+    requests than its budget. Calls run in order on one ticket, so metadata cached by an earlier call
+    is free for later ones.
+    """
+    ticket_class = None
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.server.routes = self.routes()
+
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.file_name = os.path.join(self.work_dir, 'log.txt')
+        with open(self.file_name, 'w') as f:
+            f.write('log\n')
+
+    def routes(self):
+        raise NotImplementedError
+
+    def budgets(self):
+        """
+        :return: List of (method name, budget, call) tuples. call takes the ticket.
+        """
+        raise NotImplementedError
+
+    def test_constructor(self):
+        with metrics.RequestCounter() as counter:
+            ticket = self.ticket_class(self.url, self.project, auth=('user', 'pass'), ticket_id=self.ticket_id)
+        self.addCleanup(ticket.close_requests_session)
+        # Authenticating, verifying the project and verifying the ticket.
+        self.assertLessEqual(counter.total, 3, counter.report())
+
+    def test_budgets(self):
+        ticket = self.ticket_class(self.url, self.project, auth=('user', 'pass'), ticket_id=self.ticket_id)
+        self.addCleanup(ticket.close_requests_session)
+        for name, budget, call in self.budgets():
+            with self.subTest(name):
+                with metrics.RequestCounter() as counter:
+                    result = call(ticket)
+                self.assertEqual(getattr(result, 'status', 'Success'), 'Success', result)
+                self.assertLessEqual(counter.total, budget, counter.report())
+
+    def test_every_public_method_has_a_budget(self):
+        public = set(name for name in dir(self.ticket_class)
+                     if not name.startswith('_') and callable(getattr(self.ticket_class, name)))
+        budgeted = set(name for name, budget, call in self.budgets())
+        self.assertEqual(sorted(public - NO_REQUESTS - budgeted), [])
+
+    def download_dir(self):
+        return tempfile.mkdtemp(dir=self.work_dir)
+
+    def download_path(self):
+        return os.path.join(self.download_dir(), 'log.txt')
+
+
+def _unit_of_work(ticket, status, **fields):
+    with ticket.unit_of_work() as work:
+        work.edit(**fields)
+        work.add_comment('Done')
+        work.change_status(status)
+    return work.result
+
+
+class TestJiraRoundTrips(RoundTrips, TestCase):
+    """JIRA round trip budgets
+    """
+    ticket_class = JiraTicket
+    project = 'PROJ'
+    ticket_id = 'PROJ-1'
+
+    def routes(self):
+        issue = {'key': 'PROJ-1',
+                 'fields': {'summary': 'Disk full',
+                            'priority': {'name': 'Major'},
+                            'status': {'name': 'Open'},
+                            'updated': '2026-10-01T10:00:00.000+0000',
+                            'attachment': [{'id': '10', 'filename': 'log.txt',
+                                            'content': self.url + '/files/10'}]}}
+        issue_path = '/rest/api/2/issue/PROJ-\\d+'
+        return [('GET', '/', 'ok'),
+                ('GET', '/rest/api/2/project/PROJ', {'key': 'PROJ'}),
+                ('GET', issue_path, issue),
+                ('PUT', issue_path, None),
+                ('POST', '/rest/api/2/issue', {'key': 'PROJ-2'}),
+                ('POST', issue_path + '/comment', {'id': '100'}),
+                ('GET', issue_path + '/transitions', {'transitions': [{'id': '5', 'to': {'name': 'Done'}}]}),
+                ('POST', issue_path + '/transitions', None),
+                ('GET', issue_path + '/watchers', {'watchers': [{'name': 'alice'}, {'name': 'bob'}]}),
+                ('POST', issue_path + '/watchers', None),
+                ('DELETE', issue_path + '/watchers', None),
+                ('POST', issue_path + '/attachments', [{'id': '11'}]),
+                ('GET', '/rest/api/2/search', {'issues': [issue], 'total': 1}),
+                ('GET', '/files/10', 'log\n')]
+
+    def budgets(self):
+        attachment = {'id': '10', 'file_name': 'log.txt', 'url': self.url + '/files/10'}
+        return [('set_ticket_id', 1, lambda t: t.set_ticket_id('PROJ-1')),
+                ('get_ticket_content', 1, lambda t: t.get_ticket_content()),
+                ('get_ticket_history', 1, lambda t: t.get_ticket_history()),
+                ('edit', 1, lambda t: t.edit(priority='Critical')),
+                ('edit', 2, lambda t: t.edit(diff='fetch', priority='Critical')),
+                ('add_comment', 1, lambda t: t.add_comment('Looking')),
+                ('change_status', 2, lambda t: t.change_status('Done')),
+                ('add_watcher', 1, lambda t: t.add_watcher('carol')),
+                ('remove_watcher', 1, lambda t: t.remove_watcher('bob')),
+                # One request listing the watchers and one per watcher.
+                ('remove_all_watchers', 3, lambda t: t.remove_all_watchers()),
+                ('add_attachment', 1, lambda t: t.add_attachment(self.file_name)),
+                ('get_attachments', 1, lambda t: t.get_attachments()),
+                ('get_attachment', 1, lambda t: t.get_attachment(attachment, self.download_path())),
+                ('download_attachments', 2, lambda t: t.download_attachments(self.download_dir())),
+                ('search', 1, lambda t: list(t.search())),
+                # edit() and add_comment() are one PUT, the transition needs its own two requests.
+                ('unit_of_work', 3, lambda t: _unit_of_work(t, 'Done', priority='Critical')),
+                ('create', 1, lambda t: t.create('Disk full', 'The disk is full'))]
+
+
+class TestRedmineRoundTrips(RoundTrips, TestCase):
+    """Redmine round trip budgets
+    """
+    ticket_class = RedmineTicket
+    project = 'proj'
+    ticket_id = 1
+
+    def routes(self):
+        issue = {'id': 1,
+                 'project': {'id': 7, 'name': 'proj'},
+                 'subject': 'Disk full',
+                 'status': {'id': 1, 'name': 'New'},
+                 'updated_on': '2026-10-01T10:00:00Z',
+                 'attachments': [{'id': 10, 'filename': 'log.txt', 'content_url': self.url + '/files/10'}]}
+        return [('GET', '/login', 'ok'),
+                ('GET', '/projects/proj.json', {'project': {'id': 7, 'name': 'proj'}}),
+                ('GET', '/issues/\\d+.json', {'issue': issue}),
+                ('PUT', '/issues/\\d+.json', None),
+                ('POST', '/issues.json', {'issue': {'id': 2}}),
+                ('GET', '/issues.json', {'issues': [issue], 'total_count': 1}),
+                ('GET', '/issue_statuses.json', {'issue_statuses': [{'id': 5, 'name': 'Closed'}]}),
+                ('GET', '/enumerations/issue_priorities.json', {'issue_priorities': [{'id': 3, 'name': 'High'}]}),
+                ('GET', '/users.json', {'users': [{'id': 4, 'login': 'alice'}]}),
+                ('POST', '/issues/\\d+/watchers.json', None),
+                ('DELETE', '/issues/\\d+/watchers/\\d+.json', None),
+                ('POST', '/uploads.json', {'upload': {'token': 'abc'}}),
+                ('GET', '/files/10', 'log\n')]
+
+    def budgets(self):
+        attachment = {'id': 10, 'file_name': 'log.txt', 'url': self.url + '/files/10'}
+        # The project id is known from verifying the project, the priority and user ids are looked up once.
+        return [('create', 3, lambda t: t.create('Disk full', 'The disk is full', priority='High', assignee='alice')),
+                ('create', 1, lambda t: t.create('Disk full', 'The disk is full', priority='High', assignee='alice')),
+                ('set_ticket_id', 1, lambda t: t.set_ticket_id(1)),
+                ('get_ticket_content', 1, lambda t: t.get_ticket_content()),
+                ('edit', 1, lambda t: t.edit(done_ratio=50)),
+                ('edit', 2, lambda t: t.edit(diff='fetch', subject='Disk still full')),
+                ('add_comment', 1, lambda t: t.add_comment('Looking')),
+                ('change_status', 2, lambda t: t.change_status('Closed')),
+                ('change_status', 1, lambda t: t.change_status('Closed')),
+                # The statuses are known from changing the status.
+                ('get_ticket_history', 1, lambda t: t.get_ticket_history()),
+                ('add_watcher', 1, lambda t: t.add_watcher('alice')),
+                ('remove_watcher', 1, lambda t: t.remove_watcher('alice')),
+                # Uploading the file and adding it to the issue.
+                ('add_attachment', 2, lambda t: t.add_attachment(self.file_name)),
+                ('get_attachments', 1, lambda t: t.get_attachments()),
+                ('get_attachment', 1, lambda t: t.get_attachment(attachment, self.download_path())),
+                ('download_attachments', 2, lambda t: t.download_attachments(self.download_dir())),
+                ('search', 1, lambda t: list(t.search())),
+                ('unit_of_work', 1, lambda t: _unit_of_work(t, 'Closed', priority='High'))]
+
+
+class TestBugzillaRoundTrips(RoundTrips, TestCase):
+    """Bugzilla round trip budgets
+    """
+    ticket_class = BugzillaTicket
+    project = 'Proj'
+    ticket_id = 1
+
+    def routes(self):
+        bug = {'id': 1, 'product': 'Proj', 'summary': 'Disk full', 'priority': 'P3', 'status': 'NEW',
+               'last_change_time': '2026-10-01T10:00:00Z'}
+        data = base64.standard_b64encode(b'log\n').decode()
+        return [('GET', '/rest/login', {'token': 'x'}),
+                ('GET', '/rest/product/Proj', {'products': [{'name': 'Proj'}]}),
+                ('GET', '/rest/bug/\\d+', {'bugs': [bug]}),
+                ('PUT', '/rest/bug/\\d+', {'bugs': [{'id': 1, 'changes': {'priority': {}}}]}),
+                ('POST', '/rest/bug', {'id': 2}),
+                ('GET', '/rest/bug', {'bugs': [bug]}),
+                ('POST', '/rest/bug/\\d+/comment', {'id': 100}),
+                ('GET', '/rest/bug/\\d+/history', {'bugs': [{'id': 1, 'history': []}]}),
+                ('GET', '/rest/bug/(\\d+)/comment', lambda match, query: {'bugs': {match.group(1): {'comments': []}}}),
+                ('POST', '/rest/bug/\\d+/attachment', {'ids': [11]}),
+                ('GET', '/rest/bug/(\\d+)/attachment',
+                 lambda match, query: {'bugs': {match.group(1): [{'id': 10, 'file_name': 'log.txt',
+                                                                  'content_type': 'text/plain'}]}}),
+                ('GET', '/rest/bug/attachment/10', {'attachments': {'10': {'data': data}}})]
+
+    def budgets(self):
+        attachment = {'id': 10, 'file_name': 'log.txt', 'url': self.url + '/rest/bug/attachment/10'}
+        return [('set_ticket_id', 1, lambda t: t.set_ticket_id(1)),
+                ('get_ticket_content', 1, lambda t: t.get_ticket_content()),
+                # The bug, its history and its comments.
+                ('get_ticket_history', 3, lambda t: t.get_ticket_history()),
+                ('edit', 1, lambda t: t.edit(priority='P1')),
+                ('edit', 2, lambda t: t.edit(diff='fetch', priority='P1')),
+                ('add_comment', 1, lambda t: t.add_comment('Looking')),
+                ('change_status', 1, lambda t: t.change_status('ASSIGNED')),
+                ('add_cc', 1, lambda t: t.add_cc('alice@example.com')),
+                ('remove_cc', 1, lambda t: t.remove_cc('alice@example.com')),
+                ('add_attachment', 1, lambda t: t.add_attachment('log.txt', self.file_name, 'Build log')),
+                ('get_attachments', 1, lambda t: t.get_attachments()),
+                ('get_attachment', 1, lambda t: t.get_attachment(attachment, self.download_path())),
+                ('download_attachments', 2, lambda t: t.download_attachments(self.download_dir())),
+                ('search', 1, lambda t: list(t.search())),
+                ('unit_of_work', 1, lambda t: _unit_of_work(t, 'RESOLVED', priority='P1')),
+                ('create', 1, lambda t: t.create('Disk full', 'The disk is full', component='Core', version='1.0'))]
+
+
+class TestRTRoundTrips(RoundTrips, TestCase):
+    """RT round trip budgets
+    """
+    ticket_class = RTTicket
+    project = 'General'
+    ticket_id = '1'
+
+    def routes(self):
+        def search(match, query):
+            if query['format'] == ['i']:
+                return RT_OK + 'ticket/1\n'
+            return RT_TICKET
+
+        return [('GET', '/REST/1.0/index.html', RT_OK),
+                ('GET', '/REST/1.0/queue/General', RT_OK + 'id: queue/1\nName: General\n'),
+                ('GET', '/REST/1.0/ticket/\\d+/show', RT_TICKET),
+                ('GET', '/REST/1.0/ticket/\\d+/history',
+                 RT_OK + 'id: 40\nType: Create\nCreated: 2026-10-01 10:00:00\n'),
+                ('POST', '/REST/1.0/ticket/new', RT_OK + '# Ticket 2 created.\n'),
+                ('POST', '/REST/1.0/ticket/\\d+/edit', RT_OK + '# Ticket 1 updated.\n'),
+                ('POST', '/REST/1.0/ticket/\\d+/comment', RT_OK + '# Message recorded\n'),
+                ('GET', '/REST/1.0/ticket/\\d+/attachments',
+                 RT_OK + 'id: ticket/1/attachments\nAttachments: 10: log.txt (text/plain / 4b),\n'),
+                ('GET', '/REST/1.0/ticket/\\d+/attachments/10/content', RT_OK + 'log\n\n\n\n'),
+                ('GET', '/REST/1.0/search/ticket', search)]
+
+    def budgets(self):
+        attachment = {'id': '10', 'file_name': 'log.txt',
+                      'url': self.url + '/REST/1.0/ticket/1/attachments/10/content'}
+        return [('set_ticket_id', 1, lambda t: t.set_ticket_id('1')),
+                ('get_ticket_content', 1, lambda t: t.get_ticket_content()),
+                # The ticket and its history.
+                ('get_ticket_history', 2, lambda t: t.get_ticket_history()),
+                ('edit', 1, lambda t: t.edit(priority='5')),
+                ('edit', 2, lambda t: t.edit(diff='fetch', priority='5')),
+                ('add_comment', 1, lambda t: t.add_comment('Looking')),
+                ('change_status', 1, lambda t: t.change_status('Resolved')),
+                ('add_attachment', 1, lambda t: t.add_attachment(self.file_name)),
+                ('get_attachments', 1, lambda t: t.get_attachments()),
+                ('get_attachment', 1, lambda t: t.get_attachment(attachment, self.download_path())),
+                ('download_attachments', 2, lambda t: t.download_attachments(self.download_dir())),
+                # RT can't page searches, so the ids are fetched first and then the tickets.
+                ('search', 2, lambda t: list(t.search())),
+                # Comments have their own endpoint, so the comment between them keeps edit() and
+                # change_status() from being merged.
+                ('unit_of_work', 3, lambda t: _unit_of_work(t, 'Resolved', priority='5')),
+                ('create', 1, lambda t: t.create('Disk full', 'The disk is full'))]
+
+
+class TestServiceNowRoundTrips(RoundTrips, TestCase):
+    """ServiceNow round trip budgets
+    """
+    ticket_class = ServiceNowTicket
+    project = 'incident'
+    ticket_id = 'INC001'
+
+    def routes(self):
+        record = {'number': 'INC001', 'sys_id': 's1', 'state': '1', 'priority': '3',
+                  'short_description': 'Disk full', 'watch_list': 'alice@example.com',
+                  'sys_updated_on': '2026-10-01 10:00:00'}
+        created = dict(record, number='INC002', sys_id='s2')
+        table = '/api/now/v1/table/incident'
+        return [('GET', table, {'result': [record]}),
+                ('POST', table, {'result': created}),
+                ('PUT', table + '/s1', {'result': record}),
+                ('GET', '/api/now/table/sys_choice', {'result': [{'label': 'New', 'value': '1'},
+                                                                 {'label': 'Closed', 'value': '7'}]}),
+                ('GET', '/api/now/table/sys_audit', {'result': []}),
+                ('GET', '/api/now/table/sys_journal_field', {'result': []}),
+                ('GET', '/api/now/attachment', {'result': [{'sys_id': 'a1', 'file_name': 'log.txt',
+                                                            'content_type': 'text/plain',
+                                                            'download_link': self.url + '/files/10'}]}),
+                ('GET', '/files/10', 'log\n')]
+
+    def budgets(self):
+        attachment = {'id': 'a1', 'file_name': 'log.txt', 'url': self.url + '/files/10'}
+        return [('set_ticket_id', 1, lambda t: t.set_ticket_id('INC001')),
+                ('get_ticket_content', 1, lambda t: t.get_ticket_content()),
+                # The record, the audit of its state and its comments.
+                ('get_ticket_history', 3, lambda t: t.get_ticket_history()),
+                ('edit', 1, lambda t: t.edit(priority='2')),
+                ('edit', 2, lambda t: t.edit(diff='fetch', priority='2')),
+                # The record returned by the last change is compared.
+                ('edit', 1, lambda t: t.edit(diff='cache', priority='2')),
+                ('add_comment', 1, lambda t: t.add_comment('Looking')),
+                ('change_status', 1, lambda t: t.change_status('Closed')),
+                ('add_cc', 1, lambda t: t.add_cc('bob@example.com')),
+                ('rewrite_cc', 1, lambda t: t.rewrite_cc('bob@example.com')),
+                ('remove_cc', 1, lambda t: t.remove_cc('alice@example.com')),
+                ('get_attachments', 1, lambda t: t.get_attachments()),
+                ('get_attachment', 1, lambda t: t.get_attachment(attachment, self.download_path())),
+                ('download_attachments', 2, lambda t: t.download_attachments(self.download_dir())),
+                ('search', 1, lambda t: list(t.search())),
+                ('unit_of_work', 1, lambda t: _unit_of_work(t, 'Closed', priority='2')),
+                # The created record is in the response, so it isn't fetched again for the ticket URL.
+                ('create', 1, lambda t: t.create('Disk full', 'The disk is full', 'Hardware', 'Disk'))]
+
+
+if __name__ == '__main__':
+    main()
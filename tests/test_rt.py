@@ -0,0 +1,36 @@
+import logging
+import os
+import sys
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import rt
+
+logging.disable(logging.CRITICAL)
+
+SHOW_RESPONSE = u"""RT/4.4.1 200 Ok
+
+id: ticket/12
+Queue: General
+Subject: Disk full on host1
+Status: open
+CF.{Notes}: first line
+            second line
+"""
+
+
+class TestRTParsing(TestCase):
+    """RT response parsing unit tests
+    """
+
+    def test_parse_ticket_content(self):
+        ticket_content = rt._parse_ticket_content(SHOW_RESPONSE)
+        self.assertEqual(ticket_content['id'], 'ticket/12')
+        self.assertEqual(ticket_content['Subject'], 'Disk full on host1')
+        self.assertEqual(ticket_content['CF.{Notes}'], 'first line\nsecond line')
+        self.assertNotIn('RT/4.4.1 200 Ok', ticket_content)
+
+
+if __name__ == '__main__':
+    main()
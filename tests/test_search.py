@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import sys
+import threading
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import jira, rt, ticket
+
+from fakes import PagingTicket
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeResponse(object):
+
+    def __init__(self, json_data=None, text=''):
+        self.status_code = 200
+        self.json_data = json_data
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.json_data
+
+    def iter_content(self, chunk_size):
+        body = json.dumps(self.json_data).encode('utf-8')
+        return (body[i:i + 10] for i in range(0, len(body), 10))
+
+    def close(self):
+        pass
+
+
+class FakeJiraSession(object):
+    """Answers JIRA searches from a list of issues
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.requests = []
+
+    def get(self, url, params=None, stream=False):
+        self.requests.append(dict(params))
+        start, size = params['startAt'], params['maxResults']
+        issues = [{'key': 'KEY-{0}'.format(number)} for number in range(start, min(start + size, self.total))]
+        return FakeResponse({'issues': issues, 'total': self.total})
+
+
+class FakeRTSession(object):
+    """Answers RT searches for two tickets
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append(dict(params))
+        if params['format'] == 'i':
+            return FakeResponse(text=u'RT/4.4.1 200 Ok\n\nticket/3\nticket/7\n')
+        return FakeResponse(text=u'RT/4.4.1 200 Ok\n\nid: ticket/3\nSubject: one\n\n--\n\nid: ticket/7\nSubject: two\n')
+
+
+class TestSearch(TestCase):
+    """Ticket.search() unit tests
+    """
+
+    def test_yields_every_ticket_in_order(self):
+        fake = PagingTicket(pages=5)
+        ids = [item['id'] for item in fake.search(page_size=3)]
+        self.assertEqual(ids, list(range(15)))
+
+    def test_prefetch_is_bounded(self):
+        fake = PagingTicket(pages=50)
+        results = fake.search(page_size=2, prefetch=2)
+        next(results)
+        threading.Event().wait(0.2)
+        # The consumed page, the full queue and the page waiting to be queued.
+        self.assertLessEqual(fake.fetched, 4)
+        results.close()
+        self.assertTrue(fake.finished.wait(2))
+
+    def test_error_is_raised(self):
+        fake = PagingTicket(pages=5, fail_at=2)
+        results = fake.search(page_size=1)
+        self.assertEqual([next(results)['id'], next(results)['id']], [0, 1])
+        self.assertRaises(ticket.TicketException, next, results)
+
+    def test_jira_pages(self):
+        t = jira.JiraTicket.__new__(jira.JiraTicket)
+        t.url, t.project, t.s, t.mirror = 'jira', 'KEY', FakeJiraSession(total=5), None
+        keys = [issue['key'] for issue in t.search('status = Open ORDER BY created', fields=['status'], page_size=2)]
+        self.assertEqual(keys, ['KEY-{0}'.format(number) for number in range(5)])
+        self.assertEqual([params['startAt'] for params in t.s.requests], [0, 2, 4])
+        self.assertEqual(t.s.requests[0]['jql'], 'project = "KEY" AND (status = Open) ORDER BY created')
+        self.assertEqual(t.s.requests[0]['fields'], 'status')
+
+    def test_jira_stream(self):
+        t = jira.JiraTicket.__new__(jira.JiraTicket)
+        t.url, t.project, t.s, t.mirror = 'jira', 'KEY', FakeJiraSession(total=5), None
+        keys = [issue['key'] for issue in t.search(page_size=2, stream=True)]
+        self.assertEqual(keys, ['KEY-{0}'.format(number) for number in range(5)])
+        self.assertEqual([params['startAt'] for params in t.s.requests], [0, 2, 4])
+
+    def test_stream_falls_back_to_pages(self):
+        fake = PagingTicket(pages=3)
+        self.assertEqual([item['id'] for item in fake.search(page_size=2, stream=True)], list(range(6)))
+
+    def test_rt_pages(self):
+        t = rt.RTTicket.__new__(rt.RTTicket)
+        t.rest_url, t.project, t.s, t.mirror = 'rt/REST/1.0', 'General', FakeRTSession(), None
+        tickets = list(t.search("Status = 'open'", fields=['Subject']))
+        self.assertEqual([item['Subject'] for item in tickets], ['one', 'two'])
+        self.assertEqual(t.s.requests[0]['query'], "Queue = 'General' AND (Status = 'open')")
+        self.assertEqual(t.s.requests[1]['query'], 'id = 3 OR id = 7')
+
+
+if __name__ == '__main__':
+    main()
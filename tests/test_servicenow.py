@@ -114,6 +114,32 @@ class FakeSession(object):
         return FakeResponse(status_code=self.status_code)
 
 
+class CountingSession(FakeSession):
+    """Mocks Requests session behavior, recording PUT payloads
+    """
+
+    def __init__(self, status_code=666):
+        super(CountingSession, self).__init__(status_code)
+        self.puts = []
+
+    def put(self, url, data):
+        self.puts.append(data)
+        return super(CountingSession, self).put(url, data)
+
+
+class RecordingSession(FakeSession):
+    """Mocks Requests session behavior, recording GET urls
+    """
+
+    def __init__(self, status_code=666):
+        super(RecordingSession, self).__init__(status_code)
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        return super(RecordingSession, self).get(url)
+
+
 def mock_get_ticket_content(self, ticket_id=None):
     return MOCK_RETURN_SUCCESS
 
@@ -138,6 +164,14 @@ class TestServiceNowTicket(TestCase):
         t = ticket.get_ticket_content(ticket_id=TICKET_ID)
         self.assertDictEqual(t.ticket_content, MOCK_RESULT)
 
+    @patch.object(servicenow.ServiceNowTicket, '_create_requests_session')
+    @patch('servicenow.ServiceNowTicket._verify_project', mock_verify_project)
+    def test_get_ticket_content_fields(self, mock_session):
+        mock_session.return_value = RecordingSession()
+        ticket = servicenow.ServiceNowTicket(TEST_URL, TABLE)
+        ticket.get_ticket_content(ticket_id=TICKET_ID, fields=['number', 'state'])
+        self.assertTrue(ticket.s.urls[-1].endswith('&sysparm_fields=number,state'))
+
     @patch.object(servicenow.ServiceNowTicket, '_create_requests_session')
     @patch('servicenow.ServiceNowTicket._verify_project', mock_verify_project)
     def test_get_ticket_content_unexpected_response(self, mock_session):
@@ -208,6 +242,21 @@ class TestServiceNowTicket(TestCase):
         MOCK_RESULT.update({'priority': '2', 'impact': '2'})
         self.assertDictEqual(t.ticket_content, expected_result)
 
+    @patch.object(servicenow.ServiceNowTicket, '_create_requests_session')
+    @patch('servicenow.ServiceNowTicket._verify_project', mock_verify_project)
+    def test_edit_diff(self, mock_session):
+        mock_session.return_value = CountingSession()
+        ticket = servicenow.ServiceNowTicket(TEST_URL, TABLE,
+                                             ticket_id=TICKET_ID)
+        t = ticket.edit(diff='cache', category=CATEGORY, short_description=SHORT_DESCRIPTION)
+        self.assertEqual(t.status, 'Success')
+        self.assertEqual(ticket.sent_fields, [])
+        self.assertEqual(ticket.s.puts, [])
+
+        ticket.edit(diff='cache', category=CATEGORY, item='other item')
+        self.assertEqual(ticket.sent_fields, ['item'])
+        self.assertEqual(ticket.s.puts, ['{ "u_item" : "other item"}'])
+
     @patch.object(servicenow.ServiceNowTicket, '_create_requests_session')
     @patch('servicenow.ServiceNowTicket._verify_project', mock_verify_project)
     @patch('servicenow.ServiceNowTicket.get_ticket_content',
@@ -316,5 +365,45 @@ class TestServiceNowTicket(TestCase):
         t = ticket.remove_cc(['dranck@redhat.com', 'mail@redhat.com'])
         self.assertEqual(t.status, MOCK_RETURN_FAILURE.status)
 
+    @patch.object(servicenow.ServiceNowTicket, '_create_requests_session')
+    @patch('servicenow.ServiceNowTicket._verify_project', mock_verify_project)
+    @patch('servicenow.ServiceNowTicket.get_ticket_content',
+           mock_get_ticket_content)
+    def test_unit_of_work(self, mock_session):
+        session = CountingSession()
+        mock_session.return_value = session
+        ticket = servicenow.ServiceNowTicket(TEST_URL, TABLE,
+                                             ticket_id=TICKET_ID)
+        ticket.ticket_content = {'watch_list': 'pzubaty@redhat.com'}
+        ticket.available_states = MOCK_STATE
+        with ticket.unit_of_work() as work:
+            work.edit(priority='2')
+            work.change_status('Pending')
+            work.add_comment('First comment')
+            work.add_cc('dranck@redhat.com')
+            work.add_comment('Second comment')
+        self.assertEqual(work.result.status, 'Success')
+        self.assertEqual(len(session.puts), 2)
+        self.assertIn('"state" : "-6"', session.puts[0])
+        self.assertIn('"watch_list" : "pzubaty@redhat.com, dranck@redhat.com"', session.puts[0])
+        self.assertIn('"comments" : "Second comment"', session.puts[1])
+
+    @patch.object(servicenow.ServiceNowTicket, '_create_requests_session')
+    @patch('servicenow.ServiceNowTicket._verify_project', mock_verify_project)
+    @patch('servicenow.ServiceNowTicket.get_ticket_content',
+           mock_get_ticket_content)
+    def test_unit_of_work_unexpected_response(self, mock_session):
+        session = CountingSession(status_code=404)
+        mock_session.return_value = session
+        ticket = servicenow.ServiceNowTicket(TEST_URL, TABLE,
+                                             ticket_id=TICKET_ID)
+        ticket.available_states = MOCK_STATE
+        with ticket.unit_of_work() as work:
+            work.edit(priority='2')
+            work.add_comment('First comment')
+            work.add_comment('Second comment')
+        self.assertEqual(work.result.status, MOCK_RETURN_FAILURE.status)
+        self.assertEqual(len(session.puts), 1)
+
 if __name__ == '__main__':
     main()
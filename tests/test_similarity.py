@@ -0,0 +1,144 @@
+import logging
+import os
+import sys
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import similarity
+
+from fakes import LocalTicket
+
+logging.disable(logging.CRITICAL)
+
+ALERT = u"CPU load above 95% on host web-3.example.com at {0}\nLoad average was {1} for the last 5 minutes"
+
+
+class CommentingTicket(LocalTicket):
+    """Ticket recording the comments it adds
+    """
+
+    def __init__(self):
+        super(CommentingTicket, self).__init__()
+        self.comments = []
+
+    def add_comment(self, comment):
+        self.comments.append((self.ticket_id, comment))
+        return self.request_result
+
+
+class TestSimilarityIndex(TestCase):
+    """SimilarityIndex unit tests
+    """
+
+    def test_near_duplicates(self):
+        index = similarity.SimilarityIndex()
+        index.add('KEY-1', ALERT.format('2017-01-13 10:00', 97))
+        index.add('KEY-2', u"Disk /var is full on db-3\nFree space dropped below 1%")
+        matches = index.query(ALERT.format('2017-01-13 10:45', 99))
+        self.assertEqual([match[0] for match in matches], ['KEY-1'])
+        self.assertEqual(index.query(u"Certificate for login.example.com expires in 10 days"), [])
+
+    def test_identifiers_keep_digits(self):
+        index = similarity.SimilarityIndex()
+        index.add('KEY-1', u"Disk full on web-3")
+        self.assertEqual(index.query(u"Disk full on web-4"), [])
+        self.assertEqual(index.query(u"Disk full on web-3"), [('KEY-1', 1.0)])
+        self.assertEqual(index.query(ALERT.format(1, 1)), [])
+
+    def test_signature_is_stable(self):
+        self.assertEqual(similarity.SimilarityIndex().signature(u'some text'),
+                         similarity.SimilarityIndex().signature(u'some text'))
+
+    def test_replace_and_remove(self):
+        index = similarity.SimilarityIndex()
+        index.add('KEY-1', ALERT.format(1, 1))
+        index.add('KEY-1', u"Something else entirely")
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.query(ALERT.format(1, 1)), [])
+        index.remove('KEY-1')
+        self.assertNotIn('KEY-1', index)
+        self.assertEqual(index.query(u"Something else entirely"), [])
+
+    def test_max_entries(self):
+        index = similarity.SimilarityIndex(max_entries=10)
+        for number in range(25):
+            index.add(number, u"ticket number {0} about {1}".format(number, 'x' * number))
+        self.assertEqual(len(index), 10)
+        self.assertNotIn(0, index)
+        self.assertIn(24, index)
+        # Slots of evicted tickets are reused, and buckets only refer to tickets still in the index.
+        self.assertEqual(len(index._ids), 10)
+        slots = set(index._slots.values())
+        self.assertTrue(all(slot in slots for table in index._tables for slot in table.slots if slot >= 0))
+        self.assertEqual(index.query(u"ticket number 24 about {0}".format('x' * 24))[0][0], 24)
+
+    def test_many_tickets(self):
+        index = similarity.SimilarityIndex()
+        for number in range(2000):
+            index.add(number, u"ticket {0} about service-{0}".format(number))
+        for number in range(0, 2000, 2):
+            index.remove(number)
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(index.query(u"ticket 1 about service-1"), [(1, 1.0)])
+        self.assertEqual(index.query(u"ticket 2 about service-2"), [])
+        slots = set(index._slots.values())
+        for table in index._tables:
+            self.assertEqual(table.size, len([slot for slot in table.slots if slot >= 0]))
+            self.assertTrue(all(slot in slots for slot in table.slots if slot >= 0))
+            self.assertLessEqual(table.used * 3, len(table.slots) * 2)
+
+    def test_max_bucket_size(self):
+        index = similarity.SimilarityIndex(max_bucket_size=4)
+        for number in range(10):
+            index.add('KEY-{0}'.format(number), ALERT.format(number, number))
+        matches = index.query(ALERT.format(99, 99), limit=10)
+        self.assertEqual(sorted(match[0] for match in matches), ['KEY-6', 'KEY-7', 'KEY-8', 'KEY-9'])
+        index.remove('KEY-0')
+        self.assertEqual(len(index), 9)
+
+    def test_max_candidates(self):
+        index = similarity.SimilarityIndex(max_candidates=2)
+        for number in range(5):
+            index.add('KEY-{0}'.format(number), ALERT.format(number, number))
+        self.assertEqual(len(index.query(ALERT.format(99, 99), limit=10)), 2)
+
+    def test_invalid_bands(self):
+        self.assertRaises(ValueError, similarity.SimilarityIndex, num_perm=64, bands=10)
+
+
+class TestDuplicateCreate(TestCase):
+    """Ticket._create_ticket() duplicate detection unit tests
+    """
+
+    def test_comment_on_duplicate(self):
+        fake = CommentingTicket()
+        fake.set_duplicate_index(similarity.SimilarityIndex())
+        fake._create_ticket({'summary': 'one'}, u'CPU load above 95% on web-1', u'Load average was 97')
+        self.assertEqual(fake.ticket_id, 'KEY-1')
+        self.assertIsNone(fake.duplicate_of)
+
+        t = fake._create_ticket({'summary': 'two'}, u'CPU load above 98% on web-1', u'Load average was 99')
+        self.assertEqual(t.status, 'Success')
+        self.assertEqual(len(fake.requests), 1)
+        self.assertEqual(fake.duplicate_of, 'KEY-1')
+        self.assertEqual(fake.comments, [('KEY-1', u'CPU load above 98% on web-1\n\nLoad average was 99')])
+
+        fake._create_ticket({'summary': 'web-2'}, u'CPU load above 95% on web-2', u'Load average was 97')
+        self.assertEqual(len(fake.requests), 2)
+        self.assertIsNone(fake.duplicate_of)
+
+        fake._create_ticket({'summary': 'three'}, u'Disk /var is full on db-3', u'Free space below 1%')
+        self.assertEqual(len(fake.requests), 3)
+        self.assertIsNone(fake.duplicate_of)
+
+    def test_without_index(self):
+        fake = CommentingTicket()
+        fake._create_ticket({'summary': 'one'}, u'same', u'same')
+        fake._create_ticket({'summary': 'one'}, u'same', u'same')
+        self.assertEqual(len(fake.requests), 2)
+        self.assertEqual(fake.comments, [])
+
+
+if __name__ == '__main__':
+    main()
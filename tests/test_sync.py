@@ -0,0 +1,141 @@
+import datetime
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from unittest import main, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import jira, sync
+
+from fakes import LocalTicket
+
+logging.disable(logging.CRITICAL)
+
+START = datetime.datetime(2017, 1, 13, 10, 0, 0)
+
+
+class SyncedTicket(LocalTicket):
+    """Ticket searching a local list of tickets by update time
+    """
+    _sync_fields = ['updated']
+
+    def __init__(self):
+        super(SyncedTicket, self).__init__()
+        self.tickets = {}
+        self.queries = []
+
+    def update(self, ticket_id, minutes):
+        self.tickets[ticket_id] = START + datetime.timedelta(minutes=minutes)
+
+    def _search_pages(self, query, fields, page_size):
+        # Pages by offset, reading the tickets again for every page like a tool does.
+        self.queries.append((query, fields))
+        offset = 0
+        while True:
+            matches = [{'id': ticket_id, 'updated': updated}
+                       for ticket_id, updated in sorted(self.tickets.items(), key=lambda item: (item[1], item[0]))
+                       if query is None or updated >= query]
+            page = matches[offset:offset + page_size]
+            if not page:
+                return
+            yield page
+            offset += len(page)
+
+    def _updated_since_query(self, since):
+        return since
+
+    def _ticket_updated(self, item):
+        return item['id'], item['updated']
+
+
+class TestSyncEngine(TestCase):
+    """SyncEngine unit tests
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'sync.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _ids(self, engine, fake):
+        return [change.ticket_id for change in engine.sync(fake)]
+
+    def test_only_changes_are_pulled(self):
+        engine = sync.SyncEngine(self.path, overlap=300)
+        fake = SyncedTicket()
+        for number in range(3):
+            fake.update(number, number)
+        self.assertEqual(self._ids(engine, fake), [0, 1, 2])
+        self.assertEqual(engine.get_watermark(fake), START + datetime.timedelta(minutes=2))
+
+        # The overlap searches the same tickets again, but they are skipped.
+        self.assertEqual(self._ids(engine, fake), [])
+        self.assertEqual(fake.queries[-1][0], START - datetime.timedelta(minutes=3))
+
+        fake.update(1, 10)
+        fake.update(3, 1)  # Indexed late, with a time inside the overlap.
+        self.assertEqual(self._ids(engine, fake), [3, 1])
+
+    def test_state_is_persisted(self):
+        fake = SyncedTicket()
+        fake.update('a', 0)
+        self.assertEqual(self._ids(sync.SyncEngine(self.path), fake), ['a'])
+        engine = sync.SyncEngine(self.path)
+        self.assertEqual(engine.get_watermark(fake), START)
+        self.assertEqual(self._ids(engine, fake), [])
+        engine.reset(fake)
+        self.assertEqual(self._ids(engine, fake), ['a'])
+
+    def test_interrupted_sync(self):
+        engine = sync.SyncEngine(self.path)
+        fake = SyncedTicket()
+        for number in range(4):
+            fake.update(number, number)
+        changes = engine.sync(fake)
+        self.assertEqual([next(changes).ticket_id, next(changes).ticket_id], [0, 1])
+        changes.close()
+        self.assertIsNone(engine.get_watermark(fake))
+        self.assertEqual(self._ids(sync.SyncEngine(self.path), fake), [2, 3])
+
+    def test_ticket_updated_during_sync(self):
+        engine = sync.SyncEngine(self.path)
+        fake = SyncedTicket()
+        for number in range(6):
+            fake.update(number, number)
+        ids = []
+        for change in engine.sync(fake, page_size=2):
+            ids.append(change.ticket_id)
+            if change.ticket_id == 0:
+                # Moves ticket 0 to the end; by offset, ticket 2 would shift into the page already read.
+                fake.update(0, 10)
+        self.assertEqual(ids, [0, 1, 2, 3, 4, 5, 0])
+        self.assertEqual(engine.get_watermark(fake), START + datetime.timedelta(minutes=10))
+
+    def test_same_update_time_pages_by_offset(self):
+        fake = SyncedTicket()
+        for number in range(5):
+            fake.update(number, 0)
+        self.assertEqual([change.ticket_id for change in sync.SyncEngine().sync(fake, page_size=2)],
+                         [0, 1, 2, 3, 4])
+        # Only the first full page moves the query off None; the others share an update time.
+        self.assertEqual([query for query, fields in fake.queries], [None, START])
+
+    def test_sync_fields_are_added(self):
+        fake = SyncedTicket()
+        list(sync.SyncEngine().sync(fake, fields=['summary']))
+        self.assertEqual(fake.queries[0][1], ['summary', 'updated'])
+
+    def test_jira(self):
+        t = jira.JiraTicket.__new__(jira.JiraTicket)
+        self.assertEqual(t._updated_since_query(START), 'updated >= "2017/01/13 10:00" ORDER BY updated ASC')
+        issue = {'key': 'KEY-1', 'fields': {'updated': '2017-01-13T10:00:00.000+0100'}}
+        self.assertEqual(t._ticket_updated(issue), ('KEY-1', START))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import main, skipIf, skipUnless, TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import ticket, tracing, transport
+
+try:
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+except ImportError:
+    TracerProvider = None
+
+logging.disable(logging.CRITICAL)
+
+RESULT = namedtuple('Result', ['status', 'error_message', 'url', 'ticket_content'])
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers every request with a small JSON body, echoing the traceparent header
+    """
+    protocol_version = 'HTTP/1.1'
+    traceparents = []
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.traceparents.append(self.headers.get('traceparent'))
+        body = json.dumps({'id': '1'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTicket(ticket.Ticket):
+    """Makes requests the way the backends do
+    """
+
+    def create(self, summary):
+        self._get_status_id()
+        self.s.post('{0}/issue'.format(self.url), json={'summary': summary})
+        self.ticket_id = 'KEY-1'
+        return self.request_result
+
+    def change_status(self, status):
+        return self.request_result._replace(status='Failure', error_message='Status not valid')
+
+    def _get_status_id(self):
+        return self.s.get('{0}/status'.format(self.url))
+
+    def _search_pages(self, query, fields, page_size):
+        for page in range(2):
+            self.s.get('{0}/search'.format(self.url), params={'page': page})
+            yield [{'key': 'KEY-{0}'.format(page)}]
+
+    def _list_attachments(self, ticket_id):
+        return [{'id': str(index), 'file_name': 'log{0}.txt'.format(index), 'size': None, 'digest': None,
+                 'url': '{0}/files/{1}'.format(self.url, index)} for index in range(2)]
+
+
+def ticket_object(url):
+    t = FakeTicket.__new__(FakeTicket)
+    t.ticketing_tool = 'JIRA'
+    t.url = url
+    t.ticket_id = None
+    t.mirror = None
+    t.s = transport.Session()
+    t.request_result = RESULT('Success', None, None, None)
+    return t
+
+
+class TestTracing(TestCase):
+    """Tracing unit tests
+    """
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.ticket = ticket_object('http://127.0.0.1:{0}'.format(self.server.server_port))
+        self.addCleanup(self.ticket.s.close)
+        del Handler.traceparents[:]
+
+    @skipIf(tracing.trace is not None, "OpenTelemetry is installed")
+    def test_noop_without_opentelemetry(self):
+        create = FakeTicket.create
+        self.assertFalse(tracing.instrument())
+        self.assertIs(FakeTicket.create, create)
+        self.assertEqual(self.ticket.create('Disk full').status, 'Success')
+
+    @skipUnless(TracerProvider, "OpenTelemetry SDK is not installed")
+    def test_spans(self):
+        exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+        self.assertTrue(tracing.instrument(provider))
+        self.addCleanup(tracing.uninstrument)
+
+        with provider.get_tracer('caller').start_as_current_span('handle request') as caller:
+            self.ticket.create('Disk full')
+        self.ticket.change_status('Done')
+
+        spans = dict((span.name, span) for span in exporter.get_finished_spans())
+        self.assertEqual(sorted(spans), ['FakeTicket.change_status', 'FakeTicket.create', 'GET _get_status_id',
+                                         'POST create', 'handle request'])
+        create = spans['FakeTicket.create']
+        self.assertEqual(create.parent.span_id, caller.get_span_context().span_id)
+        self.assertEqual((create.attributes['ticketutil.backend'], create.attributes['ticketutil.ticket_id'],
+                          create.attributes['ticketutil.status']), ('JIRA', 'KEY-1', 'Success'))
+        lookup = spans['GET _get_status_id']
+        self.assertEqual(lookup.parent.span_id, create.context.span_id)
+        self.assertEqual(lookup.attributes['http.response.status_code'], 200)
+        self.assertEqual(lookup.attributes['ticketutil.operation'], 'create')
+        self.assertFalse(spans['FakeTicket.change_status'].status.is_ok)
+
+        # The trace context reaches the server.
+        trace_id = '{0:032x}'.format(caller.get_span_context().trace_id)
+        self.assertTrue(all(trace_id in header for header in Handler.traceparents))
+
+        tracing.uninstrument()
+        self.assertFalse(hasattr(FakeTicket.create, '__wrapped__'))
+
+    @skipUnless(TracerProvider, "OpenTelemetry SDK is not installed")
+    def test_worker_thread_spans(self):
+        exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+        tracing.instrument(provider)
+        self.addCleanup(tracing.uninstrument)
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+
+        results = self.ticket.search()
+        self.assertEqual([item['key'] for item in results], ['KEY-0', 'KEY-1'])
+        # The test server answers one connection at a time, so downloads run one at a time.
+        self.assertEqual(self.ticket.download_attachments(work_dir, ticket_id='KEY-1', concurrency=1).status,
+                         'Success')
+
+        spans = exporter.get_finished_spans()
+        search = [span for span in spans if span.name == 'FakeTicket.search'][0]
+        # Pages are fetched by the prefetch thread, inside the search span, which ends once the results
+        # are consumed.
+        pages = [span for span in spans if span.name == 'GET _search_pages']
+        self.assertEqual(len(pages), 2)
+        self.assertTrue(all(span.parent.span_id == search.context.span_id for span in pages))
+        self.assertGreaterEqual(search.end_time, max(span.end_time for span in pages))
+
+        download = [span for span in spans if span.name == 'FakeTicket.download_attachments'][0]
+        attachments = [span for span in spans if span.name == 'FakeTicket.get_attachment']
+        self.assertEqual(len(attachments), 2)
+        self.assertTrue(all(span.parent.span_id == download.context.span_id for span in attachments))
+        requests = [span for span in spans if span.name == 'GET _attachment_chunks']
+        self.assertEqual(sorted(span.parent.span_id for span in requests),
+                         sorted(span.context.span_id for span in attachments))
+
+
+if __name__ == '__main__':
+    main()
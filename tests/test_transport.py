@@ -0,0 +1,137 @@
+import logging
+import os
+import sys
+import threading
+import time
+from io import BytesIO
+from unittest import main, TestCase
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import transport
+
+logging.disable(logging.CRITICAL)
+
+HOST = 'tickets.example.com'
+
+
+class TestRequestScheduler(TestCase):
+    """RequestScheduler unit tests
+    """
+
+    def _queue(self, scheduler, lanes):
+        """Queues one request per lane behind a held slot, then releases it
+        :return: The order in which the requests were admitted.
+        """
+        order = []
+        lock = threading.Lock()
+
+        def request(lane):
+            with scheduler.slot(HOST, lane):
+                with lock:
+                    order.append(lane)
+
+        scheduler.acquire(HOST, lanes[0])
+        threads = []
+        for queued, lane in enumerate(lanes, 1):
+            thread = threading.Thread(target=request, args=(lane,))
+            thread.start()
+            threads.append(thread)
+            # Make sure the requests queue in the order given.
+            while sum(stats['queued'] for stats in scheduler.stats().values()) < queued:
+                time.sleep(0.001)
+        scheduler.release(HOST, lanes[0])
+        for thread in threads:
+            thread.join()
+        return order
+
+    def test_interactive_before_bulk(self):
+        scheduler = transport.RequestScheduler(concurrency=1)
+        order = self._queue(scheduler, [transport.BULK, transport.BULK, transport.BULK, transport.INTERACTIVE])
+        self.assertEqual(order[0], transport.INTERACTIVE)
+
+    def test_weighted_sharing(self):
+        scheduler = transport.RequestScheduler(concurrency=1, lanes={'a': 2, 'b': 1})
+        order = self._queue(scheduler, ['b', 'b', 'b', 'a', 'a', 'a', 'a'])
+        self.assertEqual(order[:3].count('a'), 2)
+        self.assertEqual(order[-1], 'b')
+
+    def test_stats(self):
+        scheduler = transport.RequestScheduler(concurrency=1)
+        self._queue(scheduler, [transport.INTERACTIVE])
+        stats = scheduler.stats()
+        self.assertEqual(stats[transport.INTERACTIVE]['requests'], 2)
+        self.assertEqual(stats[transport.INTERACTIVE]['queued'], 0)
+        self.assertEqual(stats[transport.BULK]['active'], 0)
+        self.assertGreater(stats[transport.INTERACTIVE]['max_wait'], 0)
+
+    def test_rate(self):
+        scheduler = transport.RequestScheduler(rate=20, burst=1)
+        start = time.time()
+        for _ in range(4):
+            with scheduler.slot(HOST, transport.INTERACTIVE):
+                pass
+        self.assertGreaterEqual(time.time() - start, 0.14)
+
+    def test_unknown_lane(self):
+        scheduler = transport.RequestScheduler()
+        with self.assertRaises(ValueError):
+            scheduler.acquire(HOST, 'urgent')
+
+    def test_use_lane(self):
+        with transport.use_lane(transport.BULK):
+            self.assertEqual(transport._local.lane, transport.BULK)
+        self.assertIsNone(transport._local.lane)
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    """Answers every request with a 200 and a short body
+    """
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = BytesIO(b'body')
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class TestSession(TestCase):
+    """Session unit tests
+    """
+
+    def setUp(self):
+        self.scheduler = transport.RequestScheduler(concurrency=1)
+        self.s = transport.Session()
+        self.s.scheduler = self.scheduler
+        self.s.mount('https://', FakeAdapter())
+
+    def active(self):
+        return self.scheduler.stats()[transport.INTERACTIVE]['active']
+
+    def test_slot_released(self):
+        self.s.get('https://{0}/rest'.format(HOST))
+        self.assertEqual(self.active(), 0)
+
+    def test_stream_holds_slot_until_closed(self):
+        r = self.s.get('https://{0}/rest'.format(HOST), stream=True)
+        self.assertEqual(self.active(), 1)
+        self.assertEqual(b''.join(r.iter_content(2)), b'body')
+        self.assertEqual(self.active(), 1)
+        r.close()
+        r.close()
+        self.assertEqual(self.active(), 0)
+
+        with self.s.get('https://{0}/rest'.format(HOST), stream=True):
+            self.assertEqual(self.active(), 1)
+        self.assertEqual(self.active(), 0)
+
+
+if __name__ == '__main__':
+    main()
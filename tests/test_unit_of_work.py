@@ -0,0 +1,148 @@
+import logging
+import os
+import sys
+from unittest import main, TestCase
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import bugzilla, jira, redmine, rt
+
+from fakes import FakeResponse, ticket_object
+
+logging.disable(logging.CRITICAL)
+
+
+class RecordingSession(object):
+    """Records the payload of every request, answering with a canned body per HTTP method
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def _request(self, method, url, **kwargs):
+        self.requests.append((method, url.rsplit('/', 1)[-1], kwargs.get('json', kwargs.get('data'))))
+        return FakeResponse(self.responses.get(method))
+
+    def get(self, url, **kwargs):
+        return self._request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._request('POST', url, **kwargs)
+
+
+def recording_ticket(cls, ticketing_tool, responses):
+    t = ticket_object(cls, ticketing_tool, None)
+    t.s = RecordingSession(responses)
+    return t
+
+
+class FailingSession(RecordingSession):
+    """Fails every PUT with error, or with a response of status_code and body
+    """
+
+    def __init__(self, error=None, status_code=None, body=None):
+        super(FailingSession, self).__init__({})
+        self.error = error
+        self.status_code = status_code
+        self.body = body
+
+    def put(self, url, **kwargs):
+        if self.error is not None:
+            raise self.error
+        return FakeResponse(self.body, self.status_code)
+
+
+class TestMergedPayloads(TestCase):
+    """UnitOfWork payload unit tests
+    """
+
+    def test_jira(self):
+        t = recording_ticket(jira.JiraTicket, 'JIRA',
+                             {'GET': {'transitions': [{'id': '5', 'to': {'name': 'Done'}}]}})
+        with t.unit_of_work() as work:
+            work.edit(priority='Major')
+            work.add_comment('First')
+            work.add_comment('Second')
+            work.change_status('Done')
+        self.assertEqual(work.result.status, 'Success')
+        self.assertEqual(t.s.requests,
+                         [('PUT', '1', {'fields': {'priority': {'name': 'Major'}},
+                                        'update': {'comment': [{'add': {'body': 'First'}},
+                                                               {'add': {'body': 'Second'}}]}}),
+                          ('GET', 'transitions', None),
+                          ('POST', 'transitions', {'transition': {'id': '5'}})])
+
+    def test_jira_failures(self):
+        for session, error_message in [
+                (FailingSession(error=requests.ConnectionError('Connection refused')),
+                 'Error updating ticket - Connection refused'),
+                (FailingSession(status_code=502, body='<html>Bad Gateway</html>'),
+                 'Error updating ticket - 502 Error'),
+                (FailingSession(status_code=400, body={'errorMessages': [], 'errors': {'priority': 'Unknown'}}),
+                 'Error updating ticket - Unknown')]:
+            t = recording_ticket(jira.JiraTicket, 'JIRA', {})
+            t.s = session
+            with t.unit_of_work() as work:
+                work.edit(priority='Major')
+                work.add_comment('First')
+            self.assertEqual((work.result.status, work.result.error_message), ('Failure', error_message))
+
+    def test_redmine(self):
+        t = recording_ticket(redmine.RedmineTicket, 'Redmine', {})
+        t._metadata.update(issue_priorities=[{'id': 3, 'name': 'High'}],
+                           issue_statuses=[{'id': 5, 'name': 'Closed'}])
+        with t.unit_of_work() as work:
+            work.edit(priority='High')
+            work.change_status('Closed')
+            work.add_comment('Done')
+            work.add_comment('Again')
+        self.assertEqual(work.result.status, 'Success')
+        # Redmine takes one note per request.
+        self.assertEqual(t.s.requests,
+                         [('PUT', '1.json', {'issue': {'priority_id': 3, 'status_id': 5, 'notes': 'Done'}}),
+                          ('PUT', '1.json', {'issue': {'notes': 'Again'}})])
+
+    def test_bugzilla_comments_are_appended(self):
+        t = recording_ticket(bugzilla.BugzillaTicket, 'Bugzilla',
+                             {'PUT': {'bugs': [{'id': 1, 'changes': {}}]}, 'POST': {'id': 100}})
+        with t.unit_of_work() as work:
+            work.add_comment('Fixed in 1.2')
+            work.change_status('RESOLVED', resolution='FIXED', comment={'body': 'Closing'})
+            work.add_comment('Private note', is_private=True)
+        self.assertEqual(work.result.status, 'Success')
+        self.assertEqual(t.s.requests,
+                         [('PUT', '1', {'comment': {'body': 'Fixed in 1.2\n\nClosing'},
+                                        'status': 'RESOLVED', 'resolution': 'FIXED'}),
+                          ('POST', 'comment', {'comment': 'Private note', 'is_private': True})])
+
+    def test_bugzilla_cc_keeps_order(self):
+        t = recording_ticket(bugzilla.BugzillaTicket, 'Bugzilla', {'PUT': {'bugs': [{'id': 1, 'changes': {}}]}})
+        with t.unit_of_work() as work:
+            work.add_cc('alice@example.com')
+            work.add_cc('bob@example.com')
+            work.remove_cc('alice@example.com')
+        self.assertEqual(work.result.status, 'Success')
+        self.assertEqual(t.s.requests,
+                         [('PUT', '1', {'cc': {'add': ['alice@example.com', 'bob@example.com']}}),
+                          ('PUT', '1', {'cc': {'remove': ['alice@example.com']}})])
+
+    def test_rt(self):
+        t = recording_ticket(rt.RTTicket, 'RT', {'POST': 'RT/4.4.2 200 Ok\n\n# Ticket 1 updated.\n'})
+        with t.unit_of_work() as work:
+            work.edit(priority='5')
+            work.change_status('Resolved')
+            work.add_comment('Done')
+        self.assertEqual(work.result.status, 'Success')
+        self.assertEqual(t.s.requests,
+                         [('POST', 'edit', {'content': 'Priority: 5\nStatus: resolved\n'}),
+                          ('POST', 'comment', {'content': 'Action: correspond\nText: Done\n'})])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import sys
+from unittest import main, TestCase
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from ticketutil import jira, mirror, redmine, rt, servicenow, webhook
+
+logging.disable(logging.CRITICAL)
+
+
+def ticket_object(cls, tool, url):
+    t = cls.__new__(cls)
+    t.ticketing_tool = tool
+    t.url = url
+    t.project = 'KEY'
+    t._metadata = {}
+    t.mirror = mirror.Mirror()
+    return t
+
+
+def body(payload):
+    return json.dumps(payload).encode('utf-8')
+
+
+class TestWebhookReceiver(TestCase):
+    """WebhookReceiver unit tests
+    """
+
+    def setUp(self):
+        self.receiver = webhook.WebhookReceiver(port=0, token='secret')
+        self.jira = ticket_object(jira.JiraTicket, 'JIRA', 'https://jira')
+        self.receiver.register(self.jira)
+        self.events = []
+        self.receiver.subscribe(self.events.append)
+
+    def test_jira_update_refreshes_mirror(self):
+        self.jira.mirror.store('JIRA', 'https://jira', {'ticket_id': 'KEY-1', 'status': 'Open'},
+                               {'key': 'KEY-1', 'fields': {'status': {'name': 'Open'}}})
+        payload = {'webhookEvent': 'jira:issue_updated',
+                   'issue': {'key': 'KEY-1', 'fields': {'summary': 'Disk full', 'status': {'name': 'Closed'}}},
+                   'changelog': {'items': [{'field': 'status', 'fromString': 'Open', 'toString': 'Closed'}]}}
+        status, event = self.receiver.handle('/jira?token=secret', body(payload))
+        self.assertEqual(status, 204)
+        self.assertEqual((event.instance, event.ticket_id, event.action), ('https://jira', 'KEY-1', 'updated'))
+        self.assertEqual(event.changes, {'status': 'Closed'})
+        self.assertEqual(self.events, [event])
+        stored = self.jira.mirror.get('JIRA', 'https://jira', 'KEY-1')
+        self.assertEqual(stored['status'], 'Closed')
+        self.assertEqual(stored['summary'], 'Disk full')
+        self.assertFalse(stored['stale'])
+
+    def test_partial_payload_keeps_fields(self):
+        self.jira.mirror.store('JIRA', 'https://jira', {'ticket_id': 'KEY-1', 'status': 'Open', 'summary': 'Disk'},
+                               {'key': 'KEY-1', 'fields': {'status': {'name': 'Open'}, 'summary': 'Disk'}})
+        self.jira.mirror.invalidate('JIRA', 'https://jira', 'KEY-1')
+        payload = {'webhookEvent': 'jira:issue_updated',
+                   'issue': {'key': 'KEY-1', 'fields': {'status': {'name': 'Closed'}}}}
+        self.receiver.handle('/jira?token=secret', body(payload))
+        stored = self.jira.mirror.get('JIRA', 'https://jira', 'KEY-1')
+        self.assertEqual(stored['status'], 'Closed')
+        self.assertEqual(stored['summary'], 'Disk')
+        self.assertEqual(stored['content']['fields']['summary'], 'Disk')
+        self.assertTrue(stored['stale'])
+
+    def test_servicenow_refreshes_ticket_content(self):
+        t = ticket_object(servicenow.ServiceNowTicket, 'ServiceNow', 'https://servicenow')
+        t.ticket_id = 'PNT0001'
+        t.ticket_content = {'number': 'PNT0001', 'sys_id': 'abc', 'watch_list': 'alice@x.com'}
+        other = ticket_object(servicenow.ServiceNowTicket, 'ServiceNow', 'https://servicenow')
+        other.ticket_id = 'PNT0002'
+        other.ticket_content = {'number': 'PNT0002', 'watch_list': ''}
+        self.receiver.register(t)
+        self.receiver.register(other)
+        payload = {'operation': 'update', 'record': {'number': 'PNT0001', 'watch_list': 'alice@x.com, bob@x.com'}}
+        self.receiver.handle('/servicenow?token=secret', body(payload))
+        self.assertEqual(t.ticket_content, {'number': 'PNT0001', 'sys_id': 'abc',
+                                            'watch_list': 'alice@x.com, bob@x.com'})
+        self.assertEqual(other.ticket_content, {'number': 'PNT0002', 'watch_list': ''})
+        self.receiver.handle('/servicenow?token=secret', body({'operation': 'delete', 'record': {'number': 'PNT0001'}}))
+        self.assertIsNone(t.ticket_content)
+
+    def test_jira_delete_and_metadata(self):
+        self.jira.mirror.store('JIRA', 'https://jira', {'ticket_id': 'KEY-1'}, {'key': 'KEY-1'})
+        self.jira._metadata['users'] = ['alice']
+        self.receiver.handle('/jira', body({'webhookEvent': 'jira:issue_deleted', 'issue': {'key': 'KEY-1'}}),
+                             {'X-Ticketutil-Token': 'secret'})
+        self.assertIsNone(self.jira.mirror.get('JIRA', 'https://jira', 'KEY-1'))
+        status, event = self.receiver.handle('/jira?token=secret', body({'webhookEvent': 'user_updated'}))
+        self.assertEqual(event.action, 'metadata')
+        self.assertEqual(self.jira._metadata, {})
+
+    def test_rejected_requests(self):
+        self.assertEqual(self.receiver.handle('/jira?token=wrong', body({}))[0], 403)
+        self.assertEqual(self.receiver.handle('/bugzilla?token=secret', body({}))[0], 404)
+        self.assertEqual(self.receiver.handle('/jira?token=secret', b'not json')[0], 400)
+        self.assertEqual(self.events, [])
+
+    def test_redmine_updates_metadata_in_place(self):
+        t = ticket_object(redmine.RedmineTicket, 'Redmine', 'https://redmine')
+        t._metadata['issue_statuses'] = [{'id': 1, 'name': 'New'}]
+        t._metadata['users'] = [{'id': 5, 'login': 'alice'}]
+        self.receiver.register(t)
+        payload = {'payload': {'action': 'updated',
+                               'issue': {'id': 7, 'subject': 'Disk full', 'status': {'id': 4, 'name': 'Triaged'},
+                                         'priority': {'id': 2, 'name': 'Normal'},
+                                         'assignee': {'id': 6, 'login': 'bob', 'firstname': 'Bob'}},
+                               'journal': {'details': [{'property': 'attr', 'prop_key': 'status_id',
+                                                        'value': '4'}]}}}
+        status, event = self.receiver.handle('/redmine?token=secret', body(payload))
+        self.assertEqual(event.changes, {'status_id': '4'})
+        self.assertEqual(t._get_status_id('Triaged'), 4)
+        self.assertEqual(t._get_user_id('bob'), 6)
+        self.assertNotIn('issue_priorities', t._metadata)
+        self.assertEqual(t.mirror.get('Redmine', 'https://redmine', 7)['assignee'], 'Bob')
+
+    def test_rt_form_invalidates_mirror(self):
+        t = ticket_object(rt.RTTicket, 'RT', 'https://rt')
+        t.mirror.store('RT', 'https://rt', {'ticket_id': '9'}, {'id': 'ticket/9'})
+        self.receiver.register(t, '/hooks/rt')
+        status, event = self.receiver.handle('/hooks/rt?token=secret', b'Ticket=9&Type=Status&NewValue=resolved',
+                                             {'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual((event.ticket_id, event.action, event.changes), ('9', 'updated', {'Status': 'resolved'}))
+        self.assertTrue(t.mirror.get('RT', 'https://rt', '9')['stale'])
+
+    def test_http_server(self):
+        with self.receiver:
+            host, port = self.receiver.address
+            url = 'http://{0}:{1}/jira'.format(host, port)
+            payload = body({'webhookEvent': 'comment_created', 'issue': {'key': 'KEY-2'}})
+            headers = {'X-Ticketutil-Token': 'secret', 'Content-Type': 'application/json'}
+            r = urlopen(Request(url, payload, headers))
+            self.assertEqual(r.status, 204)
+            with self.assertRaises(HTTPError) as context:
+                urlopen(Request(url, payload))
+            self.assertEqual(context.exception.code, 403)
+        self.assertEqual([(event.ticket_id, event.action) for event in self.events], [('KEY-2', 'commented')])
+
+
+if __name__ == '__main__':
+    main()
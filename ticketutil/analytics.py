@@ -0,0 +1,506 @@
+import array
+import csv
+import datetime
+import io
+import logging
+
+from . import ticket
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Event kinds. RESOLVED is a resolution without the status entered, eg. an export's resolution date.
+CREATED = 0
+STATUS = 1
+COMMENT = 2
+RESOLVED = 3
+
+RESOLVED_STATUSES = ('resolved', 'closed', 'done', 'verified', 'closed complete', 'closed completed')
+
+# ServiceNow states are numeric codes. These are the labels of the incident table's states, used for
+# records without 'state_labels', see ServiceNowTicket.get_ticket_history(). Other tables may differ.
+SERVICENOW_STATES = {'1': 'new', '2': 'in progress', '3': 'on hold', '6': 'resolved', '7': 'closed',
+                     '8': 'canceled'}
+
+# Per tool, the columns of a ticketutil.export file with the default schema read by from_export():
+# the id, the creation time, the resolution time and the group, with the format of the times.
+EXPORT_COLUMNS = {'JIRA': ('key', 'created', 'resolved', None, '%Y-%m-%dT%H:%M:%S.%f%z'),
+                  'Bugzilla': ('id', 'created', None, None, '%Y-%m-%dT%H:%M:%SZ'),
+                  'Redmine': ('id', 'created', 'closed', None, '%Y-%m-%dT%H:%M:%SZ'),
+                  'RT': ('id', 'created', 'resolved', 'queue', '%a %b %d %H:%M:%S %Y'),
+                  'ServiceNow': ('number', 'opened', 'closed', None, '%Y-%m-%d %H:%M:%S')}
+
+# Number of events parsed before they are added to the table's arrays.
+_BATCH_SIZE = 100000
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class EventTable(object):
+    """
+    Ticket events, ie. creations, status changes and comments, held in NumPy arrays for metrics.
+
+    Tickets are added from their raw content with history, as read with Ticket.get_ticket_history(),
+    from a mirror, see from_mirror(), or from an export, see from_export(). Every tool has a parser, see
+    PARSERS. Ids, groups (the project or queue) and statuses are stored as integer codes, and times as
+    seconds since the epoch in UTC.
+    """
+    def __init__(self):
+        if numpy is None:
+            raise ticket.TicketException("Analytics requires numpy")
+        self.tickets = []
+        self.groups = []
+        self.statuses = []
+        self._codes = ({}, {}, {})
+        self._ticket = array.array('l')
+        self._group = array.array('l')
+        self._time = array.array('d')
+        self._kind = array.array('b')
+        self._status = array.array('l')
+        self._arrays = None
+
+    @classmethod
+    def from_tickets(cls, tool, tickets):
+        """
+        Creates an EventTable from raw tickets.
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param tickets: Iterable of tickets as returned by the tool, with their history.
+        :return: EventTable.
+        """
+        table = cls()
+        table._add_parsed(tool, tickets)
+        return table
+
+    @classmethod
+    def from_mirror(cls, mirror, tool, instance=None):
+        """
+        Creates an EventTable from a tool's tickets in a ticketutil.mirror.Mirror.
+        Tickets mirrored by get_ticket_history() have their history. Other tickets only add their creation
+        and comments, and tickets that can't be parsed, eg. ones only read with a field projection, are skipped.
+        :param mirror: The Mirror.
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param instance: Optional URL of the ticketing tool, for mirrors of several instances.
+        :return: EventTable.
+        """
+        table = cls()
+        tickets = (ticket['content'] for ticket in mirror.query(tool=tool, instance=instance, limit=None))
+        table._add_parsed(tool, tickets, skip_invalid=True)
+        return table
+
+    @classmethod
+    def from_export(cls, path, tool, group=None):
+        """
+        Creates an EventTable from a Parquet or CSV file written by ticketutil.export with the tool's schema.
+        Exports have no history, so every ticket only adds its creation and, once resolved, a RESOLVED event
+        at its resolution time. Time-to-resolve is computed, first response and dwell times aren't. Bugzilla
+        exports have no resolution time.
+        :param path: The exported file. Files ending with .csv are read as CSV, others as Parquet.
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param group: The group of the tickets, eg. the project exported. Defaults to the queue for RT and
+                      the key's project for JIRA.
+        :return: EventTable.
+        """
+        id_column, created_column, resolved_column, group_column, time_format = EXPORT_COLUMNS[tool]
+        names = [name for name in (id_column, created_column, resolved_column, group_column) if name]
+        columns = _read_export(path, names)
+
+        ticket_ids = columns[id_column]
+        if tool == 'RT':
+            ticket_ids = [str(ticket_id).split('/')[-1] for ticket_id in ticket_ids]
+        if group is not None or not (group_column or tool == 'JIRA'):
+            groups = [group] * len(ticket_ids)
+        elif group_column:
+            groups = columns[group_column]
+        else:
+            groups = [key.rsplit('-', 1)[0] for key in ticket_ids]
+
+        created = [_seconds(value, time_format) for value in columns[created_column]]
+        resolved = [_seconds(value, time_format) if value not in (None, '', 'Not set') else None
+                    for value in columns.get(resolved_column) or [None] * len(ticket_ids)]
+        done = [index for index, value in enumerate(resolved) if value is not None]
+
+        table = cls()
+        table.add_events(ticket_ids, groups, created, [CREATED] * len(ticket_ids))
+        table.add_events([ticket_ids[index] for index in done], [groups[index] for index in done],
+                         [resolved[index] for index in done], [RESOLVED] * len(done))
+        return table
+
+    def add_ticket(self, tool, content):
+        """
+        Adds the events of a ticket, parsed with the tool's parser.
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param content: The ticket as returned by the tool, with its history.
+        """
+        self._add_parsed(tool, [content])
+
+    def add(self, ticket_id, group, time, kind, status=None):
+        """
+        Adds one event.
+        :param ticket_id: The id of the ticket.
+        :param group: The group metrics are computed for, eg. the project or queue.
+        :param time: Datetime in UTC or seconds since the epoch.
+        :param kind: CREATED, STATUS, COMMENT or RESOLVED.
+        :param status: The status entered, for CREATED and STATUS events.
+        """
+        if isinstance(time, datetime.datetime):
+            time = (time - _EPOCH).total_seconds()
+        self._ticket.append(self._code(0, self.tickets, ticket_id))
+        self._group.append(self._code(1, self.groups, group))
+        self._time.append(time)
+        self._kind.append(kind)
+        self._status.append(-1 if status is None else self._code(2, self.statuses, status.lower()))
+        self._arrays = None
+
+    def add_events(self, ticket_ids, groups, times, kinds, statuses=None):
+        """
+        Adds many events at once. Each column is encoded and appended to its array in one pass.
+        :param ticket_ids: List of the events' ticket ids.
+        :param groups: List of the events' groups.
+        :param times: List of the events' times, in seconds since the epoch.
+        :param kinds: List of the events' kinds.
+        :param statuses: Optional list of the statuses entered, None for events without one.
+        """
+        self._ticket.extend(self._encode(0, self.tickets, ticket_ids))
+        self._group.extend(self._encode(1, self.groups, groups))
+        self._time.extend(times)
+        self._kind.extend(kinds)
+        if statuses is None:
+            self._status.extend([-1] * len(times))
+        else:
+            statuses = [status.lower() if status is not None else None for status in statuses]
+            self._status.extend(self._encode(2, self.statuses, statuses, missing=True))
+        self._arrays = None
+
+    def arrays(self):
+        """
+        :return: (ticket, group, time, kind, status): NumPy arrays of the events. They are copies, so events
+                 can still be added to the table, and are reused until events are added.
+        """
+        if self._arrays is None:
+            self._arrays = tuple(numpy.array(column, dtype=column.typecode)
+                                 for column in (self._ticket, self._group, self._time, self._kind, self._status))
+        return self._arrays
+
+    def __len__(self):
+        return len(self._time)
+
+    def _code(self, index, names, name):
+        codes = self._codes[index]
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(names)
+            names.append(name)
+        return code
+
+    def _encode(self, index, names, values, missing=False):
+        """
+        :return: codes: The codes of values. New names get codes in the order they first appear.
+                 With missing, None values are -1 instead.
+        """
+        codes = self._codes[index]
+        for name in dict.fromkeys(values):
+            if name not in codes and not (missing and name is None):
+                codes[name] = len(names)
+                names.append(name)
+        if not missing:
+            return list(map(codes.__getitem__, values))
+        return [-1 if value is None else codes[value] for value in values]
+
+    def _add_parsed(self, tool, tickets, skip_invalid=False):
+        """
+        Parses tickets with the tool's parser and adds their events, _BATCH_SIZE events at a time.
+        """
+        parser = PARSERS[tool]
+        columns = ([], [], [], [], [])
+        skipped = 0
+        for content in tickets:
+            try:
+                ticket_id, group, events = parser(content)
+            except (KeyError, TypeError, ValueError):
+                if not skip_invalid:
+                    raise
+                skipped += 1
+                continue
+            for time, kind, status in events:
+                for column, value in zip(columns, (ticket_id, group, time, kind, status)):
+                    column.append(value)
+            if len(columns[0]) >= _BATCH_SIZE:
+                self.add_events(*columns)
+                columns = ([], [], [], [], [])
+        if columns[0]:
+            self.add_events(*columns)
+        if skipped:
+            logging.warning("Skipped {0} tickets without the fields analytics needs".format(skipped))
+
+
+def sla_metrics(table, percentiles=(50, 90, 99), resolved_statuses=RESOLVED_STATUSES):
+    """
+    Computes time-to-first-response, time-to-resolve and status dwell time percentiles per group.
+    The first response is the first comment or status change after creation. A ticket is resolved by the
+    first status change to one of resolved_statuses, or its RESOLVED event. Durations are in seconds.
+    :param table: EventTable.
+    :param percentiles: Percentiles to compute, between 0 and 100.
+    :param resolved_statuses: Statuses counting as resolved, case insensitive.
+    :return: metrics: Dict with 'first_response' and 'resolve', mapping group to a dict of count and the
+             percentiles, eg. {'p50': 3600.0}, and 'dwell', mapping (group, status) the same way.
+    """
+    tickets, groups, times, kinds, statuses = table.arrays()
+    count = len(table.tickets)
+    ticket_group = numpy.full(count, -1, dtype=numpy.int64)
+    ticket_group[tickets] = groups
+
+    # Sort the events by ticket and time once. Masked subsets stay sorted.
+    order = _sort_order(times, tickets, count)
+    tickets = tickets[order]
+    times = times[order]
+    kinds = kinds[order]
+    statuses = statuses[order]
+
+    created = _first_per_ticket(tickets, times, kinds == CREATED, count)
+    responded = _first_per_ticket(tickets, times, (kinds == COMMENT) | (kinds == STATUS), count)
+    resolved_names = set(name.lower() for name in resolved_statuses)
+    resolved_codes = [code for code, name in enumerate(table.statuses) if name in resolved_names]
+    resolved_mask = ((kinds == STATUS) & numpy.isin(statuses, resolved_codes)) | (kinds == RESOLVED)
+    resolved = _first_per_ticket(tickets, times, resolved_mask, count)
+
+    metrics = {'first_response': _report(responded - created, ticket_group, table.groups, percentiles),
+               'resolve': _report(resolved - created, ticket_group, table.groups, percentiles)}
+
+    # A status is dwelled in from the event entering it until the ticket's next status change.
+    mask = (kinds == CREATED) | (kinds == STATUS)
+    tickets = tickets[mask]
+    times = times[mask]
+    statuses = statuses[mask]
+    same = (tickets[1:] == tickets[:-1]) & (statuses[:-1] >= 0)
+    dwell = (times[1:] - times[:-1])[same]
+    keys = ticket_group[tickets[:-1][same]] * max(len(table.statuses), 1) + statuses[:-1][same]
+    names = [(group, status) for group in table.groups for status in table.statuses]
+    metrics['dwell'] = _report(dwell, keys, names, percentiles)
+    return metrics
+
+
+def grouped_percentiles(values, groups, percentiles=(50, 90, 99)):
+    """
+    Computes percentiles of values per group with linear interpolation.
+    Values are ordered by group with one integer sort, then each group is summarized with numpy.percentile.
+    NaN values are ignored.
+    :param values: NumPy array of values.
+    :param groups: NumPy array of non-negative integer group codes, one per value.
+    :param percentiles: Percentiles to compute, between 0 and 100.
+    :return: (codes, counts, results): The group codes present, their value counts and a 2-D array with
+             a row of percentiles per group.
+    """
+    valid = ~numpy.isnan(values)
+    values = values[valid]
+    groups = groups[valid]
+    counts = numpy.bincount(groups, minlength=1)
+    codes = numpy.flatnonzero(counts)
+    counts = counts[codes]
+    dense = numpy.zeros(len(counts) and codes[-1] + 1, dtype=numpy.int64)
+    dense[codes] = numpy.arange(len(codes))
+    values = values[_group_order(dense[groups], len(codes))]
+    results = numpy.empty((len(codes), len(percentiles)))
+    end = 0
+    for index, size in enumerate(counts):
+        results[index] = numpy.percentile(values[end:end + size], percentiles)
+        end += size
+    return codes, counts, results
+
+
+def _group_order(groups, count):
+    """
+    :return: order: Indices stably sorting integer group codes below count. Codes are narrowed to 16 bits
+             where they fit, which NumPy sorts with a radix sort.
+    """
+    if count <= numpy.iinfo(numpy.uint16).max:
+        groups = groups.astype(numpy.uint16)
+    return numpy.argsort(groups, kind='stable')
+
+
+def _sort_order(times, tickets, count):
+    """
+    :return: order: Indices sorting events by ticket, then time. Events at the same time keep the order
+             they were added in, so a status set on creation follows the creation.
+    """
+    order = numpy.argsort(times, kind='stable')
+    return order[_group_order(tickets[order], count)]
+
+
+def _first_per_ticket(tickets, times, mask, count):
+    """
+    :param tickets: Ticket codes of the events, sorted by ticket and time.
+    :param times: Times of the events.
+    :param mask: Events to consider.
+    :param count: Number of tickets.
+    :return: first: Array of the earliest masked event time per ticket, NaN if a ticket has none.
+    """
+    first = numpy.full(count, numpy.nan)
+    masked_tickets = tickets[mask]
+    masked_times = times[mask]
+    keep = numpy.ones(len(masked_tickets), dtype=bool)
+    keep[1:] = masked_tickets[1:] != masked_tickets[:-1]
+    first[masked_tickets[keep]] = masked_times[keep]
+    return first
+
+
+def _report(values, groups, names, percentiles):
+    codes, counts, results = grouped_percentiles(values, groups, percentiles)
+    report = {}
+    for code, count, row in zip(codes, counts, results):
+        report[names[code]] = dict([('count', int(count))] +
+                                   [('p{0:g}'.format(q), float(value)) for q, value in zip(percentiles, row)])
+    return report
+
+
+def _read_export(path, names):
+    """
+    Reads columns of an exported file. Empty CSV values are None.
+    :return: columns: Dict of column name to list of values.
+    """
+    if not path.endswith('.csv'):
+        if pyarrow is None:
+            raise ticket.TicketException("Reading Parquet exports requires pyarrow")
+        table = pyarrow.parquet.read_table(path, columns=names)
+        return dict((name, table.column(name).to_pylist()) for name in names)
+    columns = dict((name, []) for name in names)
+    with io.open(path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            for name in names:
+                columns[name].append(row[name] or None)
+    return columns
+
+
+def _status_name(names, value):
+    """
+    :return: The name of a status value, or the value itself if names has none. None for empty values.
+    """
+    if value in (None, ''):
+        return None
+    value = str(value)
+    return names.get(value, value)
+
+
+def _seconds(value, time_format):
+    """
+    Parses a timestamp into seconds since the epoch. Timestamps without a UTC offset are taken as UTC.
+    """
+    parsed = datetime.datetime.strptime(value, time_format)
+    if parsed.tzinfo is not None:
+        parsed = parsed.replace(tzinfo=None) - parsed.utcoffset()
+    return (parsed - _EPOCH).total_seconds()
+
+
+def jira_events(issue):
+    """
+    Parses a JIRA issue read with expand=changelog.
+    :return: (ticket_id, group, events): events are (time, kind, status) tuples.
+    """
+    time_format = '%Y-%m-%dT%H:%M:%S.%f%z'
+    fields = issue['fields']
+    histories = (issue.get('changelog') or {}).get('histories', [])
+    changes = [(history['created'], item) for history in histories for item in history['items']
+               if item['field'] == 'status']
+    initial = changes[0][1]['fromString'] if changes else (fields.get('status') or {}).get('name')
+    events = [(_seconds(fields['created'], time_format), CREATED, initial)]
+    events.extend((_seconds(created, time_format), STATUS, item['toString']) for created, item in changes)
+    events.extend((_seconds(comment['created'], time_format), COMMENT, None)
+                  for comment in (fields.get('comment') or {}).get('comments', []))
+    return issue['key'], (fields.get('project') or {}).get('key'), events
+
+
+def bugzilla_events(bug):
+    """
+    Parses a Bugzilla bug with its 'history' from rest/bug/<id>/history and optional 'comments'.
+    :return: (ticket_id, group, events): events are (time, kind, status) tuples.
+    """
+    time_format = '%Y-%m-%dT%H:%M:%SZ'
+    changes = [(entry['when'], change) for entry in bug.get('history', []) for change in entry['changes']
+               if change['field_name'] == 'status']
+    initial = changes[0][1]['removed'] if changes else bug.get('status')
+    events = [(_seconds(bug['creation_time'], time_format), CREATED, initial)]
+    events.extend((_seconds(when, time_format), STATUS, change['added']) for when, change in changes)
+    # The first comment is the bug's description.
+    events.extend((_seconds(comment['creation_time'], time_format), COMMENT, None)
+                  for comment in bug.get('comments', [])[1:])
+    return bug['id'], bug.get('product'), events
+
+
+def redmine_events(issue):
+    """
+    Parses a Redmine issue read with include=journals. Journals hold status ids, which are named with the
+    issue's 'status_names', a dict of id to name added by RedmineTicket.get_ticket_history(). Without it,
+    statuses are ids.
+    :return: (ticket_id, group, events): events are (time, kind, status) tuples.
+    """
+    time_format = '%Y-%m-%dT%H:%M:%SZ'
+    names = issue.get('status_names') or {}
+    events = []
+    initial = None
+    for journal in issue.get('journals', []):
+        time = _seconds(journal['created_on'], time_format)
+        for detail in journal.get('details', []):
+            if detail.get('property') == 'attr' and detail.get('name') == 'status_id':
+                if initial is None:
+                    initial = _status_name(names, detail.get('old_value'))
+                events.append((time, STATUS, _status_name(names, detail.get('new_value'))))
+        if journal.get('notes'):
+            events.append((time, COMMENT, None))
+    if initial is None:
+        status = issue.get('status') or {}
+        initial = status.get('name') or _status_name(names, status.get('id'))
+    events.insert(0, (_seconds(issue['created_on'], time_format), CREATED, initial))
+    return issue['id'], (issue.get('project') or {}).get('name'), events
+
+
+def rt_events(content):
+    """
+    Parses a RT ticket dict with its 'History', a list of entries read from ticket/<id>/history?format=l.
+    :return: (ticket_id, group, events): events are (time, kind, status) tuples.
+    """
+    time_format = '%Y-%m-%d %H:%M:%S'
+    history = content.get('History', [])
+    changes = [entry for entry in history if entry.get('Type') == 'Status']
+    initial = changes[0].get('OldValue') if changes else content.get('Status')
+    events = [(_seconds(content['Created'], '%a %b %d %H:%M:%S %Y'), CREATED, initial)]
+    events.extend((_seconds(entry['Created'], time_format), STATUS, entry.get('NewValue')) for entry in changes)
+    events.extend((_seconds(entry['Created'], time_format), COMMENT, None) for entry in history
+                  if entry.get('Type') in ('Correspond', 'Comment'))
+    return content['id'].split('/')[-1], content.get('Queue'), events
+
+
+def servicenow_events(record):
+    """
+    Parses a ServiceNow record with its 'audit', sys_audit records of the state field, and optional
+    'journals', sys_journal_field records of comments. Records are grouped by assignment group.
+    States are numeric codes, named with the record's 'state_labels', a dict of code to label added by
+    ServiceNowTicket.get_ticket_history(), or else SERVICENOW_STATES.
+    :return: (ticket_id, group, events): events are (time, kind, status) tuples.
+    """
+    time_format = '%Y-%m-%d %H:%M:%S'
+    labels = record.get('state_labels') or SERVICENOW_STATES
+    changes = sorted((entry for entry in record.get('audit', []) if entry.get('fieldname') == 'state'),
+                     key=lambda entry: entry['sys_created_on'])
+    initial = changes[0].get('oldvalue') if changes else record.get('state')
+    events = [(_seconds(record['opened_at'], time_format), CREATED, _status_name(labels, initial))]
+    events.extend((_seconds(entry['sys_created_on'], time_format), STATUS, _status_name(labels, entry['newvalue']))
+                  for entry in changes)
+    events.extend((_seconds(entry['sys_created_on'], time_format), COMMENT, None)
+                  for entry in record.get('journals', []) if entry.get('element') == 'comments')
+    group = record.get('assignment_group')
+    if isinstance(group, dict):
+        group = group.get('value')
+    return record['number'], group or None, events
+
+
+PARSERS = {'JIRA': jira_events,
+           'Bugzilla': bugzilla_events,
+           'Redmine': redmine_events,
+           'RT': rt_events,
+           'ServiceNow': servicenow_events}
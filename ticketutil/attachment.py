@@ -0,0 +1,132 @@
+import base64
+import hashlib
+import io
+import os
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+# Hash algorithms of the digests tools report, by hex length. Redmine used MD5 before 4.0 and SHA-256 since.
+_ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256'}
+
+
+def algorithm(digest):
+    """
+    :param digest: A hex digest reported by a tool, or None.
+    :return: name: The hashlib name of the digest's algorithm. Defaults to 'sha256'.
+    """
+    return _ALGORITHMS.get(len(digest), 'sha256') if digest else 'sha256'
+
+
+def file_digest(path, name='sha256', chunk_size=CHUNK_SIZE):
+    """
+    :param path: The file to hash.
+    :param name: The hashlib algorithm.
+    :return: digest: The hex digest of the file.
+    """
+    digest = hashlib.new(name)
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def matches(path, size=None, digest=None):
+    """
+    Checks whether a local file already holds an attachment.
+    Attachments are immutable in every tool, so without a digest a matching size is enough.
+    :param path: The local file.
+    :param size: The attachment's size in bytes, or None if the tool doesn't report it.
+    :param digest: The attachment's hex digest, or None if the tool doesn't report it.
+    :return: True if the file exists with the same size and digest. False if neither is known.
+    """
+    if size is None and not digest:
+        return False
+    if not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    return not digest or file_digest(path, algorithm(digest)) == digest.lower()
+
+
+def write(chunks, destination, name='sha256'):
+    """
+    Writes chunks of bytes to a file as they arrive, hashing them on the way.
+    Files are written to a temporary name and renamed when complete, so an interrupted download never
+    leaves a partial file behind.
+    :param chunks: Iterable of bytes.
+    :param destination: A path, or a writable binary file object.
+    :param name: The hashlib algorithm.
+    :return: (size, digest): Number of bytes written and their hex digest.
+    """
+    digest = hashlib.new(name)
+    size = 0
+    if hasattr(destination, 'write'):
+        sink = destination
+        temporary = None
+    else:
+        temporary = '{0}.part'.format(destination)
+        sink = io.open(temporary, 'wb')
+    complete = False
+    try:
+        for chunk in chunks:
+            if chunk:
+                sink.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        complete = True
+    finally:
+        if temporary is not None:
+            sink.close()
+            if complete:
+                os.replace(temporary, destination)
+            else:
+                os.remove(temporary)
+    return size, digest.hexdigest()
+
+
+def decode_base64_field(chunks, field):
+    """
+    Decodes a base64 string field of a JSON document as the document streams in, eg. the data of a
+    Bugzilla attachment, so only about one chunk is held in memory.
+    :param chunks: Iterable of bytes of the JSON document.
+    :param field: The name of the field, eg. 'data'.
+    :return: Generator of decoded bytes.
+    """
+    start = re.compile(b'"' + field.encode('utf-8') + b'"\\s*:\\s*"')
+    chunks = iter(chunks)
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        match = start.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+        # Keep enough to match a field name split across chunks.
+        buffer = buffer[-(len(field) + 64):]
+    else:
+        raise ValueError("No {0} field in response".format(field))
+
+    pending = b''
+    while True:
+        end = buffer.find(b'"')
+        data = buffer if end < 0 else buffer[:end]
+        # An escape sequence split across chunks is completed by the next one.
+        escaped = len(data) - len(data.rstrip(b'\\'))
+        if end < 0 and escaped % 2:
+            data, buffer = data[:-1], b'\\'
+        else:
+            buffer = b''
+        pending += data.replace(b'\\n', b'').replace(b'\\r', b'').replace(b'\\/', b'/')
+        usable = len(pending) // 4 * 4
+        if usable:
+            yield base64.b64decode(pending[:usable])
+            pending = pending[usable:]
+        if end >= 0:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("Truncated {0} field in response".format(field))
+        buffer += chunk
+    if pending:
+        yield base64.b64decode(pending)
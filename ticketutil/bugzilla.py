@@ -1,10 +1,15 @@
 import base64
+import datetime
 import logging
 import mimetypes
 
 import requests
 
+from . import attachment as attachment_module
+from . import mirror
+from . import sync
 from . import ticket
+from . import transport
 
 __author__ = 'dranck, rnester, kshirsal'
 
@@ -13,6 +18,9 @@ class BugzillaTicket(ticket.Ticket):
     """
     A BZ Ticket object. Contains BZ-specific methods for working with tickets.
     """
+    # Fields search() must return for SyncEngine.
+    _sync_fields = ['id', 'last_change_time']
+
     def __init__(self, url, project, auth=None, ticket_id=None):
         self.ticketing_tool = 'Bugzilla'
 
@@ -65,7 +73,7 @@ class BugzillaTicket(ticket.Ticket):
         elif 'api_key' in self.auth:
             self.credentials = self.auth
 
-        s = requests.Session()
+        s = transport.Session()
         s.params.update(self.credentials)
         s.verify = False
 
@@ -139,6 +147,49 @@ class BugzillaTicket(ticket.Ticket):
             logging.debug("Ticket {0} is valid".format(ticket_id))
             return True
 
+    def get_ticket_content(self, ticket_id=None, fields=None):
+        """
+        Gets the content of a bug.
+        :param ticket_id: The bug to get. Defaults to the current bug.
+        :param fields: Optional list of field names to return, eg. ['summary', 'status']. Only these fields
+                       are requested from Bugzilla. Defaults to all default fields.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, the bug as returned by Bugzilla.
+        """
+        if ticket_id is None:
+            ticket_id = self.ticket_id
+            if not self.ticket_id:
+                error_message = "No ticket ID associated with ticket object. " \
+                                "Set ticket ID with set_ticket_id(<ticket_id>)"
+                logging.error(error_message)
+                return self.request_result._replace(status='Failure', error_message=error_message)
+
+        params = {'include_fields': ','.join(fields)} if fields else None
+        try:
+            r = self.s.get("{0}/{1}".format(self.rest_url, ticket_id), params=params)
+            logging.debug("Get ticket content: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            error_message = ticket.content_error_message(ticket_id, e)
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
+        # Bugzilla's API returns 200 even if the request was not valid. We need to parse the response.
+        ticket_content = r.json()
+        if 'error' in ticket_content or not ticket_content.get('bugs'):
+            # Code 101 is a bug that doesn't exist.
+            if ticket_content.get('code') == 101 or 'error' not in ticket_content:
+                error_message = ticket.NOT_FOUND.format(ticket_id)
+            else:
+                error_message = "Error getting ticket content"
+            logging.error(error_message)
+            logging.error(ticket_content.get('message'))
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
+        self._mirror_content(ticket_content['bugs'][0], partial=bool(fields))
+        return self.request_result._replace(ticket_content=ticket_content['bugs'][0])
+
     def create(self, summary, description, **kwargs):
         """
         Creates a ticket.
@@ -161,7 +212,7 @@ class BugzillaTicket(ticket.Ticket):
         params = self._create_ticket_parameters(summary, description, kwargs)
 
         # Create our ticket.
-        return self._create_ticket_request(params)
+        return self._create_ticket(params, summary, description)
 
     def _create_ticket_parameters(self, summary, description, fields):
         """
@@ -211,6 +262,7 @@ class BugzillaTicket(ticket.Ticket):
             logging.debug("Create ticket: status code: {0}".format(r.status_code))
             r.raise_for_status()
         except requests.RequestException as e:
+            self._create_error = e
             logging.error("Error creating ticket")
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=str(e))
@@ -230,10 +282,134 @@ class BugzillaTicket(ticket.Ticket):
         logging.info("Created ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
         return self.request_result
 
-    def edit(self, **kwargs):
+    def _find_created_ticket(self, params):
+        """
+        Searches for a bug created in the last day in the product with the summary of params, and
+        checks the description (the bug's first comment) of the newest ones.
+        :param params: The payload from _create_ticket_parameters().
+        :return: ticket_id: The id of the matching bug, or None.
+        """
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        query = {'product': params['product'],
+                 'summary': params['summary'],
+                 'creation_time': since.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 'include_fields': 'id,summary'}
+        try:
+            r = self.s.get(self.rest_url, params=query)
+            logging.debug("Find created ticket: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error searching for created ticket")
+            logging.error(e)
+            return
+
+        # The summary search matches substrings, so compare the whole summary. The newest bug wins.
+        bug_ids = sorted((bug['id'] for bug in r.json().get('bugs', []) if bug['summary'] == params['summary']),
+                         reverse=True)
+        for bug_id in bug_ids[:5]:
+            try:
+                r = self.s.get("{0}/{1}/comment".format(self.rest_url, bug_id))
+                logging.debug("Find created ticket: status code: {0}".format(r.status_code))
+                r.raise_for_status()
+            except requests.RequestException as e:
+                logging.error("Error searching for created ticket")
+                logging.error(e)
+                return
+            comments = r.json()['bugs'][str(bug_id)]['comments']
+            if comments and comments[0]['text'] == params['description']:
+                return bug_id
+
+    def _search_pages(self, query, fields, page_size):
+        """
+        Fetches the product's bugs matching search parameters, eg. {'status': 'NEW'}, page by page.
+        :param query: Dict of Bugzilla search parameters.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of bugs fetched per request.
+        :return: Generator of lists of bugs.
+        """
+        params = {'product': self.project, 'order': 'bug_id'}
+        params.update(query or {})
+        params['limit'] = page_size
+        if fields:
+            params['include_fields'] = ','.join(fields)
+
+        offset = 0
+        while True:
+            params['offset'] = offset
+            page = self._get_search_page(self.rest_url, params).json()
+            # Bugzilla's API returns 200 even if the request was not valid. We need to parse the response.
+            if 'error' in page:
+                logging.error(page.get('message'))
+                raise ticket.TicketException("Error searching for tickets")
+            bugs = page['bugs']
+            if bugs:
+                yield bugs
+            offset += len(bugs)
+            if len(bugs) < page_size:
+                return
+
+    def _updated_since_query(self, since):
+        """
+        Builds search parameters for the bugs changed since a time, oldest first.
+        :param since: Datetime in UTC, or None for every bug.
+        :return: query: Dict of Bugzilla search parameters.
+        """
+        query = {'order': 'changeddate'}
+        if since is not None:
+            query['last_change_time'] = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return query
+
+    def _ticket_updated(self, item):
+        """
+        :param item: A bug yielded by search().
+        :return: (ticket_id, updated): The bug id and last change time.
+        """
+        return item['id'], sync.parse_time(item['last_change_time'], '%Y-%m-%dT%H:%M:%SZ')
+
+    def _mirror_fields(self, content):
+        """
+        :param content: A bug as returned by Bugzilla.
+        :return: fields: Dict of the columns stored by ticketutil.mirror.Mirror.
+        """
+        if 'id' not in content:
+            return None
+        # Bugs are read without their comments, so description and comments aren't mirrored.
+        columns = mirror.read_columns(content, {
+            'project': ('product', content.get('product')),
+            'summary': ('summary', content.get('summary')),
+            'status': ('status', content.get('status')),
+            'assignee': ('assigned_to', content.get('assigned_to')),
+            'updated': ('last_change_time', content.get('last_change_time'))})
+        columns['ticket_id'] = content['id']
+        return columns
+
+    def _edit_content_fields(self, names):
+        """
+        :param names: List of edit() keyword argument names.
+        :return: fields: The Bugzilla field names.
+        """
+        return ['assigned_to' if name == 'assignee' else name for name in names]
+
+    def _edit_field_values(self, content, name, value):
+        """
+        Reads a field edit() would set from a bug. Groups are only ever added, so the desired groups
+        are the bug's groups and the new ones.
+        """
+        field = 'assigned_to' if name == 'assignee' else name
+        if field not in content:
+            return None
+        current = content[field]
+        if name == 'groups':
+            groups = value if isinstance(value, list) else [value]
+            return current, list(set(current or []) | set(groups))
+        return current, value
+
+    def edit(self, diff=None, **kwargs):
         """
         Edits fields in a Bugzilla ticket.
         Keyword arguments are used to specify ticket fields.
+        With diff, only the fields that would change the ticket are sent, and no request is made if
+        none would. The names of the fields sent are set in sent_fields.
 
         Fields examples:
         summary='Ticket summary'
@@ -245,6 +421,8 @@ class BugzillaTicket(ticket.Ticket):
         severity='medium'
         alias='SomeAlias'
 
+        :param diff: None to send every field. 'fetch' to compare with the ticket's current fields first,
+                     or 'cache' to compare with the mirrored ticket unless it is stale.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
         if not self.ticket_id:
@@ -252,6 +430,13 @@ class BugzillaTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        kwargs = self._edit_fields(kwargs, diff)
+        if kwargs is None:
+            return self.request_result._replace(status='Failure', error_message="Error getting ticket content")
+        if diff and not kwargs:
+            logging.info("Ticket {0} already has these field values".format(self.ticket_id))
+            return self.request_result
+
         # Some of the ticket fields need to be in a specific form for the tool.
         kwargs = _prepare_ticket_fields("edit", kwargs)
         params = kwargs
@@ -313,6 +498,7 @@ class BugzillaTicket(ticket.Ticket):
 
     def add_attachment(self, file_name, data, summary, **kwargs):
         """
+        Files already on the ticket are skipped if set_attachment_dedup() is on.
         :param file_name: The "file name" that will be displayed in the UI for this attachment.
         :param data: A string representing the file to attach.
         :param summary: A short string describing the attachment.
@@ -323,6 +509,11 @@ class BugzillaTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        attached, key = self._find_attachment(data, file_name)
+        if attached:
+            logging.info("File {0} is already attached to ticket {1} as {2}".format(data, self.ticket_id, attached))
+            return self.request_result
+
         # Read the contents from the file path, guess the mimetypes and update the params.
         try:
             f = open(data, "rb")
@@ -359,9 +550,58 @@ class BugzillaTicket(ticket.Ticket):
             error_message = r.json()['message']
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
+        self._record_attachment(key, file_name)
         logging.info("Attached file {0} to ticket {1} - {2}".format(file_name, self.ticket_id, self.ticket_url))
         return self.request_result
 
+    def _list_attachments(self, ticket_id):
+        """
+        :param ticket_id: The id of the ticket.
+        :return: attachments: List of attachment dicts, see Ticket.get_attachments().
+        """
+        r = self.s.get("{0}/{1}/attachment".format(self.rest_url, ticket_id), params={'exclude_fields': 'data'})
+        logging.debug("Get attachments: status code: {0}".format(r.status_code))
+        r.raise_for_status()
+
+        # Bugzilla's API returns 200 even if the request response is not valid. We need to parse r.text.
+        if 'error' in r.json():
+            raise ticket.TicketException(r.json()['message'])
+        return [{'id': attachment['id'],
+                 'file_name': attachment['file_name'],
+                 'size': attachment.get('size'),
+                 'content_type': attachment.get('content_type'),
+                 'url': "{0}/attachment/{1}?include_fields=data".format(self.rest_url, attachment['id']),
+                 'digest': None}
+                for attachment in r.json()['bugs'].get(str(ticket_id), [])]
+
+    def _read_history(self, ticket_id):
+        """
+        :param ticket_id: The id of the ticket.
+        :return: ticket_content: The bug with its history and comments, see Ticket.get_ticket_history().
+        """
+        url = "{0}/{1}".format(self.rest_url, ticket_id)
+        parts = [self._get_history_part(url).json(),
+                 self._get_history_part("{0}/history".format(url)).json(),
+                 self._get_history_part("{0}/comment".format(url)).json()]
+        # Bugzilla's API returns 200 even if the request response is not valid. We need to parse r.text.
+        for part in parts:
+            if 'error' in part:
+                raise ticket.TicketException(part['message'])
+        bug = parts[0]['bugs'][0]
+        bug['history'] = parts[1]['bugs'][0]['history']
+        bug['comments'] = parts[2]['bugs'][str(bug['id'])]['comments']
+        return bug
+
+    def _attachment_chunks(self, attachment, chunk_size):
+        """
+        Streams the content of an attachment, decoding Bugzilla's base64 data as it arrives.
+        :param attachment: An attachment dict.
+        :param chunk_size: Number of bytes read at a time.
+        :return: Generator of bytes.
+        """
+        chunks = super(BugzillaTicket, self)._attachment_chunks(attachment, chunk_size)
+        return attachment_module.decode_base64_field(chunks, 'data')
+
     def change_status(self, status, **kwargs):
         """
         Changes status of a Bugzilla ticket.
@@ -395,6 +635,72 @@ class BugzillaTicket(ticket.Ticket):
         logging.info("Changed status of ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
         return self.request_result
 
+    def _merge_operation(self, payload, method_name, args, kwargs):
+        """
+        Merges edit(), add_comment(), change_status(), add_cc() and remove_cc() into one bug PUT.
+        Comments, including the comment of change_status(), are appended to the comment already merged.
+        Adding and removing the same cc user aren't merged, so they keep their order.
+        :param payload: The dict of the combined request. Only modified if the operation is merged.
+        :param method_name: The name of the recorded Ticket method.
+        :param args: Positional arguments of the recorded call.
+        :param kwargs: Keyword arguments of the recorded call.
+        :return: True if the operation was merged into payload, False if it must be sent on its own.
+        """
+        if method_name == 'edit' and not args and 'diff' not in kwargs:
+            fields = _prepare_ticket_fields("edit", dict(kwargs))
+            if any(isinstance(payload.get(key), dict) for key in fields if key != 'comment'):
+                return False
+            return _merge_fields(payload, fields)
+        if method_name == 'add_comment':
+            extra = dict(kwargs)
+            comment = args[0] if args else extra.pop('comment', None)
+            if not set(extra) <= {'is_private', 'is_markdown'}:
+                return False
+            extra['body'] = comment
+            return _merge_fields(payload, {'comment': extra})
+        if method_name == 'change_status' and len(args) <= 1:
+            fields = dict(kwargs)
+            if args:
+                fields['status'] = args[0]
+            return _merge_fields(payload, fields)
+        if method_name in ['add_cc', 'remove_cc']:
+            user = args[0] if args else kwargs.get('user')
+            if not isinstance(user, list):
+                user = [user]
+            cc = payload.get('cc', {})
+            if not isinstance(cc, dict):
+                return False
+            key = 'add' if method_name == 'add_cc' else 'remove'
+            if set(user) & set(cc.get('remove' if key == 'add' else 'add', [])):
+                return False
+            cc.setdefault(key, []).extend(user)
+            payload['cc'] = cc
+            return True
+        return False
+
+    def _send_merged_request(self, payload):
+        """
+        Sends a combined bug PUT built by _merge_operation().
+        :param payload: The dict of the combined request.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        try:
+            r = self.s.put("{0}/{1}".format(self.rest_url, self.ticket_id), json=payload)
+            logging.debug("Merged update: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error updating ticket")
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=str(e))
+
+        # Bugzilla's API returns 200 even if the request response is not valid. We need to parse r.text.
+        if 'error' in r.json():
+            error_message = r.json()['message']
+            logging.error(error_message)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+        logging.info("Updated ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
+        return self.request_result
+
     def add_cc(self, user):
         """
         Adds user(s) to cc list.
@@ -472,6 +778,30 @@ class BugzillaTicket(ticket.Ticket):
         return self.request_result
 
 
+def _merge_fields(payload, fields):
+    """
+    Merges fields into the payload of a combined bug PUT. A comment is appended to the comment already
+    in the payload, if both have the same options, eg. is_private.
+    :param payload: The dict of the combined request. Only modified if the fields are merged.
+    :param fields: The fields to merge.
+    :return: True if the fields were merged, False if their comment can't be combined.
+    """
+    fields = dict(fields)
+    comment = fields.pop('comment', None)
+    if comment is not None:
+        if not isinstance(comment, dict):
+            comment = {'body': comment}
+        merged = payload.get('comment')
+        if merged is not None:
+            if dict((key, value) for key, value in merged.items() if key != 'body') != \
+                    dict((key, value) for key, value in comment.items() if key != 'body'):
+                return False
+            comment = dict(merged, body='{0}\n\n{1}'.format(merged['body'], comment['body']))
+        payload['comment'] = comment
+    payload.update(fields)
+    return True
+
+
 def _prepare_ticket_fields(operation, fields):
     """
     Makes sure each key value pair in the fields dictionary is in the correct form.
@@ -484,7 +814,7 @@ def _prepare_ticket_fields(operation, fields):
                 fields["groups"] = [fields["groups"]]
             fields["groups"] = {"add": fields["groups"]}
 
-    for key, value in fields.items():
+    for key, value in list(fields.items()):
         if key == 'assignee':
             fields['assigned_to'] = value
             fields.pop('assignee')
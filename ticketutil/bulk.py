@@ -0,0 +1,282 @@
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from . import operation as ticket_operation
+from . import ticket
+
+MANIFEST = 'manifest.json'
+
+
+class BulkRunner(object):
+    """
+    Runs a large stream of ticket operations in parallel worker processes.
+
+    The stream is split into shards by ticket_id, so every operation on a ticket is applied in order
+    by the same worker. Each worker process creates its own Ticket object (and requests Session) from
+    ticket_factory and applies its shard with the regular Ticket methods. Results are written to one
+    JSONL file per shard as operations complete; those files are also the checkpoint, so running again
+    with the same work_dir resumes where an interrupted run stopped.
+    """
+    def __init__(self, ticket_factory, work_dir, shards=4, processes=None, checkpoint_interval=100,
+                 worker_log_level=logging.WARNING):
+        """
+        :param ticket_factory: Picklable callable returning a new Ticket object, eg.
+                               functools.partial(JiraTicket, <url>, <project>, auth='kerberos')
+        :param work_dir: Directory for shard, result, and metrics files.
+        :param shards: Number of shards to split the operation stream into.
+        :param processes: Number of worker processes. Defaults to the number of shards.
+        :param checkpoint_interval: Number of operations between fsync()s of a shard's results.
+        :param worker_log_level: Log level in the worker processes. Per-operation INFO logging is
+                                 expensive at millions of operations.
+        """
+        self.ticket_factory = ticket_factory
+        self.work_dir = work_dir
+        self.shards = shards
+        self.processes = processes or shards
+        self.checkpoint_interval = checkpoint_interval
+        self.worker_log_level = worker_log_level
+
+    def run(self, operations):
+        """
+        Splits operations into shards and applies them in worker processes.
+        If work_dir already holds a split of a previous run, the split is reused and only operations
+        without a result are applied. operations must then be the same as in the previous run, they are
+        read again to check that they match the split.
+        :param operations: A path to a JSONL file, or an iterable of operation dicts.
+        :return: metrics: Dict containing the merged metrics of all shards.
+        :raises TicketException: If work_dir holds the split of different operations.
+        """
+        if not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+
+        manifest = self._read_manifest()
+        if manifest:
+            logging.info("Resuming bulk run in {0}".format(self.work_dir))
+            self.shards = manifest['shards']
+            self._check_manifest(manifest, operations)
+        else:
+            self._split(operations)
+
+        start = time.time()
+        jobs = [(self.ticket_factory, self._shard_path(shard, 'jsonl'), self._shard_path(shard, 'results.jsonl'),
+                 self._shard_path(shard, 'metrics.json'), self.checkpoint_interval, self.worker_log_level)
+                for shard in range(self.shards)]
+        pool = multiprocessing.Pool(min(self.processes, self.shards))
+        try:
+            shard_metrics = pool.map(_run_shard, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        metrics = _merge_metrics(shard_metrics)
+        metrics['elapsed'] = time.time() - start
+        metrics['results'] = self._merge_results()
+        logging.info("Bulk run complete: {0} succeeded, {1} failed".format(metrics['succeeded'], metrics['failed']))
+        return metrics
+
+    def _split(self, operations):
+        """
+        Writes each operation to the JSONL file of its shard.
+        Operations are streamed, so memory use doesn't depend on the size of the input.
+        :param operations: A path to a JSONL file, or an iterable of operation dicts.
+        """
+        shard_files = [io.open(self._shard_path(shard, 'jsonl'), 'w', encoding='utf-8')
+                       for shard in range(self.shards)]
+        digest = hashlib.sha256()
+        count = 0
+        try:
+            for shard, line in _shard_lines(operations, self.shards):
+                shard_files[shard].write(line)
+                digest.update(line.encode('utf-8'))
+                count += 1
+        finally:
+            for shard_file in shard_files:
+                shard_file.close()
+
+        # The manifest is written last. Its presence means the split is complete.
+        with io.open(os.path.join(self.work_dir, MANIFEST), 'w', encoding='utf-8') as f:
+            f.write(u'{0}'.format(json.dumps({'shards': self.shards, 'operations': count,
+                                              'sha256': digest.hexdigest()})))
+
+    def _check_manifest(self, manifest, operations):
+        """
+        Checks that operations are the ones split by the previous run, so that a different input isn't
+        silently ignored in favour of the old split.
+        :param manifest: The manifest of the previous run.
+        :param operations: A path to a JSONL file, or an iterable of operation dicts.
+        """
+        if 'sha256' not in manifest:
+            return
+        digest = hashlib.sha256()
+        count = 0
+        for shard, line in _shard_lines(operations, self.shards):
+            digest.update(line.encode('utf-8'))
+            count += 1
+        if count != manifest['operations'] or digest.hexdigest() != manifest['sha256']:
+            raise ticket.TicketException("Operations don't match the bulk run in {0}, resume it with the same "
+                                         "operations or use a new work_dir".format(self.work_dir))
+
+    def _read_manifest(self):
+        """
+        :return: manifest: Dict describing a previous split of this work_dir, or None.
+        """
+        try:
+            with io.open(os.path.join(self.work_dir, MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def _merge_results(self):
+        """
+        Concatenates the per-shard result files into results.jsonl.
+        :return: path: The path of the merged results file.
+        """
+        path = os.path.join(self.work_dir, 'results.jsonl')
+        with io.open(path, 'wb') as merged:
+            for shard in range(self.shards):
+                with io.open(self._shard_path(shard, 'results.jsonl'), 'rb') as f:
+                    for line in f:
+                        merged.write(line)
+        return path
+
+    def _shard_path(self, shard, suffix):
+        return os.path.join(self.work_dir, 'shard-{0:04d}.{1}'.format(shard, suffix))
+
+
+def _shard_lines(operations, shards):
+    """
+    Yields the shard and the JSONL line of every operation. Operations without an id get their line number.
+    """
+    for line_number, item in enumerate(_iter_operations(operations)):
+        shard = ticket_operation.shard_for(item, shards, default_key=line_number)
+        if item.get('id') is None:
+            item['id'] = line_number
+        yield shard, u'{0}\n'.format(json.dumps(item))
+
+
+def _iter_operations(operations):
+    """
+    Yields operation dicts from a JSONL file path or an iterable.
+    """
+    if isinstance(operations, str):
+        with io.open(operations, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield ticket_operation.parse_operation(line)
+    else:
+        for item in operations:
+            yield dict(item)
+
+
+def _completed_operations(results_path):
+    """
+    Counts complete lines in a shard's results file, truncating a partially written last line.
+    :param results_path: The path of the shard's results file.
+    :return: completed: Number of operations with a result.
+    """
+    if not os.path.exists(results_path):
+        return 0
+    completed = 0
+    good_size = 0
+    with io.open(results_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            completed += 1
+            good_size += len(line)
+    if good_size != os.path.getsize(results_path):
+        with io.open(results_path, 'rb+') as f:
+            f.truncate(good_size)
+    return completed
+
+
+def _run_shard(job):
+    """
+    Applies the operations of one shard. Runs in a worker process.
+    :param job: Tuple of (ticket_factory, shard_path, results_path, metrics_path, checkpoint_interval,
+                log_level).
+    :return: metrics: Dict containing the shard's metrics.
+    """
+    ticket_factory, shard_path, results_path, metrics_path, checkpoint_interval, log_level = job
+    logging.getLogger().setLevel(log_level)
+
+    metrics = {'shards': 1, 'total': 0, 'succeeded': 0, 'failed': 0, 'resumed': 0, 'operations': {}}
+    skip = _completed_operations(results_path)
+    metrics['resumed'] = skip
+
+    start = time.time()
+    ticket_object = None
+    with io.open(shard_path, encoding='utf-8') as operations, io.open(results_path, 'a', encoding='utf-8') as results:
+        for line_number, line in enumerate(operations):
+            if line_number < skip:
+                continue
+            item = ticket_operation.parse_operation(line)
+            if ticket_object is None:
+                try:
+                    ticket_object = ticket_factory()
+                except ticket.TicketException as e:
+                    logging.error("Error creating Ticket object for {0}".format(shard_path))
+                    logging.error(e)
+                    metrics['error_message'] = str(e)
+                    break
+
+            result = ticket_operation.apply_operation(ticket_object, item)
+            results.write(u'{0}\n'.format(json.dumps(result)))
+            results.flush()
+
+            metrics['total'] += 1
+            if result['status'] == 'Success':
+                metrics['succeeded'] += 1
+            else:
+                metrics['failed'] += 1
+            counts = metrics['operations'].setdefault(item['operation'], {'Success': 0, 'Failure': 0})
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+
+            if metrics['total'] % checkpoint_interval == 0:
+                os.fsync(results.fileno())
+        os.fsync(results.fileno())
+
+    if ticket_object is not None:
+        ticket_object.close_requests_session()
+
+    metrics['busy_time'] = time.time() - start
+    with io.open(metrics_path, 'w', encoding='utf-8') as f:
+        f.write(u'{0}'.format(json.dumps(metrics)))
+    return metrics
+
+
+def _merge_metrics(shard_metrics):
+    """
+    Sums the metrics of all shards.
+    :param shard_metrics: List of metrics dicts returned by _run_shard().
+    :return: metrics: The merged metrics dict.
+    """
+    metrics = {'shards': 0, 'total': 0, 'succeeded': 0, 'failed': 0, 'resumed': 0, 'busy_time': 0.0,
+               'operations': {}, 'errors': []}
+    for shard in shard_metrics:
+        for key in ['shards', 'total', 'succeeded', 'failed', 'resumed', 'busy_time']:
+            metrics[key] += shard[key]
+        for name, counts in shard['operations'].items():
+            merged = metrics['operations'].setdefault(name, {})
+            for status, count in counts.items():
+                merged[status] = merged.get(status, 0) + count
+        if 'error_message' in shard:
+            metrics['errors'].append(shard['error_message'])
+    return metrics
+
+
+def main():
+    """
+    main() function, not directly callable.
+    :return:
+    """
+    print("Not directly executable")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import csv
+import functools
+import io
+import json
+import logging
+import os
+import sys
+import threading
+
+from . import bugzilla
+from . import jira
+from . import operation as ticket_operation
+from . import pipeline
+from . import redmine
+from . import rt
+from . import servicenow
+from . import ticket
+from . import transport
+
+TOOLS = {'jira': jira.JiraTicket,
+         'rt': rt.RTTicket,
+         'redmine': redmine.RedmineTicket,
+         'bugzilla': bugzilla.BugzillaTicket,
+         'servicenow': servicenow.ServiceNowTicket}
+
+USAGE_EXAMPLE = """
+Operations are read one per line (JSONL) or one per row (CSV), eg.
+  {"operation": "create", "args": ["Ticket summary", "Ticket description"]}
+  {"operation": "comment", "ticket_id": "KEY-12", "args": ["A comment"]}
+  {"operation": "edit", "ticket_id": "KEY-12", "kwargs": {"priority": "Major"}}
+
+CSV files need an 'operation' column and may have 'id', 'ticket_id' and 'args'
+(a JSON list) columns. Every other non-empty column is passed as a keyword argument.
+
+Results are written as JSONL in the order operations complete. Operations on the
+same ticket are applied one at a time, in input order. A line that can't be parsed
+gets a Failure result.
+"""
+
+
+def build_parser():
+    """
+    Creates the argument parser of the ticketutil command.
+    :return: parser: argparse.ArgumentParser.
+    """
+    parser = argparse.ArgumentParser(prog='ticketutil',
+                                     description='Stream ticket operations from JSONL or CSV to a ticketing tool.',
+                                     epilog=USAGE_EXAMPLE,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tool', choices=sorted(TOOLS), help='Ticketing tool')
+    parser.add_argument('url', help='URL of the ticketing tool')
+    parser.add_argument('project', help='Project, queue, product or table to work in')
+    parser.add_argument('-i', '--input', default='-', help='Operations file, - for stdin (default)')
+    parser.add_argument('-o', '--output', default='-', help='Results file, - for stdout (default)')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'],
+                        help='Input format. Guessed from the input file extension, jsonl for stdin')
+    parser.add_argument('--auth', choices=['kerberos', 'basic', 'api_key'], default='basic',
+                        help='Authentication method (default: basic)')
+    parser.add_argument('--user', default=os.environ.get('TICKETUTIL_USER'),
+                        help='Username for basic auth. Defaults to $TICKETUTIL_USER')
+    parser.add_argument('--password', default=os.environ.get('TICKETUTIL_PASSWORD'),
+                        help='Password for basic auth. Defaults to $TICKETUTIL_PASSWORD')
+    parser.add_argument('--api-key', default=os.environ.get('TICKETUTIL_API_KEY'),
+                        help='Bugzilla API key. Defaults to $TICKETUTIL_API_KEY')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='Number of operations in flight (default: 4)')
+    parser.add_argument('-r', '--rate', type=float, help='Maximum requests per second to the tool')
+    parser.add_argument('--checkpoint', help='Checkpoint file. An existing checkpoint is resumed from')
+    parser.add_argument('--checkpoint-interval', type=int, default=100,
+                        help='Operations between checkpoint writes (default: 100)')
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the ticketutil command.
+    :param argv: Command line arguments. Defaults to sys.argv[1:].
+    :return: exit_code: 0 if every operation succeeded, 1 otherwise, 2 if the ticketing tool couldn't be used
+             and 130 if interrupted.
+    """
+    args = build_parser().parse_args(argv)
+
+    if args.auth == 'kerberos':
+        auth = 'kerberos'
+    elif args.auth == 'api_key':
+        auth = {'api_key': args.api_key}
+    else:
+        auth = (args.user, args.password)
+
+    if args.rate:
+        transport.set_default_scheduler(transport.RequestScheduler(concurrency=args.concurrency, rate=args.rate))
+
+    input_format = args.format
+    if input_format is None:
+        input_format = 'csv' if args.input.lower().endswith('.csv') else 'jsonl'
+
+    checkpoint = Checkpoint(args.checkpoint, args.checkpoint_interval)
+    pool = ticket_operation.TicketPool(functools.partial(TOOLS[args.tool], args.url, args.project, auth=auth),
+                                       size=args.concurrency)
+
+    input_file = sys.stdin if args.input == '-' else io.open(args.input, encoding='utf-8', newline='')
+    mode = 'a' if checkpoint.resumed else 'w'
+    output_file = sys.stdout if args.output == '-' else io.open(args.output, mode, encoding='utf-8')
+
+    failures = 0
+    try:
+        operations = read_operations(input_file, input_format, checkpoint)
+        run = pipeline.Pipeline(operations, buffer=args.concurrency * 2)
+        run.map(functools.partial(_apply, pool), concurrency=args.concurrency, name='apply', key=_ticket_key)
+        for result in run:
+            output_file.write(u'{0}\n'.format(json.dumps(result)))
+            output_file.flush()
+            checkpoint.done(result['id'])
+            if result['status'] != 'Success':
+                failures += 1
+    except ticket.TicketException as e:
+        logging.error(e)
+        return 2
+    except KeyboardInterrupt:
+        logging.error("Interrupted, operations in flight may have been applied without a result")
+        return 130
+    finally:
+        # Whatever stopped the run, a resumed run must not apply the written results again.
+        checkpoint.save()
+        pool.close()
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    logging.info("Completed operations with {0} failures".format(failures))
+    return 1 if failures else 0
+
+
+def read_operations(input_file, input_format, checkpoint=None):
+    """
+    Lazily reads operations from a JSONL or CSV file.
+    Operations without an id get their line (or row) number as id. A line (or row) that can't be parsed
+    is yielded as an operation with an 'invalid' key holding the error, so that it gets a Failure result.
+    :param input_file: File object to read.
+    :param input_format: 'jsonl' or 'csv'.
+    :param checkpoint: Checkpoint whose completed operations are skipped.
+    :return: Generator of operation dicts.
+    """
+    if input_format == 'csv':
+        rows = (_parse(_csv_operation, row) for row in csv.DictReader(input_file))
+    else:
+        rows = (_parse(ticket_operation.parse_operation, line) for line in input_file if line.strip())
+
+    for number, item in enumerate(rows):
+        if item.get('id') is None:
+            item['id'] = number
+        if checkpoint is not None:
+            if checkpoint.is_done(number):
+                continue
+            checkpoint.started(item['id'], number)
+        yield item
+
+
+def _parse(parser, line):
+    """
+    Parses a line (or row), returning an invalid operation instead of raising.
+    """
+    try:
+        return parser(line)
+    except (ValueError, KeyError, ticket.TicketException) as e:
+        error_message = "Error parsing operation: {0}".format(e)
+        logging.error(error_message)
+        return {'operation': None, 'invalid': error_message}
+
+
+def _apply(pool, item):
+    """
+    Applies an operation through the pool, or returns a Failure result for an invalid one.
+    """
+    if 'invalid' in item:
+        return {'id': item['id'], 'operation': None, 'ticket_id': None,
+                'status': 'Failure', 'error_message': item['invalid'], 'url': None}
+    return pool.apply(item)
+
+
+def _ticket_key(item):
+    """
+    Operations on the same ticket share a key, so they are applied in order. Creates are independent.
+    """
+    if item.get('ticket_id') is not None:
+        return str(item['ticket_id'])
+    return ('id', item['id'])
+
+
+def _csv_operation(row):
+    """
+    Converts a CSV row to an operation dict.
+    """
+    item = {'operation': row.pop('operation'),
+            'id': row.pop('id', None) or None,
+            'ticket_id': row.pop('ticket_id', None) or None,
+            'args': json.loads(row.pop('args', None) or '[]')}
+    item['kwargs'] = dict((key, value) for key, value in row.items() if key and value not in (None, ''))
+    return item
+
+
+class Checkpoint(object):
+    """
+    Tracks which input lines are complete so that an interrupted run can resume.
+    Operations complete out of order, so the checkpoint stores the number of leading lines that are all
+    complete plus the few complete lines after them. Memory stays bounded by the number of operations
+    in flight.
+    """
+    def __init__(self, path, interval=100):
+        self.path = path
+        self.interval = interval
+        self.done_below = 0
+        self.completed = set()
+        self.resumed = False
+        self._line_numbers = {}
+        self._since_save = 0
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                state = json.load(f)
+            self.done_below = state['done_below']
+            self.completed = set(state['completed'])
+            self.resumed = True
+            logging.info("Resuming from line {0}".format(self.done_below))
+
+    def is_done(self, number):
+        return number < self.done_below or number in self.completed
+
+    def started(self, op_id, number):
+        with self._lock:
+            self._line_numbers[op_id] = number
+
+    def done(self, op_id):
+        with self._lock:
+            number = self._line_numbers.pop(op_id, None)
+            if number is None:
+                return
+            self.completed.add(number)
+            while self.done_below in self.completed:
+                self.completed.remove(self.done_below)
+                self.done_below += 1
+            self._since_save += 1
+        if self._since_save >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Atomically writes the checkpoint file.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            state = {'done_below': self.done_below, 'completed': sorted(self.completed)}
+        temporary = '{0}.tmp'.format(self.path)
+        with io.open(temporary, 'w', encoding='utf-8') as f:
+            f.write(u'{0}'.format(json.dumps(state)))
+        os.replace(temporary, self.path)
+        self._since_save = 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import csv
+import io
+import logging
+import multiprocessing
+import time
+from collections import deque, namedtuple
+
+from . import ticket
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Per tool, the fields requested from search() and the columns they are flattened into.
+# Columns are (name, path into the ticket dict, type), with type 'string' or 'int'.
+SCHEMAS = {
+    'JIRA': {
+        'fields': ['summary', 'status', 'priority', 'issuetype', 'assignee', 'reporter', 'resolution',
+                   'labels', 'created', 'updated', 'resolutiondate'],
+        'columns': [('key', ('key',), 'string'),
+                    ('summary', ('fields', 'summary'), 'string'),
+                    ('status', ('fields', 'status', 'name'), 'string'),
+                    ('priority', ('fields', 'priority', 'name'), 'string'),
+                    ('type', ('fields', 'issuetype', 'name'), 'string'),
+                    ('assignee', ('fields', 'assignee', 'name'), 'string'),
+                    ('reporter', ('fields', 'reporter', 'name'), 'string'),
+                    ('resolution', ('fields', 'resolution', 'name'), 'string'),
+                    ('labels', ('fields', 'labels'), 'string'),
+                    ('created', ('fields', 'created'), 'string'),
+                    ('updated', ('fields', 'updated'), 'string'),
+                    ('resolved', ('fields', 'resolutiondate'), 'string')]},
+    'Bugzilla': {
+        'fields': ['id', 'summary', 'status', 'resolution', 'priority', 'severity', 'component', 'assigned_to',
+                   'creator', 'creation_time', 'last_change_time'],
+        'columns': [('id', ('id',), 'int'),
+                    ('summary', ('summary',), 'string'),
+                    ('status', ('status',), 'string'),
+                    ('resolution', ('resolution',), 'string'),
+                    ('priority', ('priority',), 'string'),
+                    ('severity', ('severity',), 'string'),
+                    ('component', ('component',), 'string'),
+                    ('assigned_to', ('assigned_to',), 'string'),
+                    ('creator', ('creator',), 'string'),
+                    ('created', ('creation_time',), 'string'),
+                    ('updated', ('last_change_time',), 'string')]},
+    'Redmine': {
+        'fields': ['id', 'subject', 'tracker', 'status', 'priority', 'author', 'assigned_to', 'created_on',
+                   'updated_on', 'closed_on'],
+        'columns': [('id', ('id',), 'int'),
+                    ('subject', ('subject',), 'string'),
+                    ('tracker', ('tracker', 'name'), 'string'),
+                    ('status', ('status', 'name'), 'string'),
+                    ('priority', ('priority', 'name'), 'string'),
+                    ('author', ('author', 'name'), 'string'),
+                    ('assigned_to', ('assigned_to', 'name'), 'string'),
+                    ('created', ('created_on',), 'string'),
+                    ('updated', ('updated_on',), 'string'),
+                    ('closed', ('closed_on',), 'string')]},
+    'RT': {
+        'fields': ['Subject', 'Queue', 'Status', 'Owner', 'Requestors', 'Priority', 'Created', 'LastUpdated',
+                   'Resolved'],
+        'columns': [('id', ('id',), 'string'),
+                    ('subject', ('Subject',), 'string'),
+                    ('queue', ('Queue',), 'string'),
+                    ('status', ('Status',), 'string'),
+                    ('owner', ('Owner',), 'string'),
+                    ('requestors', ('Requestors',), 'string'),
+                    ('priority', ('Priority',), 'string'),
+                    ('created', ('Created',), 'string'),
+                    ('updated', ('LastUpdated',), 'string'),
+                    ('resolved', ('Resolved',), 'string')]},
+    'ServiceNow': {
+        'fields': ['number', 'short_description', 'state', 'priority', 'impact', 'urgency', 'assigned_to',
+                   'opened_by', 'opened_at', 'sys_updated_on', 'closed_at'],
+        'columns': [('number', ('number',), 'string'),
+                    ('short_description', ('short_description',), 'string'),
+                    ('state', ('state',), 'string'),
+                    ('priority', ('priority',), 'string'),
+                    ('impact', ('impact',), 'string'),
+                    ('urgency', ('urgency',), 'string'),
+                    ('assigned_to', ('assigned_to', 'value'), 'string'),
+                    ('opened_by', ('opened_by', 'value'), 'string'),
+                    ('opened', ('opened_at',), 'string'),
+                    ('updated', ('sys_updated_on',), 'string'),
+                    ('closed', ('closed_at',), 'string')]},
+}
+
+ExportStats = namedtuple('ExportStats', ['rows', 'batches', 'seconds', 'rows_per_second'])
+
+
+def export(ticket_object, path, output_format='parquet', query=None, schema=None, batch_size=10000,
+           processes=None, page_size=100, prefetch=2):
+    """
+    Exports the tickets matching a search to a Parquet or CSV file, batch_size tickets at a time.
+    Tickets are streamed from search(), flattened into columns and written as record batches, so memory
+    is bounded by the batch size however many tickets are exported.
+    :param ticket_object: A Ticket object, eg. a JiraTicket.
+    :param path: The file to write.
+    :param output_format: 'parquet' or 'csv'. Parquet needs pyarrow. Without pyarrow, CSV is written
+                          with the csv module.
+    :param query: A search() query. Defaults to every ticket in the project.
+    :param schema: Dict of 'fields' and 'columns', see SCHEMAS. Defaults to the tool's schema.
+    :param batch_size: Number of tickets per record batch.
+    :param processes: Number of processes flattening batches. Flattens in this process by default.
+    :param page_size: Number of tickets fetched per request.
+    :param prefetch: Number of pages fetched ahead of the one being consumed.
+    :return: ExportStats named tuple with rows, batches, seconds and rows_per_second.
+    """
+    schema = schema or SCHEMAS.get(ticket_object.ticketing_tool)
+    if schema is None:
+        raise ticket.TicketException("No export schema for {0}".format(ticket_object.ticketing_tool))
+    if output_format not in ('parquet', 'csv'):
+        raise ticket.TicketException("Unknown export format {0}".format(output_format))
+    if output_format == 'parquet' and pyarrow is None:
+        raise ticket.TicketException("Exporting to Parquet requires pyarrow")
+
+    start = time.time()
+    items = ticket_object.search(query, schema['fields'], page_size, prefetch)
+    batches = _batches(items, batch_size)
+    columns = schema['columns']
+    if processes:
+        pool = multiprocessing.Pool(processes)
+        flattened = _flatten_in_pool(pool, batches, columns, processes * 2)
+    else:
+        pool = None
+        flattened = (flatten(columns, batch) for batch in batches)
+
+    writer = _writer(path, output_format, columns)
+    rows = 0
+    count = 0
+    try:
+        for data in flattened:
+            writer.write(data)
+            rows += len(data[columns[0][0]])
+            count += 1
+            logging.debug("Exported {0} tickets".format(rows))
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.terminate()
+
+    seconds = time.time() - start
+    stats = ExportStats(rows, count, seconds, rows / seconds if seconds else 0.0)
+    logging.info("Exported {0} tickets to {1} in {2:.1f}s ({3:.0f} tickets/s)".format(
+        rows, path, seconds, stats.rows_per_second))
+    return stats
+
+
+def flatten(columns, items):
+    """
+    Flattens ticket dicts into columns.
+    Lists are joined with commas, and values missing from a ticket are None.
+    :param columns: List of (name, path, type) tuples.
+    :param items: List of ticket dicts.
+    :return: data: Dict of column name to list of values.
+    """
+    data = {}
+    for name, path, column_type in columns:
+        values = []
+        for item in items:
+            value = item
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if isinstance(value, list):
+                value = ','.join(str(element.get('name', element) if isinstance(element, dict) else element)
+                                 for element in value)
+            if value is None or value == '':
+                values.append(None)
+            elif column_type == 'int':
+                values.append(int(value))
+            else:
+                values.append(str(value))
+        data[name] = values
+    return data
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _flatten_in_pool(pool, batches, columns, window):
+    """
+    Flattens batches in a process pool, in order, with at most window batches in flight.
+    """
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(flatten, (columns, batch)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _writer(path, output_format, columns):
+    if pyarrow is None:
+        return _CsvWriter(path, columns)
+    return _ArrowWriter(path, output_format, columns)
+
+
+class _ArrowWriter(object):
+    """
+    Writes record batches to Parquet or CSV with pyarrow.
+    """
+    def __init__(self, path, output_format, columns):
+        types = {'string': pyarrow.string(), 'int': pyarrow.int64()}
+        self.schema = pyarrow.schema([(name, types[column_type]) for name, path, column_type in columns])
+        if output_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.csv.CSVWriter(path, self.schema)
+
+    def write(self, data):
+        self.writer.write_batch(pyarrow.RecordBatch.from_pydict(data, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class _CsvWriter(object):
+    """
+    Writes batches to CSV with the csv module, when pyarrow isn't installed.
+    """
+    def __init__(self, path, columns):
+        self.names = [name for name, path, column_type in columns]
+        self.file = io.open(path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.names)
+
+    def write(self, data):
+        self.writer.writerows(zip(*[data[name] for name in self.names]))
+
+    def close(self):
+        self.file.close()
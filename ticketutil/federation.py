@@ -0,0 +1,188 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from . import ticket
+
+Hit = namedtuple('Hit', ['instance', 'item'])
+
+_ITEM = 'item'
+_DONE = 'done'
+_ERROR = 'error'
+
+
+class Federation(object):
+    """
+    Runs reads and searches across many instances of ticketing tools in parallel, eg. one JIRA
+    per business unit.
+
+    Every instance is queried by its own thread, and results are yielded as they arrive from any
+    instance, so a slow instance doesn't hold back the others. An instance that doesn't finish
+    within its timeout is given up on, and reported in the results' errors.
+
+    federation = Federation({'emea': JiraTicket(<emea_url>, <project>, auth='kerberos'),
+                             'apac': JiraTicket(<apac_url>, <project>, auth='kerberos')}, timeout=10)
+    results = federation.search('"External Reference" ~ "CASE-1234"', fields=['summary'])
+    for hit in results:
+        print(hit.instance, hit.item['key'])
+    print(results.errors)
+    """
+    def __init__(self, tickets, timeout=30, buffer=100):
+        """
+        :param tickets: Dict of instance name to Ticket object. A list of Ticket objects is named by URL.
+        :param timeout: Seconds each instance has to finish a call, or a dict of instance name to seconds.
+                        None waits for every instance.
+        :param buffer: Number of results buffered ahead of the consumer.
+        """
+        if not isinstance(tickets, dict):
+            tickets = dict((ticket_object.url, ticket_object) for ticket_object in tickets)
+        self.tickets = tickets
+        self.timeout = timeout
+        self.buffer = buffer
+        # Ticket objects aren't shared between threads. An instance still busy with a call that timed
+        # out is skipped.
+        self._busy = dict((name, threading.Lock()) for name in tickets)
+
+    def search(self, query=None, fields=None, page_size=100, timeout=None):
+        """
+        Searches every instance, yielding tickets as they arrive from any of them.
+        :param query: A query for Ticket.search(), or a function taking a Ticket object and returning its
+                      query, eg. to build JQL for JIRA instances and a dict for Bugzilla ones.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of tickets fetched per request.
+        :param timeout: Overrides the Federation's timeout for this call.
+        :return: Results: Iterable of Hit named tuples of instance and ticket.
+        """
+        def search(ticket_object):
+            return ticket_object.search(query(ticket_object) if callable(query) else query, fields, page_size)
+        return self.fan_out(search, timeout)
+
+    def get_ticket_content(self, ticket_id, fields=None, timeout=None):
+        """
+        Reads a ticket from every instance that has it.
+        Instances without the ticket are completed without a hit. Instances failing otherwise are in the
+        results' errors.
+        :param ticket_id: The ticket to get.
+        :param fields: Optional list of field names to return.
+        :param timeout: Overrides the Federation's timeout for this call.
+        :return: Results: Iterable of Hit named tuples of instance and ticket content.
+        """
+        def read(ticket_object):
+            result = ticket_object.get_ticket_content(ticket_id, fields)
+            if result.status != 'Failure':
+                return [result.ticket_content]
+            if result.error_message == ticket.NOT_FOUND.format(ticket_id):
+                return []
+            raise ticket.TicketException(result.error_message)
+        return self.fan_out(read, timeout)
+
+    def fan_out(self, func, timeout=None):
+        """
+        Calls a function with every instance's Ticket object in parallel.
+        :param func: Function taking a Ticket object and returning an iterable of items.
+        :param timeout: Overrides the Federation's timeout for this call.
+        :return: Results: Iterable of Hit named tuples of instance and item, in the order items arrive.
+        """
+        return Results(self, func, self.timeout if timeout is None else timeout)
+
+
+class Results(object):
+    """
+    The results of a Federation call. Iterating starts the call on every instance.
+
+    After iterating, completed lists the instances that returned all their results, and errors maps
+    the others to the reason they didn't, eg. a timeout.
+    """
+    def __init__(self, federation, func, timeout):
+        self.federation = federation
+        self.func = func
+        self.timeout = timeout
+        self.completed = []
+        self.errors = {}
+
+    def __iter__(self):
+        return self._run()
+
+    def _run(self):
+        buffered = queue.Queue(maxsize=max(self.federation.buffer, 1))
+        start = time.time()
+        stopped = {}
+        deadlines = {}
+        for name, ticket_object in self.federation.tickets.items():
+            lock = self.federation._busy[name]
+            if not lock.acquire(False):
+                self.errors[name] = "Busy with an earlier call"
+                continue
+            timeout = self.timeout.get(name) if isinstance(self.timeout, dict) else self.timeout
+            deadlines[name] = start + timeout if timeout is not None else None
+            stopped[name] = threading.Event()
+            thread = threading.Thread(target=self._produce, args=(name, ticket_object, lock, buffered, stopped[name]),
+                                      name='ticketutil-federation-{0}'.format(name))
+            thread.daemon = True
+            thread.start()
+
+        pending = set(stopped)
+        try:
+            while pending:
+                now = time.time()
+                for name in [name for name in pending if deadlines[name] is not None and deadlines[name] <= now]:
+                    self.errors[name] = "Timed out after {0}s".format(deadlines[name] - start)
+                    logging.warning("Instance {0} timed out".format(name))
+                    stopped[name].set()
+                    pending.discard(name)
+                if not pending:
+                    break
+                waits = [deadlines[name] - now for name in pending if deadlines[name] is not None]
+                try:
+                    name, kind, value = buffered.get(timeout=min(waits) if waits else None)
+                except queue.Empty:
+                    continue
+                if name not in pending:
+                    continue
+                if kind == _ITEM:
+                    yield Hit(name, value)
+                elif kind == _DONE:
+                    self.completed.append(name)
+                    pending.discard(name)
+                else:
+                    logging.error("Error querying instance {0}".format(name))
+                    logging.error(value)
+                    self.errors[name] = str(value)
+                    pending.discard(name)
+        finally:
+            for event in stopped.values():
+                event.set()
+
+    def _produce(self, name, ticket_object, lock, buffered, stopped):
+        """
+        Queues the items of one instance, in its own thread.
+        """
+        items = None
+        try:
+            items = self.func(ticket_object)
+            for item in items:
+                if not _put_unless_stopped(buffered, (name, _ITEM, item), stopped):
+                    return
+            _put_unless_stopped(buffered, (name, _DONE, None), stopped)
+        except Exception as e:
+            _put_unless_stopped(buffered, (name, _ERROR, e), stopped)
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+            lock.release()
+
+
+def _put_unless_stopped(buffered, item, stopped):
+    """
+    Puts item in the queue, giving up if the consumer stopped.
+    :return: True if the item was queued.
+    """
+    while not stopped.is_set():
+        try:
+            buffered.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    namespace TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (namespace, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS fingerprints_created ON fingerprints (created);
+"""
+
+
+def fingerprint(*parts):
+    """
+    Returns a stable fingerprint of JSON serializable values.
+    Dicts are serialized with sorted keys, so the order fields were passed in doesn't matter.
+    Strings holding a JSON document, like the ServiceNow create payload, are decoded first.
+    :param parts: Values to fingerprint, eg. the tool, project and create payload.
+    :return: fingerprint: Hex encoded SHA-256 digest.
+    """
+    normalized = []
+    for part in parts:
+        if isinstance(part, str):
+            try:
+                part = json.loads(part)
+            except ValueError:
+                pass
+        normalized.append(part)
+    data = json.dumps(normalized, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class FingerprintIndex(object):
+    """
+    A local, bounded index of fingerprint -> value with a time to live.
+
+    Used by Ticket.set_idempotency_index() to remember which create payloads already made a ticket.
+    Entries are kept in SQLite, in memory by default or in a file to survive restarts. When the index
+    grows past max_entries, the oldest entries are dropped.
+    """
+    def __init__(self, path=':memory:', max_entries=100000, ttl=7 * 24 * 3600):
+        """
+        :param path: Path of the SQLite database, or ':memory:'.
+        :param max_entries: Maximum number of entries kept.
+        :param ttl: Seconds an entry is kept.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._entries = self._db.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def get(self, key, namespace='create'):
+        """
+        :param key: The fingerprint.
+        :param namespace: Keeps different kinds of fingerprints apart.
+        :return: value: The stored value, or None if missing or expired.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT value FROM fingerprints WHERE namespace = ? AND fingerprint = ? '
+                                   'AND created >= ?', (namespace, key, time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, value, namespace='create'):
+        """
+        Stores a value, replacing any previous value for the fingerprint.
+        :param key: The fingerprint.
+        :param value: A JSON serializable value, eg. a ticket_id.
+        :param namespace: Keeps different kinds of fingerprints apart.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute('INSERT OR REPLACE INTO fingerprints (namespace, fingerprint, value, created) '
+                                      'VALUES (?, ?, ?, ?)', (namespace, key, json.dumps(value), now))
+            self._entries += cursor.rowcount
+            if self._entries > self.max_entries:
+                self._prune(now)
+            self._db.commit()
+
+    def delete(self, key, namespace='create'):
+        """
+        Removes a fingerprint.
+        :param key: The fingerprint.
+        :param namespace: Keeps different kinds of fingerprints apart.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM fingerprints WHERE namespace = ? AND fingerprint = ?', (namespace, key))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _prune(self, now):
+        """
+        Drops expired entries, then the oldest entries beyond max_entries.
+        Pruning down to 90% of max_entries keeps it from running on every put.
+        """
+        self._db.execute('DELETE FROM fingerprints WHERE created < ?', (now - self.ttl,))
+        count = self._db.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+        keep = int(self.max_entries * 0.9)
+        if count > keep:
+            self._db.execute('DELETE FROM fingerprints WHERE rowid IN '
+                             '(SELECT rowid FROM fingerprints ORDER BY created LIMIT ?)', (count - keep,))
+            count = keep
+        self._entries = count
@@ -1,8 +1,12 @@
 import logging
+import os
+import re
 from collections import namedtuple
 
 import requests
 
+from . import mirror
+from . import sync
 from . import ticket
 
 __author__ = 'dranck, rnester, kshirsal'
@@ -12,6 +16,9 @@ class JiraTicket(ticket.Ticket):
     """
     A JIRA Ticket object. Contains JIRA-specific methods for working with tickets.
     """
+    # Fields search() must return for SyncEngine.
+    _sync_fields = ['updated']
+
     def __init__(self, url, project, auth=None, ticket_id=None):
         self.ticketing_tool = 'JIRA'
 
@@ -92,6 +99,38 @@ class JiraTicket(ticket.Ticket):
                 logging.error(e)
             return False
 
+    def get_ticket_content(self, ticket_id=None, fields=None):
+        """
+        Gets the content of a ticket.
+        :param ticket_id: The ticket to get. Defaults to the current ticket.
+        :param fields: Optional list of field names to return, eg. ['summary', 'status']. Only these fields
+                       are requested from JIRA. Defaults to all fields.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, the issue as returned by JIRA.
+        """
+        if ticket_id is None:
+            ticket_id = self.ticket_id
+            if not self.ticket_id:
+                error_message = "No ticket ID associated with ticket object. " \
+                                "Set ticket ID with set_ticket_id(<ticket_id>)"
+                logging.error(error_message)
+                return self.request_result._replace(status='Failure', error_message=error_message)
+
+        params = {'fields': ','.join(fields)} if fields else None
+        try:
+            r = self.s.get("{0}/{1}".format(self.rest_url, ticket_id), params=params)
+            logging.debug("Get ticket content: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            error_message = ticket.content_error_message(ticket_id, e)
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
+        ticket_content = r.json()
+        self._mirror_content(ticket_content, partial=bool(fields))
+        return self.request_result._replace(ticket_content=ticket_content)
+
     def create(self, summary, description, **kwargs):
         """
         Creates a ticket.
@@ -114,7 +153,7 @@ class JiraTicket(ticket.Ticket):
         params = self._create_ticket_parameters(summary, description, kwargs)
 
         # Create our ticket.
-        return self._create_ticket_request(params)
+        return self._create_ticket(params, summary, description)
 
     def _create_ticket_parameters(self, summary, description, fields):
         """
@@ -166,7 +205,8 @@ class JiraTicket(ticket.Ticket):
             logging.debug("Create ticket: status code: {0}".format(r.status_code))
             r.raise_for_status()
         except requests.RequestException as e:
-            error_message = "Error creating ticket - {0}".format(list(r.json()['errors'].values())[0])
+            self._create_error = e
+            error_message = "Error creating ticket - {0}".format(_error_reason(e))
             logging.error(error_message)
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=error_message)
@@ -178,10 +218,155 @@ class JiraTicket(ticket.Ticket):
         logging.info("Created ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
         return self.request_result
 
-    def edit(self, **kwargs):
+    def _find_created_ticket(self, params):
+        """
+        Searches for a ticket created in the last day with the summary and description of params.
+        :param params: The payload from _create_ticket_parameters().
+        :return: ticket_id: The key of the matching ticket, or None.
+        """
+        fields = params['fields']
+        summary = fields['summary'].replace('\\', '\\\\').replace('"', '\\"')
+        jql = 'project = "{0}" AND summary ~ "\\"{1}\\"" AND created >= -1d ORDER BY created DESC'.format(
+            self.project, summary)
+        try:
+            r = self.s.get("{0}/rest/api/2/search".format(self.url),
+                           params={'jql': jql, 'fields': 'summary,description', 'maxResults': 10})
+            logging.debug("Find created ticket: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error searching for created ticket")
+            logging.error(e)
+            return
+
+        for issue in r.json()['issues']:
+            if issue['fields']['summary'] == fields['summary'] and \
+                    issue['fields']['description'] == fields['description']:
+                return issue['key']
+
+    def _search_pages(self, query, fields, page_size):
+        """
+        Fetches the project's issues matching a JQL query, eg. 'status = Open ORDER BY created', page by page.
+        :param query: JQL, restricted to the project.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of issues fetched per request.
+        :return: Generator of lists of issues.
+        """
+        params = self._search_params(query, fields, page_size)
+        start_at = 0
+        while True:
+            params['startAt'] = start_at
+            page = self._get_search_page("{0}/rest/api/2/search".format(self.url), params).json()
+            issues = page['issues']
+            if issues:
+                yield issues
+            start_at += len(issues)
+            if not issues or start_at >= page['total']:
+                return
+
+    def _search_records(self, query, fields, page_size):
+        """
+        Fetches the project's issues matching a JQL query one at a time, decoding pages as they arrive.
+        :param query: JQL, restricted to the project.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of issues fetched per request.
+        :return: Generator of single issue lists.
+        """
+        params = self._search_params(query, fields, page_size)
+        start_at = 0
+        while True:
+            params['startAt'] = start_at
+            page = {}
+            count = 0
+            for issue in self._stream_search_page("{0}/rest/api/2/search".format(self.url), params, 'issues', page):
+                count += 1
+                yield [issue]
+            start_at += count
+            # JIRA sends the total before the issues. Without it, a short page is the last one.
+            total = page.get('total')
+            if not count or (start_at >= total if total is not None else count < page_size):
+                return
+
+    def _search_params(self, query, fields, page_size):
+        """
+        :return: params: The search parameters of a JQL query, restricted to the project.
+        """
+        jql = 'project = "{0}"'.format(self.project)
+        if query:
+            parts = re.split(r'\s*\bORDER\s+BY\b', query, 1, flags=re.IGNORECASE)
+            if parts[0].strip():
+                jql = '{0} AND ({1})'.format(jql, parts[0])
+            if len(parts) > 1:
+                jql = '{0} ORDER BY{1}'.format(jql, parts[1])
+        params = {'jql': jql, 'maxResults': page_size}
+        if fields:
+            params['fields'] = ','.join(fields)
+        return params
+
+    def _updated_since_query(self, since):
+        """
+        Builds JQL for the issues updated since a time, oldest first. JQL has minute precision.
+        :param since: Datetime in the JIRA user's timezone, or None for every issue.
+        :return: query: JQL.
+        """
+        if since is None:
+            return 'ORDER BY updated ASC'
+        return 'updated >= "{0}" ORDER BY updated ASC'.format(since.strftime('%Y/%m/%d %H:%M'))
+
+    def _ticket_updated(self, item):
+        """
+        :param item: An issue yielded by search().
+        :return: (ticket_id, updated): The issue key and update time.
+        """
+        return item['key'], sync.parse_time(item['fields']['updated'], '%Y-%m-%dT%H:%M:%S.%f%z')
+
+    def _mirror_fields(self, content):
+        """
+        :param content: An issue as returned by JIRA.
+        :return: fields: Dict of the columns stored by ticketutil.mirror.Mirror.
+        """
+        if 'key' not in content:
+            return None
+        fields = content.get('fields', {})
+        comments = fields.get('comment') or {}
+        columns = mirror.read_columns(fields, {
+            'project': ('project', (fields.get('project') or {}).get('key')),
+            'summary': ('summary', fields.get('summary')),
+            'description': ('description', fields.get('description')),
+            'comments': ('comment', mirror.join_comments(comment.get('body')
+                                                         for comment in comments.get('comments', []))),
+            'status': ('status', (fields.get('status') or {}).get('name')),
+            'assignee': ('assignee', (fields.get('assignee') or {}).get('name')),
+            'updated': ('updated', fields.get('updated'))})
+        columns['ticket_id'] = content['key']
+        return columns
+
+    def _edit_content_fields(self, names):
+        """
+        :param names: List of edit() keyword argument names.
+        :return: fields: The JIRA field names.
+        """
+        return ['issuetype' if name == 'type' else name for name in names]
+
+    def _edit_field_values(self, content, name, value):
+        """
+        Reads a field edit() would set from an issue. Values JIRA wraps, eg. {'name': 'Major', 'id': '3'},
+        are unwrapped unless the desired value is a dict itself.
+        """
+        fields = content.get('fields', {})
+        field = 'issuetype' if name == 'type' else name
+        if field not in fields:
+            return None
+        current = fields[field]
+        if not isinstance(value, dict):
+            current = _field_value(current)
+        return current, value
+
+    def edit(self, diff=None, **kwargs):
         """
         Edits fields in a JIRA ticket.
         Keyword arguments are used to specify ticket fields.
+        With diff, only the fields that would change the ticket are sent, and no request is made if
+        none would. The names of the fields sent are set in sent_fields.
 
         Fields examples:
         summary='Ticket summary'
@@ -195,6 +380,8 @@ class JiraTicket(ticket.Ticket):
         parent='KEY-XX'
         customfield_XXXXX='Custom field text'
 
+        :param diff: None to send every field. 'fetch' to compare with the ticket's current fields first,
+                     or 'cache' to compare with the mirrored ticket unless it is stale.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
         if not self.ticket_id:
@@ -202,6 +389,13 @@ class JiraTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        kwargs = self._edit_fields(kwargs, diff)
+        if kwargs is None:
+            return self.request_result._replace(status='Failure', error_message="Error getting ticket content")
+        if diff and not kwargs:
+            logging.info("Ticket {0} already has these field values".format(self.ticket_id))
+            return self.request_result
+
         # Some of the ticket fields need to be in a specific form for the tool.
         fields = _prepare_ticket_fields(kwargs)
 
@@ -283,6 +477,43 @@ class JiraTicket(ticket.Ticket):
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+    def _merge_operation(self, payload, method_name, args, kwargs):
+        """
+        Merges edit() and add_comment() into one issue PUT.
+        Status changes are workflow transitions in JIRA, which need their own request.
+        :param payload: The dict of the combined request. Only modified if the operation is merged.
+        :param method_name: The name of the recorded Ticket method.
+        :param args: Positional arguments of the recorded call.
+        :param kwargs: Keyword arguments of the recorded call.
+        :return: True if the operation was merged into payload, False if it must be sent on its own.
+        """
+        if method_name == 'edit' and not args and 'diff' not in kwargs:
+            payload.setdefault('fields', {}).update(_prepare_ticket_fields(dict(kwargs)))
+            return True
+        if method_name == 'add_comment':
+            comment = args[0] if args else kwargs.get('comment')
+            payload.setdefault('update', {}).setdefault('comment', []).append({'add': {'body': comment}})
+            return True
+        return False
+
+    def _send_merged_request(self, payload):
+        """
+        Sends a combined issue PUT built by _merge_operation().
+        :param payload: The dict of the combined request.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        try:
+            r = self.s.put("{0}/{1}".format(self.rest_url, self.ticket_id), json=payload)
+            logging.debug("Merged update: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+            logging.info("Updated ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
+            return self.request_result
+        except requests.RequestException as e:
+            error_message = "Error updating ticket - {0}".format(_error_reason(e))
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
     def remove_all_watchers(self):
         """
         Removes all watchers from a JIRA ticket.
@@ -381,6 +612,7 @@ class JiraTicket(ticket.Ticket):
     def add_attachment(self, file_name):
         """
         Attaches a file to a JIRA ticket.
+        Files already on the ticket are skipped if set_attachment_dedup() is on.
         :param file_name: A string representing the file to attach.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
@@ -389,6 +621,12 @@ class JiraTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        attached, key = self._find_attachment(file_name, os.path.basename(file_name))
+        if attached:
+            logging.info("File {0} is already attached to ticket {1} as {2}".format(file_name, self.ticket_id,
+                                                                                    attached))
+            return self.request_result
+
         headers = {"X-Atlassian-Token": "nocheck"}
 
         # Attempt to attach file.
@@ -399,6 +637,7 @@ class JiraTicket(ticket.Ticket):
                             headers=headers)
             logging.debug("Add attachment: status code: {0}".format(r.status_code))
             r.raise_for_status()
+            self._record_attachment(key, os.path.basename(file_name))
             logging.info("Attached file {0} to ticket {1} - {2}".format(file_name, self.ticket_id, self.ticket_url))
             return self.request_result
         except requests.RequestException as e:
@@ -411,6 +650,29 @@ class JiraTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+    def _list_attachments(self, ticket_id):
+        """
+        :param ticket_id: The id of the ticket.
+        :return: attachments: List of attachment dicts, see Ticket.get_attachments().
+        """
+        r = self.s.get("{0}/{1}".format(self.rest_url, ticket_id), params={'fields': 'attachment'})
+        logging.debug("Get attachments: status code: {0}".format(r.status_code))
+        r.raise_for_status()
+        return [{'id': attachment['id'],
+                 'file_name': attachment['filename'],
+                 'size': attachment.get('size'),
+                 'content_type': attachment.get('mimeType'),
+                 'url': attachment['content'],
+                 'digest': None}
+                for attachment in r.json()['fields'].get('attachment') or []]
+
+    def _read_history(self, ticket_id):
+        """
+        :param ticket_id: The id of the ticket.
+        :return: ticket_content: The issue with its changelog, see Ticket.get_ticket_history().
+        """
+        return self._get_history_part("{0}/{1}".format(self.rest_url, ticket_id), {'expand': 'changelog'}).json()
+
     def _get_status_id(self, status_name):
         """
         Gets status id corresponding to status name.
@@ -460,7 +722,7 @@ def _prepare_ticket_fields(fields):
         :param fields: Ticket fields.
         :return: fields: Ticket fields in the correct form for the ticketing tool.
         """
-        for key, value in fields.items():
+        for key, value in list(fields.items()):
             if key in ['priority', 'assignee', 'reporter', 'parent']:
                 fields[key] = {'name': value}
             if key == 'type':
@@ -469,6 +731,35 @@ def _prepare_ticket_fields(fields):
         return fields
 
 
+def _error_reason(error):
+    """
+    Reads why JIRA rejected a request from its error response. Responses that aren't JIRA's, eg. a proxy's
+    503 page, and requests that got no response at all, eg. after a timeout, fall back to the exception.
+    :param error: The requests exception the request failed with.
+    :return: The first error JIRA returned, or the exception text.
+    """
+    try:
+        content = error.response.json()
+        reasons = list(content.get('errors', {}).values()) + content.get('errorMessages', [])
+    except (AttributeError, ValueError):
+        reasons = []
+    return reasons[0] if reasons else str(error)
+
+
+def _field_value(value):
+    """
+    Unwraps a field value as JIRA returns it, eg. {'name': 'Major', 'id': '3'} or a list of components,
+    to the form edit() takes.
+    """
+    if isinstance(value, list):
+        return [_field_value(item) for item in value]
+    if isinstance(value, dict):
+        for key in ['name', 'value', 'key']:
+            if key in value:
+                return value[key]
+    return value
+
+
 def main():
     """
     main() function, not directly callable.
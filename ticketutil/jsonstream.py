@@ -0,0 +1,80 @@
+import codecs
+import json
+import re
+
+
+def iter_items(chunks, key, header=None):
+    """
+    Yields the items of an array in a JSON object one at a time as the document's bytes arrive, eg. the
+    issues of a JIRA search page, so only about one item is held in memory at once.
+    Each item is decoded by the json module's C decoder as soon as its closing bracket arrives.
+    Raises ValueError if the document is invalid or ends early.
+    :param chunks: Iterable of bytes of the JSON document.
+    :param key: The top-level key of the array, eg. 'issues'.
+    :param header: Optional dict filled with the top-level scalar values before the array, eg. JIRA's total.
+    :return: Generator of items.
+    """
+    if header is None:
+        header = {}
+    start = re.compile(r'"{0}"\s*:\s*\['.format(re.escape(key)))
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        match = start.search(buffer)
+        if match:
+            header.update(_header(buffer[:match.start()]))
+            buffer = buffer[match.end():]
+            break
+    else:
+        raise ValueError("No {0} array in response".format(key))
+
+    position = 0
+    # Decoding is only retried once the buffer doubled, so a large item is decoded a few times, not per chunk.
+    retry_at = 0
+    ended = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        if position < len(buffer) and (len(buffer) >= retry_at or ended):
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                value, end = None, None
+            if end is not None and (end < len(buffer) or isinstance(value, (dict, list))):
+                yield value
+                buffer = buffer[end:]
+                position = 0
+                retry_at = 0
+                continue
+            retry_at = 2 * len(buffer)
+        if ended:
+            raise ValueError("Truncated {0} array in response".format(key))
+        chunk = next(chunks, None)
+        if chunk is None:
+            ended = True
+        else:
+            buffer += text.decode(chunk)
+
+
+def _header(text):
+    """
+    Reads the top-level scalar values from the start of a JSON object, eg. '{"startAt": 0, "total": 3, '.
+    """
+    text = text.rstrip()
+    if text.endswith(','):
+        text = '{0}"": null}}'.format(text)
+    elif text.endswith('{'):
+        text = '{0}}}'.format(text)
+    try:
+        values = json.loads(text)
+    except ValueError:
+        return {}
+    if not isinstance(values, dict):
+        return {}
+    return dict((name, value) for name, value in values.items()
+                if name and not isinstance(value, (dict, list)))
@@ -0,0 +1,236 @@
+import threading
+from collections import namedtuple
+
+from . import transport
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = namedtuple('Labels', ['backend', 'host', 'operation', 'method'])
+
+
+class Metrics(object):
+    """
+    Collects request counts, status codes, latency histograms, bytes sent and received and connection
+    reuse for the requests made by Ticket objects, labelled by backend, host, operation and method.
+
+    operation is the public Ticket method called, eg. 'create', and method the Ticket method that made
+    the request, eg. '_get_status_id', so the sub-requests of an operation can be told apart.
+    Nothing is recorded, and requests cost nothing extra, until enable() is called.
+
+    metrics = Metrics().enable()
+    ticket = JiraTicket(<jira_url>, <project_key>, auth='kerberos')
+    ticket.create(...)
+    print(metrics.prometheus())
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Upper bounds of the latency histogram buckets, in seconds.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def enable(self):
+        """
+        Starts recording the requests made by every Ticket object in the process.
+        :return: self: The Metrics object.
+        """
+        transport.add_request_listener(self.observe)
+        return self
+
+    def disable(self):
+        """
+        Stops recording requests. The metrics recorded so far are kept.
+        """
+        transport.remove_request_listener(self.observe)
+
+    def observe(self, event):
+        """
+        Records one request. Called by the transport for every request once enabled.
+        :param event: A ticketutil.transport.RequestEvent.
+        """
+        labels = Labels(event.backend or '', event.host, event.operation or '', event.method or '')
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = _Series(len(self.buckets))
+            series.observe(event, self.buckets)
+
+    def reset(self):
+        """
+        Forgets the metrics recorded so far.
+        """
+        with self._lock:
+            self._series = {}
+
+    def snapshot(self):
+        """
+        Returns the metrics recorded so far.
+        :return: snapshot: List of dicts, one per combination of labels, containing backend, host,
+                 operation, method, requests, statuses (dict of status code or error to count),
+                 latency (dict of bucket upper bound to cumulative count, with 'sum' and 'count'),
+                 bytes_sent, bytes_received, reused_connections and new_connections.
+        """
+        with self._lock:
+            snapshot = []
+            for labels, series in sorted(self._series.items()):
+                item = labels._asdict()
+                item.update(series.as_dict(self.buckets))
+                snapshot.append(item)
+            return snapshot
+
+    def prometheus(self):
+        """
+        Renders the metrics recorded so far in the Prometheus text exposition format.
+        :return: text: The metrics.
+        """
+        lines = []
+        snapshot = self.snapshot()
+
+        _header(lines, 'ticketutil_requests_total', 'counter', "HTTP requests made by ticketutil.")
+        for item in snapshot:
+            for status, count in sorted(item['statuses'].items()):
+                lines.append(_sample('ticketutil_requests_total', item, count, code=status))
+
+        _header(lines, 'ticketutil_request_duration_seconds', 'histogram', "HTTP request latency.")
+        for item in snapshot:
+            for bound in self.buckets:
+                lines.append(_sample('ticketutil_request_duration_seconds_bucket', item,
+                                     item['latency'][bound], le=repr(float(bound))))
+            lines.append(_sample('ticketutil_request_duration_seconds_bucket', item,
+                                 item['latency']['count'], le='+Inf'))
+            lines.append(_sample('ticketutil_request_duration_seconds_sum', item, item['latency']['sum']))
+            lines.append(_sample('ticketutil_request_duration_seconds_count', item, item['latency']['count']))
+
+        _header(lines, 'ticketutil_request_bytes_total', 'counter', "Bytes of request bodies sent.")
+        for item in snapshot:
+            lines.append(_sample('ticketutil_request_bytes_total', item, item['bytes_sent']))
+
+        _header(lines, 'ticketutil_response_bytes_total', 'counter', "Bytes of response bodies received.")
+        for item in snapshot:
+            lines.append(_sample('ticketutil_response_bytes_total', item, item['bytes_received']))
+
+        _header(lines, 'ticketutil_connections_total', 'counter', "Requests by whether they reused a connection.")
+        for item in snapshot:
+            lines.append(_sample('ticketutil_connections_total', item, item['reused_connections'], reused='true'))
+            lines.append(_sample('ticketutil_connections_total', item, item['new_connections'], reused='false'))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestCounter(object):
+    """
+    Counts the HTTP requests made by Ticket objects while it's active, by the Ticket method that made them,
+    to find operations making more round trips than they need to.
+
+    with RequestCounter() as counter:
+        ticket.create(...)
+    print(counter.report())
+
+    Requests made from any thread are counted, eg. by download_attachments() workers.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.by_method = {}
+        self.by_operation = {}
+        self.events = []
+
+    def __enter__(self):
+        transport.add_request_listener(self.observe)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        transport.remove_request_listener(self.observe)
+
+    def observe(self, event):
+        """
+        Counts one request.
+        :param event: A ticketutil.transport.RequestEvent.
+        """
+        with self._lock:
+            self.total += 1
+            method = event.method or ''
+            operation = event.operation or ''
+            self.by_method[method] = self.by_method.get(method, 0) + 1
+            self.by_operation[operation] = self.by_operation.get(operation, 0) + 1
+            self.events.append(event)
+
+    def reset(self):
+        """
+        Forgets the requests counted so far.
+        """
+        with self._lock:
+            self.total = 0
+            self.by_method = {}
+            self.by_operation = {}
+            self.events = []
+
+    def report(self):
+        """
+        :return: text: The total, then one line per request counted with its HTTP method, status code and
+                 the Ticket method and operation that made it.
+        """
+        with self._lock:
+            lines = ['{0} request(s)'.format(self.total)]
+            for event in self.events:
+                lines.append('  {0} {1} from {2} in {3}'.format(event.http_method, event.status_code or event.error,
+                                                                event.method or '-', event.operation or '-'))
+            return '\n'.join(lines)
+
+
+class _Series(object):
+    def __init__(self, buckets):
+        self.requests = 0
+        self.statuses = {}
+        self.counts = [0] * buckets
+        self.latency_sum = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.reused_connections = 0
+        self.new_connections = 0
+
+    def observe(self, event, buckets):
+        self.requests += 1
+        status = str(event.status_code) if event.status_code is not None else event.error
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        for index, bound in enumerate(buckets):
+            if event.elapsed <= bound:
+                self.counts[index] += 1
+                break
+        self.latency_sum += event.elapsed
+        self.bytes_sent += event.bytes_sent
+        self.bytes_received += event.bytes_received
+        if event.reused is True:
+            self.reused_connections += 1
+        elif event.reused is False:
+            self.new_connections += 1
+
+    def as_dict(self, buckets):
+        latency = {'sum': self.latency_sum, 'count': self.requests}
+        cumulative = 0
+        for bound, count in zip(buckets, self.counts):
+            cumulative += count
+            latency[bound] = cumulative
+        return {'requests': self.requests,
+                'statuses': dict(self.statuses),
+                'latency': latency,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'reused_connections': self.reused_connections,
+                'new_connections': self.new_connections}
+
+
+def _header(lines, name, kind, description):
+    lines.append('# HELP {0} {1}'.format(name, description))
+    lines.append('# TYPE {0} {1}'.format(name, kind))
+
+
+def _sample(name, item, value, **extra):
+    labels = [(field, item[field]) for field in Labels._fields] + sorted(extra.items())
+    text = ','.join('{0}="{1}"'.format(key, _escape(value)) for key, value in labels)
+    return '{0}{{{1}}} {2}'.format(name, text, value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,256 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY,
+    tool TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    ticket_id TEXT NOT NULL,
+    project TEXT COLLATE NOCASE,
+    summary TEXT,
+    description TEXT,
+    comments TEXT,
+    status TEXT COLLATE NOCASE,
+    assignee TEXT COLLATE NOCASE,
+    updated TEXT,
+    content TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    stale INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (tool, instance, ticket_id)
+);
+CREATE INDEX IF NOT EXISTS tickets_project ON tickets (project);
+CREATE INDEX IF NOT EXISTS tickets_status ON tickets (status);
+CREATE INDEX IF NOT EXISTS tickets_assignee ON tickets (assignee);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+    summary, description, comments, content='tickets', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS tickets_fts_insert AFTER INSERT ON tickets BEGIN
+    INSERT INTO tickets_fts (rowid, summary, description, comments)
+    VALUES (new.id, new.summary, new.description, new.comments);
+END;
+CREATE TRIGGER IF NOT EXISTS tickets_fts_delete AFTER DELETE ON tickets BEGIN
+    INSERT INTO tickets_fts (tickets_fts, rowid, summary, description, comments)
+    VALUES ('delete', old.id, old.summary, old.description, old.comments);
+END;
+CREATE TRIGGER IF NOT EXISTS tickets_fts_update AFTER UPDATE OF summary, description, comments ON tickets BEGIN
+    INSERT INTO tickets_fts (tickets_fts, rowid, summary, description, comments)
+    VALUES ('delete', old.id, old.summary, old.description, old.comments);
+    INSERT INTO tickets_fts (rowid, summary, description, comments)
+    VALUES (new.id, new.summary, new.description, new.comments);
+END;
+"""
+
+COLUMNS = ['project', 'summary', 'description', 'comments', 'status', 'assignee', 'updated']
+
+
+class Mirror(object):
+    """
+    A local SQLite copy of the tickets read through ticketutil, for offline queries.
+
+    Set it on Ticket objects with set_mirror(). Tickets read with get_ticket_content() or search() are
+    stored, and tickets changed through the Ticket object are marked stale until they are read again.
+    Summary, description and comments are full-text indexed with FTS5 where SQLite has it, and status,
+    assignee and project are indexed. Every ticket returned by query() reports its age in seconds.
+    """
+    def __init__(self, path=':memory:'):
+        """
+        :param path: Path of the SQLite database, or ':memory:'.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        try:
+            self._db.executescript(FTS_SCHEMA)
+            self.full_text = True
+        except sqlite3.OperationalError:
+            logging.warning("SQLite has no FTS5, text queries will scan the mirror")
+            self.full_text = False
+        self._db.commit()
+
+    def store(self, tool, instance, fields, content, partial=False):
+        """
+        Stores or refreshes one ticket.
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param instance: The URL of the ticketing tool.
+        :param fields: Dict of ticket_id and the indexed columns, from Ticket._mirror_fields().
+        :param content: The ticket as returned by the tool.
+        :param partial: True if the ticket was read with a field projection, see store_many().
+        """
+        self.store_many([(tool, instance, fields, content)], partial)
+
+    def store_many(self, tickets, partial=False):
+        """
+        Stores or refreshes several tickets in one transaction.
+        A full read replaces the mirrored ticket, since tools leave cleared fields out of it, eg. Redmine drops
+        assigned_to when a ticket is unassigned. A partial read is merged into the mirrored ticket, and only the
+        columns in fields are written, the others keep their mirrored values.
+        :param tickets: Iterable of (tool, instance, fields, content) tuples.
+        :param partial: True if the tickets were read with a field projection. Stale tickets stay stale,
+                        since the fields that weren't read may still be out of date.
+        """
+        now = time.time()
+        with self._lock:
+            for tool, instance, fields, content in tickets:
+                key = (tool, instance, str(fields['ticket_id']))
+                if partial:
+                    row = self._db.execute('SELECT content FROM tickets WHERE tool = ? AND instance = ? '
+                                           'AND ticket_id = ?', key).fetchone()
+                    if row is not None:
+                        content = _merge(json.loads(row['content']), content)
+                    columns = [column for column in COLUMNS if column in fields]
+                else:
+                    fields = dict((column, fields.get(column)) for column in COLUMNS)
+                    columns = COLUMNS
+                updates = ['{0} = excluded.{0}'.format(column) for column in columns]
+                if not partial:
+                    updates.append('stale = 0')
+                self._db.execute(
+                    'INSERT INTO tickets (tool, instance, ticket_id, {0}content, fetched, stale) '
+                    'VALUES (?, ?, ?, {1}?, ?, 0) '
+                    'ON CONFLICT (tool, instance, ticket_id) DO UPDATE SET {2}'.format(
+                        ''.join('{0}, '.format(column) for column in columns), '?, ' * len(columns),
+                        ', '.join(updates + ['content = excluded.content', 'fetched = excluded.fetched'])),
+                    list(key) + [fields[column] for column in columns] + [json.dumps(content), now])
+            self._db.commit()
+
+    def invalidate(self, tool, instance, ticket_id):
+        """
+        Marks a ticket as stale, eg. after it was changed.
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param instance: The URL of the ticketing tool.
+        :param ticket_id: The id of the ticket.
+        """
+        with self._lock:
+            self._db.execute('UPDATE tickets SET stale = 1 WHERE tool = ? AND instance = ? AND ticket_id = ?',
+                             (tool, instance, str(ticket_id)))
+            self._db.commit()
+
+    def remove(self, tool, instance, ticket_id):
+        """
+        Removes a ticket from the mirror.
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param instance: The URL of the ticketing tool.
+        :param ticket_id: The id of the ticket.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM tickets WHERE tool = ? AND instance = ? AND ticket_id = ?',
+                             (tool, instance, str(ticket_id)))
+            self._db.commit()
+
+    def get(self, tool, instance, ticket_id):
+        """
+        :param tool: The ticketing tool, eg. 'JIRA'.
+        :param instance: The URL of the ticketing tool.
+        :param ticket_id: The id of the ticket.
+        :return: ticket: The mirrored ticket dict, see query(), or None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM tickets WHERE tool = ? AND instance = ? AND ticket_id = ?',
+                                   (tool, instance, str(ticket_id))).fetchone()
+        return _ticket(row, time.time()) if row else None
+
+    def query(self, text=None, project=None, status=None, assignee=None, tool=None, instance=None, limit=100):
+        """
+        Finds mirrored tickets. All given conditions must match.
+        :param text: Full-text query over summary, description and comments, in FTS5 syntax,
+                     eg. 'disk AND "web-3.example.com"'. Without FTS5, a substring to look for.
+        :param project: Project, case insensitive.
+        :param status: Status, case insensitive.
+        :param assignee: Assignee, case insensitive.
+        :param tool: Ticketing tool, eg. 'JIRA'.
+        :param instance: The URL of the ticketing tool.
+        :param limit: Maximum number of tickets returned, None for all.
+        :return: tickets: List of dicts with ticket_id, tool, instance, the indexed columns, content,
+                 age (seconds since the ticket was read) and stale (True if it changed since).
+                 Best text matches come first, otherwise the most recently updated.
+        """
+        conditions = []
+        params = []
+        for column, value in (('project', project), ('status', status), ('assignee', assignee),
+                              ('tool', tool), ('instance', instance)):
+            if value is not None:
+                conditions.append('tickets.{0} = ?'.format(column))
+                params.append(value)
+        tables = 'tickets'
+        order = 'tickets.updated DESC'
+        if text and self.full_text:
+            tables = 'tickets JOIN tickets_fts ON tickets_fts.rowid = tickets.id'
+            conditions.append('tickets_fts MATCH ?')
+            params.append(text)
+            order = 'tickets_fts.rank'
+        elif text:
+            conditions.append("(tickets.summary LIKE ? OR tickets.description LIKE ? OR tickets.comments LIKE ?)")
+            params.extend(['%{0}%'.format(text)] * 3)
+
+        sql = 'SELECT tickets.* FROM {0}'.format(tables)
+        if conditions:
+            sql = '{0} WHERE {1}'.format(sql, ' AND '.join(conditions))
+        sql = '{0} ORDER BY {1} LIMIT ?'.format(sql, order)
+        # SQLite takes a negative limit as no limit.
+        params.append(-1 if limit is None else limit)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        now = time.time()
+        return [_ticket(row, now) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM tickets').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _ticket(row, now):
+    ticket = dict((column, row[column]) for column in ['ticket_id', 'tool', 'instance'] + COLUMNS)
+    ticket['content'] = json.loads(row['content'])
+    ticket['age'] = now - row['fetched']
+    ticket['stale'] = bool(row['stale'])
+    return ticket
+
+
+def _merge(old, new):
+    """
+    Merges a newly read ticket into the mirrored one, one level deep, so partial reads don't drop fields.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    merged = dict(old)
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = dict(merged[key], **value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def read_columns(content, columns):
+    """
+    Picks the mirrored columns whose fields a read returned.
+    :param content: Dict of the ticket's fields, as returned by the tool.
+    :param columns: Dict of column name to a (field name, value) tuple.
+    :return: fields: Dict of column name to value, for the fields in content. Fields left out of the
+             read, eg. by a field projection, are left out here too, so the mirror keeps their values.
+    """
+    return dict((column, value) for column, (field, value) in columns.items() if field in content)
+
+
+def join_comments(comments):
+    """
+    Joins comment texts for the full-text index.
+    :param comments: List of comment texts. Empty texts are skipped.
+    :return: text: The comments separated by blank lines, or None if there are none.
+    """
+    comments = [comment for comment in comments or [] if comment]
+    return '\n\n'.join(comments) if comments else None
@@ -0,0 +1,185 @@
+import json
+import logging
+import queue
+import threading
+import zlib
+
+from . import ticket
+
+
+# Short operation names accepted in operation streams, mapped to the Ticket methods they call.
+OPERATION_ALIASES = {'create': 'create',
+                     'edit': 'edit',
+                     'comment': 'add_comment',
+                     'status': 'change_status',
+                     'attach': 'add_attachment'}
+
+
+def resolve_operation(name):
+    """
+    Maps an operation name from an operation stream to the Ticket method it calls.
+    Both the short aliases in OPERATION_ALIASES and public Ticket method names are accepted.
+    :param name: The operation name, eg. 'comment' or 'add_comment'.
+    :return: method_name: The name of the Ticket method.
+    """
+    method_name = OPERATION_ALIASES.get(name, name)
+    if not method_name or method_name.startswith('_'):
+        raise ticket.TicketException("Not a valid operation: {0}".format(name))
+    return method_name
+
+
+def parse_operation(line):
+    """
+    Parses one line of a JSONL operation stream.
+
+    Operation example:
+    {"id": "op-1", "operation": "edit", "ticket_id": "KEY-12", "kwargs": {"priority": "Major"}}
+    {"id": "op-2", "operation": "create", "args": ["Ticket summary", "Ticket description"]}
+
+    :param line: A JSON encoded operation.
+    :return: operation: The operation dict.
+    """
+    operation = json.loads(line)
+    if not isinstance(operation, dict):
+        raise ticket.TicketException("Operation is not a JSON object: {0}".format(line.strip()))
+    if 'operation' not in operation:
+        raise ticket.TicketException("Operation is missing the 'operation' key: {0}".format(line.strip()))
+    operation.setdefault('args', [])
+    operation.setdefault('kwargs', {})
+    return operation
+
+
+def shard_for(operation, shards, default_key=None):
+    """
+    Returns the shard an operation belongs to.
+    Operations on the same ticket always land in the same shard, so they are applied in order.
+    A stable checksum is used rather than hash() so that every process agrees on the shard.
+    :param operation: The operation dict.
+    :param shards: The number of shards.
+    :param default_key: Key to use when the operation has no ticket_id, eg. the line number of a create.
+    :return: shard: The shard number.
+    """
+    key = operation.get('ticket_id')
+    if key is None:
+        key = operation.get('id', default_key)
+    return zlib.crc32(str(key).encode('utf-8')) % shards
+
+
+def apply_operation(ticket_object, operation):
+    """
+    Applies one operation to a Ticket object using its public ticketing methods.
+    If the operation names a ticket_id, set_ticket_id() is called first when the Ticket object
+    is currently working on another ticket.
+    :param ticket_object: A JiraTicket, RTTicket, RedmineTicket, BugzillaTicket or ServiceNowTicket object.
+    :param operation: The operation dict.
+    :return: result: Dict containing the operation id, ticket_id, status, error_message, and url.
+    """
+    result = {'id': operation.get('id'),
+              'operation': operation.get('operation'),
+              'ticket_id': operation.get('ticket_id')}
+    try:
+        method_name = resolve_operation(operation['operation'])
+        method = getattr(ticket_object, method_name, None)
+        if not callable(method):
+            raise ticket.TicketException("{0} does not support {1}()".format(ticket_object.ticketing_tool,
+                                                                             method_name))
+
+        ticket_id = operation.get('ticket_id')
+        if method_name != 'create' and ticket_id is not None and \
+                str(ticket_id) != str(ticket_object.ticket_id):
+            request_result = ticket_object.set_ticket_id(ticket_id)
+            if request_result.status == 'Failure':
+                result.update(status=request_result.status, error_message=request_result.error_message, url=None)
+                return result
+
+        request_result = method(*operation.get('args', []), **operation.get('kwargs', {}))
+    except Exception as e:
+        logging.error("Error applying operation {0}".format(operation.get('id')))
+        logging.error(e)
+        result.update(status='Failure', error_message=str(e), url=None)
+        return result
+
+    result.update(status=request_result.status,
+                  error_message=request_result.error_message,
+                  url=request_result.url,
+                  ticket_id=ticket_object.ticket_id)
+    return result
+
+
+class TicketPool(object):
+    """
+    A bounded pool of Ticket objects created from a factory.
+    Ticket objects hold the ticket_id they are working on, so they can't be shared between threads.
+    Each thread checks one out, which also gives each thread its own requests Session.
+    """
+    def __init__(self, ticket_factory, size=4):
+        """
+        :param ticket_factory: Callable returning a new Ticket object, eg.
+                               functools.partial(JiraTicket, <url>, <project>, auth='kerberos')
+        :param size: The maximum number of Ticket objects in the pool.
+        """
+        self.ticket_factory = ticket_factory
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # Metadata lookups, eg. Redmine status ids, are shared by every Ticket object in the pool.
+        self._metadata = {}
+
+    def acquire(self):
+        """
+        Checks out a Ticket object, creating one if the pool isn't full yet.
+        Blocks until a Ticket object is returned when the pool is full.
+        :return: ticket_object: A Ticket object.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                ticket_object = self.ticket_factory()
+                if hasattr(ticket_object, '_metadata'):
+                    ticket_object._metadata = self._metadata
+                return ticket_object
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, ticket_object):
+        """
+        Returns a Ticket object to the pool.
+        :param ticket_object: The Ticket object from acquire().
+        """
+        self._idle.put(ticket_object)
+
+    def apply(self, operation):
+        """
+        Applies an operation using a Ticket object from the pool.
+        :param operation: The operation dict.
+        :return: result: Dict containing the operation id, ticket_id, status, error_message, and url.
+        """
+        ticket_object = self.acquire()
+        try:
+            return apply_operation(ticket_object, operation)
+        finally:
+            self.release(ticket_object)
+
+    def close(self):
+        """
+        Closes the requests session of every idle Ticket object in the pool.
+        """
+        while True:
+            try:
+                ticket_object = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            ticket_object.close_requests_session()
+            with self._lock:
+                self._created -= 1
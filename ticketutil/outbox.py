@@ -0,0 +1,331 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import operation as ticket_operation
+from . import ticket, transport
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ticket_key TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    result TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS operations_ticket ON operations (ticket_key, state, id);
+CREATE INDEX IF NOT EXISTS operations_state ON operations (state, next_attempt, id);
+"""
+
+# Statuses besides 5xx a failed request may succeed with later: request timeouts and rate limiting.
+TRANSIENT_STATUSES = (408, 429)
+
+
+class Outbox(object):
+    """
+    A durable write-behind outbox for ticket operations.
+
+    enqueue() records an operation in an SQLite journal and returns its operation id straight away.
+    A flusher, either a background thread started with start() or a separate process calling
+    serve(), applies journaled operations through a TicketPool. Operations on the same ticket are
+    applied in the order they were enqueued. Operations failing with a timeout, a connection error or
+    a 5xx response are retried with exponential backoff, while operations the tool rejected, eg. with a
+    400 for an invalid field, fail straight away. Because the journal is on disk, pending operations
+    survive process restarts.
+
+    Only one flusher should drain a journal at a time.
+    """
+    def __init__(self, path, ticket_factory=None, concurrency=4, batch_size=50, max_attempts=5,
+                 retry_delay=1.0, poll_interval=0.5):
+        """
+        :param path: Path of the SQLite journal.
+        :param ticket_factory: Callable returning a new Ticket object. Only needed by the flusher.
+        :param concurrency: Maximum number of operations applied at once.
+        :param batch_size: Maximum number of operations claimed from the journal per batch.
+        :param max_attempts: Number of attempts before a retried operation is marked failed.
+        :param retry_delay: Delay in seconds before the first retry. Doubles on every retry.
+        :param poll_interval: Seconds between journal polls when the outbox is idle.
+        """
+        self.path = path
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.pool = ticket_operation.TicketPool(ticket_factory, size=concurrency) if ticket_factory else None
+
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # The last request made by each flusher thread, which tells whether a failure is worth retrying.
+        self._requests = threading.local()
+        if self.pool is not None:
+            transport.add_request_listener(self._record_request)
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def enqueue(self, operation, ticket_id=None, *args, **kwargs):
+        """
+        Records an operation in the journal.
+        :param operation: The operation name, eg. 'create', 'edit', 'comment' or 'add_comment'.
+        :param ticket_id: The ticket the operation applies to. None for create().
+        :param args: Positional arguments of the Ticket method.
+        :param kwargs: Keyword arguments of the Ticket method.
+        :return: op_id: The operation id, used with status() and wait().
+        """
+        ticket_operation.resolve_operation(operation)
+        item = {'operation': operation, 'ticket_id': ticket_id, 'args': list(args), 'kwargs': kwargs}
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO operations (ticket_key, operation, state, next_attempt, '
+                                      'created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                                      (str(ticket_id), json.dumps(item), PENDING, now, now, now))
+            op_id = cursor.lastrowid
+            if ticket_id is None:
+                # Creates aren't ordered against anything else, so each gets its own key.
+                self._db.execute('UPDATE operations SET ticket_key = ? WHERE id = ?', ('op:{0}'.format(op_id), op_id))
+            self._db.commit()
+        self._wakeup.set()
+        logging.debug("Enqueued operation {0}: {1}".format(op_id, operation))
+        return op_id
+
+    def status(self, op_id):
+        """
+        Returns the state of an operation.
+        :param op_id: The operation id returned by enqueue().
+        :return: status: Dict containing the id, state, attempts, and result of the operation, or None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT id, state, attempts, result FROM operations WHERE id = ?',
+                                   (op_id,)).fetchone()
+        if row is None:
+            return None
+        return {'id': row[0], 'state': row[1], 'attempts': row[2],
+                'result': json.loads(row[3]) if row[3] else None}
+
+    def wait(self, op_id, timeout=None):
+        """
+        Blocks until an operation is done or failed.
+        :param op_id: The operation id returned by enqueue().
+        :param timeout: Maximum number of seconds to wait. None waits forever.
+        :return: status: The status() dict of the operation. Its state is still pending on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            status = self.status(op_id)
+            if status is None or status['state'] in (DONE, FAILED):
+                return status
+            remaining = self.poll_interval if deadline is None else min(self.poll_interval, deadline - time.time())
+            if remaining <= 0:
+                return status
+            with self._flushed:
+                self._flushed.wait(remaining)
+
+    def pending(self):
+        """
+        :return: count: Number of operations not yet done or failed.
+        """
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM operations WHERE state IN (?, ?)',
+                                    (PENDING, RUNNING)).fetchone()[0]
+
+    def flush(self, executor=None):
+        """
+        Claims one batch of ready operations and applies them.
+        :param executor: Executor to apply operations with. A temporary one is used if None.
+        :return: count: Number of operations applied.
+        """
+        if self.pool is None:
+            raise ticket.TicketException("Outbox needs a ticket_factory to flush operations")
+
+        batch = self._claim_batch()
+        if not batch:
+            return 0
+
+        if executor is None:
+            with ThreadPoolExecutor(self.concurrency) as temporary_executor:
+                results = list(temporary_executor.map(self._apply, [item for _, item, _ in batch]))
+        else:
+            results = list(executor.map(self._apply, [item for _, item, _ in batch]))
+
+        self._record_results(batch, results)
+        with self._flushed:
+            self._flushed.notify_all()
+        return len(batch)
+
+    def serve(self):
+        """
+        Flushes the outbox until stop() is called. Run this in a separate process to drain a
+        journal that other processes enqueue to.
+        """
+        self._recover()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            while not self._stop.is_set():
+                try:
+                    flushed = self.flush(executor)
+                except Exception as e:
+                    # Keep serving, eg. through a journal error. Claimed operations are retried.
+                    logging.error("Error flushing outbox")
+                    logging.error(e)
+                    self._recover()
+                    flushed = 0
+                if not flushed:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+
+    def start(self):
+        """
+        Starts a background flusher thread.
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.serve, name='ticketutil-outbox')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the background flusher thread after its current batch.
+        :param timeout: Maximum number of seconds to wait for the thread.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def close(self):
+        """
+        Stops the flusher and closes the journal and the Ticket objects of the pool.
+        """
+        self.stop()
+        if self.pool is not None:
+            transport.remove_request_listener(self._record_request)
+            self.pool.close()
+        with self._lock:
+            self._db.close()
+
+    def _apply(self, item):
+        """
+        Applies one operation through the pool. Errors getting a Ticket object from the pool, eg. the
+        ticket_factory failing to authenticate during an outage, are a failure of the operation, and
+        are retried since the operation wasn't tried.
+        :param item: The operation dict.
+        :return: (result, transient): Dict containing the operation id, ticket_id, status, error_message,
+                 and url, and whether a failure is worth retrying, see _transient().
+        """
+        self._requests.last = None
+        try:
+            result = self.pool.apply(item)
+        except Exception as e:
+            logging.error("Error applying operation {0}".format(item.get('operation')))
+            logging.error(e)
+            return {'id': item.get('id'),
+                    'operation': item.get('operation'),
+                    'ticket_id': item.get('ticket_id'),
+                    'status': 'Failure',
+                    'error_message': str(e),
+                    'url': None}, True
+        return result, _transient(self._requests.last)
+
+    def _record_request(self, event):
+        """
+        Request listener keeping the last request made by the current thread, see _apply().
+        :param event: The transport.RequestEvent of the request.
+        """
+        self._requests.last = event
+
+    def _recover(self):
+        """
+        Returns operations left running by a flusher that died to the pending state.
+        """
+        with self._lock:
+            self._db.execute('UPDATE operations SET state = ? WHERE state = ?', (PENDING, RUNNING))
+            self._db.commit()
+
+    def _claim_batch(self):
+        """
+        Marks up to batch_size ready operations as running.
+        An operation is ready when no earlier operation on the same ticket is still pending or running.
+        :return: batch: List of (op_id, operation, attempts) tuples.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, operation, attempts FROM operations o '
+                'WHERE state = ? AND next_attempt <= ? AND NOT EXISTS '
+                '(SELECT 1 FROM operations p WHERE p.ticket_key = o.ticket_key AND p.id < o.id '
+                'AND p.state IN (?, ?)) ORDER BY id LIMIT ?',
+                (PENDING, now, PENDING, RUNNING, self.batch_size)).fetchall()
+            self._db.executemany('UPDATE operations SET state = ?, updated = ? WHERE id = ?',
+                                 [(RUNNING, now, row[0]) for row in rows])
+            self._db.commit()
+        return [(row[0], json.loads(row[1]), row[2]) for row in rows]
+
+    def _record_results(self, batch, results):
+        """
+        Stores the results of a batch in one transaction, scheduling retries for transient failures.
+        :param batch: List of (op_id, operation, attempts) tuples from _claim_batch().
+        :param results: List of (result, transient) tuples from _apply().
+        """
+        now = time.time()
+        updates = []
+        for (op_id, item, attempts), (result, transient) in zip(batch, results):
+            attempts += 1
+            if result['status'] == 'Success':
+                state, next_attempt = DONE, now
+            elif not transient:
+                state, next_attempt = FAILED, now
+                logging.error("Operation {0} was rejected: {1}".format(op_id, result['error_message']))
+            elif attempts < self.max_attempts:
+                state, next_attempt = PENDING, now + self.retry_delay * 2 ** (attempts - 1)
+                logging.warning("Operation {0} failed, retrying in {1}s".format(op_id, next_attempt - now))
+            else:
+                state, next_attempt = FAILED, now
+                logging.error("Operation {0} failed after {1} attempts".format(op_id, attempts))
+            updates.append((state, attempts, next_attempt, json.dumps(result), now, op_id))
+        with self._lock:
+            self._db.executemany('UPDATE operations SET state = ?, attempts = ?, next_attempt = ?, result = ?, '
+                                 'updated = ? WHERE id = ?', updates)
+            self._db.commit()
+
+
+def _transient(event):
+    """
+    Tells whether a failed operation may succeed if retried, from the last request it made.
+    :param event: The transport.RequestEvent of the last request, or None if no request was made.
+    :return: False if the tool answered the request, other than with a 5xx or TRANSIENT_STATUSES, eg.
+             rejected a field with a 400. True for timeouts, connection errors, and unknown outcomes.
+    """
+    if event is None or event.status_code is None:
+        return True
+    return event.status_code >= 500 or event.status_code in TRANSIENT_STATUSES
+
+
+def main():
+    """
+    main() function, not directly callable.
+    :return:
+    """
+    print("Not directly executable")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import logging
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class Pipeline(object):
+    """
+    A lazy, streaming pipeline of stages over ticket operations.
+
+    Items flow from any iterable through the stages one at a time. Each stage runs its own worker
+    threads and the stages are connected by bounded queues, so a slow stage makes the stages before it
+    wait instead of buffering, and memory use stays constant however large the input is.
+    With more than one worker per stage, items may come out in a different order than they went in,
+    unless the stage has a key: items with the same key are processed in order by the same worker.
+
+    pool = TicketPool(partial(JiraTicket, <jira_url>, <project_key>, auth='kerberos'), size=8)
+    pipeline = (Pipeline(read_records())
+                .map(to_fields)
+                .operation(pool, lambda r: {'operation': 'create', 'args': [r['summary'], r['description']]},
+                           concurrency=8)
+                .operation(pool, lambda r: {'operation': 'attach', 'ticket_id': r['ticket_id'],
+                                            'args': [r['log_file']]}, concurrency=4))
+    for record in pipeline:
+        print(record['ticket_id'], record['result']['status'])
+    """
+    def __init__(self, source, buffer=100):
+        """
+        :param source: Any iterable of items.
+        :param buffer: Default size of the queue in front of each stage.
+        """
+        self.source = source
+        self.buffer = buffer
+        self.stages = []
+        self._started = False
+
+    def map(self, func, concurrency=1, buffer=None, name=None, key=None):
+        """
+        Adds a stage calling func on every item.
+        :param func: Function taking an item and returning the item passed to the next stage.
+                     Returning None drops the item.
+        :param concurrency: Number of worker threads for the stage.
+        :param buffer: Size of the queue in front of the stage.
+        :param name: Stage name used in stats().
+        :param key: Optional function taking an item and returning a hashable key, eg. its ticket_id.
+                    Items with the same key are processed by the same worker, in the order they came in.
+        :return: self
+        """
+        if self._started:
+            raise RuntimeError("Stages can't be added to a running pipeline")
+        name = name or getattr(func, '__name__', None) or 'stage{0}'.format(len(self.stages))
+        self.stages.append(Stage(name, func, concurrency, buffer or self.buffer, key))
+        return self
+
+    def operation(self, pool, build, concurrency=1, buffer=None, name=None, skip_failed=True):
+        """
+        Adds a stage applying a ticket operation for every item through a TicketPool.
+
+        Items should be dicts. The operation's result is stored in the item's 'result' key and the
+        ticket it applied to in 'ticket_id', so later stages can use the ticket a create() made.
+        :param pool: The TicketPool to apply operations with.
+        :param build: Function taking an item and returning an operation dict, or None to skip it.
+        :param concurrency: Number of worker threads for the stage. Should not exceed the pool size.
+        :param buffer: Size of the queue in front of the stage.
+        :param name: Stage name used in stats().
+        :param skip_failed: Pass items whose previous operation failed through without applying.
+        :return: self
+        """
+        def apply(item):
+            if skip_failed and item.get('result') and item['result']['status'] == 'Failure':
+                return item
+            operation = build(item)
+            if operation is None:
+                return item
+            result = pool.apply(operation)
+            item = dict(item)
+            item['result'] = result
+            item['ticket_id'] = result['ticket_id']
+            return item
+
+        return self.map(apply, concurrency, buffer, name or 'operation{0}'.format(len(self.stages)))
+
+    def __iter__(self):
+        if self._started:
+            raise RuntimeError("A pipeline can only be iterated once")
+        self._started = True
+        self._stop = threading.Event()
+        self._error = None
+
+        inbox = queue.Queue(self.stages[0].buffer if self.stages else self.buffer)
+        feeder = threading.Thread(target=self._feed, args=(inbox,), name='ticketutil-pipeline-source')
+        feeder.daemon = True
+        feeder.start()
+        for index, stage in enumerate(self.stages):
+            buffer = self.stages[index + 1].buffer if index + 1 < len(self.stages) else self.buffer
+            inbox = stage.start(self, inbox, queue.Queue(buffer))
+
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+        if self._error is not None:
+            raise self._error
+
+    def stats(self):
+        """
+        Returns throughput and latency counters of every stage.
+        :return: stats: List of dicts containing name, processed, dropped, errors, in_flight,
+                 queued, average_latency and throughput (items per second) per stage.
+        """
+        return [stage.stats() for stage in self.stages]
+
+    def _feed(self, outbox):
+        try:
+            for item in self.source:
+                if not self._put(outbox, item):
+                    return
+        except Exception as e:
+            logging.error("Error reading pipeline source")
+            logging.error(e)
+            self._fail(e)
+        self._put(outbox, _DONE)
+
+    def _get(self, inbox):
+        """
+        Waits for the next item, giving up when the pipeline stops.
+        """
+        while True:
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _DONE
+
+    def _put(self, outbox, item):
+        """
+        Waits for room in a bounded queue, giving up when the pipeline stops.
+        :return: True if the item was queued.
+        """
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+
+class Stage(object):
+    """
+    A pipeline stage: a function run by a number of worker threads between two bounded queues.
+    A stage with a key gives each worker its own queue and routes items to them by key.
+    """
+    def __init__(self, name, func, concurrency, buffer, key=None):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.buffer = buffer
+        self.key = key
+
+        self._lock = threading.Lock()
+        self._workers_left = concurrency
+        self._inbox = None
+        self._worker_inboxes = []
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def start(self, pipeline, inbox, outbox):
+        """
+        Starts the stage's worker threads.
+        :return: outbox: The queue the stage writes to.
+        """
+        self._inbox = inbox
+        if self.key is not None:
+            self._worker_inboxes = [queue.Queue(max(1, self.buffer // self.concurrency))
+                                    for number in range(self.concurrency)]
+            dispatcher = threading.Thread(target=self._dispatch, args=(pipeline, inbox),
+                                          name='ticketutil-pipeline-{0}-dispatch'.format(self.name))
+            dispatcher.daemon = True
+            dispatcher.start()
+        for number in range(self.concurrency):
+            worker_inbox = self._worker_inboxes[number] if self._worker_inboxes else inbox
+            worker = threading.Thread(target=self._work, args=(pipeline, worker_inbox, outbox),
+                                      name='ticketutil-pipeline-{0}-{1}'.format(self.name, number))
+            worker.daemon = True
+            worker.start()
+        return outbox
+
+    def stats(self):
+        with self._lock:
+            elapsed = (self.last_end or 0) - (self.first_start or 0)
+            return {'name': self.name,
+                    'processed': self.processed,
+                    'dropped': self.dropped,
+                    'errors': self.errors,
+                    'in_flight': self.in_flight,
+                    'queued': sum(q.qsize() for q in [self._inbox] + self._worker_inboxes if q is not None),
+                    'average_latency': self.latency / self.processed if self.processed else 0.0,
+                    'throughput': self.processed / elapsed if elapsed > 0 else 0.0}
+
+    def _dispatch(self, pipeline, inbox):
+        """
+        Routes items to the inbox of the worker for their key.
+        """
+        while True:
+            item = pipeline._get(inbox)
+            if item is _DONE:
+                for worker_inbox in self._worker_inboxes:
+                    pipeline._put(worker_inbox, _DONE)
+                return
+            try:
+                worker_inbox = self._worker_inboxes[hash(self.key(item)) % self.concurrency]
+            except Exception as e:
+                logging.error("Error in pipeline stage {0}".format(self.name))
+                logging.error(e)
+                with self._lock:
+                    self.errors += 1
+                pipeline._fail(e)
+                return
+            if not pipeline._put(worker_inbox, item):
+                return
+
+    def _work(self, pipeline, inbox, outbox):
+        while True:
+            item = pipeline._get(inbox)
+            if item is _DONE:
+                # Let the other workers of this stage see the end of the stream too.
+                pipeline._put(inbox, _DONE)
+                with self._lock:
+                    self._workers_left -= 1
+                    last = self._workers_left == 0
+                if last:
+                    pipeline._put(outbox, _DONE)
+                return
+
+            start = time.time()
+            with self._lock:
+                self.in_flight += 1
+                if self.first_start is None:
+                    self.first_start = start
+            try:
+                item = self.func(item)
+            except Exception as e:
+                logging.error("Error in pipeline stage {0}".format(self.name))
+                logging.error(e)
+                with self._lock:
+                    self.in_flight -= 1
+                    self.errors += 1
+                pipeline._fail(e)
+                return
+            end = time.time()
+            with self._lock:
+                self.in_flight -= 1
+                self.processed += 1
+                self.latency += end - start
+                self.last_end = end
+                if item is None:
+                    self.dropped += 1
+
+            if item is not None and not pipeline._put(outbox, item):
+                return
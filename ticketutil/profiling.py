@@ -0,0 +1,298 @@
+import collections
+import inspect
+import json
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import transport
+
+# Connection setup times of the request being sent by the current thread.
+_connection = threading.local()
+
+
+class Profiler(object):
+    """
+    Records a breakdown of the Ticket calls that take longer than a threshold.
+
+    For every HTTP request a slow call made, the breakdown holds the time spent resolving the host (dns),
+    opening the connection (connect), the TLS handshake (tls), waiting for the response headers (server),
+    reading the body (transfer) and decoding JSON (parse), and the request and response sizes.
+    dns, connect and tls are 0 when an open connection was reused.
+    Optionally, the call's Python stack is sampled while it runs.
+
+    Breakdowns are kept in a ring buffer holding the latest slow calls.
+
+    profiler = Profiler(threshold=2.0, sample_interval=0.01)
+    ticket.set_profiler(profiler)
+    ticket.add_attachment('sosreport.tar.xz')
+    profiler.dump('slow_calls.jsonl')
+
+    Calls to generator methods, eg. search(), aren't profiled.
+    """
+    def __init__(self, threshold=1.0, size=100, sample_interval=None):
+        """
+        :param threshold: Calls taking at least this many seconds are recorded.
+        :param size: Number of slow calls kept. The oldest are dropped first.
+        :param sample_interval: Seconds between samples of the Python stack of a running call.
+                                None to not sample stacks.
+        """
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self._records = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._running = {}
+        self._attached = {}
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def attach(self, ticket_object):
+        """
+        Starts profiling the calls of a Ticket object. Use Ticket.set_profiler() rather than calling this.
+        :param ticket_object: The Ticket object.
+        """
+        if id(ticket_object) in self._attached:
+            return
+        session = ticket_object.s
+        adapters = dict(session.adapters)
+        adapter = _TimedAdapter(self)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        names = []
+        for name, method in inspect.getmembers(type(ticket_object), callable):
+            if name.startswith('_') or name == 'set_profiler' or inspect.isgeneratorfunction(method):
+                continue
+            setattr(ticket_object, name, self._profiled(ticket_object, name, getattr(ticket_object, name)))
+            names.append(name)
+        self._attached[id(ticket_object)] = (adapters, names)
+
+    def detach(self, ticket_object):
+        """
+        Stops profiling the calls of a Ticket object.
+        :param ticket_object: The Ticket object.
+        """
+        adapters, names = self._attached.pop(id(ticket_object), (None, []))
+        if adapters is not None:
+            for adapter in set(ticket_object.s.adapters.values()) - set(adapters.values()):
+                adapter.close()
+            ticket_object.s.adapters.clear()
+            for prefix, adapter in adapters.items():
+                ticket_object.s.mount(prefix, adapter)
+        for name in names:
+            delattr(ticket_object, name)
+
+    def records(self):
+        """
+        :return: records: List of the slow calls recorded, oldest first. Each is a dict containing operation,
+                 backend, ticket_id, started (epoch seconds), elapsed, bytes_sent, bytes_received, requests
+                 (list of dicts containing method, http_method, url, status_code, dns, connect, tls, server,
+                 transfer, parse, bytes_sent and bytes_received) and stacks (dict of sampled stack, outermost
+                 frame first and joined with ';', to number of samples, or None).
+        """
+        with self._lock:
+            return list(self._records)
+
+    def dump(self, file_name):
+        """
+        Writes the slow calls recorded to a file, one JSON object per line.
+        :param file_name: The file to write.
+        :return: count: The number of calls written.
+        """
+        records = self.records()
+        with open(file_name, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        return len(records)
+
+    def clear(self):
+        """
+        Forgets the slow calls recorded so far.
+        """
+        with self._lock:
+            self._records.clear()
+
+    def close(self):
+        """
+        Stops the stack sampling thread.
+        """
+        self._stopped.set()
+
+    def _profiled(self, ticket_object, name, method):
+        def profiled(*args, **kwargs):
+            # Public methods calling each other are profiled as the outermost call.
+            if getattr(self._local, 'call', None) is not None:
+                return method(*args, **kwargs)
+            call = self._local.call = {'operation': name, 'requests': [], 'stacks': None}
+            thread_id = threading.current_thread().ident
+            if self.sample_interval:
+                call['stacks'] = {}
+                with self._lock:
+                    self._running[thread_id] = call
+                self._start_sampler()
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                self._local.call = None
+                with self._lock:
+                    self._running.pop(thread_id, None)
+                if elapsed >= self.threshold:
+                    call.update({'backend': getattr(ticket_object, 'ticketing_tool', None),
+                                 'ticket_id': getattr(ticket_object, 'ticket_id', None),
+                                 'started': start,
+                                 'elapsed': elapsed,
+                                 'bytes_sent': sum(request['bytes_sent'] for request in call['requests']),
+                                 'bytes_received': sum(request['bytes_received'] for request in call['requests'])})
+                    with self._lock:
+                        self._records.append(call)
+        return profiled
+
+    def _start_sampler(self):
+        with self._lock:
+            if self._sampler is not None:
+                return
+            self._sampler = threading.Thread(target=self._sample, name='ticketutil-profiler')
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def _sample(self):
+        """
+        Samples the stacks of the threads running a profiled call, in its own thread.
+        """
+        while not self._stopped.wait(self.sample_interval):
+            with self._lock:
+                running = list(self._running.items())
+            if not running:
+                continue
+            frames = sys._current_frames()
+            for thread_id, call in running:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = ';'.join('{0} ({1}:{2})'.format(name, file_name, line)
+                                 for file_name, line, name, _ in traceback.extract_stack(frame))
+                with self._lock:
+                    call['stacks'][stack] = call['stacks'].get(stack, 0) + 1
+
+
+class _TimedAdapter(HTTPAdapter):
+    """
+    Adds a breakdown of every request made during a profiled call to the call.
+    """
+    def __init__(self, profiler):
+        self.profiler = profiler
+        super(_TimedAdapter, self).__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TimedAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool,
+                                                   'https': _TimedHTTPSConnectionPool}
+
+    def send(self, request, stream=False, *args, **kwargs):
+        call = getattr(self.profiler._local, 'call', None)
+        if call is None:
+            return super(_TimedAdapter, self).send(request, stream, *args, **kwargs)
+
+        _connection.timings = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+        start = time.time()
+        response = super(_TimedAdapter, self).send(request, stream, *args, **kwargs)
+        headers_received = time.time()
+        if not stream:
+            # Session.send() reads the body right after this anyway.
+            bytes_received = len(response.content)
+        else:
+            # Updated with the bytes read when the response is closed, if it has no Content-Length.
+            bytes_received = transport._bytes_received(response, stream)
+            if transport._content_length(response) is None:
+                read = transport._count_body(response)
+                transport._on_close(response, lambda: breakdown.update(bytes_received=read()))
+        timings = _connection.timings
+        server = headers_received - start - timings['dns'] - timings['connect'] - timings['tls']
+        breakdown = {'method': transport._call_site()[2],
+                     'http_method': request.method,
+                     'url': request.url.split('?')[0],
+                     'status_code': response.status_code,
+                     'dns': timings['dns'],
+                     'connect': timings['connect'],
+                     'tls': timings['tls'],
+                     'server': max(0.0, server),
+                     'transfer': time.time() - headers_received,
+                     'parse': 0.0,
+                     'bytes_sent': transport._bytes_sent(request),
+                     'bytes_received': bytes_received}
+        call['requests'].append(breakdown)
+
+        decode = response.json
+
+        def json(**kwargs):
+            parse_start = time.time()
+            try:
+                return decode(**kwargs)
+            finally:
+                breakdown['parse'] += time.time() - parse_start
+        response.json = json
+        return response
+
+
+class _TimedConnection(object):
+    """
+    Records the time spent resolving the host, connecting and in the TLS handshake.
+    """
+    def _new_conn(self):
+        timings = getattr(_connection, 'timings', None)
+        if timings is None:
+            return super(_TimedConnection, self)._new_conn()
+        host = self._dns_host
+        start = time.time()
+        try:
+            address = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)[0][4][0]
+        except socket.gaierror:
+            # Let the connection report the error.
+            address = host
+        resolved = time.time()
+        timings['dns'] = resolved - start
+        self._dns_host = address
+        try:
+            sock = super(_TimedConnection, self)._new_conn()
+        except Exception:
+            if address == host:
+                raise
+            # Fall back to the host's other addresses.
+            self._dns_host = host
+            sock = super(_TimedConnection, self)._new_conn()
+        finally:
+            self._dns_host = host
+        timings['connect'] = time.time() - resolved
+        return sock
+
+    def connect(self):
+        start = time.time()
+        super(_TimedConnection, self).connect()
+        timings = getattr(_connection, 'timings', None)
+        if timings is not None and isinstance(self, HTTPSConnection):
+            timings['tls'] = max(0.0, time.time() - start - timings['dns'] - timings['connect'])
+
+
+class _TimedHTTPConnection(_TimedConnection, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnection, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
@@ -1,7 +1,11 @@
+import datetime
 import logging
+import os
 
 import requests
 
+from . import mirror
+from . import sync
 from . import ticket
 
 __author__ = 'dranck, rnester, kshirsal'
@@ -11,6 +15,9 @@ class RedmineTicket(ticket.Ticket):
     """
     A Redmine Ticket object. Contains Redmine-specific methods for working with tickets.
     """
+    # Fields search() must return for SyncEngine.
+    _sync_fields = ['id', 'updated_on']
+
     def __init__(self, url, project, auth=None, ticket_id=None):
         self.ticketing_tool = 'Redmine'
 
@@ -56,6 +63,8 @@ class RedmineTicket(ticket.Ticket):
             logging.debug("Verify project: status code: {0}".format(r.status_code))
             r.raise_for_status()
             logging.debug("Project {0} is valid".format(project))
+            # Keep the project id, so that create() doesn't have to look it up again.
+            self._metadata['project_id'] = r.json()['project']['id']
             return True
         except requests.RequestException as e:
             logging.error("Project {0} is not valid".format(project))
@@ -77,6 +86,39 @@ class RedmineTicket(ticket.Ticket):
             logging.error("Ticket {0} is not valid".format(ticket_id))
             return False
 
+    def get_ticket_content(self, ticket_id=None, fields=None):
+        """
+        Gets the content of an issue.
+        :param ticket_id: The issue to get. Defaults to the current issue.
+        :param fields: Optional list of field names to return, eg. ['subject', 'status']. Redmine has no
+                       field projection, so the issue is filtered after it is received. Defaults to all fields.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, the issue as returned by Redmine.
+        """
+        if ticket_id is None:
+            ticket_id = self.ticket_id
+            if not self.ticket_id:
+                error_message = "No ticket ID associated with ticket object. " \
+                                "Set ticket ID with set_ticket_id(<ticket_id>)"
+                logging.error(error_message)
+                return self.request_result._replace(status='Failure', error_message=error_message)
+
+        try:
+            r = self.s.get("{0}/{1}.json".format(self.rest_url, ticket_id))
+            logging.debug("Get ticket content: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            error_message = ticket.content_error_message(ticket_id, e)
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
+        ticket_content = r.json()['issue']
+        if fields:
+            ticket_content = dict((key, value) for key, value in ticket_content.items() if key in fields)
+        self._mirror_content(ticket_content, partial=bool(fields))
+        return self.request_result._replace(ticket_content=ticket_content)
+
     def create(self, subject, description, **kwargs):
         """
         Creates a ticket.
@@ -99,7 +141,7 @@ class RedmineTicket(ticket.Ticket):
         params = self._create_ticket_parameters(subject, description, kwargs)
 
         # Create our ticket.
-        return self._create_ticket_request(params)
+        return self._create_ticket(params, subject, description)
 
     def _create_ticket_parameters(self, subject, description, fields):
         """
@@ -147,6 +189,7 @@ class RedmineTicket(ticket.Ticket):
             logging.debug("Create ticket: status code: {0}".format(r.status_code))
             r.raise_for_status()
         except requests.RequestException as e:
+            self._create_error = e
             logging.error("Error creating ticket")
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=str(e))
@@ -158,10 +201,128 @@ class RedmineTicket(ticket.Ticket):
         logging.info("Created ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
         return self.request_result
 
-    def edit(self, **kwargs):
+    def _find_created_ticket(self, params):
+        """
+        Searches for an issue created in the last day with the subject and description of params.
+        :param params: The payload from _create_ticket_parameters().
+        :return: ticket_id: The id of the matching issue, or None.
+        """
+        issue = params['issue']
+        since = datetime.date.today() - datetime.timedelta(days=1)
+        query = {'project_id': issue['project_id'],
+                 'subject': '~{0}'.format(issue['subject']),
+                 'created_on': '>={0}'.format(since.isoformat()),
+                 'status_id': '*',
+                 'sort': 'created_on:desc',
+                 'limit': 25}
+        try:
+            r = self.s.get("{0}.json".format(self.rest_url), params=query)
+            logging.debug("Find created ticket: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error searching for created ticket")
+            logging.error(e)
+            return
+
+        for found in r.json()['issues']:
+            if found['subject'] == issue['subject'] and found.get('description') == issue['description']:
+                return found['id']
+
+    def _search_pages(self, query, fields, page_size):
+        """
+        Fetches the project's issues matching filter parameters, eg. {'status_id': 'open'}, page by page.
+        Redmine has no field projection, so issues are filtered to fields after they are received.
+        :param query: Dict of Redmine issue filter parameters.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of issues fetched per request. Redmine caps this at 100 by default.
+        :return: Generator of lists of issues.
+        """
+        params = {'project_id': self.project, 'sort': 'id'}
+        params.update(query or {})
+        params['limit'] = page_size
+
+        offset = 0
+        while True:
+            params['offset'] = offset
+            page = self._get_search_page("{0}.json".format(self.rest_url), params).json()
+            issues = page['issues']
+            if fields:
+                issues = [dict((key, value) for key, value in issue.items() if key in fields) for issue in issues]
+            if issues:
+                yield issues
+            offset += len(issues)
+            if not issues or offset >= page['total_count']:
+                return
+
+    def _updated_since_query(self, since):
+        """
+        Builds filter parameters for the issues updated since a time, oldest first, including closed issues.
+        :param since: Datetime in UTC, or None for every issue.
+        :return: query: Dict of Redmine issue filter parameters.
+        """
+        query = {'status_id': '*', 'sort': 'updated_on'}
+        if since is not None:
+            query['updated_on'] = '>={0}'.format(since.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return query
+
+    def _ticket_updated(self, item):
+        """
+        :param item: An issue yielded by search().
+        :return: (ticket_id, updated): The issue id and update time.
+        """
+        return item['id'], sync.parse_time(item['updated_on'], '%Y-%m-%dT%H:%M:%SZ')
+
+    def _mirror_fields(self, content):
+        """
+        :param content: An issue as returned by Redmine.
+        :return: fields: Dict of the columns stored by ticketutil.mirror.Mirror.
+        """
+        if 'id' not in content:
+            return None
+        # Redmine leaves empty fields out, eg. an issue without assignee has no assigned_to. Every issue
+        # has an author, so when it is there the issue wasn't projected and a missing assignee is empty.
+        if 'author' in content:
+            content = dict({'assigned_to': None}, **content)
+        columns = mirror.read_columns(content, {
+            'project': ('project', (content.get('project') or {}).get('name')),
+            'summary': ('subject', content.get('subject')),
+            'description': ('description', content.get('description')),
+            'comments': ('journals', mirror.join_comments(journal.get('notes')
+                                                          for journal in content.get('journals', []))),
+            'status': ('status', (content.get('status') or {}).get('name')),
+            'assignee': ('assigned_to', (content.get('assigned_to') or {}).get('name')),
+            'updated': ('updated_on', content.get('updated_on'))})
+        columns['ticket_id'] = content['id']
+        return columns
+
+    def _edit_content_fields(self, names):
+        """
+        :param names: List of edit() keyword argument names.
+        :return: fields: The Redmine field names.
+        """
+        fields = {'assignee': 'assigned_to', 'estimated_time': 'total_estimated_hours'}
+        return [fields.get(name, name) for name in names]
+
+    def _edit_field_values(self, content, name, value):
+        """
+        Reads a field edit() would set from an issue. Assignees are compared by user id, priorities by name.
+        Redmine leaves unset fields out, so a missing assignee or priority is None.
+        """
+        if name == 'assignee':
+            return (content.get('assigned_to') or {}).get('id'), self._get_user_id(value)
+        if name == 'priority':
+            return (content.get('priority') or {}).get('name'), value
+        field = 'total_estimated_hours' if name == 'estimated_time' else name
+        if field not in content:
+            return None
+        return content[field], value
+
+    def edit(self, diff=None, **kwargs):
         """
         Edits fields in a Redmine ticket.
         Keyword arguments are used to specify ticket fields.
+        With diff, only the fields that would change the ticket are sent, and no request is made if
+        none would. The names of the fields sent are set in sent_fields.
 
         Fields examples:
         subject='Ticket subject'
@@ -172,6 +333,8 @@ class RedmineTicket(ticket.Ticket):
         done_ratio='70'
         assignee='username@mail.com'
 
+        :param diff: None to send every field. 'fetch' to compare with the ticket's current fields first,
+                     or 'cache' to compare with the mirrored ticket unless it is stale.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
         if not self.ticket_id:
@@ -179,6 +342,13 @@ class RedmineTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        kwargs = self._edit_fields(kwargs, diff)
+        if kwargs is None:
+            return self.request_result._replace(status='Failure', error_message="Error getting ticket content")
+        if diff and not kwargs:
+            logging.info("Ticket {0} already has these field values".format(self.ticket_id))
+            return self.request_result
+
         # Some of the ticket fields need to be in a specific form for the tool.
         fields = self._prepare_ticket_fields(kwargs)
 
@@ -254,6 +424,48 @@ class RedmineTicket(ticket.Ticket):
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=str(e))
 
+    def _merge_operation(self, payload, method_name, args, kwargs):
+        """
+        Merges edit(), add_comment() and change_status() into one issues/<id>.json PUT.
+        Only one comment (notes) can be sent per request.
+        :param payload: The dict of the combined request. Only modified if the operation is merged.
+        :param method_name: The name of the recorded Ticket method.
+        :param args: Positional arguments of the recorded call.
+        :param kwargs: Keyword arguments of the recorded call.
+        :return: True if the operation was merged into payload, False if it must be sent on its own.
+        """
+        issue = payload.get('issue', {})
+        if method_name == 'edit' and not args and 'diff' not in kwargs:
+            issue.update(self._prepare_ticket_fields(dict(kwargs)))
+        elif method_name == 'add_comment' and 'notes' not in issue:
+            issue['notes'] = args[0] if args else kwargs.get('comment')
+        elif method_name == 'change_status':
+            status_id = self._get_status_id(args[0] if args else kwargs.get('status'))
+            if not status_id:
+                return False
+            issue['status_id'] = status_id
+        else:
+            return False
+        payload['issue'] = issue
+        return True
+
+    def _send_merged_request(self, payload):
+        """
+        Sends a combined issues/<id>.json PUT built by _merge_operation().
+        :param payload: The dict of the combined request.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        try:
+            r = self.s.put('{0}/{1}.json'.format(self.rest_url, self.ticket_id), json=payload)
+            logging.debug("Merged update: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+            logging.info("Updated ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
+            return self.request_result
+        except requests.RequestException as e:
+            logging.error("Error updating ticket")
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=str(e))
+
     def remove_watcher(self, watcher):
         """
         Removes watcher from a Redmine ticket.
@@ -321,6 +533,8 @@ class RedmineTicket(ticket.Ticket):
     def add_attachment(self, file_name):
         """
         Attaches a file to a Redmine ticket.
+        Files already on the ticket are skipped if set_attachment_dedup() is on. Redmine reports digests,
+        so they are found whatever their name.
         :param file_name: A string representing the file to attach.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
@@ -329,6 +543,12 @@ class RedmineTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        attached, key = self._find_attachment(file_name, os.path.basename(file_name))
+        if attached:
+            logging.info("File {0} is already attached to ticket {1} as {2}".format(file_name, self.ticket_id,
+                                                                                    attached))
+            return self.request_result
+
         # First, upload the file to Redmine and retrieve a token to be used in subsequent request.
         token = self._upload_file(file_name)
 
@@ -340,6 +560,7 @@ class RedmineTicket(ticket.Ticket):
                 r = self.s.put('{0}/{1}.json'.format(self.rest_url, self.ticket_id), json=params)
                 logging.debug("Add attachment: status code: {0}".format(r.status_code))
                 r.raise_for_status()
+                self._record_attachment(key, os.path.basename(file_name))
                 logging.info("Attached file {0} to ticket {1} - {2}".format(file_name, self.ticket_id, self.ticket_url))
                 return self.request_result
             except requests.RequestException as e:
@@ -383,6 +604,36 @@ class RedmineTicket(ticket.Ticket):
         logging.info("Uploaded file {0} to Redmine".format(file_name))
         return token
 
+    def _list_attachments(self, ticket_id):
+        """
+        :param ticket_id: The id of the ticket.
+        :return: attachments: List of attachment dicts, see Ticket.get_attachments().
+        """
+        r = self.s.get('{0}/{1}.json'.format(self.rest_url, ticket_id), params={'include': 'attachments'})
+        logging.debug("Get attachments: status code: {0}".format(r.status_code))
+        r.raise_for_status()
+        return [{'id': attachment['id'],
+                 'file_name': attachment['filename'],
+                 'size': attachment.get('filesize'),
+                 'content_type': attachment.get('content_type'),
+                 'url': attachment['content_url'],
+                 'digest': attachment.get('digest') or None}
+                for attachment in r.json()['issue'].get('attachments', [])]
+
+    def _read_history(self, ticket_id):
+        """
+        Journals hold status ids, so the issue gets 'status_names', a dict of status id to name.
+        :param ticket_id: The id of the ticket.
+        :return: ticket_content: The issue with its journals, see Ticket.get_ticket_history().
+        """
+        issue = self._get_history_part('{0}/{1}.json'.format(self.rest_url, ticket_id),
+                                       {'include': 'journals'}).json()['issue']
+        # Fetches the statuses once per object.
+        self._get_status_id(None)
+        issue['status_names'] = dict((str(status['id']), status['name'])
+                                     for status in self._metadata.get('issue_statuses', []))
+        return issue
+
     def _get_project_id(self):
         """
         Get project id from project name.
@@ -390,6 +641,9 @@ class RedmineTicket(ticket.Ticket):
         but the Project ID is needed when creating the ticket.
         :return: project_id: The id of the project.
         """
+        if 'project_id' in self._metadata:
+            return self._metadata['project_id']
+
         try:
             r = self.s.get('{0}/projects/{1}.json'.format(self.url, self.project))
             logging.debug("Get project id: status code: {0}".format(r.status_code))
@@ -402,6 +656,7 @@ class RedmineTicket(ticket.Ticket):
         project_json = r.json()
         project_id = project_json['project']['id']
         logging.debug("Retrieved Project ID: {0}".format(project_id))
+        self._metadata['project_id'] = project_id
         return project_id
 
     def _get_status_id(self, status_name):
@@ -411,17 +666,18 @@ class RedmineTicket(ticket.Ticket):
         :param status_name: The name of the status.
         :return: status_id: The id of the status.
         """
-        try:
-            r = self.s.get('{0}/issue_statuses.json'.format(self.url))
-            logging.debug("Get status id: status code: {0}".format(r.status_code))
-            r.raise_for_status()
-        except requests.RequestException as e:
-            logging.error("Error retrieving Redmine status information")
-            logging.error(e)
-            return
+        if 'issue_statuses' not in self._metadata:
+            try:
+                r = self.s.get('{0}/issue_statuses.json'.format(self.url))
+                logging.debug("Get status id: status code: {0}".format(r.status_code))
+                r.raise_for_status()
+            except requests.RequestException as e:
+                logging.error("Error retrieving Redmine status information")
+                logging.error(e)
+                return
+            self._metadata['issue_statuses'] = r.json()['issue_statuses']
 
-        status_json = r.json()
-        for status in status_json['issue_statuses']:
+        for status in self._metadata['issue_statuses']:
             if status['name'] == status_name:
                 return status['id']
 
@@ -432,17 +688,18 @@ class RedmineTicket(ticket.Ticket):
         :param priority_name: The name of the priority.
         :return: priority_id: The id of the priority.
         """
-        try:
-            r = self.s.get('{0}/enumerations/issue_priorities.json'.format(self.url))
-            logging.debug("Get priority id: status code: {0}".format(r.status_code))
-            r.raise_for_status()
-        except requests.RequestException as e:
-            logging.error("Error retrieving Redmine priority information")
-            logging.error(e)
-            return
+        if 'issue_priorities' not in self._metadata:
+            try:
+                r = self.s.get('{0}/enumerations/issue_priorities.json'.format(self.url))
+                logging.debug("Get priority id: status code: {0}".format(r.status_code))
+                r.raise_for_status()
+            except requests.RequestException as e:
+                logging.error("Error retrieving Redmine priority information")
+                logging.error(e)
+                return
+            self._metadata['issue_priorities'] = r.json()['issue_priorities']
 
-        priority_json = r.json()
-        for priority in priority_json['issue_priorities']:
+        for priority in self._metadata['issue_priorities']:
             if priority['name'] == priority_name:
                 return priority['id']
 
@@ -453,21 +710,22 @@ class RedmineTicket(ticket.Ticket):
         :param user_name: The name of the user.
         :return: user_id: The id of the user.
         """
-        try:
-            r = self.s.get('{0}/users.json'.format(self.url))
-            logging.debug("Get user id: status code: {0}".format(r.status_code))
-            r.raise_for_status()
-        except requests.RequestException as e:
-            logging.error("Error retrieving Redmine user information")
-            logging.error(e)
-            return
+        if 'users' not in self._metadata:
+            try:
+                r = self.s.get('{0}/users.json'.format(self.url))
+                logging.debug("Get user id: status code: {0}".format(r.status_code))
+                r.raise_for_status()
+            except requests.RequestException as e:
+                logging.error("Error retrieving Redmine user information")
+                logging.error(e)
+                return
+            self._metadata['users'] = r.json()['users']
 
         # If an email address was passed in for user_name param, extract the 'name' piece.
         if '@' in user_name:
             user_name = "{0}".format(user_name.split('@')[0].strip())
 
-        user_json = r.json()
-        for user in user_json['users']:
+        for user in self._metadata['users']:
             if user['login'] == user_name:
                 return user['id']
 
@@ -477,7 +735,7 @@ class RedmineTicket(ticket.Ticket):
         :param fields: Ticket fields.
         :return: fields: Ticket fields in the correct form for the ticketing tool.
         """
-        for key, value in fields.items():
+        for key, value in list(fields.items()):
             if key == 'priority':
                 fields['priority_id'] = self._get_priority_id(value)
                 fields.pop('priority')
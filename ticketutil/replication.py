@@ -0,0 +1,424 @@
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import sync
+from . import ticket
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    source TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    target TEXT NOT NULL,
+    target_id TEXT NOT NULL,
+    PRIMARY KEY (source, source_id)
+);
+CREATE INDEX IF NOT EXISTS links_target ON links (target, target_id);
+CREATE TABLE IF NOT EXISTS known (
+    instance TEXT NOT NULL,
+    ticket_id TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    status TEXT,
+    PRIMARY KEY (instance, ticket_id)
+);
+CREATE TABLE IF NOT EXISTS pending (
+    source TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    error_message TEXT,
+    failed REAL NOT NULL,
+    PRIMARY KEY (source, source_id)
+);
+"""
+
+
+class Mapping(object):
+    """
+    Field and status mapping tables from one ticketing tool to another, eg. ServiceNow incidents to
+    JIRA issues.
+    """
+    def __init__(self, fields, statuses=None, values=None, create_fields=None):
+        """
+        :param fields: Dict of source field name to target field name, eg. {'short_description': 'summary'}.
+                       Target names are the keyword arguments of the target's create() and edit().
+        :param statuses: Optional dict of source status to target status, eg. {'1': 'In Progress'}.
+                         Statuses missing from it aren't replicated.
+        :param values: Optional dict of source field name to a dict of source value to target value,
+                       eg. {'priority': {'1': 'Critical', '2': 'Major'}}. Other values are copied.
+        :param create_fields: Optional dict of target fields only set when the target ticket is created,
+                              eg. {'type': 'Task'}.
+        """
+        self.fields = fields
+        self.statuses = statuses or {}
+        self.values = values or {}
+        self.create_fields = create_fields or {}
+
+    def read(self, ticket_object, content):
+        """
+        Reads the mapped fields and the status of a source ticket.
+        :param ticket_object: The source Ticket object.
+        :param content: The ticket as returned by the tool, eg. by search().
+        :return: (fields, status): Dict of source field name to value, and the status.
+        """
+        fields = dict((name, read_field(content, name)) for name in self.fields)
+        return fields, ticket_object._mirror_fields(content)['status']
+
+    def apply(self, fields, status):
+        """
+        Maps source fields and status to the target.
+        :param fields: Dict of source field name to value, from read().
+        :param status: The source status.
+        :return: (fields, status): Dict of target field name to value, and the target status or None.
+        """
+        target_fields = {}
+        for name, value in fields.items():
+            table = self.values.get(name)
+            if table is not None and _hashable(value) in table:
+                value = table[_hashable(value)]
+            target_fields[self.fields[name]] = value
+        return target_fields, self.statuses.get(status)
+
+
+class IdMap(object):
+    """
+    A persistent map between replicated tickets, in SQLite.
+
+    Besides the links between source and target tickets, it keeps the field values and status each
+    linked ticket was last known to have, and the source tickets that failed to replicate.
+    Tickets are identified by instance, the URL and project of their Ticket object, and ticket_id.
+    """
+    def __init__(self, path=':memory:'):
+        """
+        :param path: Path of the SQLite database, or ':memory:'.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get(self, instance, ticket_id, other):
+        """
+        Finds the ticket linked to a ticket, whichever side of the link it is on.
+        :param instance: The instance of the ticket.
+        :param ticket_id: The id of the ticket.
+        :param other: The instance of the linked ticket.
+        :return: ticket_id: The id of the linked ticket, or None.
+        """
+        key = (instance, str(ticket_id), other)
+        with self._lock:
+            row = self._db.execute('SELECT target_id FROM links WHERE source = ? AND source_id = ? AND target = ?',
+                                   key).fetchone()
+            if row is None:
+                row = self._db.execute('SELECT source_id FROM links WHERE target = ? AND target_id = ? '
+                                       'AND source = ?', key).fetchone()
+        return row[0] if row else None
+
+    def link(self, source, source_id, target, target_id):
+        """
+        Links a source ticket to the target ticket it was replicated to.
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO links (source, source_id, target, target_id) VALUES (?, ?, ?, ?)',
+                             (source, str(source_id), target, str(target_id)))
+            self._db.commit()
+
+    def known(self, instance, ticket_id):
+        """
+        :return: (fields, status): The field values and status a ticket was last known to have.
+                 fields is empty and status None if the ticket was never replicated.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT fields, status FROM known WHERE instance = ? AND ticket_id = ?',
+                                   (instance, str(ticket_id))).fetchone()
+        return (json.loads(row[0]), row[1]) if row else ({}, None)
+
+    def remember(self, instance, ticket_id, fields, status=None):
+        """
+        Records field values and the status of a ticket, keeping the values of other fields.
+        :param status: The status, or None to keep the known status.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT fields, status FROM known WHERE instance = ? AND ticket_id = ?',
+                                   (instance, str(ticket_id))).fetchone()
+            known = json.loads(row[0]) if row else {}
+            known.update(fields)
+            if status is None and row:
+                status = row[1]
+            self._db.execute('INSERT OR REPLACE INTO known (instance, ticket_id, fields, status) VALUES (?, ?, ?, ?)',
+                             (instance, str(ticket_id), json.dumps(known, default=str), status))
+            self._db.commit()
+
+    def fail(self, source, source_id, error_message):
+        """
+        Records a source ticket that failed to replicate, to retry it on the next run.
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO pending (source, source_id, error_message, failed) '
+                             'VALUES (?, ?, ?, ?)', (source, str(source_id), error_message, time.time()))
+            self._db.commit()
+
+    def resolve(self, source, source_id):
+        """
+        Removes a source ticket from the failed ones.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM pending WHERE source = ? AND source_id = ?', (source, str(source_id)))
+            self._db.commit()
+
+    def pending(self, source):
+        """
+        :param source: The instance of the source tickets.
+        :return: ticket_ids: List of the source tickets that failed to replicate, oldest first.
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT source_id FROM pending WHERE source = ? ORDER BY failed',
+                                    (source,)).fetchall()
+        return [row[0] for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM links').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Replicator(object):
+    """
+    Replicates tickets from one ticketing tool to another, eg. ServiceNow incidents into JIRA.
+
+    Every run pulls the source tickets changed since the last run with a SyncEngine, maps their fields
+    and status with a Mapping and applies them to the target with concurrent workers. A new source
+    ticket creates a target ticket, linked in the IdMap. For linked tickets, only the fields whose
+    mapped values changed since they were last replicated are edited, and the status is only changed
+    if it differs.
+
+    Loops are avoided by comparing with the values each linked ticket was last known to have. A ticket
+    changed by replication, eg. when another Replicator runs the other way with the same IdMap, reads
+    back the values written to it and isn't replicated again. Tickets that fail are retried on the next run.
+    """
+    def __init__(self, source, target_factory, mapping, id_map, sync_engine=None, workers=4, source_utc_offset=0):
+        """
+        :param source: The source Ticket object, eg. a ServiceNowTicket.
+        :param target_factory: Callable returning a new target Ticket object, eg.
+                               functools.partial(JiraTicket, <url>, <project>, auth='kerberos'). Every worker
+                               thread makes its own, as Ticket objects hold the current ticket.
+        :param mapping: A Mapping from the source to the target.
+        :param id_map: An IdMap.
+        :param sync_engine: A SyncEngine keeping the source watermark. Defaults to one in memory.
+        :param workers: Number of worker threads applying changes.
+        :param source_utc_offset: Hours the source's timestamps are ahead of UTC, for the lag metrics.
+        """
+        self.source = source
+        self.target_factory = target_factory
+        self.mapping = mapping
+        self.id_map = id_map
+        self.sync_engine = sync_engine or sync.SyncEngine()
+        self.workers = workers
+        self.source_utc_offset = datetime.timedelta(hours=source_utc_offset)
+        self._local = threading.local()
+        self._source_instance = instance(source)
+        self._target_instance = None
+
+    def run(self, since=None, page_size=100):
+        """
+        Replicates the source tickets changed since the last run, and retries the ones that failed.
+        :param since: Datetime, in the source's time, to start from if the source was never replicated.
+                      Defaults to every ticket in the project.
+        :param page_size: Number of tickets fetched per search request.
+        :return: metrics: Dict of the number of changes, created, updated, unchanged and failed tickets,
+                 fields_sent, elapsed seconds, throughput in changes per second, and lag, the mean and
+                 max seconds between a source change and its replication.
+        """
+        start = time.time()
+        self._target_instance = instance(self._target())
+        metrics = {'changes': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0, 'fields_sent': 0,
+                   'lag': {'mean': None, 'max': None}, 'errors': []}
+        lags = []
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = set()
+        try:
+            for source_id, content in self._changes(since, page_size):
+                if len(futures) >= 2 * self.workers:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._count(metrics, lags, future.result())
+                futures.add(executor.submit(self._replicate, source_id, content))
+            for future in futures:
+                self._count(metrics, lags, future.result())
+        finally:
+            executor.shutdown()
+
+        metrics['elapsed'] = time.time() - start
+        metrics['throughput'] = metrics['changes'] / metrics['elapsed'] if metrics['elapsed'] else 0.0
+        if lags:
+            metrics['lag'] = {'mean': sum(lags) / len(lags), 'max': max(lags)}
+        logging.info("Replicated {0} changes from {1} to {2}: {3} created, {4} updated, {5} failed".format(
+            metrics['changes'], self._source_instance, self._target_instance, metrics['created'],
+            metrics['updated'], metrics['failed']))
+        return metrics
+
+    def _changes(self, since, page_size):
+        """
+        Yields the source tickets to replicate: first the ones that failed before, read again, then the
+        ones changed since the last run.
+        :return: Generator of (source_id, content).
+        """
+        retried = set()
+        for source_id in self.id_map.pending(self._source_instance):
+            result = self.source.get_ticket_content(source_id)
+            if result.status == 'Failure':
+                logging.error("Error reading ticket {0} to retry its replication".format(source_id))
+                continue
+            retried.add(source_id)
+            yield source_id, result.ticket_content
+
+        fields = _search_fields(self.source, self.mapping)
+        for change in self.sync_engine.sync(self.source, fields=fields, since=since, page_size=page_size):
+            if str(change.ticket_id) not in retried:
+                yield change.ticket_id, change.ticket
+
+    def _replicate(self, source_id, content):
+        """
+        Applies one source ticket to the target, in a worker thread.
+        :return: (outcome, fields_sent, lag, error_message): outcome is 'created', 'updated',
+                 'unchanged' or 'failed'.
+        """
+        try:
+            outcome, sent, error_message = self._apply(source_id, content)
+        except Exception as e:
+            outcome, sent, error_message = 'failed', 0, str(e)
+        if outcome == 'failed':
+            logging.error("Error replicating ticket {0}".format(source_id))
+            logging.error(error_message)
+            self.id_map.fail(self._source_instance, source_id, error_message)
+            return outcome, 0, None, error_message
+        self.id_map.resolve(self._source_instance, source_id)
+        return outcome, sent, self._lag(content), None
+
+    def _apply(self, source_id, content):
+        """
+        :return: (outcome, fields_sent, error_message)
+        """
+        source_fields, source_status = self.mapping.read(self.source, content)
+        known_fields, known_status = self.id_map.known(self._source_instance, source_id)
+        if source_status == known_status and all(name in known_fields and
+                                                 ticket._same_value(known_fields[name], value)
+                                                 for name, value in source_fields.items()):
+            return 'unchanged', 0, None
+
+        fields, status = self.mapping.apply(source_fields, source_status)
+        target = self._target()
+        target_id = self.id_map.get(self._source_instance, source_id, self._target_instance)
+        if target_id is None:
+            result = target.create(**dict(self.mapping.create_fields, **fields))
+            if result.status == 'Failure':
+                return 'failed', 0, result.error_message
+            target_id = target.ticket_id
+            self.id_map.link(self._source_instance, source_id, self._target_instance, target_id)
+            outcome, sent, target_status = 'created', fields, None
+        else:
+            target_fields, target_status = self.id_map.known(self._target_instance, target_id)
+            sent = dict((name, value) for name, value in fields.items()
+                        if name not in target_fields or not ticket._same_value(target_fields[name], value))
+            if not sent and (status is None or status == target_status):
+                self.id_map.remember(self._source_instance, source_id, source_fields, source_status)
+                return 'unchanged', 0, None
+            result = target.set_ticket_id(target_id)
+            if result.status != 'Failure' and sent:
+                result = target.edit(**sent)
+            if result.status == 'Failure':
+                return 'failed', 0, result.error_message
+            outcome = 'updated'
+
+        if status is not None and status != target_status:
+            result = target.change_status(status)
+            if result.status == 'Failure':
+                self.id_map.remember(self._target_instance, target_id, sent)
+                return 'failed', 0, result.error_message
+        self.id_map.remember(self._target_instance, target_id, sent, status)
+        self.id_map.remember(self._source_instance, source_id, source_fields, source_status)
+        logging.debug("Replicated {0} to {1}: {2}".format(source_id, target_id, ', '.join(sorted(sent))))
+        return outcome, len(sent), None
+
+    def _target(self):
+        """
+        :return: target: The target Ticket object of the current thread.
+        """
+        target = getattr(self._local, 'target', None)
+        if target is None:
+            target = self._local.target = self.target_factory()
+        return target
+
+    def _lag(self, content):
+        """
+        :return: lag: Seconds since the source ticket was updated, or None if it can't be read.
+        """
+        try:
+            updated = self.source._ticket_updated(content)[1]
+        except (KeyError, TypeError, ValueError, NotImplementedError):
+            return None
+        now = datetime.datetime.utcnow() + self.source_utc_offset
+        return max((now - updated).total_seconds(), 0.0)
+
+    def _count(self, metrics, lags, result):
+        outcome, sent, lag, error_message = result
+        metrics['changes'] += 1
+        metrics[outcome] += 1
+        metrics['fields_sent'] += sent
+        if lag is not None:
+            lags.append(lag)
+        if error_message:
+            metrics['errors'].append(error_message)
+
+
+def instance(ticket_object):
+    """
+    :param ticket_object: A Ticket object.
+    :return: instance: The key of the Ticket object's instance and project in an IdMap.
+    """
+    return '{0} {1}'.format(ticket_object.url, ticket_object.project)
+
+
+def read_field(content, name):
+    """
+    Reads a field from a ticket as returned by any tool, unwrapping values such as JIRA's
+    {'name': 'Major', 'id': '3'} or ServiceNow references.
+    :param content: The ticket as returned by the tool.
+    :param name: The field name.
+    :return: value: The field value, or None if the ticket doesn't have it.
+    """
+    # JIRA issues keep their fields apart from the key.
+    fields = content.get('fields') if isinstance(content.get('fields'), dict) else content
+    return _plain(fields.get(name))
+
+
+def _plain(value):
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    if isinstance(value, dict):
+        for key in ['name', 'value', 'display_value', 'key']:
+            if key in value:
+                return value[key]
+    return value
+
+
+def _hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _search_fields(ticket_object, mapping):
+    """
+    :return: fields: The source fields search() must return, or None where the status field isn't known.
+    """
+    status_fields = {'JIRA': 'status', 'Bugzilla': 'status', 'ServiceNow': 'state'}
+    status = status_fields.get(getattr(ticket_object, 'ticketing_tool', None))
+    if status is None:
+        return None
+    return list(mapping.fields) + [status]
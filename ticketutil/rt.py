@@ -1,18 +1,35 @@
+import datetime
 import logging
+import os
 import re
 
 import requests
 from requests_kerberos import HTTPKerberosAuth, DISABLED
 
+from . import mirror
+from . import sync
 from . import ticket
+from . import transport
 
 __author__ = 'dranck, rnester, kshirsal'
 
+# An attachment in RT's attachment list, eg. '12: log.txt (text/plain / 1.2k),'.
+_ATTACHMENT = re.compile(r'^(?:Attachments:)?\s*(\d+): (.*) \(([^()]*) / [^()]*\),?$', re.MULTILINE)
+
 
 class RTTicket(ticket.Ticket):
     """
     A RT Ticket object. Contains RT-specific methods for working with tickets.
     """
+    # Fields search() must return for SyncEngine.
+    _sync_fields = ['LastUpdated']
+
+    # Attachments are listed with rounded sizes and no digests, so they can't be matched to files.
+    _attachments_comparable = False
+
+    # Search reads the matching ids first, so tickets updated during a sync can't shift the pages.
+    _sync_by_update_time = False
+
     def __init__(self, url, project, auth=None, ticket_id=None):
         self.ticketing_tool = 'RT'
 
@@ -49,7 +66,7 @@ class RTTicket(ticket.Ticket):
         We're using a Session to persist cookies across all requests made from the Session instance.
         :return s: Requests Session.
         """
-        s = requests.Session()
+        s = transport.Session()
         # Kerberos Auth
         if self.auth == 'kerberos':
             self.principal = ticket._get_kerberos_principal()
@@ -124,6 +141,48 @@ class RTTicket(ticket.Ticket):
             logging.debug("Ticket {0} is valid".format(ticket_id))
             return True
 
+    def get_ticket_content(self, ticket_id=None, fields=None):
+        """
+        Gets the content of a ticket.
+        :param ticket_id: The ticket to get. Defaults to the current ticket.
+        :param fields: Optional list of field names to return, eg. ['Subject', 'Status']. Only these fields
+                       are requested from RT. Defaults to all fields.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, a dict of the ticket's fields.
+        """
+        if ticket_id is None:
+            ticket_id = self.ticket_id
+            if not self.ticket_id:
+                error_message = "No ticket ID associated with ticket object. " \
+                                "Set ticket ID with set_ticket_id(<ticket_id>)"
+                logging.error(error_message)
+                return self.request_result._replace(status='Failure', error_message=error_message)
+
+        params = {'fields': ','.join(fields)} if fields else None
+        try:
+            r = self.s.get("{0}/ticket/{1}/show".format(self.rest_url, ticket_id), params=params)
+            logging.debug("Get ticket content: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            error_message = ticket.content_error_message(ticket_id, e)
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
+        # RT's API returns 200 even if the ticket is not valid. We need to parse the response.
+        if "Ticket {0} does not exist.".format(ticket_id) in r.text:
+            error_message = ticket.NOT_FOUND.format(ticket_id)
+            logging.error(error_message)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+        if "Bad Request" in r.text:
+            error_message = "Error getting ticket content"
+            logging.error(error_message)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
+        ticket_content = _parse_ticket_content(r.text)
+        self._mirror_content(ticket_content, partial=bool(fields))
+        return self.request_result._replace(ticket_content=ticket_content)
+
     def create(self, subject, text, **kwargs):
         """
         Creates a ticket.
@@ -146,7 +205,7 @@ class RTTicket(ticket.Ticket):
         params = self._create_ticket_parameters(subject, text, kwargs)
 
         # Create our ticket.
-        return self._create_ticket_request(params)
+        return self._create_ticket(params, subject, text)
 
     def _create_ticket_parameters(self, subject, text, fields):
         """
@@ -200,6 +259,7 @@ class RTTicket(ticket.Ticket):
             logging.debug("Create ticket: status code: {0}".format(r.status_code))
             r.raise_for_status()
         except requests.RequestException as e:
+            self._create_error = e
             logging.error("Error creating ticket")
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=str(e))
@@ -216,10 +276,119 @@ class RTTicket(ticket.Ticket):
         logging.info("Created ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
         return self.request_result
 
-    def edit(self, **kwargs):
+    def _find_created_ticket(self, params):
+        """
+        Searches for a ticket created in the last day in the queue with the subject and requestor of params.
+        :param params: The payload from _create_ticket_parameters().
+        :return: ticket_id: The id of the matching ticket, or None.
+        """
+        subject = re.search('^Subject: (.*)$', params['content'], re.MULTILINE).group(1)
+        requestor = re.search('^Requestor: (.*)$', params['content'], re.MULTILINE).group(1)
+        since = datetime.date.today() - datetime.timedelta(days=1)
+        query = "Queue = '{0}' AND Subject = '{1}' AND Requestor = '{2}' AND Created > '{3}'".format(
+            self.project, subject.replace("'", "\\'"), requestor.replace("'", "\\'"), since.isoformat())
+        try:
+            r = self.s.get('{0}/search/ticket'.format(self.rest_url),
+                           params={'query': query, 'orderby': '-Created', 'format': 's'})
+            logging.debug("Find created ticket: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error searching for created ticket")
+            logging.error(e)
+            return
+
+        # Results are lines of the form '<id>: <subject>'.
+        match = re.search('^(\\d+): ', r.text, re.MULTILINE)
+        if match:
+            return match.group(1)
+
+    def _search_pages(self, query, fields, page_size):
+        """
+        Fetches the queue's tickets matching a TicketSQL query, eg. "Status = 'open'", page by page.
+        RT's REST 1.0 search can't page, so the matching ids are fetched first and the tickets are
+        then fetched page_size at a time.
+        :param query: TicketSQL, restricted to the queue.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of tickets fetched per request.
+        :return: Generator of lists of ticket dicts.
+        """
+        ticket_sql = "Queue = '{0}'".format(self.project)
+        if query:
+            ticket_sql = "{0} AND ({1})".format(ticket_sql, query)
+        search_url = '{0}/search/ticket'.format(self.rest_url)
+        r = self._get_search_page(search_url, {'query': ticket_sql, 'orderby': 'id', 'format': 'i'})
+        ticket_ids = re.findall('^ticket/(\\d+)$', r.text, re.MULTILINE)
+
+        params = {'orderby': 'id', 'format': 'l'}
+        if fields:
+            params['fields'] = ','.join(fields)
+        for start in range(0, len(ticket_ids), page_size):
+            params['query'] = ' OR '.join('id = {0}'.format(ticket_id)
+                                          for ticket_id in ticket_ids[start:start + page_size])
+            r = self._get_search_page(search_url, params)
+            tickets = [_parse_ticket_content(text) for text in re.split('^--$', r.text, flags=re.MULTILINE)]
+            yield [ticket_content for ticket_content in tickets if ticket_content]
+
+    def _updated_since_query(self, since):
+        """
+        Builds TicketSQL for the tickets updated since a time.
+        :param since: Datetime in the RT user's timezone, or None for every ticket.
+        :return: query: TicketSQL.
+        """
+        if since is None:
+            return None
+        return "LastUpdated >= '{0}'".format(since.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def _ticket_updated(self, item):
+        """
+        :param item: A ticket dict yielded by search().
+        :return: (ticket_id, updated): The ticket id and update time.
+        """
+        return item['id'].split('/')[-1], sync.parse_time(item['LastUpdated'], '%a %b %d %H:%M:%S %Y')
+
+    def _mirror_fields(self, content):
+        """
+        :param content: A ticket dict parsed from RT.
+        :return: fields: Dict of the columns stored by ticketutil.mirror.Mirror.
+        """
+        if 'id' not in content:
+            return None
+        # Tickets are read without their history, so description and comments aren't mirrored.
+        columns = mirror.read_columns(content, {
+            'project': ('Queue', content.get('Queue')),
+            'summary': ('Subject', content.get('Subject')),
+            'status': ('Status', content.get('Status')),
+            'assignee': ('Owner', content.get('Owner')),
+            'updated': ('LastUpdated', content.get('LastUpdated'))})
+        columns['ticket_id'] = content['id'].split('/')[-1]
+        return columns
+
+    def _edit_content_fields(self, names):
+        """
+        :param names: List of edit() keyword argument names.
+        :return: fields: The RT field names.
+        """
+        return [name.title() for name in names]
+
+    def _edit_field_values(self, content, name, value):
+        """
+        Reads a field edit() would set from a ticket. RT field names are case insensitive, and address
+        lists such as cc are compared as lists.
+        """
+        fields = dict((key.lower(), field_value) for key, field_value in content.items())
+        if name.lower() not in fields:
+            return None
+        current = fields[name.lower()]
+        if name.lower() in ['requestors', 'cc', 'admincc']:
+            return _split_addresses(current), _split_addresses(value)
+        return current, value
+
+    def edit(self, diff=None, **kwargs):
         """
         Edits fields in a RT ticket.
         Keyword arguments are used to specify ticket fields.
+        With diff, only the fields that would change the ticket are sent, and no request is made if
+        none would. The names of the fields sent are set in sent_fields.
 
         Fields examples:
         priority='5'
@@ -227,6 +396,8 @@ class RTTicket(ticket.Ticket):
         cc='username@mail.com'
         admincc=['username@mail.com', 'username2@mail.com']
 
+        :param diff: None to send every field. 'fetch' to compare with the ticket's current fields first,
+                     or 'cache' to compare with the mirrored ticket unless it is stale.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
         if not self.ticket_id:
@@ -234,6 +405,13 @@ class RTTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        kwargs = self._edit_fields(kwargs, diff)
+        if kwargs is None:
+            return self.request_result._replace(status='Failure', error_message="Error getting ticket content")
+        if diff and not kwargs:
+            logging.info("Ticket {0} already has these field values".format(self.ticket_id))
+            return self.request_result
+
         # Some of the ticket fields need to be in a specific form for the tool.
         fields = _prepare_ticket_fields(kwargs)
 
@@ -263,6 +441,54 @@ class RTTicket(ticket.Ticket):
         logging.info("Edited ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
         return self.request_result
 
+    def _merge_operation(self, payload, method_name, args, kwargs):
+        """
+        Merges edit() and change_status() into one ticket edit request.
+        Comments go through a separate endpoint in RT.
+        :param payload: The dict of the combined request. Only modified if the operation is merged.
+        :param method_name: The name of the recorded Ticket method.
+        :param args: Positional arguments of the recorded call.
+        :param kwargs: Keyword arguments of the recorded call.
+        :return: True if the operation was merged into payload, False if it must be sent on its own.
+        """
+        if method_name == 'edit' and not args and 'diff' not in kwargs:
+            payload.update(_prepare_ticket_fields(dict(kwargs)))
+            return True
+        if method_name == 'change_status':
+            status = args[0] if args else kwargs.get('status')
+            payload['status'] = status.lower()
+            return True
+        return False
+
+    def _send_merged_request(self, payload):
+        """
+        Sends a combined ticket edit request built by _merge_operation().
+        :param payload: The dict of the combined request.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        content = ''
+        for key, value in payload.items():
+            content += '{0}: {1}\n'.format(key.title(), value)
+
+        params = {'content': content}
+
+        try:
+            r = self.s.post("{0}/ticket/{1}/edit".format(self.rest_url, self.ticket_id), data=params)
+            logging.debug("Merged update: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error updating ticket")
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=str(e))
+
+        # RT's API returns 200 even if the ticket is not valid. We need to parse the response.
+        if '409 Syntax Error' in r.text:
+            error_message = r.text.replace('\n', ' ')
+            logging.error(error_message)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+        logging.info("Updated ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
+        return self.request_result
+
     def add_comment(self, comment):
         """
         Adds a comment to a RT issue.
@@ -336,6 +562,8 @@ class RTTicket(ticket.Ticket):
     def add_attachment(self, file_name):
         """
         Attaches a file to a RT ticket.
+        Files uploaded before are skipped if set_attachment_dedup() is on with an index. RT doesn't report
+        exact sizes or digests, so the ticket's attachments can't be compared.
         :param file_name: A string representing the file to attach.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
@@ -344,6 +572,12 @@ class RTTicket(ticket.Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        attached, key = self._find_attachment(file_name, os.path.basename(file_name))
+        if attached:
+            logging.info("File {0} is already attached to ticket {1} as {2}".format(file_name, self.ticket_id,
+                                                                                    attached))
+            return self.request_result
+
         content = 'Action: correspond\n'
         content += 'Attachment: {0}\n'.format(file_name)
 
@@ -370,9 +604,61 @@ class RTTicket(ticket.Ticket):
             error_message = r.text.replace('\n', ' ')
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
+        self._record_attachment(key, os.path.basename(file_name))
         logging.info("Attached file {0} to ticket {1} - {2}".format(file_name, self.ticket_id, self.ticket_url))
         return self.request_result
 
+    def _list_attachments(self, ticket_id):
+        """
+        Lists the named attachments of a ticket. Unnamed ones are message bodies.
+        RT only reports rounded sizes, eg. 1.2k, so size is None.
+        :param ticket_id: The id of the ticket.
+        :return: attachments: List of attachment dicts, see Ticket.get_attachments().
+        """
+        r = self.s.get("{0}/ticket/{1}/attachments".format(self.rest_url, ticket_id))
+        logging.debug("Get attachments: status code: {0}".format(r.status_code))
+        r.raise_for_status()
+
+        # RT's API returns 200 even if the ticket is not valid. We need to parse the response.
+        if "Ticket {0} does not exist.".format(ticket_id) in r.text:
+            raise ticket.TicketException("Ticket {0} does not exist".format(ticket_id))
+        return [{'id': attachment_id,
+                 'file_name': file_name,
+                 'size': None,
+                 'content_type': content_type,
+                 'url': "{0}/ticket/{1}/attachments/{2}/content".format(self.rest_url, ticket_id, attachment_id),
+                 'digest': None}
+                for attachment_id, file_name, content_type in _parse_attachments(r.text)]
+
+    def _read_history(self, ticket_id):
+        """
+        The ticket gets 'History', a list of the transaction dicts of ticket/<id>/history?format=l.
+        :param ticket_id: The id of the ticket.
+        :return: ticket_content: The ticket with its history, see Ticket.get_ticket_history().
+        """
+        text = self._get_history_part("{0}/ticket/{1}/show".format(self.rest_url, ticket_id)).text
+        # RT's API returns 200 even if the ticket is not valid. We need to parse the response.
+        if "Ticket {0} does not exist.".format(ticket_id) in text:
+            raise ticket.TicketException("Ticket {0} does not exist".format(ticket_id))
+        ticket_content = _parse_ticket_content(text)
+
+        text = self._get_history_part("{0}/ticket/{1}/history".format(self.rest_url, ticket_id),
+                                      {'format': 'l'}).text
+        # Transactions are separated by lines of '--'.
+        history = [_parse_ticket_content(entry) for entry in re.split(r'^--$', text, flags=re.MULTILINE)]
+        ticket_content['History'] = [entry for entry in history if entry]
+        return ticket_content
+
+    def _attachment_chunks(self, attachment, chunk_size):
+        """
+        Streams the content of an attachment, without the status line and trailing newlines RT wraps it in.
+        :param attachment: An attachment dict.
+        :param chunk_size: Number of bytes read at a time.
+        :return: Generator of bytes.
+        """
+        chunks = super(RTTicket, self)._attachment_chunks(attachment, chunk_size)
+        return _strip_response(chunks)
+
 
 def _prepare_ticket_fields(fields):
         """
@@ -387,6 +673,79 @@ def _prepare_ticket_fields(fields):
         return fields
 
 
+def _split_addresses(value):
+    """
+    :param value: A list of addresses, or a string of comma separated addresses as RT returns them.
+    :return: addresses: List of addresses.
+    """
+    if isinstance(value, list):
+        return value
+    return [address.strip() for address in (value or '').split(',') if address.strip()]
+
+
+def _parse_ticket_content(text):
+    """
+    Parses a ticket returned by the RT REST API, eg. 'Subject: Ticket summary', into a dict.
+    Values spanning several lines have their continuation lines indented.
+    :param text: The response text.
+    :return: ticket_content: Dict of field name to value.
+    """
+    ticket_content = {}
+    field = None
+    for line in text.splitlines():
+        if line.startswith('RT/') or line.startswith('#'):
+            continue
+        if field and line.startswith(' '):
+            ticket_content[field] = '{0}\n{1}'.format(ticket_content[field], line.strip())
+            continue
+        field, separator, value = line.partition(':')
+        if not separator:
+            field = None
+            continue
+        ticket_content[field] = value.strip()
+    return ticket_content
+
+
+def _parse_attachments(text):
+    """
+    Parses the attachment list returned by the RT REST API, eg. 'Attachments: 12: log.txt (text/plain / 1.2k),'.
+    :param text: The response text.
+    :return: attachments: List of (id, file name, content type) tuples of the named attachments.
+    """
+    attachments = []
+    for match in _ATTACHMENT.finditer(text):
+        if match.group(2) != '(Unnamed)':
+            attachments.append((match.group(1), match.group(2), match.group(3)))
+    return attachments
+
+
+def _strip_response(chunks):
+    """
+    Strips the 'RT/4.4.2 200 Ok' status line, the blank line after it and the three trailing newlines from
+    streamed attachment content. Raises TicketException if the status isn't 200, or if the content ends
+    before the status line and the blank line after it.
+    :param chunks: Iterable of bytes.
+    :return: Generator of bytes.
+    """
+    buffer = b''
+    header = True
+    for chunk in chunks:
+        buffer += chunk
+        if header:
+            end = buffer.find(b'\n')
+            if end < 0 or len(buffer) < end + 2:
+                continue
+            if b' 200 ' not in buffer[:end]:
+                raise ticket.TicketException(buffer[:end].decode('utf-8', 'replace'))
+            buffer = buffer[end + 2:]
+            header = False
+        if len(buffer) > 3:
+            yield buffer[:-3]
+            buffer = buffer[-3:]
+    if header:
+        raise ticket.TicketException("Incomplete RT response: {0!r}".format(buffer[:80]))
+
+
 def main():
     """
     main() function, not directly callable.
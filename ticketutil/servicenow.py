@@ -3,7 +3,8 @@ import logging
 
 import requests
 
-from ticketutil.ticket import Ticket
+from ticketutil import mirror, sync
+from ticketutil.ticket import Ticket, TicketException, NOT_FOUND, content_error_message
 
 __author__ = 'dranck, rnester, kshirsal, pzubaty'
 
@@ -13,6 +14,11 @@ class ServiceNowTicket(Ticket):
     ServiceNow Ticket object. Contains ServiceNow specific methods for working
     with tickets.
     """
+    # Fields search() must return for SyncEngine.
+    _sync_fields = ['number', 'sys_updated_on']
+
+    # Attachments are downloaded as files, not JSON.
+    _attachment_headers = {'Accept': '*/*'}
 
     def __init__(self, url, project, auth=None, ticket_id=None):
         """
@@ -66,11 +72,13 @@ class ServiceNowTicket(Ticket):
         logging.debug("Project {0} is valid".format(project))
         return True
 
-    def get_ticket_content(self, ticket_id=None):
+    def get_ticket_content(self, ticket_id=None, fields=None):
         """
         Get ticket_content using ticket_id
 
         :param ticket_id: ticket number, if not set self.ticket_id is used
+        :param fields: optional list of field names to return, eg. ['number', 'state'],
+                       passed to ServiceNow as sysparm_fields. All fields by default.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
         if ticket_id is None:
@@ -81,17 +89,25 @@ class ServiceNowTicket(Ticket):
                 logging.error(error_message)
                 return self.request_result._replace(status='Failure', error_message=error_message)
 
+        query_url = "{0}?sysparm_query=GOTOnumber%3D{1}".format(self.rest_url, ticket_id)
+        if fields:
+            query_url = "{0}&sysparm_fields={1}".format(query_url, ','.join(fields))
         try:
-            r = self.s.get("{0}?sysparm_query=GOTOnumber%3D{1}".format(self.rest_url, ticket_id))
+            r = self.s.get(query_url)
             logging.debug("Get ticket content: status code: {0}".format(r.status_code))
             r.raise_for_status()
         except requests.RequestException as e:
-            error_message = "Error getting ticket content"
+            error_message = content_error_message(ticket_id, e)
             logging.error(error_message)
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
         ticket_content = r.json()
+        if not ticket_content['result']:
+            error_message = NOT_FOUND.format(ticket_id)
+            logging.error(error_message)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+        self._mirror_content(ticket_content['result'][0], partial=bool(fields))
         return self.request_result._replace(ticket_content=ticket_content['result'][0])
 
     def _verify_ticket_id(self, ticket_id):
@@ -126,8 +142,11 @@ class ServiceNowTicket(Ticket):
 
         # This method is called from set_ticket_id(), _create_ticket_request(), or Ticket.__init__().
         # If this method is being called, we want to update the url field in our Result namedtuple.
-        content = self.get_ticket_content()
-        self.request_result = self.request_result._replace(url=ticket_url, ticket_content=content.ticket_content)
+        # Each of them has just read the record, so it is only fetched again if it isn't the current one.
+        content = getattr(self, 'ticket_content', None)
+        if not content or content.get('number') != self.ticket_id:
+            content = self.get_ticket_content().ticket_content
+        self.request_result = self.request_result._replace(url=ticket_url, ticket_content=content)
 
         return ticket_url
 
@@ -171,7 +190,7 @@ class ServiceNowTicket(Ticket):
                   'u_item': item}
         kwargs.update(fields)
         params = self._create_ticket_parameters(kwargs)
-        return self._create_ticket_request(params)
+        return self._create_ticket(params, short_description, description)
 
     def _create_ticket_parameters(self, fields):
         """
@@ -199,6 +218,7 @@ class ServiceNowTicket(Ticket):
             logging.debug("Create ticket: status code: {0}".format(r.status_code))
             r.raise_for_status()
         except requests.RequestException as e:
+            self._create_error = e
             logging.error("Error creating ticket")
             logging.error(e)
             return self.request_result._replace(status='Failure', error_message=str(e))
@@ -216,6 +236,194 @@ class ServiceNowTicket(Ticket):
         self.request_result = self.request_result._replace(ticket_content=self.ticket_content)
         return self.request_result
 
+    def _find_created_ticket(self, params):
+        """
+        Searches for a record created in the last day with the short description and description of params.
+        :param params: The payload from _create_ticket_parameters().
+        :return: ticket_id: The number of the matching record, or None.
+        """
+        fields = json.loads(params)
+        query = 'short_description={0}^sys_created_on>=javascript:gs.daysAgoStart(1)^ORDERBYDESCsys_created_on'
+        query = query.format(fields['short_description'].replace('^', '^^'))
+        try:
+            r = self.s.get(self.rest_url, params={'sysparm_query': query,
+                                                  'sysparm_fields': 'number,description',
+                                                  'sysparm_limit': 10})
+            logging.debug("Find created ticket: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error searching for created ticket")
+            logging.error(e)
+            return
+
+        for record in r.json()['result']:
+            if record['description'] == fields['description']:
+                return record['number']
+
+    def _search_pages(self, query, fields, page_size):
+        """
+        Fetches the table's records matching an encoded query, eg. 'active=true', page by page.
+        :param query: ServiceNow encoded query (sysparm_query).
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of records fetched per request.
+        :return: Generator of lists of records.
+        """
+        params = self._search_params(query, fields, page_size)
+        offset = 0
+        while True:
+            params['sysparm_offset'] = offset
+            records = self._get_search_page(self.rest_url, params).json()['result']
+            if records:
+                yield records
+            offset += len(records)
+            if len(records) < page_size:
+                return
+
+    def _search_records(self, query, fields, page_size):
+        """
+        Fetches the table's records matching an encoded query one at a time, decoding pages as they arrive.
+        :param query: ServiceNow encoded query (sysparm_query).
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of records fetched per request.
+        :return: Generator of single record lists.
+        """
+        params = self._search_params(query, fields, page_size)
+        offset = 0
+        while True:
+            params['sysparm_offset'] = offset
+            count = 0
+            for record in self._stream_search_page(self.rest_url, params, 'result', {}):
+                count += 1
+                yield [record]
+            offset += count
+            if count < page_size:
+                return
+
+    def _search_params(self, query, fields, page_size):
+        """
+        :return: params: The search parameters of an encoded query, ordered by creation unless it has an order.
+        """
+        query = query or ''
+        if 'ORDERBY' not in query:
+            query = '{0}^ORDERBYsys_created_on'.format(query) if query else 'ORDERBYsys_created_on'
+        params = {'sysparm_query': query, 'sysparm_limit': page_size}
+        if fields:
+            params['sysparm_fields'] = ','.join(fields)
+        return params
+
+    def _updated_since_query(self, since):
+        """
+        Builds an encoded query for the records updated since a time, oldest first.
+        :param since: Datetime in UTC, or None for every record.
+        :return: query: ServiceNow encoded query.
+        """
+        if since is None:
+            return 'ORDERBYsys_updated_on'
+        return 'sys_updated_on>={0}^ORDERBYsys_updated_on'.format(since.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def _ticket_updated(self, item):
+        """
+        :param item: A record yielded by search().
+        :return: (ticket_id, updated): The record number and update time.
+        """
+        return item['number'], sync.parse_time(item['sys_updated_on'], '%Y-%m-%d %H:%M:%S')
+
+    def _mirror_fields(self, content):
+        """
+        :param content: A record as returned by ServiceNow.
+        :return: fields: Dict of the columns stored by ticketutil.mirror.Mirror.
+        """
+        ticket_id = content.get('number')
+        if ticket_id is None:
+            # A projection without the number can still be the current record, matched by sys_id.
+            if 'sys_id' not in content or content['sys_id'] != getattr(self, 'sys_id', None):
+                return None
+            ticket_id = self.ticket_id
+        assignee = content.get('assigned_to')
+        if isinstance(assignee, dict):
+            assignee = assignee.get('value')
+        columns = mirror.read_columns(content, {
+            'summary': ('short_description', content.get('short_description')),
+            'description': ('description', content.get('description')),
+            'comments': ('comments', content.get('comments') or None),
+            'status': ('state', content.get('state')),
+            'assignee': ('assigned_to', assignee or None),
+            'updated': ('sys_updated_on', content.get('sys_updated_on'))})
+        columns.update(ticket_id=ticket_id, project=self.project)
+        return columns
+
+    def _mirror_response(self, r, *args, **kwargs):
+        """
+        Requests session hook refreshing the mirror from changes. ServiceNow returns the changed record.
+        :param r: The response.
+        """
+        if self.mirror is None or not r.ok or r.request.method in ('GET', 'HEAD'):
+            return
+        try:
+            record = r.json().get('result')
+        except ValueError:
+            record = None
+        if isinstance(record, dict) and 'number' in record:
+            self._mirror_content(record)
+        else:
+            super(ServiceNowTicket, self)._mirror_response(r, *args, **kwargs)
+
+    def _set_created_ticket(self, ticket_id):
+        """
+        Makes a record found by the idempotency or duplicate index the current ticket.
+        ServiceNow needs the record's sys_id and content, so this verifies the ticket like set_ticket_id().
+        :param ticket_id: The number of the record.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        return self.set_ticket_id(ticket_id)
+
+    def _list_attachments(self, ticket_id):
+        """
+        :param ticket_id: The ticket number.
+        :return: attachments: List of attachment dicts, see Ticket.get_attachments().
+        """
+        sys_id = getattr(self, 'sys_id', None) if ticket_id == self.ticket_id else None
+        if sys_id is None:
+            result = self.get_ticket_content(ticket_id, fields=['sys_id'])
+            if result.status == 'Failure':
+                raise TicketException(result.error_message)
+            sys_id = result.ticket_content['sys_id']
+        r = self.s.get("{0}/api/now/attachment?sysparm_query=table_sys_id%3D{1}".format(self.url, sys_id))
+        logging.debug("Get attachments: status code: {0}".format(r.status_code))
+        r.raise_for_status()
+        return [{'id': attachment['sys_id'],
+                 'file_name': attachment['file_name'],
+                 'size': int(attachment['size_bytes']) if attachment.get('size_bytes') else None,
+                 'content_type': attachment.get('content_type'),
+                 'url': attachment.get('download_link') or
+                 "{0}/api/now/attachment/{1}/file".format(self.url, attachment['sys_id']),
+                 'digest': _sha256(attachment.get('hash'))}
+                for attachment in r.json()['result']]
+
+    def _read_history(self, ticket_id):
+        """
+        The record gets 'audit', the sys_audit records of its state, 'journals', the sys_journal_field records
+        of its comments, and 'state_labels', a dict of state value to label, as states are numeric codes.
+        :param ticket_id: The ticket number.
+        :return: ticket_content: The record with its history, see Ticket.get_ticket_history().
+        """
+        query_url = "{0}?sysparm_query=GOTOnumber%3D{1}".format(self.rest_url, ticket_id)
+        records = self._get_history_part(query_url).json()['result']
+        if not records:
+            raise TicketException(NOT_FOUND.format(ticket_id))
+        record = records[0]
+        record['audit'] = self._get_history_part(
+            "{0}/api/now/table/sys_audit".format(self.url),
+            {'sysparm_query': 'documentkey={0}^fieldname=state'.format(record['sys_id']),
+             'sysparm_fields': 'fieldname,oldvalue,newvalue,sys_created_on'}).json()['result']
+        record['journals'] = self._get_history_part(
+            "{0}/api/now/table/sys_journal_field".format(self.url),
+            {'sysparm_query': 'element_id={0}^element=comments'.format(record['sys_id']),
+             'sysparm_fields': 'element,sys_created_on'}).json()['result']
+        record['state_labels'] = dict((value, label) for label, value in
+                                      getattr(self, 'available_states', {}).items())
+        return record
+
     def change_status(self, status):
         """
         Change ServiceNow ticket status
@@ -253,12 +461,43 @@ class ServiceNowTicket(Ticket):
         self.request_result = self.request_result._replace(ticket_content=self.ticket_content)
         return self.request_result
 
-    def edit(self, **kwargs):
+    def _cached_content(self):
+        """
+        :return: content: The current record from the mirror, else the record ServiceNow last returned.
+        """
+        content = super(ServiceNowTicket, self)._cached_content()
+        if content is None and self.ticket_content and self.ticket_content.get('number') == self.ticket_id:
+            content = self.ticket_content
+        return content
+
+    def _edit_content_fields(self, names):
+        """
+        :param names: List of edit() keyword argument names.
+        :return: fields: The ServiceNow field names, with u_ prefixes.
+        """
+        return [_field_name(name) for name in names]
+
+    def _edit_field_values(self, content, name, value):
+        """
+        Reads a field edit() would set from a record. Reference fields are compared by their value,
+        eg. a sys_id.
+        """
+        field = _field_name(name)
+        if field not in content:
+            return None
+        current = content[field]
+        if isinstance(current, dict):
+            current = current.get('display_value', current.get('value'))
+        return current, value
+
+    def edit(self, diff=None, **kwargs):
         """
         Edit ticket
 
         Edits a ServiceNow ticket, ticked_id (sys_id) must be set beforehand.
         You can set ticket_id by calling set_ticket_id(ticket_id) method.
+        With diff, only the fields that would change the ticket are sent, and no request is made if
+        none would. The names of the fields sent are set in sent_fields.
 
         :param kwargs: optional fields
 
@@ -269,6 +508,9 @@ class ServiceNowTicket(Ticket):
         impact = '2',
         urgency = '2',
         priority = '2'
+        :param diff: None to send every field. 'fetch' to compare with the ticket's current fields first,
+                     or 'cache' to compare with the mirrored ticket unless it is stale, else with the
+                     record ServiceNow last returned.
         :return: self.request_result: Named tuple containing request status, error_message, and url info.
         """
         if not self.ticket_id:
@@ -276,6 +518,13 @@ class ServiceNowTicket(Ticket):
             logging.error(error_message)
             return self.request_result._replace(status='Failure', error_message=error_message)
 
+        kwargs = self._edit_fields(kwargs, diff)
+        if kwargs is None:
+            return self.request_result._replace(status='Failure', error_message="Error getting ticket content")
+        if diff and not kwargs:
+            logging.info("Ticket {0} already has these field values".format(self.ticket_id))
+            return self.request_result
+
         params = self._create_ticket_parameters(kwargs)
 
         try:
@@ -324,6 +573,70 @@ class ServiceNowTicket(Ticket):
         self.request_result = self.request_result._replace(ticket_content=self.ticket_content)
         return self.request_result
 
+    def _merge_operation(self, payload, method_name, args, kwargs):
+        """
+        Merges edit(), add_comment(), change_status() and the cc methods into one table PUT.
+        Only one comment can be sent per request.
+        :param payload: The dict of the combined request. Only modified if the operation is merged.
+        :param method_name: The name of the recorded Ticket method.
+        :param args: Positional arguments of the recorded call.
+        :param kwargs: Keyword arguments of the recorded call.
+        :return: True if the operation was merged into payload, False if it must be sent on its own.
+        """
+        if method_name == 'edit' and not args and 'diff' not in kwargs:
+            payload.update(kwargs)
+            return True
+        if method_name == 'add_comment' and 'comments' not in payload:
+            payload['comments'] = args[0] if args else kwargs.get('comment')
+            return True
+        if method_name == 'change_status':
+            status = args[0] if args else kwargs.get('status')
+            if status.lower() not in self.available_states:
+                return False
+            payload['state'] = self.available_states[status.lower()]
+            return True
+        if method_name in ['add_cc', 'remove_cc', 'rewrite_cc']:
+            user = args[0] if args else kwargs.get('user')
+            if isinstance(user, str):
+                user = [user]
+            if method_name == 'rewrite_cc':
+                watch_list = list(user)
+            else:
+                watch_list = payload.get('watch_list', self.ticket_content['watch_list']).split(',')
+                watch_list = [item.strip() for item in watch_list if item.strip()]
+                for item in user:
+                    if method_name == 'add_cc' and item not in watch_list:
+                        watch_list.append(item)
+                    if method_name == 'remove_cc' and item in watch_list:
+                        watch_list.remove(item)
+            payload['watch_list'] = ', '.join(watch_list)
+            return True
+        return False
+
+    def _send_merged_request(self, payload):
+        """
+        Sends a combined table PUT built by _merge_operation().
+        :param payload: The dict of the combined request.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        params = self._create_ticket_parameters(dict(payload))
+
+        try:
+            r = self.s.put(self.ticket_rest_url, data=params)
+            logging.debug("Merged update: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logging.error('Failed to update ticket')
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=str(e))
+
+        self.ticket_content = r.json()['result']
+        logging.info("Updated ticket {0} - {1}".format(self.ticket_id, self.ticket_url))
+
+        # Update our ticket_content field and return the result
+        self.request_result = self.request_result._replace(ticket_content=self.ticket_content)
+        return self.request_result
+
     def add_cc(self, user):
         """
         Adds user(s) to cc list.
@@ -439,7 +752,7 @@ def _prepare_ticket_fields(fields):
     :param fields: Ticket fields.
     :return: fields: Ticket fields for the ticketing tool.
     """
-    for key, value in fields.items():
+    for key, value in list(fields.items()):
         if key in ['opened_for', 'operating_system', 'category', 'item',
                    'severity', 'hostname_affected', 'opened_by_dept']:
             fields['u_{}'.format(key)] = value
@@ -453,6 +766,23 @@ def _prepare_ticket_fields(fields):
     return fields
 
 
+def _field_name(name):
+    """
+    :param name: A field name as passed to create() or edit().
+    :return: name: The ServiceNow field name, see _prepare_ticket_fields().
+    """
+    return list(_prepare_ticket_fields({name: None}))[0]
+
+
+def _sha256(digest):
+    """
+    :return: digest: The hash ServiceNow reports for an attachment, if it is a SHA-256 hex digest, else None.
+    """
+    if digest and len(digest) == 64:
+        return digest
+    return None
+
+
 def main():
     """
     main() function, not directly callable.
@@ -0,0 +1,314 @@
+import array
+import collections
+import hashlib
+import heapq
+import operator
+import re
+import struct
+import threading
+import zlib
+
+_MAX_HASH = (1 << 32) - 1
+# Larger than any hash, marks signature bins no shingle was hashed into.
+_EMPTY_BIN = 1 << 32
+# Words, and identifiers such as host names, paths and versions, eg. 'web-3.example.com' or '/var/log'.
+_WORD = re.compile(r'\w+(?:[-./:]\w+)*', re.UNICODE)
+_LETTER = re.compile(r'[^\W\d_]', re.UNICODE)
+
+# Markers of the slot array of a _BucketTable.
+_EMPTY = -1
+_DELETED = -2
+
+
+class SimilarityIndex(object):
+    """
+    A local near-duplicate index over ticket summaries and descriptions, using MinHash and
+    locality-sensitive hashing (LSH).
+
+    Every ticket's text is reduced to a small MinHash signature whose agreement with another signature
+    estimates the Jaccard similarity of their word shingles. Signatures use one permutation hashing, so
+    each shingle is hashed once rather than once per signature value. Signatures are split into bands,
+    and tickets sharing any band are candidates, so a query only compares against a handful of tickets
+    rather than the whole index. Numbers are normalized away, so alerts that only differ in counters or
+    timestamps look alike. Digits within identifiers are kept, so that alerts about web-3 and web-4 don't.
+
+    Memory is bounded by max_entries; the oldest tickets are evicted first. Signatures are kept in one
+    array, and buckets in open-addressing tables of 8-byte cells, so a ticket takes about
+    4 * num_perm + 16 * bands bytes besides its id. Each bucket only keeps its max_bucket_size most
+    recent tickets, and a query only compares the max_candidates tickets sharing the most bands with it,
+    so floods of identical alerts don't slow queries down.
+    """
+    def __init__(self, threshold=0.7, num_perm=64, bands=16, shingle_size=2, max_entries=1000000,
+                 max_bucket_size=8, max_candidates=16, seed=1):
+        """
+        :param threshold: Minimum estimated similarity reported as a duplicate, between 0 and 1.
+        :param num_perm: Number of MinHash values per signature.
+        :param bands: Number of LSH bands. num_perm must be divisible by bands. More bands find
+                      less similar candidates.
+        :param shingle_size: Number of words per shingle.
+        :param max_entries: Maximum number of tickets kept in the index.
+        :param max_bucket_size: Maximum number of tickets kept per LSH bucket.
+        :param max_candidates: Maximum number of tickets compared with the query's signature.
+        :param seed: Seed of the MinHash hashing. Indexes are only comparable with the same seed.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.max_bucket_size = max_bucket_size
+        self.max_candidates = max_candidates
+
+        self._salt = struct.pack('<Q', seed)
+        # For every bin, the bins an empty one takes its value from, tried in order: a random sequence
+        # first, then every other bin so that one is always found. The generator's low bits aren't random,
+        # so the bins are picked with its high bits.
+        generator = _Lcg(seed)
+        self._donors = [[generator.next() * num_perm >> 61 for _ in range(2 * num_perm)] +
+                        [(index + step) % num_perm for step in range(1, num_perm)]
+                        for index in range(num_perm)]
+        # Tickets are stored in numbered slots, oldest first in _slots. Slots of removed tickets are reused.
+        self._slots = collections.OrderedDict()
+        self._ids = []
+        self._free = []
+        self._signatures = array.array('I')
+        # Insertion sequence number of every slot, so that full buckets drop their oldest ticket.
+        self._added = array.array('Q')
+        self._sequence = 0
+        self._tables = [_BucketTable() for _ in range(bands)]
+        self._lock = threading.Lock()
+
+    def signature(self, text):
+        """
+        Computes the MinHash signature of a text with one permutation hashing. Every shingle is hashed once,
+        into one of num_perm bins that keep their smallest hash. Each empty bin then takes the value of the
+        first non-empty one of its donor bins (optimal densification), so that two signatures still agree
+        on a bin with a probability equal to the Jaccard similarity of the texts.
+        :param text: The text, eg. a summary and description joined together.
+        :return: signature: array of num_perm unsigned 32-bit integers.
+        """
+        num_perm = self.num_perm
+        bins = [_EMPTY_BIN] * num_perm
+        for shingle in self._shingles(text):
+            value = int.from_bytes(hashlib.blake2b(self._salt + shingle, digest_size=8).digest(), 'little')
+            index = (value & _MAX_HASH) % num_perm
+            value >>= 32
+            if value < bins[index]:
+                bins[index] = value
+        if min(bins) == _EMPTY_BIN:
+            return array.array('I', [_MAX_HASH] * num_perm)
+        signature = []
+        for index, value in enumerate(bins):
+            if value == _EMPTY_BIN:
+                for donor in self._donors[index]:
+                    value = bins[donor]
+                    if value != _EMPTY_BIN:
+                        break
+            signature.append(value)
+        return array.array('I', signature)
+
+    def add(self, ticket_id, text):
+        """
+        Adds or replaces a ticket in the index.
+        :param ticket_id: The id of the ticket.
+        :param text: The ticket's summary and description.
+        """
+        signature = self.signature(text)
+        keys = self._band_keys(signature)
+        with self._lock:
+            if ticket_id in self._slots:
+                self._remove(ticket_id)
+            while self._slots and len(self._slots) >= self.max_entries:
+                self._remove(next(iter(self._slots)))
+            if self._free:
+                slot = self._free.pop()
+                start = slot * self.num_perm
+                self._signatures[start:start + self.num_perm] = signature
+                self._ids[slot] = ticket_id
+                self._added[slot] = self._sequence
+            else:
+                slot = len(self._ids)
+                self._signatures.extend(signature)
+                self._ids.append(ticket_id)
+                self._added.append(self._sequence)
+            self._sequence += 1
+            self._slots[ticket_id] = slot
+            for table, key in zip(self._tables, keys):
+                table.add(key, slot, self.max_bucket_size, self._added)
+
+    def update(self, tickets):
+        """
+        Adds many tickets, eg. from search results.
+        :param tickets: Iterable of (ticket_id, text) tuples.
+        """
+        for ticket_id, text in tickets:
+            self.add(ticket_id, text)
+
+    def remove(self, ticket_id):
+        """
+        Removes a ticket from the index, eg. once it is closed.
+        :param ticket_id: The id of the ticket.
+        """
+        with self._lock:
+            if ticket_id in self._slots:
+                self._remove(ticket_id)
+
+    def query(self, text, threshold=None, limit=5):
+        """
+        Finds tickets whose text is likely a near duplicate of text.
+        :param text: The summary and description of a new ticket.
+        :param threshold: Minimum estimated similarity. Defaults to the index threshold.
+        :param limit: Maximum number of matches returned.
+        :return: matches: List of (ticket_id, similarity) tuples, most similar first.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        signature = self.signature(text)
+        keys = self._band_keys(signature)
+        with self._lock:
+            shared = collections.Counter()
+            for table, key in zip(self._tables, keys):
+                shared.update(table.get(key))
+            # Tickets sharing more bands are likely more similar, so only the closest ones are compared.
+            candidates = heapq.nlargest(self.max_candidates, shared, key=shared.__getitem__)
+            matches = []
+            for slot in candidates:
+                similarity = sum(map(operator.eq, signature, self._signature(slot))) / float(self.num_perm)
+                if similarity >= threshold:
+                    matches.append((self._ids[slot], similarity))
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches[:limit]
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, ticket_id):
+        return ticket_id in self._slots
+
+    def _shingles(self, text):
+        """
+        :return: shingles: Set of the normalized word shingles of text, UTF-8 encoded.
+        """
+        words = [word if _LETTER.search(word) else '0' for word in _WORD.findall((text or '').lower())]
+        size = min(self.shingle_size, len(words)) or 1
+        return set(' '.join(words[i:i + size]).encode('utf-8') for i in range(max(len(words) - size + 1, 0)))
+
+    def _signature(self, slot):
+        start = slot * self.num_perm
+        return self._signatures[start:start + self.num_perm]
+
+    def _band_keys(self, signature):
+        data = signature.tobytes()
+        step = len(data) // self.bands
+        return [zlib.crc32(data[start:start + step]) for start in range(0, len(data), step)]
+
+    def _remove(self, ticket_id):
+        slot = self._slots.pop(ticket_id)
+        for table, key in zip(self._tables, self._band_keys(self._signature(slot))):
+            table.remove(key, slot)
+        self._ids[slot] = None
+        self._free.append(slot)
+
+
+class _BucketTable(object):
+    """
+    The LSH buckets of one band, as an open-addressing hash table from 32-bit band keys to ticket slots.
+    Each bucket entry is one cell of two arrays rather than a dict item and its int objects. The cells
+    of a bucket are found by linear probing from the key up to the first empty cell.
+    """
+    def __init__(self, capacity=8):
+        self._allocate(capacity)
+
+    def get(self, key):
+        """
+        :return: slots: List of the slots in the bucket of key.
+        """
+        keys, slots, mask = self.keys, self.slots, self.mask
+        found = []
+        cell = key & mask
+        slot = slots[cell]
+        while slot != _EMPTY:
+            if slot >= 0 and keys[cell] == key:
+                found.append(slot)
+            cell = (cell + 1) & mask
+            slot = slots[cell]
+        return found
+
+    def add(self, key, slot, max_size, added):
+        """
+        Adds a slot to the bucket of key. A full bucket drops its oldest slot instead of growing.
+        :param added: Insertion sequence numbers of the slots.
+        """
+        keys, slots, mask = self.keys, self.slots, self.mask
+        bucket = []
+        free = None
+        cell = key & mask
+        while slots[cell] != _EMPTY:
+            if slots[cell] == _DELETED:
+                if free is None:
+                    free = cell
+            elif keys[cell] == key:
+                bucket.append(cell)
+            cell = (cell + 1) & mask
+        if len(bucket) >= max_size:
+            slots[min(bucket, key=lambda index: added[slots[index]])] = slot
+            return
+        if free is None:
+            free = cell
+            self.used += 1
+        keys[free] = key
+        slots[free] = slot
+        self.size += 1
+        if self.used * 3 > len(slots) * 2:
+            self._rehash()
+
+    def remove(self, key, slot):
+        """
+        Removes a slot from the bucket of key, if it is still there.
+        """
+        keys, slots, mask = self.keys, self.slots, self.mask
+        cell = key & mask
+        while slots[cell] != _EMPTY:
+            if slots[cell] == slot and keys[cell] == key:
+                slots[cell] = _DELETED
+                self.size -= 1
+                return
+            cell = (cell + 1) & mask
+
+    def _allocate(self, capacity):
+        self.keys = array.array('I', [0]) * capacity
+        self.slots = array.array('i', [_EMPTY]) * capacity
+        self.mask = capacity - 1
+        # Cells in use, and cells in use or deleted. Deleted cells are dropped when the table is rehashed.
+        self.size = 0
+        self.used = 0
+
+    def _rehash(self):
+        cells = [(key, slot) for key, slot in zip(self.keys, self.slots) if slot >= 0]
+        capacity = len(self.slots)
+        while len(cells) * 3 > capacity:
+            capacity *= 2
+        self._allocate(capacity)
+        keys, slots, mask = self.keys, self.slots, self.mask
+        for key, slot in cells:
+            cell = key & mask
+            while slots[cell] != _EMPTY:
+                cell = (cell + 1) & mask
+            keys[cell] = key
+            slots[cell] = slot
+        self.size = self.used = len(cells)
+
+
+class _Lcg(object):
+    """
+    Small deterministic generator for the donor bins, so signatures are stable across processes and
+    Python versions.
+    """
+    def __init__(self, seed):
+        self.state = seed
+
+    def next(self):
+        self.state = (self.state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+        return self.state >> 3
@@ -0,0 +1,178 @@
+import datetime
+import io
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+Change = namedtuple('Change', ['instance', 'project', 'ticket_id', 'updated', 'ticket'])
+
+
+class SyncEngine(object):
+    """
+    Pulls only the tickets modified since the last sync of each (instance, project).
+
+    Every sync searches for tickets updated since the stored watermark and yields a Change per
+    modified ticket. Watermarks are the tools' own update timestamps, never the local clock, so clock
+    skew between hosts doesn't lose changes. Each sync reaches overlap seconds back before the
+    watermark to catch changes indexed late or timestamps with coarse precision, eg. minutes in JQL.
+    Tickets already seen in that overlap are skipped.
+
+    The watermark only advances when a sync completes. If a sync is interrupted, the next one repeats
+    it, skipping the changes already yielded. State is kept in a JSON file between runs.
+
+    Results are ordered by update time, so paging them by offset would skip tickets: a ticket updated
+    during the sync moves to the end and every later ticket shifts back one place. Instead, each page
+    is searched again from the latest update time read so far (keyset paging), and the tickets read
+    twice at the boundary are skipped. Pages are fetched one after the other, since every query depends
+    on the page before it.
+    """
+    def __init__(self, path=None, overlap=300):
+        """
+        :param path: Path of the JSON state file. State is only kept in memory if not set.
+        :param overlap: Seconds before the watermark searched again on every sync.
+        """
+        self.path = path
+        self.overlap = datetime.timedelta(seconds=overlap)
+        self._lock = threading.Lock()
+        self._state = {}
+        if path and os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                self._state = json.load(f)
+
+    def sync(self, ticket_object, fields=None, since=None, page_size=100, prefetch=2):
+        """
+        Yields the tickets modified since the last sync of the ticket object's instance and project.
+        :param ticket_object: A Ticket object, eg. a JiraTicket.
+        :param fields: Optional list of field names to return. The fields sync needs are added.
+        :param since: Datetime, in the tool's time, to start from if the project was never synced.
+                      Defaults to every ticket in the project.
+        :param page_size: Number of tickets fetched per request.
+        :param prefetch: Number of pages fetched ahead of the one being consumed, for tools whose search
+                         doesn't page by update time, eg. RT.
+        :return: Generator of Change named tuples.
+        """
+        key = '{0} {1}'.format(ticket_object.url, ticket_object.project)
+        with self._lock:
+            state = self._state.get(key, {'watermark': None, 'seen': {}})
+        watermark = _parse(state['watermark'])
+        seen = dict(state['seen'])
+        start = watermark - self.overlap if watermark else since
+
+        if fields:
+            fields = list(fields) + [field for field in ticket_object._sync_fields if field not in fields]
+        if ticket_object._sync_by_update_time:
+            results = _search_by_update_time(ticket_object, start, fields, page_size)
+        else:
+            results = ticket_object.search(ticket_object._updated_since_query(start), fields, page_size, prefetch)
+        latest = watermark
+        complete = False
+        try:
+            for item in results:
+                ticket_id, updated = ticket_object._ticket_updated(item)
+                stamp = updated.strftime(TIME_FORMAT)
+                if seen.get(str(ticket_id)) == stamp:
+                    continue
+                seen[str(ticket_id)] = stamp
+                if latest is None or updated > latest:
+                    latest = updated
+                yield Change(ticket_object.url, ticket_object.project, ticket_id, updated, item)
+            complete = True
+        finally:
+            results.close()
+            if complete:
+                watermark = latest
+            if watermark is not None:
+                # Only tickets inside the next overlap window can be seen again.
+                oldest = (watermark - self.overlap).strftime(TIME_FORMAT)
+                seen = dict((ticket_id, stamp) for ticket_id, stamp in seen.items() if stamp >= oldest)
+            with self._lock:
+                self._state[key] = {'watermark': watermark.strftime(TIME_FORMAT) if watermark else None,
+                                    'seen': seen}
+            self.save()
+            logging.debug("Synced {0} up to {1}".format(key, watermark))
+
+    def get_watermark(self, ticket_object):
+        """
+        :param ticket_object: A Ticket object.
+        :return: watermark: Datetime of the latest change synced, in the tool's time, or None.
+        """
+        with self._lock:
+            state = self._state.get('{0} {1}'.format(ticket_object.url, ticket_object.project))
+        return _parse(state['watermark']) if state else None
+
+    def reset(self, ticket_object):
+        """
+        Forgets the watermark of the ticket object's instance and project, so the next sync pulls everything.
+        :param ticket_object: A Ticket object.
+        """
+        with self._lock:
+            self._state.pop('{0} {1}'.format(ticket_object.url, ticket_object.project), None)
+        self.save()
+
+    def save(self):
+        """
+        Atomically writes the state file.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._state)
+        temporary = '{0}.tmp'.format(self.path)
+        with io.open(temporary, 'w', encoding='utf-8') as f:
+            f.write(u'{0}'.format(data))
+        os.replace(temporary, self.path)
+
+
+def _search_by_update_time(ticket_object, since, fields, page_size):
+    """
+    Yields the tickets updated since a time, searching again from the latest update time after every page.
+    After a short page, or while the query doesn't change, eg. for tickets within the same minute in JQL,
+    the next page is read by offset instead. Tickets are stored in the ticket object's mirror, like search() does.
+    :param ticket_object: A Ticket object.
+    :param since: Datetime in the tool's time, or None for every ticket.
+    :param fields: Optional list of field names to return.
+    :param page_size: Number of tickets fetched per request.
+    :return: Generator of ticket dicts.
+    """
+    query = ticket_object._updated_since_query(since)
+    pages = ticket_object._search_pages(query, fields, page_size)
+    try:
+        while True:
+            page = next(pages, None)
+            if page is None:
+                return
+            if not page:
+                continue
+            ticket_object._mirror_content(*page, partial=bool(fields))
+            for item in page:
+                yield item
+            if len(page) < page_size:
+                # Likely the last page, which the search knows without another request.
+                continue
+            latest = max(ticket_object._ticket_updated(item)[1] for item in page)
+            next_query = ticket_object._updated_since_query(latest)
+            if next_query != query:
+                pages.close()
+                query = next_query
+                pages = ticket_object._search_pages(query, fields, page_size)
+    finally:
+        pages.close()
+
+
+def parse_time(value, time_format):
+    """
+    Parses a timestamp returned by a ticketing tool.
+    UTC offsets are dropped, keeping the tool's own time, which is also what its queries use.
+    :param value: The timestamp, eg. '2017-01-13T10:00:00.000+0100'.
+    :param time_format: The strptime format of value.
+    :return: datetime: A naive datetime.
+    """
+    return datetime.datetime.strptime(value, time_format).replace(tzinfo=None)
+
+
+def _parse(value):
+    return datetime.datetime.strptime(value, TIME_FORMAT) if value else None
@@ -1,11 +1,25 @@
+import functools
 import logging
 import os
+import queue
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import gssapi
 import requests
 from requests_kerberos import HTTPKerberosAuth, DISABLED
 
+try:
+    from opentelemetry import context as otel_context
+except ImportError:
+    otel_context = None
+
+from . import attachment as attachment_module
+from . import idempotency
+from . import jsonstream
+from . import transport
+
 __author__ = 'dranck, rnester, kshirsal'
 
 # Disable warnings for requests because we aren't doing certificate verification
@@ -25,6 +39,10 @@ elif LOG_LEVEL == 'CRITICAL':
     logging.basicConfig(level=logging.CRITICAL)
 
 
+# Error message of get_ticket_content() for tickets the tool doesn't have.
+NOT_FOUND = "Ticket {0} not found"
+
+
 class TicketException(Exception):
     """An issue occurred when performing a ticketing operation."""
 
@@ -33,11 +51,49 @@ class Ticket(object):
     """
     A class representing a ticket.
     """
+    # Headers sent when downloading attachments.
+    _attachment_headers = None
+
+    # Whether listed attachments have sizes or digests to match files against, see set_attachment_dedup().
+    _attachments_comparable = True
+
+    # Whether _updated_since_query() results are ordered by update time and paged by offset, so that
+    # ticketutil.sync searches again from the latest update time after every page.
+    _sync_by_update_time = True
+
+    # Set while a create request is sent, see _send_create_request().
+    _creating = False
+
     def __init__(self, project, ticket_id):
         self.project = project
         self.ticket_id = ticket_id
         self.ticket_url = None
 
+        # Metadata looked up from the ticketing tool, eg. status and user ids, is cached here.
+        self._metadata = {}
+
+        # Optional FingerprintIndex making create() idempotent, see set_idempotency_index().
+        self.idempotency_index = None
+        # The exception of the last failed create request, set by _create_ticket_request().
+        self._create_error = None
+
+        # Optional SimilarityIndex catching near-duplicate tickets, see set_duplicate_index().
+        self.duplicate_index = None
+        self.duplicate_of = None
+
+        # Names of the fields sent by the last edit(), see its diff parameter.
+        self.sent_fields = None
+
+        # Optional Mirror storing the tickets read, see set_mirror().
+        self.mirror = None
+
+        # Attachment uploads already on the ticket are skipped when set, see set_attachment_dedup().
+        self.dedup_attachments = False
+        self.attachment_index = None
+
+        # Optional Profiler recording slow calls, see set_profiler().
+        self.profiler = None
+
         # Create our default namedtuple for our request results.
         Result = namedtuple('Result', ['status', 'error_message', 'url', 'ticket_content'])
         self.request_result = Result('Success', None, None, None)
@@ -98,7 +154,7 @@ class Ticket(object):
         """
         # TODO: Support other authentication methods.
         # Set up authentication for requests session.
-        s = requests.Session()
+        s = transport.Session()
         if self.auth == 'kerberos':
             self.principal = _get_kerberos_principal()
             s.auth = HTTPKerberosAuth(mutual_authentication=DISABLED)
@@ -118,6 +174,660 @@ class Ticket(object):
             logging.error(e)
             s.close()
 
+    def set_lane(self, lane):
+        """
+        Sets the scheduler lane of requests made by the current Ticket object.
+        Lanes only take effect when a RequestScheduler is in use, see ticketutil.transport.
+        :param lane: The lane name, eg. 'interactive' or 'bulk'.
+        :return: self.request_result: Named tuple containing status, error_message, and url info.
+        """
+        self.s.lane = lane
+        return self.request_result
+
+    def set_idempotency_index(self, index):
+        """
+        Makes create() idempotent using a local index of the payloads that already made a ticket.
+        Creating a ticket with the same fields again returns the existing ticket without a request.
+        If an earlier create() had an unknown outcome, eg. it timed out, one targeted lookup is made
+        to find the ticket before creating it again.
+        :param index: A ticketutil.idempotency.FingerprintIndex, or None to turn idempotency off.
+        :return: self.request_result: Named tuple containing status, error_message, and url info.
+        """
+        self.idempotency_index = index
+        return self.request_result
+
+    def set_duplicate_index(self, index):
+        """
+        Checks create() against a local index of recent tickets' summaries and descriptions.
+        When an existing ticket is likely a near duplicate, create() adds the new summary and description
+        as a comment on that ticket instead of creating another one, and sets duplicate_of to its id.
+        Created tickets are added to the index.
+        :param index: A ticketutil.similarity.SimilarityIndex, or None to turn duplicate detection off.
+        :return: self.request_result: Named tuple containing status, error_message, and url info.
+        """
+        self.duplicate_index = index
+        return self.request_result
+
+    def set_mirror(self, mirror):
+        """
+        Keeps a local mirror up to date with the tickets read through this Ticket object.
+        Tickets returned by get_ticket_content() and search() are stored in the mirror, and tickets
+        changed through this Ticket object are marked stale.
+        :param mirror: A ticketutil.mirror.Mirror, or None to stop mirroring.
+        :return: self.request_result: Named tuple containing status, error_message, and url info.
+        """
+        self.mirror = mirror
+        hooks = self.s.hooks['response']
+        if mirror is not None and self._mirror_response not in hooks:
+            hooks.append(self._mirror_response)
+        elif mirror is None and self._mirror_response in hooks:
+            hooks.remove(self._mirror_response)
+        return self.request_result
+
+    def set_profiler(self, profiler):
+        """
+        Records a breakdown of the calls of this Ticket object that take longer than the profiler's
+        threshold, see ticketutil.profiling.Profiler.
+        :param profiler: A ticketutil.profiling.Profiler, or None to stop profiling.
+        :return: self.request_result: Named tuple containing status, error_message, and url info.
+        """
+        if self.profiler is not None:
+            self.profiler.detach(self)
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.attach(self)
+        return self.request_result
+
+    def _mirror_content(self, *contents, partial=False):
+        """
+        Stores tickets in the mirror, if one is set. Errors are logged, they don't fail the read.
+        Tickets read without their id, eg. with a field projection leaving it out, are skipped.
+        :param contents: Tickets as returned by the tool.
+        :param partial: True if the tickets were read with a field projection.
+        """
+        if self.mirror is None:
+            return
+        try:
+            tickets = ((self.ticketing_tool, self.url, self._mirror_fields(content), content) for content in contents)
+            self.mirror.store_many((ticket for ticket in tickets if ticket[2] is not None), partial)
+        except Exception as e:
+            logging.error("Error updating mirror")
+            logging.error(e)
+
+    def _mirror_fields(self, content):
+        """
+        Extracts the mirrored columns from a ticket. Tools override this.
+        :param content: A ticket as returned by the tool.
+        :return: fields: Dict of ticket_id, project, summary, description, comments, status, assignee
+                 and updated, see mirror.read_columns(). Columns whose fields weren't read are left out,
+                 None means the field is empty. None if the ticket's id wasn't read.
+        """
+        raise NotImplementedError
+
+    def _mirror_response(self, r, *args, **kwargs):
+        """
+        Requests session hook marking the current ticket stale after a successful change.
+        Create requests are skipped, see _send_create_request().
+        :param r: The response.
+        """
+        if self.mirror is not None and self.ticket_id and r.ok and r.request.method not in ('GET', 'HEAD') and \
+                not self._creating:
+            self.mirror.invalidate(self.ticketing_tool, self.url, self.ticket_id)
+
+    def _edit_fields(self, fields, diff=None):
+        """
+        Chooses the fields edit() sends, and records their names in sent_fields.
+        Without diff, every field is sent. With diff, fields that already have the desired value are dropped.
+        They are compared with the current ticket in the form edit() takes them, see _edit_field_values().
+        :param fields: The keyword arguments of edit().
+        :param diff: None to send every field. 'fetch' to read the fields from the tool first, or 'cache'
+                     to compare with the cached ticket unless it is stale, see _cached_content(), and
+                     read the fields from the tool otherwise.
+        :return: fields: Dict of the fields to send, or None if the ticket couldn't be read.
+        """
+        if diff:
+            content = self._cached_content() if diff == 'cache' else None
+            if content is None:
+                result = self.get_ticket_content(fields=self._edit_content_fields(list(fields)))
+                if result.status == 'Failure':
+                    return None
+                content = result.ticket_content
+            changed = {}
+            for name, value in fields.items():
+                values = self._edit_field_values(content, name, value)
+                if values is None or not _same_value(*values):
+                    changed[name] = value
+            fields = changed
+        self.sent_fields = list(fields)
+        return fields
+
+    def _cached_content(self):
+        """
+        :return: content: The current ticket from the mirror, or None if it isn't mirrored or is stale.
+        """
+        if self.mirror is None:
+            return None
+        ticket = self.mirror.get(self.ticketing_tool, self.url, self.ticket_id)
+        if ticket is None or ticket['stale']:
+            return None
+        return ticket['content']
+
+    def _edit_content_fields(self, names):
+        """
+        Maps edit() field names to the names get_ticket_content() projects. Tools override this.
+        :param names: List of edit() keyword argument names.
+        :return: fields: List of field names for get_ticket_content().
+        """
+        return names
+
+    def _edit_field_values(self, content, name, value):
+        """
+        Reads a field edit() would set from the current ticket, in the form edit() takes.
+        Tools override this to undo the renaming and wrapping their _prepare_ticket_fields() does.
+        :param content: The ticket as returned by get_ticket_content().
+        :param name: The edit() keyword argument name.
+        :param value: The desired value.
+        :return: (current, desired): The values to compare, or None if the ticket doesn't have the field.
+        """
+        if name not in content:
+            return None
+        return content[name], value
+
+    def _create_ticket(self, params, summary=None, description=None):
+        """
+        Creates the ticket, consulting the duplicate index if one is set.
+        :param params: The payload from _create_ticket_parameters().
+        :param summary: The ticket summary, checked against the duplicate index.
+        :param description: The ticket description, checked against the duplicate index.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        self.duplicate_of = None
+        index = self.duplicate_index
+        if index is None or summary is None:
+            return self._create_idempotent_ticket(params)
+
+        text = u'{0}\n{1}'.format(summary, description or '')
+        matches = index.query(text, limit=1)
+        if matches:
+            ticket_id, similarity = matches[0]
+            logging.info("Ticket {0} is {1:.0%} similar, commenting on it instead".format(ticket_id, similarity))
+            result = self._set_created_ticket(ticket_id)
+            if result.status == 'Failure':
+                return result
+            self.duplicate_of = ticket_id
+            return self.add_comment(u'{0}\n\n{1}'.format(summary, description or ''))
+
+        result = self._create_idempotent_ticket(params)
+        if result.status == 'Success' and self.ticket_id:
+            index.add(self.ticket_id, text)
+        return result
+
+    def _create_idempotent_ticket(self, params):
+        """
+        Creates the ticket with _create_ticket_request(), consulting the idempotency index if one is set.
+        :param params: The payload from _create_ticket_parameters().
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        index = self.idempotency_index
+        if index is None:
+            return self._send_create_request(params)
+
+        key = idempotency.fingerprint(self.ticketing_tool, self.url, self.project, params)
+        ticket_id = index.get(key)
+        if ticket_id == idempotency.PENDING:
+            # An earlier attempt didn't finish. Check whether it created the ticket anyway.
+            ticket_id = self._find_created_ticket(params)
+            if ticket_id is None:
+                index.delete(key)
+        if ticket_id is not None:
+            logging.info("Ticket {0} was already created with these fields".format(ticket_id))
+            index.put(key, ticket_id)
+            return self._set_created_ticket(ticket_id)
+
+        index.put(key, idempotency.PENDING)
+        self._create_error = None
+        result = self._send_create_request(params)
+        if result.status == 'Failure':
+            # A timeout, a dropped connection or a 5xx may come after the ticket was stored. Any other
+            # failure means the tool rejected the ticket, so a ticket found now would be another one.
+            ticket_id = None
+            if _outcome_unknown(self._create_error):
+                ticket_id = self._find_created_ticket(params)
+            if ticket_id is None:
+                index.delete(key)
+                return result
+            logging.info("Ticket {0} was created despite the error".format(ticket_id))
+            index.put(key, ticket_id)
+            return self._set_created_ticket(ticket_id)
+
+        index.put(key, self.ticket_id)
+        return result
+
+    def _send_create_request(self, params):
+        """
+        Sends the create request with _create_ticket_request(). Until it succeeds, ticket_id is still the
+        previous ticket, which the create doesn't change, so _mirror_response() leaves it fresh.
+        :param params: The payload from _create_ticket_parameters().
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        self._creating = True
+        try:
+            return self._create_ticket_request(params)
+        finally:
+            self._creating = False
+
+    def _find_created_ticket(self, params):
+        """
+        Looks up a recently created ticket matching a create payload, after a create request whose
+        outcome is unknown. Tools override this with a targeted search, and only return a ticket whose
+        description or reporter matches too.
+        :param params: The payload from _create_ticket_parameters().
+        :return: ticket_id: The id of the matching ticket, or None.
+        """
+        return None
+
+    def _set_created_ticket(self, ticket_id):
+        """
+        Makes a ticket found by the idempotency or duplicate index the current ticket.
+        :param ticket_id: The id of the ticket.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        self.ticket_id = ticket_id
+        self.ticket_url = self._generate_ticket_url()
+        return self.request_result
+
+    def unit_of_work(self):
+        """
+        Returns a UnitOfWork for the current ticket. Use it as a context manager to record
+        several operations and send them in the fewest requests the ticketing tool allows.
+        :return: UnitOfWork object.
+        """
+        return UnitOfWork(self)
+
+    def _merge_operation(self, payload, method_name, args, kwargs):
+        """
+        Merges an operation into the payload of a combined update request.
+        Tools that can combine operations into one request override this method.
+        :param payload: The dict of the combined request. Only modified if the operation is merged.
+        :param method_name: The name of the recorded Ticket method.
+        :param args: Positional arguments of the recorded call.
+        :param kwargs: Keyword arguments of the recorded call.
+        :return: True if the operation was merged into payload, False if it must be sent on its own.
+        """
+        return False
+
+    def _send_merged_request(self, payload):
+        """
+        Sends a combined update request built by _merge_operation().
+        :param payload: The dict of the combined request.
+        :return: self.request_result: Named tuple containing request status, error_message, and url info.
+        """
+        raise NotImplementedError
+
+    def search(self, query=None, fields=None, page_size=100, prefetch=2, stream=False):
+        """
+        Searches the project for tickets, yielding them one at a time.
+        Pages of results are fetched in a background thread while the current page is consumed.
+        At most prefetch pages are buffered, so memory stays flat however many tickets match.
+        Tickets are also stored in the mirror, if one is set.
+        Raises TicketException if a page can't be fetched.
+        :param query: A query in the tool's own search syntax, eg. JQL for JIRA or a dict of search
+                      parameters for Bugzilla and Redmine. Defaults to every ticket in the project.
+        :param fields: Optional list of field names to return. Defaults to all fields.
+        :param page_size: Number of tickets fetched per request.
+        :param prefetch: Number of pages fetched ahead of the one being consumed. When streaming, the
+                         number of tickets decoded ahead.
+        :param stream: Decode each page incrementally, yielding tickets as their bytes arrive instead of
+                       once the whole page is read. This keeps about one ticket in memory instead of a
+                       page, see ticketutil.jsonstream. JIRA and ServiceNow support it, other tools fetch
+                       whole pages.
+        :return: Generator of ticket dicts, in the form returned by the tool.
+        """
+        if stream:
+            pages = self._search_records(query, fields, page_size)
+        else:
+            pages = self._search_pages(query, fields, page_size)
+        results = _prefetch(pages, prefetch)
+        if self.mirror is not None:
+            results = self._mirror_results(results, page_size, bool(fields))
+        return results
+
+    def _mirror_results(self, results, batch_size, partial=False):
+        """
+        Passes search results through, storing them in the mirror batch_size at a time.
+        """
+        batch = []
+        try:
+            for item in results:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    self._mirror_content(*batch, partial=partial)
+                    batch = []
+                yield item
+        finally:
+            if batch:
+                self._mirror_content(*batch, partial=partial)
+
+    def _search_pages(self, query, fields, page_size):
+        """
+        Fetches search results page by page. Tools override this method.
+        :param query: A query in the tool's own search syntax.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of tickets fetched per request.
+        :return: Generator of lists of ticket dicts.
+        """
+        raise NotImplementedError
+
+    def _search_records(self, query, fields, page_size):
+        """
+        Fetches search results one ticket at a time, decoding pages as they arrive. Tools override this
+        with _stream_search_page(). By default, whole pages are fetched.
+        :param query: A query in the tool's own search syntax.
+        :param fields: Optional list of field names to return.
+        :param page_size: Number of tickets fetched per request.
+        :return: Generator of single ticket lists.
+        """
+        for page in self._search_pages(query, fields, page_size):
+            for item in page:
+                yield [item]
+
+    def _updated_since_query(self, since):
+        """
+        Builds a search() query for the tickets updated since a time, oldest first. Tools override this.
+        :param since: Datetime in the tool's time, or None for every ticket.
+        :return: query: A query in the tool's own search syntax.
+        """
+        raise NotImplementedError
+
+    def _ticket_updated(self, item):
+        """
+        Reads the id and update time of a search result. Tools override this.
+        :param item: A ticket dict yielded by search().
+        :return: (ticket_id, updated): The ticket id and a naive datetime in the tool's time.
+        """
+        raise NotImplementedError
+
+    def _get_search_page(self, url, params):
+        """
+        Requests one page of search results.
+        :param url: The search URL.
+        :param params: The query parameters.
+        :return: r: The response.
+        """
+        try:
+            r = self.s.get(url, params=params)
+            logging.debug("Search: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            error_message = "Error searching for tickets"
+            logging.error(error_message)
+            logging.error(e)
+            raise TicketException(error_message)
+        return r
+
+    def _stream_search_page(self, url, params, key, header):
+        """
+        Requests one page of search results and decodes its tickets as the response arrives.
+        :param url: The search URL.
+        :param params: The query parameters.
+        :param key: The key of the array of tickets in the response, eg. 'issues'.
+        :param header: Dict filled with the response's top-level values, eg. its total.
+        :return: Generator of ticket dicts.
+        """
+        r = None
+        try:
+            r = self.s.get(url, params=params, stream=True)
+            logging.debug("Search: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+            for item in jsonstream.iter_items(r.iter_content(attachment_module.CHUNK_SIZE), key, header):
+                yield item
+        except (requests.RequestException, ValueError) as e:
+            error_message = "Error searching for tickets"
+            logging.error(error_message)
+            logging.error(e)
+            raise TicketException(error_message)
+        finally:
+            if r is not None:
+                r.close()
+
+    def get_ticket_history(self, ticket_id=None):
+        """
+        Gets the content of a ticket with its history of status changes and comments, in the form
+        ticketutil.analytics parses. The ticket is mirrored with its history, if a mirror is set.
+        :param ticket_id: The ticket to get. Defaults to the current ticket.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, the ticket with its history.
+        """
+        if ticket_id is None:
+            ticket_id = self.ticket_id
+            if not self.ticket_id:
+                error_message = "No ticket ID associated with ticket object. " \
+                                "Set ticket ID with set_ticket_id(<ticket_id>)"
+                logging.error(error_message)
+                return self.request_result._replace(status='Failure', error_message=error_message)
+
+        try:
+            ticket_content = self._read_history(ticket_id)
+        except (requests.RequestException, TicketException, KeyError, IndexError) as e:
+            error_message = "Error getting ticket history"
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+        self._mirror_content(ticket_content)
+        return self.request_result._replace(ticket_content=ticket_content)
+
+    def _read_history(self, ticket_id):
+        """
+        Requests a ticket with its history. Tools override this.
+        Raises requests.RequestException or TicketException on errors, and KeyError or IndexError on
+        responses without the ticket.
+        :param ticket_id: The id of the ticket.
+        :return: ticket_content: The ticket with its history, see get_ticket_history().
+        """
+        raise NotImplementedError
+
+    def _get_history_part(self, url, params=None):
+        """
+        Requests one part of a ticket's history.
+        Raises requests.RequestException on errors.
+        :return: r: The response.
+        """
+        r = self.s.get(url, params=params)
+        logging.debug("Get ticket history: status code: {0}".format(r.status_code))
+        r.raise_for_status()
+        return r
+
+    def set_attachment_dedup(self, enabled=True, index=None):
+        """
+        Skips uploading attachments whose content is already on the ticket, eg. build logs attached again
+        when a job is retried. Every file is hashed as it is read, chunk by chunk, and looked up in the
+        index of files already uploaded. Otherwise the ticket's attachments are listed once and compared
+        by digest where the tool reports one, else by name and size.
+        :param enabled: True to skip attachments already on the ticket.
+        :param index: Optional ticketutil.idempotency.FingerprintIndex of the files uploaded, so files
+                      uploaded before are skipped without a request.
+        :return: self.request_result: Named tuple containing status, error_message, and url info.
+        """
+        self.dedup_attachments = enabled
+        self.attachment_index = index
+        return self.request_result
+
+    def _find_attachment(self, path, file_name):
+        """
+        Looks for an attachment with the content of a file on the current ticket, if deduplication is on.
+        :param path: The local file.
+        :param file_name: The name of the attachment on the ticket.
+        :return: (attached, key): The name of the attachment holding the content, or None, and the index
+                 fingerprint to record once the file is uploaded, see _record_attachment(), or None.
+        """
+        if not self.dedup_attachments:
+            return None, None
+        try:
+            size = os.path.getsize(path)
+            digests = {'sha256': attachment_module.file_digest(path)}
+        except (IOError, OSError):
+            return None, None
+
+        key = None
+        if self.attachment_index is not None:
+            key = idempotency.fingerprint(self.ticketing_tool, self.url, str(self.ticket_id), size, digests['sha256'])
+            attached = self.attachment_index.get(key, namespace='attachment')
+            if attached is not None:
+                return attached, key
+        if not self._attachments_comparable:
+            return None, key
+
+        try:
+            attachments = self._list_attachments(self.ticket_id)
+        except (requests.RequestException, TicketException, ValueError) as e:
+            logging.warning("Error listing attachments of ticket {0}, uploading {1}".format(self.ticket_id, path))
+            logging.warning(e)
+            return None, key
+        for attachment in attachments:
+            if attachment['size'] is not None and attachment['size'] != size:
+                continue
+            digest = attachment['digest']
+            if digest:
+                name = attachment_module.algorithm(digest)
+                if name not in digests:
+                    digests[name] = attachment_module.file_digest(path, name)
+                if digests[name] != digest.lower():
+                    continue
+            elif attachment['size'] is None or attachment['file_name'] != file_name:
+                # Without a digest, only an attachment of the same name and size is taken as the same file.
+                continue
+            self._record_attachment(key, attachment['file_name'])
+            return attachment['file_name'], key
+        return None, key
+
+    def _record_attachment(self, key, file_name):
+        """
+        Records an uploaded file in the attachment index, if one is set.
+        :param key: The fingerprint returned by _find_attachment(), or None.
+        :param file_name: The name of the attachment on the ticket.
+        """
+        if key is not None and self.attachment_index is not None:
+            self.attachment_index.put(key, file_name, namespace='attachment')
+
+    def get_attachments(self, ticket_id=None):
+        """
+        Lists the attachments of a ticket.
+        :param ticket_id: The ticket whose attachments are listed. Defaults to the current ticket.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, a list of attachment dicts with id, file_name, size, content_type, url and
+                 digest. size and digest are None where the tool doesn't report them.
+        """
+        if ticket_id is None:
+            ticket_id = self.ticket_id
+            if not self.ticket_id:
+                error_message = "No ticket ID associated with ticket object. " \
+                                "Set ticket ID with set_ticket_id(<ticket_id>)"
+                logging.error(error_message)
+                return self.request_result._replace(status='Failure', error_message=error_message)
+
+        try:
+            attachments = self._list_attachments(ticket_id)
+        except (requests.RequestException, TicketException) as e:
+            error_message = "Error listing attachments"
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+        return self.request_result._replace(ticket_content=attachments)
+
+    def get_attachment(self, attachment, destination, chunk_size=attachment_module.CHUNK_SIZE):
+        """
+        Downloads an attachment, streaming it to a file chunk_size bytes at a time.
+        :param attachment: An attachment dict returned by get_attachments().
+        :param destination: The path to write, or a writable binary file object.
+        :param chunk_size: Number of bytes read at a time.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, the attachment dict with size and the hex digest of the bytes written.
+        """
+        name = attachment_module.algorithm(attachment.get('digest'))
+        try:
+            size, digest = attachment_module.write(self._attachment_chunks(attachment, chunk_size), destination, name)
+        except (requests.RequestException, TicketException, ValueError, IOError) as e:
+            error_message = "Error downloading attachment {0}".format(attachment['file_name'])
+            logging.error(error_message)
+            logging.error(e)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+
+        if attachment.get('size') is not None and size != attachment['size'] or \
+                attachment.get('digest') and digest != attachment['digest'].lower():
+            error_message = "Attachment {0} doesn't match its size or digest".format(attachment['file_name'])
+            logging.error(error_message)
+            if not hasattr(destination, 'write'):
+                os.remove(destination)
+            return self.request_result._replace(status='Failure', error_message=error_message)
+        logging.info("Downloaded attachment {0} ({1} bytes)".format(attachment['file_name'], size))
+        return self.request_result._replace(ticket_content=dict(attachment, size=size, digest=digest))
+
+    def download_attachments(self, directory, ticket_id=None, concurrency=4, chunk_size=attachment_module.CHUNK_SIZE):
+        """
+        Downloads every attachment of a ticket to a directory, concurrency at a time.
+        Attachments already in the directory with the same size and digest are skipped.
+        Attachments sharing a file name are saved as <id>-<file name>.
+        :param directory: The directory to download to. It is created if needed.
+        :param ticket_id: The ticket whose attachments are downloaded. Defaults to the current ticket.
+        :param concurrency: Maximum number of downloads in parallel.
+        :param chunk_size: Number of bytes read at a time.
+        :return: self.request_result: Named tuple containing request status, error_message, url info and
+                 ticket_content, a list of the attachment dicts with path and downloaded, False if skipped.
+        """
+        result = self.get_attachments(ticket_id)
+        if result.status == 'Failure':
+            return result
+        attachments = result.ticket_content
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        names = [attachment['file_name'] for attachment in attachments]
+
+        def download(attachment):
+            file_name = os.path.basename(attachment['file_name'])
+            if names.count(attachment['file_name']) > 1:
+                file_name = '{0}-{1}'.format(attachment['id'], file_name)
+            path = os.path.join(directory, file_name)
+            if attachment_module.matches(path, attachment.get('size'), attachment.get('digest')):
+                logging.debug("Attachment {0} is already downloaded".format(path))
+                return dict(attachment, path=path, downloaded=False), None
+            result = self.get_attachment(attachment, path, chunk_size)
+            return dict(result.ticket_content or attachment, path=path, downloaded=True), result.error_message
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            downloads = list(executor.map(_in_current_context(download), attachments))
+        errors = [error for content, error in downloads if error]
+        ticket_content = [content for content, error in downloads]
+        if errors:
+            return self.request_result._replace(status='Failure', error_message='; '.join(errors),
+                                                ticket_content=ticket_content)
+        return self.request_result._replace(ticket_content=ticket_content)
+
+    def _list_attachments(self, ticket_id):
+        """
+        Lists the attachments of a ticket. Tools override this.
+        Raises requests.RequestException or TicketException on errors.
+        :param ticket_id: The id of the ticket.
+        :return: attachments: List of attachment dicts, see get_attachments().
+        """
+        raise NotImplementedError
+
+    def _attachment_chunks(self, attachment, chunk_size):
+        """
+        Streams the content of an attachment from its url. Tools override this where the content is encoded.
+        :param attachment: An attachment dict.
+        :param chunk_size: Number of bytes read at a time.
+        :return: Generator of bytes.
+        """
+        r = self.s.get(attachment['url'], stream=True, headers=self._attachment_headers)
+        try:
+            logging.debug("Get attachment: status code: {0}".format(r.status_code))
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size):
+                yield chunk
+        finally:
+            r.close()
+
     def close_requests_session(self):
         """
         Closes requests session for Ticket object.
@@ -128,6 +838,219 @@ class Ticket(object):
             return self.request_result
 
 
+class UnitOfWork(object):
+    """
+    Records operations on a ticket and sends them as a few combined requests.
+
+    Calls to the ticket's public methods are recorded instead of being sent. On commit(), consecutive
+    operations the ticketing tool can combine, eg. edit(), change_status() and add_comment() on Redmine,
+    are merged into one request. Operations that can't be merged are sent on their own, and everything
+    is sent in the order it was recorded. Sending stops at the first failure.
+
+    with ticket.unit_of_work() as work:
+        work.edit(priority='High')
+        work.change_status('Closed')
+        work.add_comment('Done')
+    print(work.result.status)
+    """
+    def __init__(self, ticket):
+        self.ticket = ticket
+        self.operations = []
+        self.results = []
+        self.result = ticket.request_result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(self.ticket, name, None)):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.operations.append((name, args, kwargs))
+        return record
+
+    def commit(self):
+        """
+        Sends the recorded operations.
+        :return: self.result: The request_result of the last request sent, or of the first failure.
+        """
+        if not self.ticket.ticket_id:
+            error_message = "No ticket ID associated with ticket object. Set ticket ID with set_ticket_id(<ticket_id>)"
+            logging.error(error_message)
+            self.result = self.ticket.request_result._replace(status='Failure', error_message=error_message)
+            return self.result
+
+        operations, self.operations = self.operations, []
+        payload, merged = {}, []
+        for method_name, args, kwargs in operations:
+            if self.ticket._merge_operation(payload, method_name, args, kwargs):
+                merged.append((method_name, args, kwargs))
+                continue
+            if merged and not self._send(payload, merged):
+                return self.result
+            payload, merged = {}, []
+            if self.ticket._merge_operation(payload, method_name, args, kwargs):
+                merged.append((method_name, args, kwargs))
+            elif not self._send(None, [(method_name, args, kwargs)]):
+                return self.result
+        if merged:
+            self._send(payload, merged)
+        return self.result
+
+    def _send(self, payload, operations):
+        """
+        Sends a merged payload, or a single operation through its own method.
+        :return: True if the request succeeded.
+        """
+        if len(operations) == 1:
+            method_name, args, kwargs = operations[0]
+            self.result = getattr(self.ticket, method_name)(*args, **kwargs)
+        else:
+            logging.debug("Sending {0} merged operations: {1}".format(len(operations),
+                                                                      ', '.join(op[0] for op in operations)))
+            self.result = self.ticket._send_merged_request(payload)
+        self.results.append(self.result)
+        return self.result.status != 'Failure'
+
+
+def _same_value(current, desired):
+    """
+    Compares a field's current value with the value edit() would set.
+    Values are compared as text, numbers by value, and lists ignoring order. A desired dict matches if
+    the current dict has all of its items.
+    """
+    if isinstance(desired, dict):
+        return isinstance(current, dict) and all(_same_value(current.get(key), value)
+                                                 for key, value in desired.items())
+    if isinstance(current, (list, tuple, set)) or isinstance(desired, (list, tuple, set)):
+        current, desired = _value_list(current), _value_list(desired)
+        return len(current) == len(desired) and all(_same_value(*pair) for pair in
+                                                    zip(sorted(current, key=_value_text),
+                                                        sorted(desired, key=_value_text)))
+    if isinstance(current, (int, float)) or isinstance(desired, (int, float)):
+        try:
+            return float(current) == float(desired)
+        except (TypeError, ValueError):
+            pass
+    return _value_text(current) == _value_text(desired)
+
+
+def _value_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def _value_text(value):
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def content_error_message(ticket_id, error):
+    """
+    :param ticket_id: The ticket get_ticket_content() failed to get.
+    :param error: The requests exception the request failed with.
+    :return: error_message: NOT_FOUND for 404 responses, a generic message otherwise.
+    """
+    response = getattr(error, 'response', None)
+    if response is not None and response.status_code == 404:
+        return NOT_FOUND.format(ticket_id)
+    return "Error getting ticket content"
+
+
+def _outcome_unknown(error):
+    """
+    Tells whether a failed request may have been carried out anyway.
+    :param error: The requests exception the request failed with, or None.
+    :return: True for timeouts, connection errors and 5xx responses.
+    """
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code >= 500
+
+
+def _prefetch(pages, depth):
+    """
+    Yields the items of pages while a background thread fetches the next pages.
+    :param pages: Generator of lists of items, eg. search result pages.
+    :param depth: Maximum number of pages buffered ahead of the consumer.
+    :return: Generator of items.
+    """
+    buffered = queue.Queue(maxsize=max(depth, 1))
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for page in pages:
+                if not _put_unless_stopped(buffered, (page, None), stopped):
+                    return
+            _put_unless_stopped(buffered, (None, None), stopped)
+        except Exception as e:
+            _put_unless_stopped(buffered, (None, e), stopped)
+        finally:
+            pages.close()
+
+    producer = threading.Thread(target=_in_current_context(produce), name='ticketutil-prefetch')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            page, error = buffered.get()
+            if error is not None:
+                raise error
+            if page is None:
+                return
+            for item in page:
+                yield item
+    finally:
+        # The consumer may stop early. Let the producer finish its current page and exit.
+        stopped.set()
+
+
+def _in_current_context(func):
+    """
+    Wraps func to run in the calling thread's OpenTelemetry context, so that spans started in a worker
+    thread have the caller's span as parent, see ticketutil.tracing.
+    :param func: The function run in another thread.
+    :return: The wrapped function, or func itself when OpenTelemetry isn't installed.
+    """
+    if otel_context is None:
+        return func
+    current = otel_context.get_current()
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        token = otel_context.attach(current)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            otel_context.detach(token)
+    return run
+
+
+def _put_unless_stopped(buffered, item, stopped):
+    """
+    Puts item in the queue, giving up if the consumer stopped.
+    :return: True if the item was queued.
+    """
+    while not stopped.is_set():
+        try:
+            buffered.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
 def _get_kerberos_principal():
     """
     Use gssapi to get the current kerberos principal.
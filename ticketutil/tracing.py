@@ -0,0 +1,197 @@
+import functools
+import importlib
+import logging
+import threading
+import types
+
+try:
+    from opentelemetry import propagate, trace
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+except ImportError:
+    trace = None
+
+from . import ticket, transport
+
+_BACKENDS = ['bugzilla', 'jira', 'redmine', 'rt', 'servicenow']
+
+_tracer = None
+_patched = []
+_local = threading.local()
+
+
+def instrument(tracer_provider=None):
+    """
+    Starts tracing Ticket objects with OpenTelemetry.
+
+    Every public Ticket method call, and the constructor, becomes a span named after the class and method,
+    eg. 'RedmineTicket.create', with the backend, ticket_id and result status as attributes. Methods returning
+    a generator, eg. search(), have their span last until the generator is exhausted or closed. Every HTTP
+    request becomes a child span named after the HTTP method and the Ticket method that made it, eg.
+    'GET _get_user_id', and carries the trace context to the server in its headers.
+    Spans are children of the caller's current span, so ticketutil calls show up inside the caller's traces.
+
+    When OpenTelemetry isn't installed this does nothing, and Ticket objects are left untouched.
+    :param tracer_provider: Optional OpenTelemetry TracerProvider. Defaults to the global one.
+    :return: True if tracing was started, False if OpenTelemetry isn't installed.
+    """
+    global _tracer
+    if trace is None:
+        logging.warning("OpenTelemetry is not installed, ticketutil calls won't be traced")
+        return False
+    if _tracer is not None:
+        return True
+    _tracer = trace.get_tracer('ticketutil', tracer_provider=tracer_provider)
+
+    # The backend classes are found as subclasses of Ticket, so their modules must be loaded first.
+    for backend in _BACKENDS:
+        importlib.import_module('.' + backend, __package__)
+    for cls in _ticket_classes(ticket.Ticket):
+        for name, value in list(vars(cls).items()):
+            if (name == '__init__' or not name.startswith('_')) and isinstance(value, types.FunctionType):
+                _patch(cls, name, _traced_method(value))
+    _patch(transport.Session, 'request', _traced_request(transport.Session.__dict__['request']))
+    return True
+
+
+def uninstrument():
+    """
+    Stops tracing Ticket objects, restoring their methods.
+    """
+    global _tracer
+    while _patched:
+        cls, name, original = _patched.pop()
+        setattr(cls, name, original)
+    _tracer = None
+
+
+def _ticket_classes(cls):
+    """
+    :return: cls and its subclasses.
+    """
+    classes = [cls]
+    for subclass in cls.__subclasses__():
+        classes.extend(_ticket_classes(subclass))
+    return classes
+
+
+def _patch(cls, name, wrapper):
+    _patched.append((cls, name, cls.__dict__[name]))
+    setattr(cls, name, wrapper)
+
+
+def _traced_method(func):
+    """
+    Wraps a Ticket method in a span. A method calling itself through super() gets a single span.
+    A generator returned by the method, eg. by search(), is wrapped so that the span lasts until it is
+    exhausted or closed.
+    """
+    # The wrapper's first argument isn't named self, so transport._call_site() skips its frame.
+    @functools.wraps(func)
+    def traced(ticket_object, *args, **kwargs):
+        key = (id(ticket_object), func.__name__)
+        active = _active()
+        if key in active:
+            return func(ticket_object, *args, **kwargs)
+        active.add(key)
+        try:
+            span = _tracer.start_span(_span_name(ticket_object, func), attributes=_attributes(ticket_object, func))
+            try:
+                with trace.use_span(span, record_exception=True, set_status_on_exception=True):
+                    result = func(ticket_object, *args, **kwargs)
+            except BaseException:
+                span.end()
+                raise
+            if isinstance(result, types.GeneratorType):
+                return _traced_items(span, ticket_object, result)
+            _finish(span, ticket_object, result)
+            span.end()
+            return result
+        finally:
+            active.discard(key)
+    return traced
+
+
+def _traced_items(span, ticket_object, items):
+    """
+    Yields the items of a generator returned by a Ticket method, ending the method's span when the generator
+    is exhausted or closed. The span is only current while the generator runs, not while the caller handles
+    its items.
+    """
+    try:
+        while True:
+            with trace.use_span(span, record_exception=True, set_status_on_exception=True):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+            yield item
+        _finish(span, ticket_object, None)
+    finally:
+        items.close()
+        span.end()
+
+
+def _traced_request(request):
+    """
+    Wraps Session.request in a client span, and adds the trace context to the request headers.
+    """
+    @functools.wraps(request)
+    def traced(self, method, url, *args, **kwargs):
+        backend, operation, caller = transport._call_site()
+        attributes = {'http.request.method': method.upper(),
+                      'url.full': url.split('?')[0],
+                      'server.address': transport.urlsplit(url).hostname or ''}
+        if backend is not None:
+            attributes.update({'ticketutil.backend': backend,
+                               'ticketutil.operation': operation,
+                               'ticketutil.method': caller})
+        name = '{0} {1}'.format(method.upper(), caller) if caller else method.upper()
+        with _tracer.start_as_current_span(name, kind=SpanKind.CLIENT, attributes=attributes) as span:
+            headers = dict(kwargs.get('headers') or {})
+            propagate.inject(headers)
+            kwargs['headers'] = headers
+            response = request(self, method, url, *args, **kwargs)
+            span.set_attribute('http.response.status_code', response.status_code)
+            if response.status_code >= 400:
+                span.set_status(Status(StatusCode.ERROR))
+            return response
+    return traced
+
+
+def _active():
+    """
+    :return: The (object id, method name) pairs with a span open in the current thread.
+    """
+    active = getattr(_local, 'active', None)
+    if active is None:
+        active = _local.active = set()
+    return active
+
+
+def _span_name(ticket_object, func):
+    return '{0}.{1}'.format(type(ticket_object).__name__, func.__name__)
+
+
+def _attributes(ticket_object, func):
+    attributes = {'ticketutil.operation': func.__name__}
+    tool = getattr(ticket_object, 'ticketing_tool', None)
+    if tool is not None:
+        attributes['ticketutil.backend'] = tool
+    return attributes
+
+
+def _finish(span, ticket_object, result):
+    """
+    Records the backend, ticket_id and the result's status on a method's span.
+    """
+    tool = getattr(ticket_object, 'ticketing_tool', None)
+    if tool is not None:
+        span.set_attribute('ticketutil.backend', tool)
+    ticket_id = getattr(ticket_object, 'ticket_id', None)
+    if ticket_id is not None:
+        span.set_attribute('ticketutil.ticket_id', str(ticket_id))
+    status = getattr(result, 'status', None)
+    if isinstance(status, str):
+        span.set_attribute('ticketutil.status', status)
+        if status == 'Failure':
+            span.set_status(Status(StatusCode.ERROR, getattr(result, 'error_message', None) or None))
@@ -0,0 +1,449 @@
+import collections
+import logging
+import sys
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+import requests
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+_default_scheduler = None
+_local = threading.local()
+_listeners = ()
+
+# Passed to request listeners, see add_request_listener().
+RequestEvent = collections.namedtuple('RequestEvent', ['backend', 'host', 'operation', 'method', 'http_method',
+                                                       'status_code', 'elapsed', 'bytes_sent', 'bytes_received',
+                                                       'reused', 'error'])
+
+
+class Session(requests.Session):
+    """
+    The requests Session used by Ticket objects.
+    Requests are admitted by a RequestScheduler when one is set on the session or with
+    set_default_scheduler(). Without a scheduler, this behaves exactly like requests.Session.
+    A request made with stream=True holds its slot until the response is closed, so streamed responses
+    must be closed, eg. with a with statement.
+    """
+    def __init__(self):
+        super(Session, self).__init__()
+        self.scheduler = None
+        self.lane = None
+
+    def request(self, method, url, *args, **kwargs):
+        scheduler = self.scheduler or _default_scheduler
+        send = super(Session, self).request if not _listeners else self._observed_request
+        if scheduler is None:
+            return send(method, url, *args, **kwargs)
+
+        lane = getattr(_local, 'lane', None) or self.lane or scheduler.default_lane
+        host = urlsplit(url).netloc
+        if not kwargs.get('stream'):
+            with scheduler.slot(host, lane):
+                return send(method, url, *args, **kwargs)
+
+        # A streamed body is read after request() returns, so the slot is held until the response is closed.
+        scheduler.acquire(host, lane)
+        try:
+            response = send(method, url, *args, **kwargs)
+        except Exception:
+            scheduler.release(host, lane)
+            raise
+        _on_close(response, lambda: scheduler.release(host, lane))
+        return response
+
+    def _observed_request(self, method, url, *args, **kwargs):
+        """
+        Makes a request and passes a RequestEvent describing it to the request listeners.
+        """
+        backend, operation, caller = _call_site()
+        adapter = self.get_adapter(url)
+        opened = _connections_opened(adapter)
+        start = time.time()
+        response = error = None
+        try:
+            response = super(Session, self).request(method, url, *args, **kwargs)
+            return response
+        except requests.RequestException as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            reused = None
+            if opened is not None and response is not None:
+                reused = _connections_opened(adapter) == opened
+            # A streamed body is read after request() returns. Without a Content-Length, its size is
+            # only known once the response is closed.
+            stream = kwargs.get('stream', False)
+            deferred = response is not None and stream and _content_length(response) is None
+            event = RequestEvent(backend=backend,
+                                 host=urlsplit(url).netloc,
+                                 operation=operation,
+                                 method=caller,
+                                 http_method=method.upper(),
+                                 status_code=response.status_code if response is not None else None,
+                                 elapsed=time.time() - start,
+                                 bytes_sent=_bytes_sent(response.request) if response is not None else 0,
+                                 bytes_received=_bytes_received(response, stream) if response is not None else 0,
+                                 reused=reused,
+                                 error=error)
+            if deferred:
+                read = _count_body(response)
+                _on_close(response, lambda: _notify(event._replace(bytes_received=read())))
+            else:
+                _notify(event)
+
+
+def set_default_scheduler(scheduler):
+    """
+    Sets the RequestScheduler shared by every Ticket object in the process.
+    :param scheduler: A RequestScheduler, or None to stop scheduling requests.
+    """
+    global _default_scheduler
+    _default_scheduler = scheduler
+
+
+def get_default_scheduler():
+    """
+    :return: scheduler: The RequestScheduler set with set_default_scheduler(), or None.
+    """
+    return _default_scheduler
+
+
+def add_request_listener(listener):
+    """
+    Calls listener with a RequestEvent after every request made by a Ticket object, in the thread
+    that made the request. Listeners should return quickly.
+
+    RequestEvent fields:
+    backend: The ticketing tool, eg. 'JIRA'.
+    host: The host the request went to.
+    operation: The outermost Ticket method on the call stack, eg. 'create'.
+    method: The innermost Ticket method on the call stack, eg. '_get_status_id'.
+    http_method, status_code: The HTTP method and status code. status_code is None when the request failed.
+    elapsed: Seconds the request took, until the response headers for streamed responses.
+    bytes_sent, bytes_received: Size of the request and response bodies.
+
+    Streamed responses without a Content-Length are passed when they are closed, with the bytes read.
+    reused: Whether an open connection was reused. None when it can't be told.
+    error: Name of the exception class when the request failed, else None.
+
+    :param listener: Function taking a RequestEvent.
+    """
+    global _listeners
+    _listeners = _listeners + (listener,)
+
+
+def remove_request_listener(listener):
+    """
+    Stops calling a listener added with add_request_listener().
+    :param listener: The listener to remove.
+    """
+    global _listeners
+    _listeners = tuple(added for added in _listeners if added != listener)
+
+
+class use_lane(object):
+    """
+    Context manager setting the lane of requests made by the current thread, overriding the
+    lane of the Ticket object.
+
+    with use_lane('interactive'):
+        ticket.create(...)
+    """
+    def __init__(self, lane):
+        self.lane = lane
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'lane', None)
+        _local.lane = self.lane
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.lane = self.previous
+
+
+class RequestScheduler(object):
+    """
+    Admits requests to each host within a shared concurrency limit and rate budget.
+
+    Waiting requests are queued in lanes. When a slot frees up, lanes share it in proportion to their
+    weights (weighted fair queueing), so a lane with weight 4 gets four requests through for every one
+    of a lane with weight 1 while both are busy, and an idle lane doesn't hold back the others.
+    """
+    def __init__(self, concurrency=8, rate=None, burst=None, lanes=None, default_lane=INTERACTIVE):
+        """
+        :param concurrency: Maximum number of requests in flight per host.
+        :param rate: Maximum number of requests per second per host. None for no limit.
+        :param burst: Number of requests allowed at once under the rate limit. Defaults to rate.
+        :param lanes: Dict of lane name to weight. Defaults to {'interactive': 4, 'bulk': 1}.
+        :param default_lane: Lane of requests from Ticket objects without a lane.
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.lanes = lanes or {INTERACTIVE: 4, BULK: 1}
+        self.default_lane = default_lane
+
+        self._condition = threading.Condition()
+        self._hosts = {}
+        self._stats = dict((lane, _LaneStats()) for lane in self.lanes)
+
+    def slot(self, host, lane):
+        """
+        Context manager holding a request slot for host.
+        :param host: The host the request goes to.
+        :param lane: The lane the request is queued in.
+        """
+        return _Slot(self, host, lane)
+
+    def acquire(self, host, lane):
+        """
+        Blocks until a request to host is admitted.
+        :param host: The host the request goes to.
+        :param lane: The lane the request is queued in.
+        """
+        if lane not in self.lanes:
+            raise ValueError("Unknown scheduler lane: {0}".format(lane))
+
+        waiter = object()
+        queued = time.time()
+        with self._condition:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = _HostState(self.lanes, self.burst)
+            if not state.queues[lane]:
+                # A lane that was idle can't save up credit while it wasn't competing.
+                busy = [state.passes[name] for name in self.lanes if state.queues[name]]
+                if busy:
+                    state.passes[lane] = max(state.passes[lane], min(busy))
+            state.queues[lane].append(waiter)
+            self._stats[lane].queued += 1
+
+            while True:
+                timeout = None
+                if state.active < self.concurrency and state.next_waiter(self.lanes) is waiter:
+                    timeout = self._take_token(state)
+                    if timeout is None:
+                        break
+                self._condition.wait(timeout)
+
+            state.queues[lane].popleft()
+            state.active += 1
+            state.passes[lane] += 1.0 / self.lanes[lane]
+
+            stats = self._stats[lane]
+            wait_time = time.time() - queued
+            stats.queued -= 1
+            stats.active += 1
+            stats.requests += 1
+            stats.wait_time += wait_time
+            stats.max_wait = max(stats.max_wait, wait_time)
+            self._condition.notify_all()
+
+        if wait_time > 1:
+            logging.debug("Request to {0} waited {1:.2f}s in {2} lane".format(host, wait_time, lane))
+
+    def release(self, host, lane):
+        """
+        Frees the request slot taken by acquire().
+        :param host: The host the request went to.
+        :param lane: The lane the request was queued in.
+        """
+        with self._condition:
+            self._hosts[host].active -= 1
+            self._stats[lane].active -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Returns queue depth and wait times per lane.
+        :return: stats: Dict of lane name to a dict containing queued, active, requests,
+                 wait_time (total seconds), average_wait and max_wait.
+        """
+        with self._condition:
+            return dict((lane, stats.as_dict()) for lane, stats in self._stats.items())
+
+    def _take_token(self, state):
+        """
+        Takes a token from the host's rate budget.
+        :return: None if a token was taken, else the number of seconds until one is available.
+        """
+        if self.rate is None:
+            return None
+        now = time.time()
+        state.tokens = min(self.burst, state.tokens + (now - state.refilled) * self.rate)
+        state.refilled = now
+        if state.tokens >= 1:
+            state.tokens -= 1
+            return None
+        return (1 - state.tokens) / self.rate
+
+
+class _Slot(object):
+    def __init__(self, scheduler, host, lane):
+        self.scheduler = scheduler
+        self.host = host
+        self.lane = lane
+
+    def __enter__(self):
+        self.scheduler.acquire(self.host, self.lane)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scheduler.release(self.host, self.lane)
+
+
+class _HostState(object):
+    def __init__(self, lanes, burst):
+        self.active = 0
+        self.queues = dict((lane, collections.deque()) for lane in lanes)
+        self.passes = dict((lane, 0.0) for lane in lanes)
+        self.tokens = burst
+        self.refilled = time.time()
+
+    def next_waiter(self, lanes):
+        """
+        :return: waiter: The head of the waiting lane with the least service so far, or None.
+        """
+        waiting = [lane for lane in lanes if self.queues[lane]]
+        if not waiting:
+            return None
+        lane = min(waiting, key=lambda name: (self.passes[name], -lanes[name]))
+        return self.queues[lane][0]
+
+
+class _LaneStats(object):
+    def __init__(self):
+        self.queued = 0
+        self.active = 0
+        self.requests = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return {'queued': self.queued,
+                'active': self.active,
+                'requests': self.requests,
+                'wait_time': self.wait_time,
+                'average_wait': self.wait_time / self.requests if self.requests else 0.0,
+                'max_wait': self.max_wait}
+
+
+def _notify(event):
+    """
+    Passes a RequestEvent to the request listeners.
+    """
+    for listener in _listeners:
+        try:
+            listener(event)
+        except Exception as e:
+            logging.error("Error in request listener {0}".format(listener))
+            logging.error(e)
+
+
+def _on_close(response, func):
+    """
+    Calls func once, when the response is first closed, eg. to free the request slot of a streamed response.
+    """
+    close = response.close
+    called = []
+
+    def close_and_call():
+        try:
+            close()
+        finally:
+            if not called:
+                called.append(True)
+                func()
+
+    response.close = close_and_call
+
+
+def _call_site():
+    """
+    Finds the Ticket methods on the current thread's call stack.
+    :return: backend, operation, method: The ticketing tool, the outermost and the innermost Ticket method,
+             or None for each when the request wasn't made by a Ticket object.
+    """
+    backend = operation = method = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_argcount and code.co_varnames[0] == 'self':
+            tool = getattr(frame.f_locals.get('self'), '__dict__', {}).get('ticketing_tool')
+            if tool is not None:
+                if method is None:
+                    method = code.co_name
+                operation = code.co_name
+                backend = tool
+        frame = frame.f_back
+    return backend, operation, method
+
+
+def _connections_opened(adapter):
+    """
+    :return: The number of connections opened by the adapter's connection pools, or None if unknown.
+    """
+    manager = getattr(adapter, 'poolmanager', None)
+    if manager is None:
+        return None
+    opened = 0
+    for key in list(manager.pools.keys()):
+        pool = manager.pools.get(key)
+        opened += getattr(pool, 'num_connections', 0)
+    return opened
+
+
+def _bytes_sent(request):
+    body = request.body
+    if body is None:
+        return 0
+    try:
+        return len(body)
+    except TypeError:
+        return int(request.headers.get('Content-Length') or 0)
+
+
+def _count_body(response):
+    """
+    Counts the bytes of a streamed body as they are read with iter_content(), which content and
+    iter_lines() use too. urllib3 doesn't count chunked bodies.
+    :return: read: Function returning the number of bytes read so far.
+    """
+    iter_content = response.iter_content
+    read = [0]
+
+    def counted(*args, **kwargs):
+        for chunk in iter_content(*args, **kwargs):
+            read[0] += len(chunk)
+            yield chunk
+
+    response.iter_content = counted
+    return lambda: read[0]
+
+
+def _content_length(response):
+    """
+    :return: The Content-Length of a response, or None if it has none.
+    """
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit():
+        return int(length)
+    return None
+
+
+def _bytes_received(response, stream=False):
+    """
+    :return: The Content-Length of a response, else the size of its body. 0 for streamed bodies, which
+             haven't been read yet, see _count_body().
+    """
+    length = _content_length(response)
+    if length is not None:
+        return length
+    if stream:
+        return 0
+    return len(response.content)
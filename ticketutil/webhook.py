@@ -0,0 +1,363 @@
+import hmac
+import json
+import logging
+import socketserver
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# A change notified by a ticketing tool. action is 'created', 'updated', 'commented', 'deleted' or
+# 'metadata' for changes to users, projects and the like. changes maps changed fields to their new values,
+# content is the ticket when the payload carries it, and metadata lists (cache key, entry) pairs.
+Event = namedtuple('Event', ['tool', 'instance', 'ticket_id', 'action', 'changes', 'content', 'metadata',
+                             'payload'])
+
+
+class WebhookReceiver(object):
+    """
+    Receives webhooks from the ticketing tools and keeps ticketutil's caches fresh without polling.
+
+    Ticket objects are registered on a path, eg. /jira. Every notification posted to that path is
+    parsed with the tool's parser, see PARSERS. Tickets carried by the payload are merged into the ticket
+    object's mirror, as payloads may leave fields out, other changed tickets are marked stale, and cached
+    metadata such as Redmine statuses and users is updated in place, as is the ticket_content of
+    ServiceNow ticket objects. Subscribers are then called with the Event.
+
+    The receiver runs its own threaded HTTP server with start(), or handle() can be called from any
+    other web framework. With a token, requests must pass it as the token query parameter or the
+    X-Ticketutil-Token header, since not every tool can sign its webhooks.
+
+    receiver = WebhookReceiver(port=8080, token='secret')
+    receiver.register(ticket, '/jira')
+    receiver.subscribe(lambda event: print(event.ticket_id, event.action, event.changes))
+    receiver.start()
+    """
+    def __init__(self, host='127.0.0.1', port=8080, token=None, max_body=10 * 1024 * 1024):
+        """
+        :param host: Interface the server listens on.
+        :param port: Port the server listens on, 0 for any free port.
+        :param token: Optional shared secret requests must pass.
+        :param max_body: Largest accepted payload, in bytes.
+        """
+        self.host = host
+        self.port = port
+        self.token = token
+        self.max_body = max_body
+        self._routes = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def register(self, ticket_object, path=None):
+        """
+        Routes a tool's webhooks to a ticket object. Several ticket objects of the same instance can share
+        a path, eg. the ones of a TicketPool.
+        :param ticket_object: A Ticket object, eg. a JiraTicket.
+        :param path: The path the tool posts to. Defaults to the tool name, eg. /jira.
+        :return: path: The path registered.
+        """
+        path = path or '/{0}'.format(ticket_object.ticketing_tool.lower())
+        with self._lock:
+            self._routes.setdefault(path, []).append(ticket_object)
+        return path
+
+    def subscribe(self, callback):
+        """
+        :param callback: Function called with every Event. Exceptions it raises are logged.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def handle(self, target, body, headers=None):
+        """
+        Handles one notification.
+        :param target: The request path, with its query string.
+        :param body: The request body, bytes.
+        :param headers: Dict of request headers.
+        :return: (status, event): The HTTP status to answer and the Event, or None if there was none.
+        """
+        headers = dict((key.lower(), value) for key, value in (headers or {}).items())
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        if self.token is not None:
+            token = headers.get('x-ticketutil-token') or query.get('token') or ''
+            if not hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+                logging.warning("Rejected webhook to {0}: bad token".format(url.path))
+                return 403, None
+        with self._lock:
+            ticket_objects = list(self._routes.get(url.path, []))
+        if not ticket_objects:
+            return 404, None
+
+        tool = ticket_objects[0].ticketing_tool
+        try:
+            payload = _decode(body, headers.get('content-type', ''))
+            event = PARSERS[tool](payload)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.error("Error parsing {0} webhook".format(tool))
+            logging.error(e)
+            return 400, None
+        if event is None:
+            return 204, None
+
+        event = event._replace(instance=ticket_objects[0].url)
+        logging.debug("Webhook: {0} {1} {2}".format(tool, event.ticket_id, event.action))
+        with self._lock:
+            _apply(event, ticket_objects)
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                logging.error("Error in webhook subscriber")
+                logging.error(e)
+        return 204, event
+
+    def start(self):
+        """
+        Starts the HTTP server in a background thread.
+        :return: (host, port): The address listened on.
+        """
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.receiver = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='ticketutil-webhook')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("Listening for webhooks on {0}:{1}".format(*self.address))
+        return self.address
+
+    @property
+    def address(self):
+        return self._server.server_address[:2] if self._server else (self.host, self.port)
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def _apply(event, ticket_objects):
+    """
+    Updates the caches of the ticket objects of the event's instance.
+    """
+    for ticket_object in ticket_objects:
+        cache = getattr(ticket_object, '_metadata', None)
+        if cache is not None:
+            if event.action == 'metadata' and not event.metadata:
+                cache.clear()
+            for key, entry in event.metadata:
+                _update_metadata(cache, key, entry)
+
+    if event.ticket_id is None:
+        return
+    for ticket_object in ticket_objects:
+        _refresh_ticket_content(ticket_object, event)
+
+    ticket_object = ticket_objects[0]
+    if ticket_object.mirror is None:
+        return
+    try:
+        if event.action == 'deleted':
+            ticket_object.mirror.remove(event.tool, event.instance, event.ticket_id)
+        elif event.content is not None:
+            # Payloads often carry only some of the fields, so they are merged like a projected read.
+            ticket_object._mirror_content(event.content, partial=True)
+        else:
+            ticket_object.mirror.invalidate(event.tool, event.instance, event.ticket_id)
+    except Exception as e:
+        logging.error("Error updating mirror")
+        logging.error(e)
+
+
+def _refresh_ticket_content(ticket_object, event):
+    """
+    Updates the ticket_content a ticket object keeps of its current ticket, eg. ServiceNowTicket's, which
+    add_cc() and remove_cc() read. The event's fields are merged into it, and it is dropped when the event
+    doesn't carry the ticket or deleted it.
+    """
+    content = getattr(ticket_object, 'ticket_content', None)
+    if not content or str(ticket_object.ticket_id) != str(event.ticket_id):
+        return
+    if event.action == 'deleted' or event.content is None:
+        ticket_object.ticket_content = None
+    else:
+        content = dict(content)
+        content.update(event.content)
+        ticket_object.ticket_content = content
+
+
+def _update_metadata(cache, key, entry):
+    """
+    Adds or refreshes an entry, matched by id, in a cached metadata list. Lists not cached yet are left
+    alone, they are looked up in full when first needed.
+    """
+    entries = cache.get(key)
+    if not isinstance(entries, list):
+        return
+    for cached in entries:
+        if cached.get('id') == entry['id']:
+            cached.update(entry)
+            return
+    entries.append(entry)
+
+
+def _decode(body, content_type):
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    if 'application/x-www-form-urlencoded' in content_type and not body.lstrip().startswith('{'):
+        return dict(parse_qsl(body))
+    return json.loads(body)
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > receiver.max_body:
+            self.send_error(413)
+            return
+        status, event = receiver.handle(self.path, self.rfile.read(length), dict(self.headers.items()))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("Webhook {0}: {1}".format(self.address_string(), format % args))
+
+
+def jira_event(payload):
+    """
+    Parses a JIRA webhook. Events without an issue, eg. user_updated or project_created, are metadata events.
+    :param payload: The decoded webhook body.
+    :return: Event, with no instance.
+    """
+    name = payload.get('webhookEvent', '')
+    issue = payload.get('issue')
+    if issue is None:
+        return Event('JIRA', None, None, 'metadata', {}, None, [], payload)
+    if name == 'jira:issue_created':
+        action = 'created'
+    elif name == 'jira:issue_deleted':
+        action = 'deleted'
+    elif name.startswith('comment_') or (payload.get('comment') and not payload.get('changelog')):
+        action = 'commented'
+    else:
+        action = 'updated'
+    changes = dict((item['field'], item.get('toString'))
+                   for item in (payload.get('changelog') or {}).get('items', []))
+    return Event('JIRA', None, issue['key'], action, changes, issue if 'fields' in issue else None, [], payload)
+
+
+def bugzilla_event(payload):
+    """
+    Parses a Bugzilla webhook, as sent by the webhooks extension: an 'event' with its action and changes,
+    and the 'bug'.
+    :param payload: The decoded webhook body.
+    :return: Event, with no instance.
+    """
+    event = payload['event']
+    bug = dict(payload['bug'])
+    # Webhooks carry users as objects, the REST API as logins.
+    for key, value in list(bug.items()):
+        if isinstance(value, dict) and 'login' in value:
+            bug[key] = value['login']
+    action = {'create': 'created', 'comment': 'commented'}.get(event.get('action'), 'updated')
+    changes = dict((change['field'], change.get('added')) for change in event.get('changes', []))
+    return Event('Bugzilla', None, bug['id'], action, changes, bug, [], payload)
+
+
+def redmine_event(payload):
+    """
+    Parses a Redmine webhook, as sent by the redmine_webhook plugin. Statuses, priorities and users in the
+    issue update the cached metadata.
+    :param payload: The decoded webhook body.
+    :return: Event, with no instance.
+    """
+    payload = payload.get('payload', payload)
+    issue = dict(payload['issue'])
+    journal = payload.get('journal') or {}
+    details = journal.get('details', [])
+    changes = dict((detail.get('prop_key'), detail.get('value')) for detail in details
+                   if detail.get('property') == 'attr')
+    if payload.get('action') == 'opened':
+        action = 'created'
+    elif journal.get('notes') and not details:
+        action = 'commented'
+    else:
+        action = 'updated'
+
+    metadata = []
+    for key, name in (('status', 'issue_statuses'), ('priority', 'issue_priorities')):
+        if isinstance(issue.get(key), dict) and 'id' in issue[key]:
+            metadata.append((name, dict(issue[key])))
+    assignee = issue.pop('assignee', None)
+    if assignee:
+        # The plugin sends the assignee as a user, the REST API as assigned_to.
+        issue.setdefault('assigned_to', {'id': assignee.get('id'), 'name': ' '.join(
+            name for name in (assignee.get('firstname'), assignee.get('lastname')) if name)})
+        if 'login' in assignee:
+            metadata.append(('users', dict(assignee)))
+    return Event('Redmine', None, issue['id'], action, changes, issue, metadata, payload)
+
+
+def rt_event(payload):
+    """
+    Parses a RT notification. RT has no built-in webhooks, so a scrip posts the transaction's Ticket, Type
+    and, for changes, Field, OldValue and NewValue, as JSON or as a form.
+    :param payload: The decoded webhook body.
+    :return: Event, with no instance.
+    """
+    transaction = payload.get('Type')
+    if transaction == 'Create':
+        action = 'created'
+    elif transaction in ('Correspond', 'Comment'):
+        action = 'commented'
+    elif transaction == 'Status' and payload.get('NewValue') == 'deleted':
+        action = 'deleted'
+    else:
+        action = 'updated'
+    changes = {}
+    if 'NewValue' in payload:
+        changes[payload.get('Field') or transaction] = payload['NewValue']
+    return Event('RT', None, str(payload['Ticket']), action, changes, None, [], payload)
+
+
+def servicenow_event(payload):
+    """
+    Parses a ServiceNow notification, as posted by an outbound REST message from a business rule:
+    the 'record', the 'operation' (insert, update or delete) and optionally the 'changes'.
+    A bare record is taken as an update.
+    :param payload: The decoded webhook body.
+    :return: Event, with no instance.
+    """
+    record = payload.get('record', payload)
+    action = {'insert': 'created', 'delete': 'deleted'}.get(payload.get('operation'), 'updated')
+    return Event('ServiceNow', None, record['number'], action, payload.get('changes') or {}, record, [], payload)
+
+
+PARSERS = {'JIRA': jira_event,
+           'Bugzilla': bugzilla_event,
+           'Redmine': redmine_event,
+           'RT': rt_event,
+           'ServiceNow': servicenow_event}